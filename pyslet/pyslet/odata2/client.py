@@ -55,6 +55,8 @@ class MediaLinkEntry(core.Entity):
 		streamURL=str(self.GetLocation())+"/$value"
 		request=http.HTTPRequest(str(streamURL),'HEAD')
 		request.SetHeader('Accept','*/*')
+		# we want the Content-Length of the unencoded stream
+		request.autoDecode=False
 		self.client.ProcessRequest(request)
 		if request.status==404:
 			return None
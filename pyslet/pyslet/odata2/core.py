@@ -300,6 +300,22 @@ class CommonExpression(object):
 	def OrderByToString(orderBy):
 		return string.join(map(lambda x:"%s %s"%(unicode(x[0]),"asc" if x[1]>0 else "desc"),orderBy),', ')
 		
+	@staticmethod
+	def OrderByKey(orderBy):
+		"""Returns a hashable value that identifies *orderBy* exactly,
+		see :py:meth:`ExactKey`."""
+		return tuple(map(lambda x:(x[0].ExactKey(),x[1]),orderBy))
+
+	def ExactKey(self):
+		"""Returns a hashable value that identifies this expression.
+
+		Expressions with equal keys are identical, including the values
+		of any literals.  The string form of an expression is not
+		suitable for this purpose because it formats some literals with
+		reduced precision, for example, the fractional seconds of
+		DateTime values."""
+		return (self.__class__,self.operator,tuple(map(lambda x:x.ExactKey(),self.operands)))
+
 	def __unicode__(self):
 		raise NotImplementedError
 	
@@ -759,6 +775,20 @@ class LiteralExpression(CommonExpression):
 				result="'%s'"%string.join(result.split("'"),"''")
 			return result
 	
+	def ExactKey(self):
+		if not self.value:
+			return (self.__class__,self.value.typeCode,None)
+		value=self.value.value
+		if isinstance(value,iso.TimePoint):
+			date,time=value.date,value.time
+			value=(date.century,date.year,date.month,date.day,time.hour,time.minute,time.second,time.zDirection,time.zOffset)
+		elif isinstance(value,iso.Time):
+			value=(value.hour,value.minute,value.second,value.zDirection,value.zOffset)
+		elif isinstance(value,decimal.Decimal):
+			# Decimals that compare equal may differ in precision
+			value=value.as_tuple()
+		return (self.__class__,self.value.typeCode,value)
+
 	def Evaluate(self,contextEntity):
 		"""A literal evaluates to itself."""
 		return self.value
@@ -770,6 +800,9 @@ class PropertyExpression(CommonExpression):
 		super(PropertyExpression,self).__init__()
 		self.name=name
 	
+	def ExactKey(self):
+		return (self.__class__,self.name)
+
 	def __unicode__(self):
 		return unicode(self.name)
 			
@@ -806,6 +839,9 @@ class CallExpression(CommonExpression):
 		super(CallExpression,self).__init__(Operator.methodCall)
 		self.method=methodCall
 
+	def ExactKey(self):
+		return (self.__class__,self.method,tuple(map(lambda x:x.ExactKey(),self.operands)))
+
 	def __unicode__(self):
 		return "%s(%s)"%(Method.EncodeValue(self.method),string.join(map(lambda x:unicode(x),self.operands),','))
 
@@ -2664,7 +2664,16 @@ class EntityCollection(DictionaryLike):
 		insertion violates model constraints (including an attempt to
 		create two entities with duplicate keys)."""
 		raise NotImplementedError
-	
+
+	def InsertEntities(self,entities):
+		"""Inserts all the entities in the iterable *entities*
+
+		The default implementation simply calls :py:meth:`InsertEntity`
+		for each entity.  Data providers should override this method if
+		they can insert multiple entities more efficiently."""
+		for entity in entities:
+			self.InsertEntity(entity)
+
 	def UpdateEntity(self,entity):
 		"""Updates *entity* which must already be in the entity set.
 		
@@ -3021,6 +3030,68 @@ class FunctionCollection(object):
 		raise NotImplementedError("Unbound FunctionCollection: %s"%self.function.name)
 
 
+class ChangeSet(object):
+	"""Represents a group of changes to the entities in an entity
+	container that succeed or fail as a unit.
+
+	Change sets are created by :py:meth:`EntityContainer.OpenChangeSet`
+	and are used as context managers::
+
+		with container.OpenChangeSet():
+			with container['Customers'].OpenCollection() as customers:
+				customers.InsertEntity(newCustomer)
+			with container['Orders'].OpenCollection() as orders:
+				orders.InsertEntity(newOrder)
+	
+	If the with block exits normally the changes are committed, if it
+	exits with an exception they are rolled back.  Change sets apply to
+	the current thread only.
+	
+	This default implementation does nothing, the changes are applied
+	immediately as they are made and can't be rolled back.  Data
+	providers that support transactions bind their own class using
+	:py:meth:`EntityContainer.BindChangeSet`."""
+
+	Atomic=False
+	"""True if :py:meth:`Rollback` discards the changes.  This default
+	implementation can't undo changes so code that relies on rolling
+	back a failed change set, such as the OData server when executing
+	a batch request, must check this attribute first.  Classes that
+	support rollback must set it to True."""
+
+	def __init__(self,containerDef):
+		self.containerDef=containerDef		#: the :py:class:`EntityContainer` this change set applies to
+	
+	def __enter__(self):
+		self.Begin()
+		return self
+	
+	def __exit__(self, type, value, tb):
+		try:
+			if type is None:
+				self.Commit()
+			else:
+				self.Rollback()
+		finally:
+			self.close()
+		
+	def Begin(self):
+		"""Starts the change set"""
+		pass
+	
+	def Commit(self):
+		"""Commits the changes made since :py:meth:`Begin`"""
+		pass
+	
+	def Rollback(self):
+		"""Discards the changes made since :py:meth:`Begin`"""
+		pass
+	
+	def close(self):
+		"""Releases any resources held by the change set"""
+		pass
+		
+
 class CSDLElement(xmlns.XMLNSElement):
 	"""All elements in the metadata model inherit from this class."""
 	
@@ -3614,6 +3685,7 @@ class EntityContainer(NameTableMixin,CSDLElement):
 		self.AssociationSet=[]		#: a list of :py:class:`AssociationSet` instances
 		self.TypeAnnotation=[]
 		self.ValueAnnotation=[]
+		self.changeSetBinding=ChangeSet,{}
 	
 	def GetChildren(self):
 		if self.Documentation: yield self.Documentation
@@ -3635,6 +3707,25 @@ class EntityContainer(NameTableMixin,CSDLElement):
 			child.UpdateSetRefs(scope,stopOnErrors)
 		for child in self.EntitySet:
 			child.UpdateNavigation()
+	
+	def BindChangeSet(self,changeSetBinding,**extraArgs):
+		"""Binds this entity container to a specific class or callable
+		used by :py:meth:`OpenChangeSet`
+		
+		*changeSetBinding* must be a class (or other callable) that
+		returns a :py:class:`ChangeSet` instance, by default we are
+		bound to the default ChangeSet class which does not group
+		changes at all.
+		
+		*extraArgs* is a python dict of named arguments to pass to the
+		binding callable""" 
+		self.changeSetBinding=changeSetBinding,extraArgs
+		
+	def OpenChangeSet(self):
+		"""Returns a :py:class:`ChangeSet` instance suitable for
+		grouping changes to the entities in this container."""
+		cls,extraArgs=self.changeSetBinding
+		return cls(containerDef=self,**extraArgs)
 						
 		
 class EntitySet(CSDLElement):
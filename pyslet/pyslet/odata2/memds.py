@@ -10,7 +10,13 @@ import pyslet.xmlnames20091208 as xmlns
 import pyslet.iso8601 as iso8601
 import pyslet.rfc2616 as http
 
-import string, hashlib, threading
+import string, hashlib, threading, operator, math, decimal, bisect
+
+
+class FilterNotCompilable(Exception):
+	"""Raised by :py:class:`FilterCompiler` when an expression can't be
+	compiled, the filter must be evaluated on each entity instead."""
+	pass
 
 			
 class InMemoryEntityStore(object):
@@ -23,11 +29,16 @@ class InMemoryEntityStore(object):
 	Media streams are simply strings stored in a parallel dictionary
 	mapping keys on to a tuple of media-type and string.
 	
-	All access to the data itself uses the *container*'s lock to ensure
-	this object can be called from multi-threaded programs.  Although
-	individual collections must not be shared across threads multiple
-	threads can open separate collections and access the entities
-	safely."""
+	Changes to the data are serialised using the *container*'s lock to
+	ensure this object can be called from multi-threaded programs. 
+	Stored values are never modified in place, instead, a new tuple
+	replaces the old one in a single dictionary assignment.  As a
+	result, reads don't need to acquire the lock at all: readers never
+	block writers (or each other) and a reader always sees each entity
+	either before or after a change, never a mixture of the two.
+	Although individual collections must not be shared across threads
+	multiple threads can open separate collections and access the
+	entities safely."""
 	
 	def __init__(self,container,entitySet=None):
 		self.container=container	#: the :py:class:`InMemoryEntityContainer` that contains this entity set
@@ -36,7 +47,10 @@ class InMemoryEntityStore(object):
 		self.streams={}				#: simple dictionary of streams
 		self.associations={}		#: a mapping of association set names to :py:class:`InMemoryAssociation` instances *from* this entity set
 		self.reverseAssociations={}	#: a mapping of association set names to :py:class:`InMemoryAssociation` index instances *to* this entity set
+		self.filterCache={}			#: a mapping from filter strings to compiled filter functions, see :py:meth:`CompileFilter`
+		self.indexes={}				#: a mapping from property names to secondary indexes, see :py:meth:`AddIndex`
 		self._deleting=set()
+		self._positions=None
 		self.nextKey=None
 		if entitySet is not None:
 			self.BindToEntitySet(entitySet)
@@ -69,54 +83,281 @@ class InMemoryEntityStore(object):
 				value.append(self.GetTupleFromComplex(p))
 			elif isinstance(p,edm.SimpleValue):
 				value.append(p.value)
+		value=tuple(value)
 		with self.container.lock:
-			self.data[key]=tuple(value)
+			self.container.LogUndo(self.RestoreEntity,key,self.data.get(key,None))
+			self.RestoreEntity(key,value)
 			# At this point the entity exists
 			e.exists=True
 
-	def CountEntities(self):
+	def AddIndex(self,pName,ordered=False):
+		"""Declares a secondary index on the simple property *pName*.
+		
+		By default, a :py:class:`InMemoryHashIndex` is created which
+		speeds up filters that test the property for equality.  If
+		*ordered* is True a :py:class:`InMemorySortedIndex` is created
+		instead, which can also be used for filters that compare the
+		property using lt, le, gt or ge and to return entities sorted by
+		the property.  Filters are only optimised if the comparison is
+		with a literal value, optionally combined with other
+		expressions using and.
+		
+		Indexes are maintained automatically as entities are added,
+		updated and deleted.  The new index is returned."""
+		pos=0
+		for p in self.entitySet.entityType.Property:
+			if p.name==pName:
+				break
+			pos+=1
+		else:
+			raise KeyError("No property %s to index"%pName)
+		if p.simpleTypeCode is None:
+			raise KeyError("Can't index complex property %s"%pName)
+		if ordered:
+			index=InMemorySortedIndex(p,pos)
+		else:
+			index=InMemoryHashIndex(p,pos)
 		with self.container.lock:
-			return len(self.data)
+			for key,value in self.data.iteritems():
+				index.AddKey(key,value[pos])
+			with self.container.indexLock:
+				self.indexes[pName]=index
+		return index
+	
+	IndexReverse={
+		odata.Operator.eq:odata.Operator.eq,
+		odata.Operator.lt:odata.Operator.gt,
+		odata.Operator.gt:odata.Operator.lt,
+		odata.Operator.le:odata.Operator.ge,
+		odata.Operator.ge:odata.Operator.le}
+	"""Maps comparison operators onto the operator that results from
+	swapping the operands."""
+	
+	def IndexedKeys(self,filter):
+		"""Returns a list of keys obtained from the secondary indexes
+		or None if *filter* can't be optimised using an index.
+		
+		The list contains a superset of the keys of the entities that
+		pass the filter, the filter itself must still be applied to the
+		corresponding entities."""
+		if filter.operator==odata.Operator.boolAnd:
+			lKeys=self.IndexedKeys(filter.operands[0])
+			rKeys=self.IndexedKeys(filter.operands[1])
+			if lKeys is None:
+				return rKeys
+			elif rKeys is None:
+				return lKeys
+			else:
+				return list(set(lKeys).intersection(rKeys))
+		elif filter.operator in self.IndexReverse:
+			lValue,rValue=filter.operands
+			op=filter.operator
+			if isinstance(lValue,odata.LiteralExpression):
+				lValue,rValue=rValue,lValue
+				op=self.IndexReverse[op]
+			if not isinstance(lValue,odata.PropertyExpression) or not isinstance(rValue,odata.LiteralExpression):
+				return None
+			index=self.indexes.get(lValue.name,None)
+			if index is None:
+				return None
+			value=rValue.value
+			if not value:
+				if op!=odata.Operator.eq:
+					return None
+				key=None
+			else:
+				try:
+					if odata.PromoteTypes(index.typeCode,value.typeCode)!=index.typeCode:
+						# the comparison is done in a wider type
+						return None
+				except odata.EvaluationError:
+					return None
+				key=value.SimpleCast(index.typeCode).value
+			with self.container.indexLock:
+				if op==odata.Operator.eq:
+					return index.Lookup(key)
+				else:
+					return index.Range(op,key)
+		else:
+			return None
+	
+	def OrderedKeys(self,orderby):
+		"""Returns a list of all keys sorted using *orderby* or None if
+		no suitable index exists.
+		
+		*orderby* is a list of rules, only single rules of the form
+		(property, direction) can be optimised and then only if an
+		ordered index is defined for the property.  When a sort
+		results in ties the keys are in ascending order."""
+		if len(orderby)!=1:
+			return None
+		rule,ruleDir=orderby[0]
+		if not isinstance(rule,odata.PropertyExpression):
+			return None
+		index=self.indexes.get(rule.name,None)
+		if index is None:
+			return None
+		with self.container.indexLock:
+			return index.OrderedKeys(ruleDir<0)
+
+	FilterCacheSize=256		#: the maximum number of compiled filters cached by each entity store
+
+	def CompileFilter(self,filter):
+		"""Returns a function that tests the raw values of an entity
+		against *filter*, a
+		:py:class:`pyslet.odata2.core.CommonExpression` instance.
+		
+		The function is created by :py:class:`FilterCompiler` and takes
+		a tuple of values, as stored in :py:attr:`data`, returning a
+		true value only if the entity passes the filter.
+		
+		Compiled filters are cached using
+		:py:meth:`pyslet.odata2.core.CommonExpression.ExactKey` as a key
+		because literal values are built in to the compiled function.
+		If the filter can't be compiled None is returned (and cached)
+		and the caller must fall back to evaluating the filter against
+		each entity."""
+		key=filter.ExactKey()
+		try:
+			return self.filterCache[key]
+		except KeyError:
+			pass
+		try:
+			test=FilterCompiler(self.entitySet.entityType).Compile(filter)
+		except FilterNotCompilable:
+			test=None
+		with self.container.indexLock:
+			if len(self.filterCache)>=self.FilterCacheSize:
+				self.filterCache.clear()
+			self.filterCache[key]=test
+		return test
+		
+	def CountEntities(self,test=None,keys=None):
+		"""Returns the number of entities in the entity set
+		
+		*test* is an optional function returned by
+		:py:meth:`CompileFilter`, if given only entities that pass the
+		test are counted.
+		
+		*keys* is an optional list of keys (e.g., from
+		:py:meth:`IndexedKeys`), if given only entities with these keys
+		are counted."""
+		if keys is None:
+			if test is None:
+				return len(self.data)
+			values=self.data.values()
+		else:
+			values=[]
+			for k in keys:
+				value=self.data.get(k,None)
+				if value is not None:
+					values.append(value)
+			if test is None:
+				return len(values)
+		result=0
+		for value in values:
+			if test(value):
+				result+=1
+		return result
 			
-	def GenerateEntities(self,select=None):
+	def GenerateEntities(self,select=None,test=None,keys=None):
 		"""A generator function that returns the entities in the entity set
 		
-		The implementation is a compromise, we don't lock the container
-		for the duration of the iteration, instead we work on a copy of
-		the list of keys.  This creates the slight paradox that an entity
+		The implementation is a compromise, we work on a copy of the
+		list of keys.  This creates the slight paradox that an entity
 		deleted during the iteration *may* not be yielded but an entity
-		inserted during the iteration will never be yielded."""
-		with self.container.lock:
-			keys=self.data.keys()
+		inserted during the iteration will never be yielded.
+		
+		The entities are yielded as :py:class:`EntityView` instances
+		which only create property values as they are accessed,
+		*select* is applied to the views directly.
+		
+		*test* is an optional function returned by
+		:py:meth:`CompileFilter`.  The test is applied to the raw values
+		when the list of keys is copied, so entities that fail it are
+		never created, and again when each entity is read.
+		
+		*keys* is an optional list of keys (e.g., from
+		:py:meth:`IndexedKeys` or :py:meth:`OrderedKeys`), if given only
+		entities with these keys are returned, in the same order.  In
+		this case the test is applied lazily, as each entity is read."""
+		if keys is None:
+			if test is None:
+				keys=self.data.keys()
+			else:
+				keys=[k for k,v in self.data.items() if test(v)]
+		if select is None:
+			selected=None
+		else:
+			selected=self.SelectedNames(select)
+		positions=self.PropertyPositions()
 		for k in keys:
-			e=self.ReadEntity(k,select)
-			if e is not None:
-				yield e
-
-	def ReadEntity(self,key,select=None):
-		with self.container.lock:
-			value=self.data.get(key,None)
+			value=self.data.get(k,None)
 			if value is None:
-				return None
-			e=Entity(self.entitySet,self)
-			if select is not None:
-				e.Expand(None,select)
-			kv=zip(e.DataKeys(),value)
-			for pName,pValue in kv:
-				p=e[pName]
-				if select is None or e.Selected(pName) or pName in self.entitySet.keys:
-					# for speed, check if selection is an issue first
-					# we always include the keys
-					if isinstance(p,edm.Complex):
-						self.SetComplexFromTuple(p,pValue)
-					else:
-						p.SetFromValue(pValue)
+				continue
+			if test is not None and not test(value):
+				continue
+			yield EntityView(self.entitySet,self,value,positions,selected)
+
+	def PropertyPositions(self):
+		"""Returns a dictionary mapping property names onto tuples of
+		(position,property definition) for the values stored in this
+		entity set."""
+		if self._positions is None:
+			positions={}
+			i=0
+			for pDef in self.entitySet.entityType.Property:
+				positions[pDef.name]=(i,pDef)
+				i=i+1
+			self._positions=positions
+		return self._positions
+		
+	def SelectedNames(self,select):
+		"""Returns the set of property names selected by *select*
+		
+		The result is the same as the :py:attr:`csdl.Entity.selected`
+		attribute set by :py:meth:`csdl.Entity.Expand`."""
+		entityType=self.entitySet.entityType
+		selected=set()
+		for pDef in entityType.Property:
+			if pDef.name in select or "*" in select:
+				selected.add(pDef.name)
+		for pDef in entityType.NavigationProperty:
+			if pDef.name in select:
+				selected.add(pDef.name)
+		return selected
+
+	def ReadEntity(self,key,select=None,test=None):
+		"""Returns a new entity read from the entity set or None if
+		there is no entity with *key*.
+		
+		*test* is an optional function returned by
+		:py:meth:`CompileFilter`, if the entity's values do not pass the
+		test None is returned."""
+		value=self.data.get(key,None)
+		if value is None:
+			return None
+		if test is not None and not test(value):
+			return None
+		e=Entity(self.entitySet,self)
+		if select is not None:
+			e.Expand(None,select)
+		kv=zip(e.DataKeys(),value)
+		for pName,pValue in kv:
+			p=e[pName]
+			if select is None or e.Selected(pName) or pName in self.entitySet.keys:
+				# for speed, check if selection is an issue first
+				# we always include the keys
+				if isinstance(p,edm.Complex):
+					self.SetComplexFromTuple(p,pValue)
 				else:
-					if isinstance(p,edm.Complex):
-						p.SetNull()
-					else:
-						p.SetFromValue(None)
-			e.exists=True
+					p.SetFromValue(pValue)
+			else:
+				if isinstance(p,edm.Complex):
+					p.SetNull()
+				else:
+					p.SetFromValue(None)
+		e.exists=True
 		return e
 		
 	def SetComplexFromTuple(self,complexValue,t):
@@ -129,20 +370,20 @@ class InMemoryEntityStore(object):
 
 	def ReadStream(self,key):
 		"""Returns a tuple of (content type, data) of the entity's media stream."""
-		with self.container.lock:
-			if key not in self.data:
-				raise KeyError
-			if key in self.streams:
-				type,stream=self.streams[key]
-				return type,stream
-			else:
-				return http.MediaType.FromString('application/octet-stream'),''
+		if key not in self.data:
+			raise KeyError
+		result=self.streams.get(key,None)
+		if result is None:
+			return http.MediaType.FromString('application/octet-stream'),''
+		else:
+			return result
 
 	def UpdateEntity(self,e):
 		# e is an EntityTypeInstance, we need to convert it to a tuple
 		key=e.Key()
 		with self.container.lock:
-			value=list(self.data[key])		
+			oldValue=self.data[key]
+			value=list(oldValue)
 			i=0
 			for pName in e.DataKeys():
 				if e.Selected(pName):
@@ -152,12 +393,45 @@ class InMemoryEntityStore(object):
 					elif isinstance(p,edm.SimpleValue):
 						value[i]=p.value
 				i=i+1
-			self.data[key]=tuple(value)
+			value=tuple(value)
+			self.container.LogUndo(self.RestoreEntity,key,oldValue)
+			self.RestoreEntity(key,value)
 
 	def UpdateEntityStream(self,key,streamType,stream):
 		with self.container.lock:
+			self.container.LogUndo(self.RestoreStream,key,self.streams.get(key,None))
 			self.streams[key]=(streamType,stream)
 
+	def RestoreEntity(self,key,value):
+		"""Sets the stored *value* of the entity with *key*, updating
+		the secondary indexes.  If *value* is None the entity is removed.
+		
+		Used to make changes to the data and to undo them, see
+		:py:meth:`InMemoryEntityContainer.LogUndo`.  Not thread-safe,
+		must only be called if you have acquired the container lock."""
+		oldValue=self.data.get(key,None)
+		with self.container.indexLock:
+			for index in self.indexes.itervalues():
+				if oldValue is not None:
+					index.RemoveKey(key,oldValue[index.pos])
+				if value is not None:
+					index.AddKey(key,value[index.pos])
+		if value is None:
+			self.data.pop(key,None)
+		else:
+			self.data[key]=value
+
+	def RestoreStream(self,key,stream):
+		"""Sets the stored *stream* of the entity with *key*, a tuple
+		of media-type and string or None to remove the stream.
+		
+		Not thread-safe, must only be called if you have acquired the
+		container lock."""
+		if stream is None:
+			self.streams.pop(key,None)
+		else:
+			self.streams[key]=stream
+
 	def GetTupleFromComplex(self,complexValue):
 		value=[]
 		for pName in complexValue.iterkeys():
@@ -204,8 +478,11 @@ class InMemoryEntityStore(object):
 				associationIndex.DeleteHook(key)
 			for associationIndex in self.reverseAssociations.values():
 				associationIndex.ReverseDeleteHook(key)
-			del self.data[key]
+			value=self.data[key]
+			self.container.LogUndo(self.RestoreEntity,key,value)
+			self.RestoreEntity(key,None)
 			if key in self.streams:
+				self.container.LogUndo(self.RestoreStream,key,self.streams[key])
 				del self.streams[key]
 		
 	def NextKey(self):
@@ -230,6 +507,708 @@ class InMemoryEntityStore(object):
 			return self.nextKey
 
 
+class FilterCompiler(object):
+	"""Compiles filter expressions into Python functions.
+	
+	*entityType* is the :py:class:`pyslet.odata2.csdl.EntityType` of the
+	entities being filtered.  The functions returned by
+	:py:meth:`Compile` take a tuple of values, as stored in
+	:py:attr:`InMemoryEntityStore.data`, and return True, False or None
+	(for NULL) without creating any entity or simple value instances.
+	
+	Type promotion is resolved when the expression is compiled, literal
+	values are cast to the promoted type once, sub-expressions that
+	only involve literals are evaluated once and the same rules are
+	followed as :py:meth:`pyslet.odata2.core.CommonExpression.Evaluate`.
+	Expressions that can't be compiled, such as those that use
+	navigation properties or that would raise an error when evaluated,
+	cause :py:class:`FilterNotCompilable` to be raised: the caller
+	should fall back to evaluating the filter on each entity in turn."""
+	
+	NumericTypes=(
+		edm.SimpleType.Int32,
+		edm.SimpleType.Int64,
+		edm.SimpleType.Single,
+		edm.SimpleType.Double,
+		edm.SimpleType.Decimal)
+	"""The promoted types for which arithmetic and numeric comparisons
+	are defined."""
+	
+	CompileMethod={
+		}
+	"""A mapping from unary and binary operators to unbound methods
+	that compile the operator."""
+
+	CallMethod={
+		}
+	"""A mapping from method calls to unbound methods that compile the
+	method."""
+	
+	def __init__(self,entityType):
+		self.entityType=entityType
+
+	def Compile(self,expression):
+		"""Returns a function compiled from *expression*, a
+		:py:class:`pyslet.odata2.core.CommonExpression` instance."""
+		typeCode,f,const=self.CompileExpression(expression,self.entityType)
+		if typeCode!=edm.SimpleType.Boolean:
+			raise FilterNotCompilable("Boolean required for filter expression")
+		return f
+	
+	def CompileExpression(self,expression,typeDef):
+		"""Compiles *expression* in the context of *typeDef*, the entity
+		or complex type containing any property references.
+		
+		Returns a triple of (type, function, constant flag).  The type
+		is a :py:class:`pyslet.odata2.csdl.SimpleType` value (or None
+		for NULL) except for complex values which are represented by
+		their :py:class:`pyslet.odata2.csdl.ComplexType` instead."""
+		if isinstance(expression,odata.LiteralExpression):
+			return self.Constant(expression.value.typeCode,expression.value.value)
+		elif isinstance(expression,odata.PropertyExpression):
+			return self.CompileProperty(expression.name,typeDef)
+		elif isinstance(expression,odata.CallExpression):
+			method=self.CallMethod.get(expression.method,None)
+			if method is None:
+				raise FilterNotCompilable("Can't compile %s()"%odata.Method.EncodeValue(expression.method))
+			return method(self,map(lambda x:self.CompileExpression(x,typeDef),expression.operands))
+		elif expression.operator==odata.Operator.member:
+			lType,lf,lConst=self.CompileExpression(expression.operands[0],typeDef)
+			rExpression=expression.operands[1]
+			if not isinstance(lType,edm.ComplexType) or not isinstance(rExpression,odata.PropertyExpression):
+				raise FilterNotCompilable("Can't compile member expression")
+			rType,rf,rConst=self.CompileProperty(rExpression.name,lType)
+			return rType,lambda v:rf(lf(v)),False
+		else:
+			method=self.CompileMethod.get(expression.operator,None)
+			if method is None:
+				raise FilterNotCompilable("Can't compile %s"%odata.Operator.EncodeValue(expression.operator))
+			return method(self,*map(lambda x:self.CompileExpression(x,typeDef),expression.operands))
+		
+	def CompileProperty(self,name,typeDef):
+		"""Compiles a reference to the data property *name* of *typeDef*
+		into a function that looks up its value in the value tuple."""
+		i=0
+		for p in typeDef.Property:
+			if p.name==name:
+				if p.complexType is not None:
+					typeCode=p.complexType
+				else:
+					typeCode=p.simpleTypeCode
+				return typeCode,operator.itemgetter(i),False
+			i+=1
+		raise FilterNotCompilable("Can't compile reference to %s"%name)
+	
+	def Constant(self,typeCode,value):
+		return typeCode,lambda v:value,True
+	
+	def Node(self,typeCode,f,*operands):
+		"""Returns the compiled node for function *f* of *operands*.  If
+		all the operands are constants the function is evaluated once
+		and the result returned as a constant."""
+		for node in operands:
+			if not node[2]:
+				return typeCode,f,False
+		try:
+			return self.Constant(typeCode,f(None))
+		except (odata.EvaluationError,ValueError,TypeError,ArithmeticError) as e:
+			# defer the error to evaluation time
+			raise FilterNotCompilable(str(e))
+		
+	def CheckSimple(self,*operands):
+		for node in operands:
+			if isinstance(node[0],edm.ComplexType):
+				raise FilterNotCompilable("Expected primitive value")
+				
+	def PromoteOperands(self,lNode,rNode):
+		self.CheckSimple(lNode,rNode)
+		try:
+			return odata.PromoteTypes(lNode[0],rNode[0])
+		except odata.EvaluationError as e:
+			raise FilterNotCompilable(str(e))
+	
+	def Cast(self,node,typeCode):
+		"""Returns a function that evaluates *node* and casts the result
+		to *typeCode*."""
+		nodeType,f,const=node
+		if nodeType==typeCode or nodeType is None:
+			return f
+		elif const:
+			value=edm.EDMValue.NewSimpleValue(nodeType)
+			value.value=f(None)
+			try:
+				value=value.SimpleCast(typeCode).value
+			except (ValueError,TypeError) as e:
+				raise FilterNotCompilable(str(e))
+			return lambda v:value
+		else:
+			coerce=self.Coercion(typeCode)
+			def Cast(v):
+				v=f(v)
+				if v is None:
+					return None
+				else:
+					return coerce(v)
+			return Cast
+	
+	def Coercion(self,typeCode):
+		"""Returns a function that coerces a (non-null) python value to
+		the representation used by values of *typeCode*."""
+		def Coerce(v):
+			result=edm.EDMValue.NewSimpleValue(typeCode)
+			result.SetFromValue(v)
+			return result.value
+		return Coerce
+		
+	def Compare(self,lNode,rNode,typeCode,relation,nullFalse=False):
+		"""Compiles a comparison of two nodes after promoting them to
+		*typeCode*.  *relation* is a function of two arguments.  If
+		*nullFalse* is True then the comparison is False if either
+		value is NULL."""
+		lf=self.Cast(lNode,typeCode)
+		rf=self.Cast(rNode,typeCode)
+		if rNode[2] and not lNode[2]:
+			c=rf(None)
+			if nullFalse:
+				if c is None:
+					return self.Constant(edm.SimpleType.Boolean,False)
+				def f(v):
+					l=lf(v)
+					if l is None:
+						return False
+					return relation(l,c)
+			else:
+				f=lambda v:relation(lf(v),c)
+		elif lNode[2] and not rNode[2]:
+			c=lf(None)
+			if nullFalse:
+				if c is None:
+					return self.Constant(edm.SimpleType.Boolean,False)
+				def f(v):
+					r=rf(v)
+					if r is None:
+						return False
+					return relation(c,r)
+			else:
+				f=lambda v:relation(c,rf(v))
+		elif nullFalse:
+			def f(v):
+				l=lf(v)
+				r=rf(v)
+				if l is None or r is None:
+					return False
+				return relation(l,r)
+		else:
+			f=lambda v:relation(lf(v),rf(v))
+		return self.Node(edm.SimpleType.Boolean,f,lNode,rNode)
+	
+	def CompileRelation(self,lNode,rNode,relation):
+		typeCode=self.PromoteOperands(lNode,rNode)
+		if typeCode in self.NumericTypes:
+			return self.Compare(lNode,rNode,typeCode,relation,True)
+		elif typeCode in (edm.SimpleType.String, edm.SimpleType.DateTime, edm.SimpleType.Guid):
+			return self.Compare(lNode,rNode,typeCode,relation)
+		elif typeCode is None:
+			return self.Constant(edm.SimpleType.Boolean,False)
+		else:
+			raise FilterNotCompilable("Illegal operands for relation")
+	
+	def CompileLt(self,lNode,rNode):
+		return self.CompileRelation(lNode,rNode,operator.lt)
+
+	def CompileGt(self,lNode,rNode):
+		return self.CompileRelation(lNode,rNode,operator.gt)
+
+	def CompileLe(self,lNode,rNode):
+		return self.CompileRelation(lNode,rNode,operator.le)
+
+	def CompileGe(self,lNode,rNode):
+		return self.CompileRelation(lNode,rNode,operator.ge)
+
+	def CompileEquality(self,lNode,rNode,relation):
+		typeCode=self.PromoteOperands(lNode,rNode)
+		if (typeCode in self.NumericTypes or
+			typeCode in (edm.SimpleType.String, edm.SimpleType.DateTime, edm.SimpleType.Guid, edm.SimpleType.Binary)):
+			return self.Compare(lNode,rNode,typeCode,relation)
+		elif typeCode is None:	# null eq null
+			return self.Constant(edm.SimpleType.Boolean,relation(None,None))
+		else:
+			raise FilterNotCompilable("Illegal operands for equality")
+
+	def CompileEq(self,lNode,rNode):
+		return self.CompileEquality(lNode,rNode,operator.eq)
+
+	def CompileNe(self,lNode,rNode):
+		return self.CompileEquality(lNode,rNode,operator.ne)
+
+	def CompileAnd(self,lNode,rNode):
+		typeCode=self.PromoteOperands(lNode,rNode)
+		if typeCode==edm.SimpleType.Boolean:
+			lf=lNode[1]
+			rf=rNode[1]
+			f=lambda v:True if lf(v) and rf(v) else False
+			return self.Node(typeCode,f,lNode,rNode)
+		elif typeCode is None:
+			return self.Constant(edm.SimpleType.Boolean,False)
+		else:
+			raise FilterNotCompilable("Illegal operands for boolean and")
+	
+	def CompileOr(self,lNode,rNode):
+		typeCode=self.PromoteOperands(lNode,rNode)
+		if typeCode==edm.SimpleType.Boolean:
+			lf=lNode[1]
+			rf=rNode[1]
+			def f(v):
+				# NULL or true is false in OData's 2-value logic
+				l=lf(v)
+				r=rf(v)
+				if l is None or r is None:
+					return False
+				return l or r
+			return self.Node(typeCode,f,lNode,rNode)
+		elif typeCode is None:
+			return self.Constant(edm.SimpleType.Boolean,False)
+		else:
+			raise FilterNotCompilable("Illegal operands for boolean or")
+	
+	def CompileNot(self,rNode):
+		self.CheckSimple(rNode)
+		typeCode,rf,const=rNode
+		if typeCode==edm.SimpleType.Boolean:
+			def f(v):
+				r=rf(v)
+				if r is None:
+					return None
+				return not r
+			return self.Node(typeCode,f,rNode)
+		elif typeCode is None:
+			return self.Constant(edm.SimpleType.Boolean,None)
+		else:
+			raise FilterNotCompilable("Illegal operand for not")
+	
+	def CompileNegate(self,rNode):
+		self.CheckSimple(rNode)
+		typeCode=rNode[0]
+		if typeCode in (edm.SimpleType.Byte, edm.SimpleType.Int16):
+			typeCode=edm.SimpleType.Int32
+		elif typeCode==edm.SimpleType.Single:
+			typeCode=edm.SimpleType.Double
+		if typeCode in (edm.SimpleType.Int32, edm.SimpleType.Int64, edm.SimpleType.Double, edm.SimpleType.Decimal):
+			rf=self.Cast(rNode,typeCode)
+			coerce=self.Coercion(typeCode)
+			def f(v):
+				r=rf(v)
+				if r is None:
+					return None
+				return coerce(0-r)
+			return self.Node(typeCode,f,rNode)
+		elif typeCode is None:	# -null
+			return self.Constant(edm.SimpleType.Int32,None)
+		else:
+			raise FilterNotCompilable("Illegal operand for negate")
+	
+	def Arithmetic(self,lNode,rNode,typeCode,op):
+		"""Compiles an arithmetic operation on two nodes after promoting
+		them to *typeCode*.  *op* is a function of two (non-null)
+		arguments."""
+		lf=self.Cast(lNode,typeCode)
+		rf=self.Cast(rNode,typeCode)
+		coerce=self.Coercion(typeCode)
+		def f(v):
+			l=lf(v)
+			r=rf(v)
+			if l is None or r is None:
+				return None
+			return coerce(op(l,r))
+		return self.Node(typeCode,f,lNode,rNode)
+	
+	def CompileArithmetic(self,lNode,rNode,op):
+		typeCode=self.PromoteOperands(lNode,rNode)
+		if typeCode in self.NumericTypes:
+			return self.Arithmetic(lNode,rNode,typeCode,op)
+		elif typeCode is None:	# null op null
+			return self.Constant(edm.SimpleType.Int32,None)
+		else:
+			raise FilterNotCompilable("Illegal operands for arithmetic")
+			
+	def CompileMul(self,lNode,rNode):
+		return self.CompileArithmetic(lNode,rNode,operator.mul)
+			
+	def CompileAdd(self,lNode,rNode):
+		return self.CompileArithmetic(lNode,rNode,operator.add)
+			
+	def CompileSub(self,lNode,rNode):
+		return self.CompileArithmetic(lNode,rNode,operator.sub)
+
+	def CompileDiv(self,lNode,rNode):
+		typeCode=self.PromoteOperands(lNode,rNode)
+		if typeCode in (edm.SimpleType.Single, edm.SimpleType.Double, edm.SimpleType.Decimal):
+			def Div(l,r):
+				try:
+					return l/r
+				except ZeroDivisionError as e:
+					raise odata.EvaluationError(str(e))
+			return self.Arithmetic(lNode,rNode,typeCode,Div)
+		elif typeCode in (edm.SimpleType.Int32, edm.SimpleType.Int64):
+			def IntDiv(l,r):
+				# truncate towards zero, as per EvaluateDiv
+				try:
+					return int(float(l)/float(r))
+				except ZeroDivisionError as e:
+					raise odata.EvaluationError(str(e))
+			return self.Arithmetic(lNode,rNode,typeCode,IntDiv)
+		elif typeCode is None:	# null div null
+			return self.Constant(edm.SimpleType.Int32,None)
+		else:
+			raise FilterNotCompilable("Illegal operands for div")
+
+	def CompileMod(self,lNode,rNode):
+		typeCode=self.PromoteOperands(lNode,rNode)
+		if typeCode in (edm.SimpleType.Single, edm.SimpleType.Double, edm.SimpleType.Decimal):
+			def Mod(l,r):
+				try:
+					return math.fmod(l,r)
+				except (ZeroDivisionError,ValueError) as e:
+					raise odata.EvaluationError(str(e))
+			return self.Arithmetic(lNode,rNode,typeCode,Mod)
+		elif typeCode in (edm.SimpleType.Int32, edm.SimpleType.Int64):
+			def IntMod(l,r):
+				try:
+					return int(math.fmod(float(l),float(r)))
+				except (ZeroDivisionError,ValueError) as e:
+					raise odata.EvaluationError(str(e))
+			return self.Arithmetic(lNode,rNode,typeCode,IntMod)
+		elif typeCode is None:	# null mod null
+			return self.Constant(edm.SimpleType.Int32,None)
+		else:
+			raise FilterNotCompilable("Illegal operands for mod")
+
+	def PromoteParameter(self,node,typeCode):
+		self.CheckSimple(node)
+		if odata.CanCastMethodArgument(node[0],typeCode):
+			return self.Cast(node,typeCode)
+		raise FilterNotCompilable("Expected %s parameter"%edm.SimpleType.EncodeValue(typeCode))
+	
+	def CheckStrictParameter(self,node,typeCode):
+		if node[0]==typeCode:
+			return node[1]
+		raise FilterNotCompilable("Expected %s parameter"%edm.SimpleType.EncodeValue(typeCode))
+	
+	def Call(self,typeCode,method,args,*nodes):
+		"""Compiles a call to *method* with arguments obtained from the
+		list of functions *args*, the result is NULL if any of the
+		arguments is NULL.  *nodes* are the nodes of the arguments, used
+		to test for constant expressions."""
+		if len(args)==1:
+			a0=args[0]
+			def f(v):
+				x0=a0(v)
+				if x0 is None:
+					return None
+				return method(x0)
+		elif len(args)==2:
+			a0,a1=args
+			if nodes[1][2]:
+				# common case, e.g., startswith(Name,'A')
+				x1=a1(None)
+				if x1 is None:
+					return self.Constant(typeCode,None)
+				def f(v):
+					x0=a0(v)
+					if x0 is None:
+						return None
+					return method(x0,x1)
+			else:
+				def f(v):
+					x0=a0(v)
+					x1=a1(v)
+					if x0 is None or x1 is None:
+						return None
+					return method(x0,x1)
+		else:
+			def f(v):
+				x=map(lambda a:a(v),args)
+				if None in x:
+					return None
+				return method(*x)
+		return self.Node(typeCode,f,*nodes)
+		
+	def CheckArgs(self,args,name,*nArgs):
+		if len(args) not in nArgs:
+			raise FilterNotCompilable("%s() takes %s arguments, %i given"%(name,string.join(map(str,nArgs),' or '),len(args)))
+
+	def CompileStringCall(self,args,name,nArgs,typeCode,method):
+		"""Compiles a method call that takes *nArgs* String parameters
+		and returns a value of *typeCode*."""
+		self.CheckArgs(args,name,nArgs)
+		return self.Call(typeCode,method,map(lambda x:self.PromoteParameter(x,edm.SimpleType.String),args),*args)
+		
+	def CompileEndswith(self,args):
+		return self.CompileStringCall(args,"endswith",2,edm.SimpleType.Boolean,lambda x,y:x.endswith(y))
+
+	def CompileIndexof(self,args):
+		return self.CompileStringCall(args,"indexof",2,edm.SimpleType.Int32,lambda x,y:x.find(y))
+
+	def CompileReplace(self,args):
+		return self.CompileStringCall(args,"replace",3,edm.SimpleType.String,lambda x,y,z:x.replace(y,z))
+
+	def CompileStartswith(self,args):
+		return self.CompileStringCall(args,"startswith",2,edm.SimpleType.Boolean,lambda x,y:x.startswith(y))
+
+	def CompileTolower(self,args):
+		return self.CompileStringCall(args,"tolower",1,edm.SimpleType.String,lambda x:x.lower())
+
+	def CompileToupper(self,args):
+		return self.CompileStringCall(args,"toupper",1,edm.SimpleType.String,lambda x:x.upper())
+
+	def CompileTrim(self,args):
+		return self.CompileStringCall(args,"trim",1,edm.SimpleType.String,lambda x:x.strip())
+
+	def CompileSubstringof(self,args):
+		return self.CompileStringCall(args,"substringof",2,edm.SimpleType.Boolean,lambda x,y:y.find(x)>=0)
+
+	def CompileSubstring(self,args):
+		self.CheckArgs(args,"substring",2,3)
+		target=self.CheckStrictParameter(args[0],edm.SimpleType.String)
+		start=self.CheckStrictParameter(args[1],edm.SimpleType.Int32)
+		if len(args)==3:
+			length=self.CheckStrictParameter(args[2],edm.SimpleType.Int32)
+		else:
+			length=lambda v:None
+		def f(v):
+			t=target(v)
+			s=start(v)
+			l=length(v)
+			if t is None or s is None:
+				return None
+			elif l is None:
+				return t[s:]
+			else:
+				return t[s:s+l]
+		return self.Node(edm.SimpleType.String,f,*args)
+	
+	def CompileConcat(self,args):
+		self.CheckArgs(args,"concat",2)
+		return self.Call(edm.SimpleType.String,operator.add,
+			map(lambda x:self.CheckStrictParameter(x,edm.SimpleType.String),args),*args)
+
+	def CompileLength(self,args):
+		self.CheckArgs(args,"length",1)
+		return self.Call(edm.SimpleType.Int32,len,
+			[self.CheckStrictParameter(args[0],edm.SimpleType.String)],*args)
+		
+	def CompileDateTimeCall(self,args,name,method):
+		self.CheckArgs(args,name,1)
+		return self.Call(edm.SimpleType.Int32,method,
+			[self.CheckStrictParameter(args[0],edm.SimpleType.DateTime)],*args)
+		
+	def CompileYear(self,args):
+		return self.CompileDateTimeCall(args,"year",lambda x:x.date.century*100+x.date.year)
+
+	def CompileMonth(self,args):
+		return self.CompileDateTimeCall(args,"month",lambda x:x.date.month)
+
+	def CompileDay(self,args):
+		return self.CompileDateTimeCall(args,"day",lambda x:x.date.day)
+
+	def CompileHour(self,args):
+		return self.CompileDateTimeCall(args,"hour",lambda x:x.time.hour)
+
+	def CompileMinute(self,args):
+		return self.CompileDateTimeCall(args,"minute",lambda x:x.time.minute)
+
+	def CompileSecond(self,args):
+		return self.CompileDateTimeCall(args,"second",lambda x:x.time.second)
+	
+	def CompileRounding(self,args,name,decimalMethod,doubleMethod):
+		"""Compiles round, floor or ceiling which operate on Decimal
+		values if the argument can be cast to Decimal and on Double
+		values otherwise."""
+		self.CheckArgs(args,name,1)
+		try:
+			arg=self.PromoteParameter(args[0],edm.SimpleType.Decimal)
+			return self.Call(edm.SimpleType.Decimal,decimalMethod,[arg],*args)
+		except FilterNotCompilable:
+			arg=self.PromoteParameter(args[0],edm.SimpleType.Double)
+			return self.Call(edm.SimpleType.Double,doubleMethod,[arg],*args)
+	
+	def CompileRound(self,args):
+		return self.CompileRounding(args,"round",
+			lambda x:x.to_integral(decimal.ROUND_HALF_UP),
+			lambda x:float(decimal.Decimal(x).to_integral(decimal.ROUND_HALF_EVEN)))
+
+	def CompileFloor(self,args):
+		return self.CompileRounding(args,"floor",
+			lambda x:x.to_integral(decimal.ROUND_FLOOR),math.floor)
+
+	def CompileCeiling(self,args):
+		return self.CompileRounding(args,"ceiling",
+			lambda x:x.to_integral(decimal.ROUND_CEILING),math.ceil)
+
+
+FilterCompiler.CompileMethod={
+	odata.Operator.negate:FilterCompiler.CompileNegate,
+	odata.Operator.boolNot:FilterCompiler.CompileNot,
+	odata.Operator.mul:FilterCompiler.CompileMul,
+	odata.Operator.div:FilterCompiler.CompileDiv,
+	odata.Operator.mod:FilterCompiler.CompileMod,
+	odata.Operator.add:FilterCompiler.CompileAdd,
+	odata.Operator.sub:FilterCompiler.CompileSub,
+	odata.Operator.lt:FilterCompiler.CompileLt,
+	odata.Operator.gt:FilterCompiler.CompileGt,
+	odata.Operator.le:FilterCompiler.CompileLe,
+	odata.Operator.ge:FilterCompiler.CompileGe,
+	odata.Operator.eq:FilterCompiler.CompileEq,
+	odata.Operator.ne:FilterCompiler.CompileNe,
+	odata.Operator.boolAnd:FilterCompiler.CompileAnd,
+	odata.Operator.boolOr:FilterCompiler.CompileOr }
+
+FilterCompiler.CallMethod={
+	odata.Method.endswith:FilterCompiler.CompileEndswith,
+	odata.Method.indexof:FilterCompiler.CompileIndexof,
+	odata.Method.replace:FilterCompiler.CompileReplace,
+	odata.Method.startswith:FilterCompiler.CompileStartswith,
+	odata.Method.tolower:FilterCompiler.CompileTolower,
+	odata.Method.toupper:FilterCompiler.CompileToupper,
+	odata.Method.trim:FilterCompiler.CompileTrim,
+	odata.Method.substring:FilterCompiler.CompileSubstring,
+	odata.Method.substringof:FilterCompiler.CompileSubstringof,
+	odata.Method.concat:FilterCompiler.CompileConcat,
+	odata.Method.length:FilterCompiler.CompileLength,
+	odata.Method.year:FilterCompiler.CompileYear,
+	odata.Method.month:FilterCompiler.CompileMonth,
+	odata.Method.day:FilterCompiler.CompileDay,
+	odata.Method.hour:FilterCompiler.CompileHour,
+	odata.Method.minute:FilterCompiler.CompileMinute,
+	odata.Method.second:FilterCompiler.CompileSecond,
+	odata.Method.round:FilterCompiler.CompileRound,
+	odata.Method.floor:FilterCompiler.CompileFloor,
+	odata.Method.ceiling:FilterCompiler.CompileCeiling
+	}
+
+
+class InMemoryHashIndex(object):
+	"""A secondary index on a simple property of an entity set.
+	
+	*pDef* is the :py:class:`pyslet.odata2.csdl.Property` being indexed
+	and *pos* is the position of its value in the tuples stored by
+	:py:class:`InMemoryEntityStore`.
+	
+	The index is a dictionary mapping property values on to sets of
+	keys, it can be used to look up entities with a given value only.
+	Indexes are not thread safe, the methods must only be called when
+	the container's indexLock has been acquired."""
+	def __init__(self,pDef,pos):
+		self.name=pDef.name				#: the name of the property being indexed
+		self.typeCode=pDef.simpleTypeCode	#: the type of the property being indexed
+		self.pos=pos					#: the position of the property in the entity's value tuple
+		self.index={}
+	
+	def AddKey(self,key,value):
+		"""Adds *key*, the key of an entity with property *value*"""
+		self.index.setdefault(value,set()).add(key)
+	
+	def RemoveKey(self,key,value):
+		"""Removes *key*, the key of an entity with property *value*"""
+		keys=self.index.get(value,None)
+		if keys is not None:
+			keys.discard(key)
+			if not keys:
+				del self.index[value]
+	
+	def Lookup(self,value):
+		"""Returns a list of the keys of entities with property *value*"""
+		return list(self.index.get(value,()))
+		
+	def Range(self,op,value):
+		"""Returns None, hash indexes can't be used for ranges."""
+		return None
+	
+	def OrderedKeys(self,reverse=False):
+		"""Returns None, hash indexes can't be used for ordering."""
+		return None
+		
+
+class InMemorySortedIndex(InMemoryHashIndex):
+	"""A secondary index that keeps the entities sorted by a simple
+	property.
+	
+	The index is a sorted list of values and a parallel list of keys
+	(with ties sorted by key) searched using the bisect module.  NULL
+	values are not comparable with all other values so are kept
+	separately and sort before all non-NULL values."""
+	def __init__(self,pDef,pos):
+		super(InMemorySortedIndex,self).__init__(pDef,pos)
+		self.values=[]
+		self.keys=[]
+		self.nulls=set()
+
+	def AddKey(self,key,value):
+		if value is None:
+			self.nulls.add(key)
+		else:
+			lo=bisect.bisect_left(self.values,value)
+			hi=bisect.bisect_right(self.values,value,lo)
+			i=bisect.bisect_left(self.keys,key,lo,hi)
+			self.values.insert(i,value)
+			self.keys.insert(i,key)
+	
+	def RemoveKey(self,key,value):
+		if value is None:
+			self.nulls.discard(key)
+		else:
+			lo=bisect.bisect_left(self.values,value)
+			hi=bisect.bisect_right(self.values,value,lo)
+			i=bisect.bisect_left(self.keys,key,lo,hi)
+			if i<hi and self.keys[i]==key:
+				del self.values[i]
+				del self.keys[i]
+	
+	def Lookup(self,value):
+		if value is None:
+			return list(self.nulls)
+		else:
+			lo=bisect.bisect_left(self.values,value)
+			hi=bisect.bisect_right(self.values,value,lo)
+			return self.keys[lo:hi]
+
+	def Range(self,op,value):
+		"""Returns a list of keys of entities with values that satisfy
+		*op* (one of lt, le, gt or ge) when compared with *value*.
+		
+		The keys of entities with NULL values are always included as
+		the result of comparing NULL depends on the property type."""
+		if op==odata.Operator.lt:
+			keys=self.keys[:bisect.bisect_left(self.values,value)]
+		elif op==odata.Operator.le:
+			keys=self.keys[:bisect.bisect_right(self.values,value)]
+		elif op==odata.Operator.gt:
+			keys=self.keys[bisect.bisect_right(self.values,value):]
+		elif op==odata.Operator.ge:
+			keys=self.keys[bisect.bisect_left(self.values,value):]
+		else:
+			return None
+		return list(self.nulls)+keys
+
+	def OrderedKeys(self,reverse=False):
+		"""Returns a list of all keys sorted by value, NULLs first.
+		
+		If *reverse* is True the values are sorted in descending order
+		(NULLs last) but ties are still sorted in ascending order of
+		key."""
+		nulls=sorted(self.nulls)
+		if reverse:
+			result=[]
+			hi=len(self.values)
+			while hi:
+				lo=bisect.bisect_left(self.values,self.values[hi-1],0,hi)
+				result+=self.keys[lo:hi]
+				hi=lo
+			return result+nulls
+		else:
+			return nulls+self.keys
+
+
 class InMemoryAssociationIndex(object):
 	"""An in memory index that implements the association between two
 	sets of entities.
@@ -240,12 +1219,22 @@ class InMemoryAssociationIndex(object):
 	
 	If *propertyName* (and optionally *reverseName*) is provided then
 	the index is immediately bound to the associated entity sets, see
-	:py:meth:`Bind` for more information."""	
+	:py:meth:`Bind` for more information.
+	
+	The sets of keys in the index are modified in place by writers,
+	which must hold the container's lock and, while modifying the
+	sets, its indexLock.  Readers use tuple snapshots of the sets
+	which are created on demand and discarded when the set changes so
+	links can usually be read without acquiring either lock and a
+	burst of writes to the same key costs no more than the writes
+	themselves."""	
 	def __init__(self,container,associationSet,fromEntityStore,toEntityStore,propertyName=None,reverseName=None):
 		self.container=container		#: the :py:class:`InMemoryEntityContainer` that contains this index
 		self.name=associationSet.name	#: the name of the association set this index represents
 		self.index={}					#: a dictionary mapping source keys on to sets of target keys
 		self.reverseIndex={}			#: the reverse index mapping target keys on to sets of source keys
+		self.snapshot={}				# tuple snapshots of the sets in index
+		self.reverseSnapshot={}			# tuple snapshots of the sets in reverseIndex
 		self.fromEntityStore=fromEntityStore
 		fromEntityStore.AddAssociation(self,reverse=False)
 		self.toEntityStore=toEntityStore
@@ -272,50 +1261,90 @@ class InMemoryAssociationIndex(object):
 	def AddLink(self,fromKey,toKey):
 		"""Adds a link from *fromKey* to *toKey*"""
 		with self.container.lock:
-			self.index.setdefault(fromKey,set()).add(toKey)
-			self.reverseIndex.setdefault(toKey,set()).add(fromKey)
+			if toKey not in self.index.get(fromKey,()):
+				self.container.LogUndo(self.RemoveLink,fromKey,toKey)
+				with self.container.indexLock:
+					self.AddKey(self.index,self.snapshot,fromKey,toKey)
+					self.AddKey(self.reverseIndex,self.reverseSnapshot,toKey,fromKey)
 
 	def GetLinksFrom(self,fromKey):
 		"""Returns a tuple of toKeys linked from *fromKey*"""
-		with self.container.lock:
-			return tuple(self.index.get(fromKey,()))
+		return self.GetSnapshot(self.index,self.snapshot,fromKey)
 		
 	def GetLinksTo(self,toKey):
 		"""Returns a tuple of fromKeys linked to *toKey*"""
-		with self.container.lock:
-			return tuple(self.reverseIndex.get(toKey,()))
+		return self.GetSnapshot(self.reverseIndex,self.reverseSnapshot,toKey)
 
 	def RemoveLink(self,fromKey,toKey):
 		"""Removes a link from *fromKey* to *toKey*"""
 		with self.container.lock:
-			self.index.get(fromKey,set()).discard(toKey)
-			self.reverseIndex.get(toKey,set()).discard(fromKey)
+			if toKey in self.index.get(fromKey,()):
+				self.container.LogUndo(self.AddLink,fromKey,toKey)
+				with self.container.indexLock:
+					self.RemoveKey(self.index,self.snapshot,fromKey,toKey)
+					self.RemoveKey(self.reverseIndex,self.reverseSnapshot,toKey,fromKey)
 		
 	def DeleteHook(self,fromKey):
 		"""Called only by :py:meth:`InMemoryEntityStore.DeleteEntity`"""
-		try:
-			toKeys=self.index[fromKey]
+		with self.container.indexLock:
+			self.snapshot.pop(fromKey,None)
+			toKeys=self.index.pop(fromKey,())
 			for toKey in toKeys:
-				fromKeys=self.reverseIndex[toKey]
-				fromKeys.remove(fromKey)
-				if len(fromKeys)==0:
-					del self.reverseIndex[toKey]
-			del self.index[fromKey]			
-		except KeyError:
-			pass
+				self.container.LogUndo(self.AddLink,fromKey,toKey)
+				self.RemoveKey(self.reverseIndex,self.reverseSnapshot,toKey,fromKey)
 
 	def ReverseDeleteHook(self,toKey):
 		"""Called only by :py:meth:`InMemoryEntityStore.DeleteEntity`"""
-		try:
-			fromKeys=self.reverseIndex[toKey]
+		with self.container.indexLock:
+			self.reverseSnapshot.pop(toKey,None)
+			fromKeys=self.reverseIndex.pop(toKey,())
 			for fromKey in fromKeys:
-				toKeys=self.index[fromKey]
-				toKeys.remove(toKey)
-				if len(toKeys)==0:
-					del self.index[fromKey]
-			del self.reverseIndex[toKey]			
-		except KeyError:
-			pass
+				self.container.LogUndo(self.AddLink,fromKey,toKey)
+				self.RemoveKey(self.index,self.snapshot,fromKey,toKey)
+
+	def GetSnapshot(self,index,snapshot,key):
+		"""Returns a tuple of the values for *key* in *index*
+		
+		The tuple is taken from *snapshot* if possible, otherwise it is
+		created (with the container's indexLock) and saved in *snapshot*
+		for subsequent readers."""
+		values=snapshot.get(key,None)
+		if values is None:
+			with self.container.indexLock:
+				values=tuple(index.get(key,()))
+				snapshot[key]=values
+		return values
+
+	@staticmethod
+	def AddKey(index,snapshot,key,value):
+		"""Adds *value* to the set of values for *key* in *index*,
+		discarding any saved snapshot of the set in *snapshot*.
+		
+		Not thread-safe, must only be called if you have
+		acquired the container's indexLock."""
+		values=index.get(key,None)
+		if values is None:
+			index[key]=set((value,))
+		elif value not in values:
+			values.add(value)
+		else:
+			return
+		snapshot.pop(key,None)
+
+	@staticmethod
+	def RemoveKey(index,snapshot,key,value):
+		"""Removes *value* from the set of values for *key* in *index*,
+		removing *key* altogether if no values are left and discarding
+		any saved snapshot of the set in *snapshot*.
+		
+		Not thread-safe, must only be called if you have
+		acquired the container's indexLock."""
+		values=index.get(key,None)
+		if values is not None and value in values:
+			values.discard(value)
+			if not values:
+				del index[key]
+			snapshot.pop(key,None)
 
 
 class Entity(odata.Entity):
@@ -371,6 +1400,54 @@ class Entity(odata.Entity):
 			self.entityStore.UpdateEntityStream(key,streamType,data)
 	
 
+class EntityView(Entity):
+	"""A lightweight entity backed by a tuple of stored values.
+	
+	Views are created by :py:meth:`InMemoryEntityStore.GenerateEntities`
+	and only create property values when they are first accessed, so
+	iterating through a large entity set and using just a few
+	properties of each entity (e.g., as a result of $select) is cheap.
+	
+	*positions* is the dictionary returned by
+	:py:meth:`InMemoryEntityStore.PropertyPositions` and *selected* is
+	the set of selected property names or None if all properties are
+	selected.  Unselected properties that are not part of the key are
+	created NULL, just as if they had been set NULL by
+	:py:meth:`Expand`."""
+	
+	def __init__(self,entitySet,entityStore,valueTuple,positions,selected=None):
+		# we don't call the base constructors, they create all the
+		# property values up front
+		self.entitySet=entitySet
+		self.typeDef=entitySet.entityType
+		self.data={}
+		self.exists=True
+		self.selected=selected
+		self.entityStore=entityStore
+		self.valueTuple=valueTuple		#: the tuple of stored values
+		self.positions=positions
+		
+	def __getitem__(self,name):
+		try:
+			return self.data[name]
+		except KeyError:
+			pass
+		if name in self.positions:
+			i,pDef=self.positions[name]
+			value=pDef()
+			if self.selected is None or name in self.selected or name in self.entitySet.keys:
+				if isinstance(value,edm.Complex):
+					self.entityStore.SetComplexFromTuple(value,self.valueTuple[i])
+				else:
+					value.SetFromValue(self.valueTuple[i])
+		elif self.IsNavigationProperty(name):
+			value=edm.DeferredValue(name,self)
+		else:
+			raise KeyError(name)
+		self.data[name]=value
+		return value
+
+
 class EntityCollection(odata.EntityCollection):
 	"""An entity collection that provides access to entities stored in
 	the :py:class:`InMemoryEntitySet` *entityStore*."""
@@ -412,24 +1489,76 @@ class EntityCollection(odata.EntityCollection):
 			self.entityStore.AddEntity(entity)
 			self.UpdateBindings(entity)
 		
+	def CompiledFilter(self):
+		"""Returns the compiled form of the current filter or None if
+		there is no filter or it can't be compiled.  See
+		:py:meth:`InMemoryEntityStore.CompileFilter` for details."""
+		if self.filter is None:
+			return None
+		else:
+			return self.entityStore.CompileFilter(self.filter)
+			
 	def __len__(self):
+		test=self.CompiledFilter()
 		if self.filter is None:
 			return self.entityStore.CountEntities()
+		keys=self.entityStore.IndexedKeys(self.filter)
+		if test is not None:
+			return self.entityStore.CountEntities(test,keys)
 		else:
 			result=0
-			for e in self.FilterEntities(self.entityStore.GenerateEntities()):
+			for e in self.FilterEntities(self.entityStore.GenerateEntities(keys=keys)):
 				result+=1
 			return result
 		
 	def itervalues(self):
-		return self.OrderEntities(
-			self.ExpandEntities(
-			self.FilterEntities(
-			self.entityStore.GenerateEntities(self.select))))
+		test=self.CompiledFilter()
+		if self.filter is None:
+			keys=None
+		else:
+			keys=self.entityStore.IndexedKeys(self.filter)
+		if keys is None and self.orderby:
+			# use an ordered index to avoid the sort, this allows
+			# paged iteration to stop early
+			keys=self.entityStore.OrderedKeys(self.orderby)
+			if keys is not None:
+				entities=self.entityStore.GenerateEntities(self.select,test,keys)
+				if self.filter is not None and test is None:
+					entities=self.FilterEntities(entities)
+				return self.ExpandEntities(entities)
+		if self.filter is None or test is not None:
+			return self.OrderEntities(
+				self.ExpandEntities(
+				self.entityStore.GenerateEntities(self.select,test,keys)))
+		else:
+			return self.OrderEntities(
+				self.ExpandEntities(
+				self.FilterEntities(
+				self.entityStore.GenerateEntities(self.select,keys=keys))))
+		
+	def ExpandEntities(self,entityIterable):
+		"""Overridden to skip the select rules.
+		
+		The entity store has already applied :py:attr:`select` to the
+		entities it generates so they only need to be passed to
+		:py:meth:`csdl.Entity.Expand` if there are expand rules."""
+		if self.expand:
+			for e in entityIterable:
+				e.Expand(self.expand,self.select)
+				yield e
+		else:
+			for e in entityIterable:
+				yield e
 		
 	def __getitem__(self,key):
-		e=self.entityStore.ReadEntity(key,self.select)
-		if e is not None and self.CheckFilter(e):
+		test=self.CompiledFilter()
+		if self.filter is None or test is not None:
+			e=self.entityStore.ReadEntity(key,self.select,test)
+		else:
+			e=self.entityStore.ReadEntity(key,self.select)
+			if e is not None and not self.CheckFilter(e):
+				e=None
+		if e is not None:
 			e.Expand(self.expand,self.select)
 			return e
 		else:
@@ -524,21 +1653,39 @@ class NavigationCollection(odata.NavigationCollection):
 			return len(resultSet)
 		else:
 			result=0
-			for e in self.FilterEntities(self.entityGenerator()):
+			for e in self.FilteredGenerator():
 				result+=1
 			return result
 
-	def entityGenerator(self):
+	def entityGenerator(self,test=None):
 		# we create a collection from the appropriate entity set first
 		resultSet=self.lookupMethod(self.key)
-		for k in resultSet:
-			yield self.collection[k]
-		
+		if test is None:
+			for k in resultSet:
+				yield self.collection[k]
+		else:
+			entityStore=self.collection.entityStore
+			for k in resultSet:
+				e=entityStore.ReadEntity(k,None,test)
+				if e is not None:
+					yield e
+	
+	def FilteredGenerator(self):
+		"""Returns a generator of the entities that pass the current
+		filter, using the compiled form of the filter if possible."""
+		test=self.collection.entityStore.CompileFilter(self.filter)
+		if test is None:
+			return self.FilterEntities(self.entityGenerator())
+		else:
+			return self.entityGenerator(test)
+			
 	def itervalues(self):
+		if self.filter is None:
+			entities=self.entityGenerator()
+		else:
+			entities=self.FilteredGenerator()
 		return self.OrderEntities(
-			self.ExpandEntities(
-			self.FilterEntities(
-			self.entityGenerator())))
+			self.ExpandEntities(entities))
 
 	def __getitem__(self,key):
 		resultSet=self.lookupMethod(self.key)
@@ -622,6 +1769,8 @@ class InMemoryEntityContainer(object):
 	def __init__(self,containerDef):
 		self.containerDef=containerDef		#: the :py:class:`csdl.EntityContainer` that defines this container
 		self.lock=threading.RLock()			#: a lock that must be acquired before modifying any entity or association in this container
+		self.indexLock=threading.RLock()	#: a lock held briefly while indexes and caches are modified, readers acquire this lock rather than :py:attr:`lock`
+		self.undoLog=None					#: a list of changes to undo while a change set is in progress, see :py:meth:`LogUndo`
 		self.entityStorage={}				#: a mapping from entity set names to :py:class:`InMemoryEntityStore` instances
 		self.associationStorage={}			#: a mapping from association set name to :py:class:`InMemoryAssociationIndex` instances
 		# for each entity set in this container, bind some storage
@@ -644,4 +1793,89 @@ class InMemoryEntityContainer(object):
 					if target is None:
 						raise edm.ModelIncomplete("Target of navigation property %s.%s is not bound to an entity set"%(es.name,np.name))
 					toStorage=self.entityStorage[target.name]
-					self.associationStorage[associationSet.name]=InMemoryAssociationIndex(self,associationSet,fromStorage,toStorage,np.name)
\ No newline at end of file
+					self.associationStorage[associationSet.name]=InMemoryAssociationIndex(self,associationSet,fromStorage,toStorage,np.name)
+		self.containerDef.BindChangeSet(InMemoryChangeSet,container=self)
+
+	def StartUndoLog(self):
+		"""Starts recording changes in :py:attr:`undoLog`
+
+		Not thread-safe, must only be called if you have acquired
+		:py:attr:`lock`."""
+		if self.undoLog is not None:
+			raise ValueError("A change set is already in progress")
+		self.undoLog=[]
+
+	def LogUndo(self,method,*args):
+		"""Records a change in :py:attr:`undoLog`
+
+		*method* is a bound method that undoes the change when called
+		with *args*, typically by restoring the prior value of a single
+		entity, stream or link.  If no change set is in progress
+		nothing is recorded.
+
+		Not thread-safe, must only be called if you have acquired
+		:py:attr:`lock`."""
+		if self.undoLog is not None:
+			self.undoLog.append((method,args))
+
+	def StopUndoLog(self,undo=False):
+		"""Stops recording changes, if *undo* is True the changes are
+		undone first, most recent first.
+
+		Not thread-safe, must only be called if you have acquired
+		:py:attr:`lock`."""
+		undoLog=self.undoLog
+		self.undoLog=None
+		if undo and undoLog:
+			while undoLog:
+				method,args=undoLog.pop()
+				method(*args)
+
+
+class InMemoryChangeSet(edm.ChangeSet):
+	"""A change set that can be rolled back.
+
+	container
+		The :py:class:`InMemoryEntityContainer` that contains the entities.
+	
+	The container's lock is held from :py:meth:`Begin` until the change
+	set is closed so other threads can't modify the container while
+	the change set is in progress.  Readers only need the container's
+	indexLock, which is never held for longer than a single change, so
+	they are not blocked by the change set (but may see changes that
+	are later rolled back).
+	
+	While the change set is in progress the prior value of each entity,
+	stream and link that is changed is recorded in the container's
+	undo log and :py:meth:`Rollback` replays the log in reverse order.
+	The cost of a change set is proportional to the number of changes
+	it makes, not to the size of the container."""
+	Atomic=True
+
+	def __init__(self,container,**kwArgs):
+		super(InMemoryChangeSet,self).__init__(**kwArgs)
+		self.container=container		#: the parent container for this change set
+		self.locked=False
+	
+	def Begin(self):
+		self.container.lock.acquire()
+		try:
+			self.container.StartUndoLog()
+		except:
+			self.container.lock.release()
+			raise
+		self.locked=True
+	
+	def Commit(self):
+		if self.locked:
+			self.container.StopUndoLog()
+	
+	def Rollback(self):
+		if self.locked:
+			self.container.StopUndoLog(undo=True)
+	
+	def close(self):
+		if self.locked:
+			self.locked=False
+			self.container.StopUndoLog()
+			self.container.lock.release()
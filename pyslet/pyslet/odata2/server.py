@@ -2,7 +2,7 @@
 """This module implements the Open Data Protocol specification defined by Microsoft."""
 
 from types import *
-import sys, cgi, urllib, string, itertools, traceback, StringIO, json, base64, decimal, uuid, math, warnings, logging
+import sys, cgi, urllib, string, itertools, traceback, StringIO, json, base64, decimal, uuid, math, warnings, logging, threading, collections, hashlib, zlib
 
 import pyslet.info as info
 import pyslet.iso8601 as iso
@@ -39,7 +39,196 @@ class WSGIWrapper(object):
 		response_headers=response_headers+self.responseHeaders
 		return self.start_response(status,response_headers,exc_info)
 
-		
+
+class ContentEncoder(object):
+	def __init__(self,server,encoding,start_response):
+		"""A wrapper that compresses the body of a wsgi response.
+
+		*encoding* is the content-coding negotiated with the client,
+		"gzip" or "deflate", or None if the response must not be
+		compressed.  Successful responses with a type matching
+		:py:attr:`Server.CompressibleRanges` are compressed unless they
+		are smaller than :py:attr:`Server.CompressionThreshold`, or
+		already have a Content-Encoding.  Responses of unknown length
+		are always compressed."""
+		self.server=server
+		self.encoding=encoding
+		self.start_response=start_response
+		self.started=False
+		self.compressor=None
+
+	def start_response_wrapper(self,status,response_headers,exc_info=None):
+		"""Traps the start_response callback, modifying the headers of
+		compressible responses."""
+		self.started=True
+		contentType=contentLength=vary=None
+		for hName,hValue in response_headers:
+			hName=hName.lower()
+			if hName=="content-type":
+				contentType=hValue
+			elif hName=="content-length":
+				contentLength=hValue
+			elif hName=="vary":
+				vary=hValue
+			elif hName=="content-encoding":
+				# already encoded
+				return self.start_response(status,response_headers,exc_info)
+		if contentType is None or not self.server.IsCompressible(contentType):
+			return self.start_response(status,response_headers,exc_info)
+		if vary is None:
+			# the representation depends on Accept-Encoding, even if we don't compress it this time
+			response_headers=response_headers+[("Vary","Accept-Encoding")]
+		if self.encoding is None or status[:3] not in ("200","201") or \
+			(contentLength is not None and int(contentLength)<self.server.CompressionThreshold):
+			return self.start_response(status,response_headers,exc_info)
+		headers=[]
+		for hName,hValue in response_headers:
+			lName=hName.lower()
+			if lName=="content-length":
+				continue
+			elif lName=="etag" and not hValue.startswith("W/"):
+				# the compressed representation is only semantically equivalent
+				hValue="W/"+hValue
+			headers.append((hName,hValue))
+		headers.append(("Content-Encoding",self.encoding))
+		if self.encoding=="gzip":
+			wbits=16+zlib.MAX_WBITS
+		else:
+			wbits=zlib.MAX_WBITS
+		self.compressor=zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,zlib.DEFLATED,wbits)
+		return self.start_response(status,headers,exc_info)
+
+	def Encode(self,data):
+		"""Returns an iterable of the (possibly compressed) body of the
+		response given the iterable *data* returned by the application."""
+		if self.started and self.compressor is None:
+			return data
+		else:
+			return self._Compress(data)
+
+	def _Compress(self,data):
+		try:
+			for chunk in data:
+				# the application may defer calling start_response
+				if self.compressor is None:
+					yield chunk
+				else:
+					chunk=self.compressor.compress(chunk)
+					if chunk:
+						yield chunk
+			if self.compressor is not None:
+				yield self.compressor.flush()
+		finally:
+			if hasattr(data,'close'):
+				data.close()
+
+
+class ResponseCache(object):
+	"""A bounded cache of serialized responses.
+
+	Responses are cached against a key, in practice a tuple of the
+	request URI, the negotiated response type and the ETag of the entity
+	being represented.  When the total size of the cached data exceeds
+	*maxSize* bytes the least recently used responses are evicted.
+
+	Each response may also be cached as part of a *group*, typically the
+	location of the entity it represents, allowing all representations
+	of an entity to be invalidated when it is modified.
+
+	The methods of this class are thread safe."""
+	def __init__(self,maxSize=1048576):
+		self.maxSize=maxSize	#: the maximum number of bytes of response data to cache
+		self.size=0				#: the number of bytes of response data currently cached
+		self.hits=0				#: the number of successful calls to :py:meth:`Get`
+		self.misses=0			#: the number of unsuccessful calls to :py:meth:`Get`
+		self.bytesSaved=0		#: the number of bytes of response data returned from the cache
+		self.lock=threading.RLock()
+		self.responses=collections.OrderedDict()
+		self.groups={}
+
+	def Get(self,key):
+		"""Returns a tuple of (headers, data) cached against *key* or
+		None if there is no response in the cache."""
+		with self.lock:
+			response=self.responses.pop(key,None)
+			if response is None:
+				self.misses+=1
+				return None
+			# re-insert to mark this response as most recently used
+			self.responses[key]=response
+			self.hits+=1
+			self.bytesSaved+=len(response[2])
+			return response[1],response[2]
+
+	def Set(self,key,headers,data,group=None):
+		"""Caches a response against *key*
+
+		*headers* is a list of (name, value) tuples and *data* is a
+		string containing the body of the response.  *group* is an
+		optional hashable value used to invalidate this response, see
+		:py:meth:`Invalidate`.  Responses larger than
+		:py:attr:`maxSize` are not cached."""
+		if len(data)>self.maxSize:
+			return
+		with self.lock:
+			oldResponse=self.responses.pop(key,None)
+			if oldResponse is not None:
+				self._Discard(key,oldResponse)
+			self.responses[key]=(group,headers,data)
+			self.size+=len(data)
+			if group is not None:
+				self.groups.setdefault(group,set()).add(key)
+			while self.size>self.maxSize:
+				oldKey,oldResponse=self.responses.popitem(last=False)
+				self._Discard(oldKey,oldResponse)
+
+	def _Discard(self,key,response):
+		group,headers,data=response
+		self.size-=len(data)
+		if group is not None:
+			keys=self.groups[group]
+			keys.discard(key)
+			if not keys:
+				del self.groups[group]
+
+	def Invalidate(self,group):
+		"""Removes all responses cached with *group*"""
+		with self.lock:
+			for key in list(self.groups.get(group,())):
+				self._Discard(key,self.responses.pop(key))
+
+	def Clear(self):
+		"""Removes all responses from the cache"""
+		with self.lock:
+			self.responses.clear()
+			self.groups={}
+			self.size=0
+
+	def HitRatio(self):
+		"""Returns the proportion of calls to :py:meth:`Get` that
+		returned a cached response, 0.0 if there have been no calls."""
+		with self.lock:
+			total=self.hits+self.misses
+			if total:
+				return float(self.hits)/total
+			else:
+				return 0.0
+
+
+class PreparedResponse(object):
+	"""A response body serialized in advance.
+
+	*data* is a string containing the body of the response, a gzip
+	compressed copy is made on construction.  Each form is given a
+	strong entity tag derived from its content."""
+	def __init__(self,data):
+		self.data=data			#: the uncompressed body
+		self.etag=http.EntityTag(hashlib.sha1(data).hexdigest(),False)	#: a strong entity tag for :py:attr:`data`
+		c=zlib.compressobj(9,zlib.DEFLATED,16+zlib.MAX_WBITS)
+		self.gzipData=c.compress(data)+c.flush()	#: the body compressed with gzip
+		self.gzipETag=http.EntityTag(self.etag.tag+"-gzip",False)		#: a strong entity tag for :py:attr:`gzipData`
+
+
 class Server(app.Server):
 	"""Extends py:class:`pyselt.rfc5023.Server` to provide an OData server.
 	
@@ -126,6 +315,26 @@ class Server(app.Server):
 		http.MediaType.FromString('application/octet-stream'),
 		http.MediaType.FromString('octet/stream')]		# we allow this one in case someone read the spec literally!
 
+	BatchRanges=[
+		http.MediaRange.FromString('multipart/mixed')]
+		
+	CompressibleRanges=[
+		http.MediaRange.FromString('application/atom+xml'),
+		http.MediaRange.FromString('application/atomsvc+xml'),
+		http.MediaRange.FromString('application/xml'),
+		http.MediaRange.FromString('application/json'),
+		http.MediaRange.FromString('text/*')]
+	
+	ContentEncodings=["gzip","deflate"]		# in order of preference if there is a tie
+	
+	ChunkSize=8192
+	"""The size of the byte strings yielded by streamed responses, see
+	:py:meth:`StreamResponse`."""
+	
+	CompressionThreshold=1024
+	"""The minimum size of response body that is compressed, see
+	:py:class:`ContentEncoder`."""
+	
 	def __init__(self,serviceRoot="http://localhost"):
 		if serviceRoot[-1]!='/':
 			serviceRoot=serviceRoot+'/'
@@ -144,6 +353,11 @@ class Server(app.Server):
 		self.ws.ChildElement(atom.Title).SetValue("Default")
 		self.model=None			#: a :py:class:`metadata.Edmx` instance containing the model for the service
 		self.topmax=100			#: the maximum number of entities to return per request
+		self.responseCache=None	#: an optional :py:class:`ResponseCache` for serialized entities
+		self.metadataResponse=None		#: a :py:class:`PreparedResponse` containing the metadata document
+		self.serviceResponse=None		#: a :py:class:`PreparedResponse` containing the service document
+		self.jsonServiceResponse=None	#: a :py:class:`PreparedResponse` containing the JSON service document
+		self.PrepareResponses()
 		
 	def SetModel(self,model):
 		"""Sets the model for the server from a parentless
@@ -179,9 +393,33 @@ class Server(app.Server):
 					#	update the locations following SetBase above
 					es.SetLocation()
 		self.model=model
+		self.PrepareResponses()
+		if self.responseCache is not None:
+			self.responseCache.Clear()
+
+	def PrepareResponses(self):
+		"""Serializes the metadata and service documents
+
+		Called when the model changes, these documents are then served
+		from memory without being regenerated for each request."""
+		if self.model is None:
+			self.metadataResponse=None
+		else:
+			self.metadataResponse=PreparedResponse(str(self.model.GetDocument()))
+		self.serviceResponse=PreparedResponse(unicode(self.serviceDoc).encode('utf-8'))
+		self.jsonServiceResponse=PreparedResponse(str('{"d":%s}'%json.dumps({'EntitySets':map(lambda x:x.href,self.ws.Collection)})))
 		
 	def __call__(self,environ, start_response):
-		"""wsgi interface for the server."""
+		"""wsgi interface for the server.
+		
+		Responses are compressed using one of :py:attr:`ContentEncodings`
+		if the client's Accept-Encoding header allows it, see
+		:py:class:`ContentEncoder` for details."""
+		encoder=ContentEncoder(self,self.ContentEncodingNegotiation(environ,self.ContentEncodings),start_response)
+		return encoder.Encode(self.HandleWSGI(environ,encoder.start_response_wrapper))
+		
+	def HandleWSGI(self,environ,start_response):
+		"""Handles a wsgi request without any content-coding."""
 		responseHeaders=[]
 		try:
 			version=self.CheckCapabilityNegotiation(environ,start_response,responseHeaders)
@@ -372,13 +610,53 @@ class Server(app.Server):
 				raise MissingURISegment("no entity is linked by this navigation property")
 		return resource,parentEntity
 
-	def SetETag(self,entity,responseHeaders):
+	def GetETag(self,entity):
+		"""Returns a :py:class:`pyslet.rfc2616.EntityTag` instance for
+		*entity* or None if *entity* has no concurrency tokens."""
 		etag=entity.ETag()
 		if etag is not None:
-			s="%s" if entity.ETagIsStrong() else "W/%s"
-			etag=s%http.QuoteString(string.join(map(ODataURI.FormatLiteral,etag),','))
-			responseHeaders.append(("ETag",etag))
-	
+			etag=http.EntityTag(string.join(map(ODataURI.FormatLiteral,etag),','),not entity.ETagIsStrong())
+		return etag
+
+	def SetETag(self,entity,responseHeaders):
+		etag=self.GetETag(entity)
+		if etag is not None:
+			responseHeaders.append(("ETag",str(etag)))
+
+	def CheckNotModified(self,environ,etag):
+		"""Returns True if *etag* matches the If-None-Match header in
+		*environ*.
+
+		The weak comparison function is used, as allowed for GET
+		requests.  If *etag* is None or the request is not conditional
+		False is returned, badly formed headers are ignored.  Entities
+		have no modification date so If-Modified-Since is not
+		considered."""
+		ifNoneMatch=environ.get('HTTP_IF_NONE_MATCH',None)
+		if etag is None or ifNoneMatch is None:
+			return False
+		if ifNoneMatch.strip()=="*":
+			return True
+		try:
+			p=http.ParameterParser(ifNoneMatch)
+			while True:
+				if p.RequireEntityTag().tag==etag.tag:
+					return True
+				if not p.ParseSeparator(','):
+					return False
+		except http.HTTPParameterError:
+			return False
+
+	def ReturnNotModified(self,etag,start_response,responseHeaders):
+		responseHeaders.append(("ETag",str(etag)))
+		start_response("%i %s"%(304,"Not Modified"),responseHeaders)
+		return []
+
+	def InvalidateEntity(self,entity):
+		"""Removes any cached responses representing *entity*"""
+		if self.responseCache is not None:
+			self.responseCache.Invalidate(str(entity.GetLocation()))
+
 	def HandleRequest(self,request,environ,start_response,responseHeaders):
 		"""Handles a request that has been identified as being an OData request.
 		
@@ -389,7 +667,10 @@ class Server(app.Server):
 			if request.pathOption==PathOption.metadata:
 				return self.ReturnMetadata(request,environ,start_response,responseHeaders)
 			elif request.pathOption==PathOption.batch:
-				return self.ODataError(request,environ,start_response,"Bad Request","Batch requests not supported",404)
+				if method=="POST":
+					return self.HandleBatch(request,environ,start_response,responseHeaders)
+				else:
+					raise InvalidMethod("%s not supported here"%method)
 			elif request.pathOption==PathOption.count:
 				if isinstance(resource,edm.Entity):
 					return self.ReturnCount(1,request,environ,start_response,responseHeaders)
@@ -428,6 +709,7 @@ class Server(app.Server):
 						with resource as collection:
 							targetEntity=self.ReadEntityFromLink(environ)
 							collection[targetEntity.Key()]=targetEntity
+						self.InvalidateEntity(parentEntity)
 						return self.ReturnEmpty(start_response,responseHeaders)
 					else:
 						# you can't POST to a single link that already exists
@@ -438,6 +720,7 @@ class Server(app.Server):
 					with parentEntity[request.linksProperty].OpenCollection() as collection:
 						targetEntity=self.ReadEntityFromLink(environ)
 						collection.Replace(targetEntity)
+					self.InvalidateEntity(parentEntity)
 					return self.ReturnEmpty(start_response,responseHeaders)
 				elif method=="DELETE":
 					if isinstance(resource,edm.EntityCollection):
@@ -445,7 +728,8 @@ class Server(app.Server):
 					elif resource is None:
 						raise MissingURISegment("%s, no entity is related"%request.linksProperty)						
 					with parentEntity[request.linksProperty].OpenCollection() as collection:
-						del collection[resource.Key()]					
+						del collection[resource.Key()]
+					self.InvalidateEntity(parentEntity)
 					return self.ReturnEmpty(start_response,responseHeaders)
 				else:
 					raise InvalidMethod("%s not supported here"%method)
@@ -468,6 +752,7 @@ class Server(app.Server):
 								resourceType=http.MediaType.FromString('application/octet-stream')
 							input=app.InputWrapper(environ)
 							resource.SetStreamFromGenerator(resourceType,input.iterblocks())
+							self.InvalidateEntity(resource)
 							self.SetETag(resource,responseHeaders)											
 							return self.ReturnEmpty(start_response,responseHeaders)				
 						else:
@@ -476,12 +761,14 @@ class Server(app.Server):
 						# update the entity from the request
 						self.ReadEntity(resource,environ)
 						resource.Update()
+						self.InvalidateEntity(resource)
 						# now we've updated the entity it is safe to calculate the ETag
 						self.SetETag(resource,responseHeaders)
 						return self.ReturnEmpty(start_response,responseHeaders)
 				elif method=="DELETE":
 					if request.pathOption==PathOption.value:
 						raise BadURISegment("$value cannot be used with DELETE")
+					self.InvalidateEntity(resource)
 					resource.Delete()
 					return self.ReturnEmpty(start_response,responseHeaders)
 				else:
@@ -545,6 +832,7 @@ class Server(app.Server):
 					else:
 						self.ReadValue(resource,environ)
 					parentEntity.Update()
+					self.InvalidateEntity(parentEntity)
 					self.SetETag(parentEntity,responseHeaders)
 					return self.ReturnEmpty(start_response,responseHeaders)
 				elif method=="DELETE":
@@ -555,6 +843,7 @@ class Server(app.Server):
 						raise InvalidMethod("DELETE failed, %s property is not nullable"%resource.pDef.name)
 					resource.value=None
 					parentEntity.Update()
+					self.InvalidateEntity(parentEntity)
 					return self.ReturnEmpty(start_response,responseHeaders)						
 				else:
 					raise InvalidMethod("%s not supported here"%method)											
@@ -569,11 +858,7 @@ class Server(app.Server):
 					return self.ReturnJSONRoot(request,environ,start_response,responseHeaders)
 				else:
 					# override the default handling of service root to improve content negotiation
-					data=unicode(self.serviceDoc).encode('utf-8')
-					responseHeaders.append(("Content-Type",str(responseType)))
-					responseHeaders.append(("Content-Length",str(len(data))))
-					start_response("200 Ok",responseHeaders)
-					return [data]
+					return self.ReturnPrepared(self.serviceResponse,responseType,environ,start_response,responseHeaders)
 					# wrapper=WSGIWrapper(environ,start_response,responseHeaders)
 					# super essentially allows us to pass a bound method of our parent
 					# that we ourselves are hiding.
@@ -589,6 +874,371 @@ class Server(app.Server):
 		except NotImplementedError,e:
 			return self.ODataError(request,environ,start_response,"NotImplementedError",str(e),405)
 			
+	def HandleBatch(self,request,environ,start_response,responseHeaders):
+		"""Handles a $batch request.
+		
+		The body of the request is a multipart/mixed MIME message.  Each
+		part is either a single operation (a query) or a change set: a
+		nested multipart/mixed message containing one or more change
+		requests.  The operations are parsed by :py:meth:`ReadBatch`
+		before the response is started so that badly formed requests
+		result in a single error response.
+		
+		Each operation is dispatched through the normal request
+		handlers by calling this server with a new WSGI environment, see
+		:py:meth:`ExecuteBatchOperation`.  The operations are executed
+		as the multipart response is generated so the response is
+		streamed in the same way as a single request."""
+		try:
+			batch=self.ReadBatch(environ)
+		except InvalidData,e:
+			return self.ODataError(request,environ,start_response,"Bad Request","Batch request is invalid: %s"%str(e),400)
+		boundary="batchresponse_%s"%str(uuid.uuid4())
+		responseHeaders.append(("Content-Type","multipart/mixed; boundary=%s"%boundary))
+		start_response("%i %s"%(202,"Accepted"),responseHeaders)
+		return self.GenerateBatchResponse(environ,batch,boundary)
+	
+	def ReadBatch(self,environ):
+		"""Reads a batch request from *environ*
+		
+		Returns a list of items, each item is either a single operation
+		or a list of (Content-ID, operation) tuples representing a
+		change set, the Content-ID is None if the part had no Content-ID
+		header.  Change sets may not contain GET requests.  Each operation is a tuple of::
+		
+			(method, uri, headers, body)
+		
+		where headers is a list of (name, value) tuples.  Raises
+		:py:class:`InvalidData` if the request can't be parsed."""
+		batch=[]
+		for headers,body in self.ReadMultipart(environ.get("CONTENT_TYPE",None),app.InputWrapper(environ).read()):
+			partType=self.GetBatchHeader(headers,"Content-Type")
+			if partType is not None and partType.strip().lower().startswith("multipart/"):
+				changeSet=[]
+				for csHeaders,csBody in self.ReadMultipart(partType,body):
+					operation=self.ReadBatchOperation(csHeaders,csBody)
+					if operation[0]=="GET":
+						raise InvalidData("retrieve requests are not allowed in change sets")
+					changeSet.append((self.GetBatchHeader(csHeaders,"Content-ID"),operation))
+				batch.append(changeSet)
+			else:
+				batch.append(self.ReadBatchOperation(headers,body))
+		return batch
+		
+	def ReadMultipart(self,contentType,data):
+		"""Splits *data*, the body of a multipart message with
+		*contentType*, into a list of (headers, body) tuples."""
+		if contentType is None:
+			raise InvalidData("missing Content-Type")
+		try:
+			mType=http.MediaType.FromString(contentType)
+		except http.HTTPParameterError:
+			raise InvalidData("bad Content-Type: %s"%contentType)
+		for r in self.BatchRanges:
+			if r.MatchMediaType(mType):
+				break
+		else:
+			raise InvalidData("expected multipart/mixed, found %s"%contentType)
+		boundary=mType.parameters.get('boundary',(None,None))[1]
+		if not boundary:
+			raise InvalidData("missing boundary parameter")
+		if '\r\n' not in data:
+			# we can't tell line breaks from LFs in the body parts
+			raise InvalidData("multipart body must use CRLF line breaks")
+		parts=[]
+		# the delimiter includes the preceding line break
+		chunks=('\r\n'+data).split('\r\n--'+boundary)
+		if len(chunks)<2:
+			raise InvalidData("boundary not found")
+		# ignore the preamble
+		for chunk in chunks[1:]:
+			if chunk.startswith('--'):
+				# the close-delimiter, ignore the epilogue
+				break
+			# discard any transport padding
+			i=chunk.find('\r\n')
+			if i<0:
+				raise InvalidData("badly formed body part")
+			parts.append(self.ReadBatchHeaders(chunk[i+2:]))
+		else:
+			raise InvalidData("missing close delimiter")
+		return parts
+	
+	def ReadBatchHeaders(self,data):
+		"""Splits *data* into a list of (name, value) tuples and a body
+		
+		The header lines are separated from the body by an empty line,
+		the result is returned as a tuple of (headers, body)."""
+		if data.startswith('\r\n'):
+			headerData,body='',data[2:]
+		else:
+			i=data.find('\r\n\r\n')
+			if i<0:
+				headerData,body=data,''
+			else:
+				headerData,body=data[:i],data[i+4:]
+		headers=[]
+		for line in headerData.split('\r\n'):
+			if not line:
+				continue
+			if line[0] in ' \t' and headers:
+				# a continuation line
+				headers[-1][1]=headers[-1][1]+' '+line.strip()
+				continue
+			h=line.split(':',1)
+			if len(h)!=2:
+				raise InvalidData("badly formed header line: %s"%line)
+			headers.append([h[0].strip(),h[1].strip()])
+		return headers,body
+	
+	def GetBatchHeader(self,headers,name):
+		"""Returns the value of header *name* from a list of headers
+		returned by :py:meth:`ReadBatchHeaders` or None if it is missing."""
+		name=name.lower()
+		for h in headers:
+			if h[0].lower()==name:
+				return h[1]
+		return None
+				
+	def ReadBatchOperation(self,headers,body):
+		"""Reads a single operation from the body part with *headers*
+		and *body*, returning an operation tuple as described in
+		:py:meth:`ReadBatch`."""
+		partType=self.GetBatchHeader(headers,"Content-Type")
+		if partType is None or partType.split(';')[0].strip().lower()!="application/http":
+			raise InvalidData("expected application/http, found %s"%partType)
+		i=body.find('\r\n')
+		if i<0:
+			requestLine,body=body,''
+		else:
+			requestLine,body=body[:i],body[i+2:]
+		requestLine=requestLine.split()
+		if len(requestLine)<2:
+			raise InvalidData("bad request line: %s"%string.join(requestLine,' '))
+		method,target=requestLine[0].upper(),requestLine[1]
+		headers,body=self.ReadBatchHeaders(body)
+		length=self.GetBatchHeader(headers,"Content-Length")
+		if length is not None:
+			try:
+				body=body[:int(length)]
+			except ValueError:
+				raise InvalidData("bad Content-Length: %s"%length)
+		return method,target,headers,body
+		
+	def GenerateBatchResponse(self,environ,batch,boundary):
+		"""A generator that executes the operations in *batch*, as
+		returned by :py:meth:`ReadBatch`, yielding the body of the
+		multipart response."""
+		for item in batch:
+			yield "--%s\r\n"%boundary
+			if isinstance(item,list):
+				failed,responses=self.ExecuteChangeSet(environ,item)
+				if failed:
+					contentId,status,headers,data=responses[0]
+					for chunk in self.GenerateBatchPart(status,headers,[data]):
+						yield chunk
+				else:
+					csBoundary="changesetresponse_%s"%str(uuid.uuid4())
+					yield "Content-Type: multipart/mixed; boundary=%s\r\n\r\n"%csBoundary
+					for contentId,status,headers,data in responses:
+						yield "--%s\r\n"%csBoundary
+						for chunk in self.GenerateBatchPart(status,headers,[data],contentId):
+							yield chunk
+					yield "--%s--\r\n"%csBoundary
+			else:
+				status,headers,data=self.ExecuteBatchOperation(environ,item)
+				try:
+					for chunk in self.GenerateBatchPart(status,headers,data):
+						yield chunk
+				finally:
+					if hasattr(data,'close'):
+						data.close()
+		yield "--%s--\r\n"%boundary
+		
+	def GenerateBatchPart(self,status,headers,data,contentId=None):
+		"""A generator that yields a single body part of a batch
+		response containing the response to an operation."""
+		partHeaders=["Content-Type: application/http\r\n","Content-Transfer-Encoding: binary\r\n"]
+		if contentId is not None:
+			partHeaders.append("Content-ID: %s\r\n"%contentId)
+		partHeaders.append("\r\n")
+		partHeaders.append("HTTP/1.1 %s\r\n"%status)
+		for h in headers:
+			partHeaders.append("%s: %s\r\n"%h)
+		partHeaders.append("\r\n")
+		yield string.join(partHeaders,'')
+		for chunk in data:
+			yield chunk
+		yield "\r\n"
+			
+	def ExecuteChangeSet(self,environ,changeSet):
+		"""Executes the operations in a change set
+		
+		All the operations in a change set must apply to the same entity
+		container and a :py:class:`csdl.ChangeSet` is opened on that
+		container for the duration of the change set.  If all the
+		operations succeed the change set is committed, otherwise it is
+		rolled back and processing stops at the first failed operation.
+		
+		The change set fails before any operation is executed if the
+		operations apply to more than one container or if the
+		container's change sets can't be rolled back (see
+		:py:attr:`csdl.ChangeSet.Atomic`), so a failed change set never
+		leaves partial changes behind.
+		
+		Returns a tuple of (failed, responses) where responses is a list
+		of (Content-ID, status, headers, data) tuples.  If failed is True
+		the list contains a single response, the response to the failed
+		operation (or an error response if the change set could not be
+		committed)."""
+		containers=set()
+		for contentId,operation in changeSet:
+			container=self.GetBatchOperationContainer(operation[1])
+			if container is not None:
+				containers.add(container)
+		if len(containers)>1:
+			return True,[self.CaptureResponse(self.ODataError,ODataURI('error'),environ,"ChangeSetError",
+				"Change set spans more than one entity container",400)]
+		cs=None
+		if containers:
+			cs=containers.pop().OpenChangeSet()
+			if not cs.Atomic:
+				return True,[self.CaptureResponse(self.ODataError,ODataURI('error'),environ,"ChangeSetError",
+					"Entity container %s does not support change sets"%cs.containerDef.name,501)]
+		responses=[]
+		contentIds={}
+		failed=False
+		try:
+			if cs is not None:
+				cs.Begin()
+			for contentId,operation in changeSet:
+				status,headers,body=self.ExecuteBatchOperation(environ,operation,contentIds)
+				try:
+					data=string.join(body,'')
+				finally:
+					if hasattr(body,'close'):
+						body.close()
+				if not status[:1] in "123":
+					failed=True
+					responses=[(contentId,status,headers,data)]
+					break
+				if contentId is not None:
+					for h in headers:
+						if h[0].lower()=="location":
+							contentIds["$"+contentId]=h[1]
+				responses.append((contentId,status,headers,data))
+		except Exception,e:
+			logging.error("Change set failed: %s",str(e))
+			failed=True
+			responses=[self.CaptureResponse(self.ODataError,ODataURI('error'),environ,"ChangeSetError",
+				"Change set failed: %s"%str(e),500)]
+		if cs is not None:
+			try:
+				if failed:
+					cs.Rollback()
+				else:
+					cs.Commit()
+			except Exception,e:
+				logging.error("Change set commit failed: %s",str(e))
+				failed=True
+				responses=[self.CaptureResponse(self.ODataError,ODataURI('error'),environ,"ChangeSetError",
+					"Change set failed: %s"%str(e),500)]
+			finally:
+				cs.close()
+		return failed,responses
+	
+	def GetBatchOperationContainer(self,target):
+		"""Returns the :py:class:`csdl.EntityContainer` that contains
+		the entity set or function import identified by the first
+		segment of the request URI *target*.
+		
+		Returns None if *target* is a Content-ID reference (these refer
+		to entities created earlier in the same change set) or if the
+		container can't be determined, in which case the operation will
+		fail when it is executed."""
+		if target.startswith('$'):
+			return None
+		try:
+			request=ODataURI(self.ResolveBatchTarget(target),self.pathPrefix)
+			if self.model is None or not request.navPath:
+				return None
+			resource=self.model.DataServices.SearchContainers(request.navPath[0][0])
+		except (ServerError,ValueError,KeyError):
+			return None
+		if isinstance(resource,(edm.EntitySet,edm.FunctionImport)):
+			return resource.parent
+		else:
+			return None
+		
+	def CaptureResponse(self,method,*args):
+		"""Calls a response method passing a start_response function
+		that captures the response status and headers.
+		
+		*args* are the arguments to pass to *method* before the
+		start_response argument, any remaining arguments follow it. 
+		Returns a (None, status, headers, data) tuple suitable for
+		adding to a batch response."""
+		result=[]
+		def StartResponse(status,headers,exc_info=None):
+			result[:]=[status,headers]
+		data=method(*(args[:2]+(StartResponse,)+args[2:]))
+		return None,result[0],result[1],string.join(data,'')
+		
+	def ExecuteBatchOperation(self,environ,operation,contentIds=None):
+		"""Executes a single batch operation
+		
+		*environ* is the environment of the batch request itself, it is
+		copied to make the environment of the operation, replacing the
+		request-specific values.  *contentIds* is a dictionary mapping
+		Content-ID references (e.g., "$1") on to the locations of
+		entities created earlier in the same change set, these are
+		expanded when they start the request URI.
+		
+		Returns a tuple of (status, headers, data) where data is the
+		iterable returned by the WSGI call."""
+		method,target,headers,body=operation
+		target=self.ResolveBatchTarget(target,contentIds)
+		opEnviron={}
+		for k,v in environ.iteritems():
+			if k.startswith('HTTP_') and k!='HTTP_HOST':
+				continue
+			opEnviron[k]=v
+		opEnviron['REQUEST_METHOD']=method
+		opEnviron['SCRIPT_NAME']=''
+		opEnviron['PATH_INFO']=target.absPath
+		opEnviron['QUERY_STRING']=target.query
+		opEnviron['CONTENT_LENGTH']=str(len(body))
+		opEnviron['wsgi.input']=StringIO.StringIO(body)
+		opEnviron.pop('CONTENT_TYPE',None)
+		for hName,hValue in headers:
+			hName=hName.upper().replace('-','_')
+			if hName=="CONTENT_TYPE":
+				opEnviron["CONTENT_TYPE"]=hValue
+			elif hName!="CONTENT_LENGTH":
+				opEnviron["HTTP_"+hName]=hValue
+		result=[]
+		def StartResponse(status,headers,exc_info=None):
+			result[:]=[status,headers]
+		data=self(opEnviron,StartResponse)
+		if not result:
+			# the application may defer start_response until iterated
+			data=[string.join(data,'')]
+		return result[0],result[1],data
+	
+	def ResolveBatchTarget(self,target,contentIds=None):
+		"""Returns the absolute URI of a batch operation's request URI
+		*target*, expanding any Content-ID reference using
+		*contentIds* (as described in :py:meth:`ExecuteBatchOperation`)
+		and resolving the result relative to the service root."""
+		if contentIds and target.startswith('$'):
+			i=target.find('/')
+			if i<0:
+				i=len(target)
+			location=contentIds.get(target[:i],None)
+			if location is not None:
+				target=location+target[i:]
+		return uri.URIFactory.Resolve(self.serviceRoot,uri.URIFactory.URI(target))
+	
 	def ExpandResource(self,resource,sysQueryOptions):
 		try:
 			expand=sysQueryOptions.get(SystemQueryOption.expand,None)
@@ -602,20 +1252,28 @@ class Server(app.Server):
 			raise InvalidSystemQueryOption("$select/$expand error: %s"%str(e))					
 		
 	def ReturnJSONRoot(self,request,environ,start_response,responseHeaders):
-		data=str('{"d":%s}'%json.dumps({'EntitySets':map(lambda x:x.href,self.ws.Collection)}))
-		responseHeaders.append(("Content-Type","application/json"))
-		responseHeaders.append(("Content-Length",str(len(data))))
-		start_response("%i %s"%(200,"Success"),responseHeaders)
-		return [data]
+		return self.ReturnPrepared(self.jsonServiceResponse,"application/json",environ,start_response,responseHeaders)
 		
 	def ReturnMetadata(self,request,environ,start_response,responseHeaders):
-		doc=self.model.GetDocument()
 		responseType=self.ContentNegotiation(request,environ,self.MetadataTypes)
 		if responseType is None:
 			return self.ODataError(request,environ,start_response,"Not Acceptable",'xml or plain text formats supported',406)
-		data=str(doc)
+		return self.ReturnPrepared(self.metadataResponse,responseType,environ,start_response,responseHeaders)
+
+	def ReturnPrepared(self,response,responseType,environ,start_response,responseHeaders):
+		"""Returns a :py:class:`PreparedResponse`, compressed if the
+		client accepts gzip encoding."""
+		if self.ContentEncodingNegotiation(environ,["gzip"])=="gzip":
+			data,etag=response.gzipData,response.gzipETag
+			responseHeaders.append(("Content-Encoding","gzip"))
+		else:
+			data,etag=response.data,response.etag
+		responseHeaders.append(("Vary","Accept-Encoding"))
+		if self.CheckNotModified(environ,etag):
+			return self.ReturnNotModified(etag,start_response,responseHeaders)
 		responseHeaders.append(("Content-Type",str(responseType)))
 		responseHeaders.append(("Content-Length",str(len(data))))
+		responseHeaders.append(("ETag",str(etag)))
 		start_response("%i %s"%(200,"Success"),responseHeaders)
 		return [data]
 			
@@ -671,20 +1329,54 @@ class Server(app.Server):
 		if responseType is None:
 			return self.ODataError(request,environ,start_response,"Not Acceptable",'xml, json or plain text formats supported',406)
 		if responseType=="application/json":
-			data=str('{"d":%s}'%string.join(entities.GenerateEntitySetInJSON(request.version),''))
+			data=itertools.chain(('{"d":',),entities.GenerateEntitySetInJSON(request.version),('}',))
 		else:
-			# Here's a challenge, we want to pull data through the feed by yielding strings
-			# just load in to memory at the moment
+			# The feed pulls entities through the collection's iterpage
+			# method as the document is generated
 			entities.TopMax(self.topmax)
 			f=Feed(None,entities)
 			doc=Document(root=f)
 			f.collection=entities
 			f.SetBase(str(self.serviceRoot))
-			data=str(doc)
+			data=doc.GenerateXML(xml.EscapeCharData7)
+		data=self.StreamResponse(data,entities)
+		# the length is not known in advance so no Content-Length is sent
 		responseHeaders.append(("Content-Type",str(responseType)))
-		responseHeaders.append(("Content-Length",str(len(data))))
 		start_response("%i %s"%(200,"Success"),responseHeaders)
-		return [data]
+		return data
+	
+	def StreamResponse(self,data,collection=None):
+		"""Returns an iterable of byte strings suitable for returning as
+		the body of a WSGI response.
+		
+		*data* is an iterable of strings which is encoded with UTF-8 in
+		chunks of :py:attr:`ChunkSize` bytes.  The first chunk is
+		generated immediately so that any errors raised when opening the
+		data source are raised before the response is started, the rest
+		are generated on demand so the response is never held in memory
+		in its entirety.
+		
+		If *collection* is given it is closed when the response is
+		complete (or is abandoned by the WSGI server)."""
+		chunks=xml.EncodeChunks(data,self.ChunkSize)
+		try:
+			first=chunks.next()
+		except StopIteration:
+			first=''
+		except Exception:
+			if collection is not None:
+				collection.close()
+			raise
+		return self._StreamChunks(first,chunks,collection)
+	
+	def _StreamChunks(self,first,chunks,collection):
+		try:
+			yield first
+			for chunk in chunks:
+				yield chunk
+		finally:
+			if collection is not None:
+				collection.close()
 				
 	def ReadXMLOrJSON(self,environ):
 		"""Reads either an XML document or a JSON object from environ."""
@@ -759,6 +1451,21 @@ class Server(app.Server):
 		responseType=self.ContentNegotiation(request,environ,self.EntryTypes)
 		if responseType is None:
 			return self.ODataError(request,environ,start_response,"Not Acceptable",'xml, json or plain text formats supported',406)
+		etag=self.GetETag(entity)
+		cacheKey=None
+		if status==200:
+			if self.CheckNotModified(environ,etag):
+				return self.ReturnNotModified(etag,start_response,responseHeaders)
+			# expanded entities may change without changing the ETag
+			if self.responseCache is not None and etag is not None and \
+				SystemQueryOption.expand not in request.sysQueryOptions:
+				cacheKey=(str(request.uri),str(responseType),request.version,str(etag))
+				response=self.responseCache.Get(cacheKey)
+				if response is not None:
+					headers,data=response
+					responseHeaders.extend(headers)
+					start_response("%i %s"%(status,statusMsg),responseHeaders)
+					return [data]
 		# Here's a challenge, we want to pull data through the feed by yielding strings
 		# just load in to memory at the moment
 		if responseType=="application/json":
@@ -769,9 +1476,12 @@ class Server(app.Server):
 			e.SetBase(str(self.serviceRoot))
 			e.SetValue(entity)
 			data=str(doc)
-		responseHeaders.append(("Content-Type",str(responseType)))
-		responseHeaders.append(("Content-Length",str(len(data))))
-		self.SetETag(entity,responseHeaders)
+		headers=[("Content-Type",str(responseType)),("Content-Length",str(len(data)))]
+		if etag is not None:
+			headers.append(("ETag",str(etag)))
+		if cacheKey is not None:
+			self.responseCache.Set(cacheKey,headers,data,str(entity.GetLocation()))
+		responseHeaders.extend(headers)
 		start_response("%i %s"%(status,statusMsg),responseHeaders)
 		return [data]
 
@@ -781,6 +1491,9 @@ class Server(app.Server):
 		responseType=self.ContentNegotiation(request,environ,types)
 		if responseType is None:
 			return self.ODataError(request,environ,start_response,"Not Acceptable",'media stream type refused, try application/octet-stream',406)
+		etag=self.GetETag(entity)
+		if self.CheckNotModified(environ,etag):
+			return self.ReturnNotModified(etag,start_response,responseHeaders)
 		responseHeaders.append(("Content-Type",str(responseType)))
 		responseHeaders.append(("Content-Length",entity.GetStreamSize()))
 		self.SetETag(entity,responseHeaders)
@@ -805,6 +1518,10 @@ class Server(app.Server):
 		responseType=self.ContentNegotiation(request,environ,self.ValueTypes)
 		if responseType is None:
 			return self.ODataError(request,environ,start_response,"Not Acceptable",'xml, json or plain text formats supported',406)
+		if entity is not None:
+			etag=self.GetETag(entity)
+			if self.CheckNotModified(environ,etag):
+				return self.ReturnNotModified(etag,start_response,responseHeaders)
 		if responseType=="application/json":
 			if isinstance(value,edm.Complex):
 				if request.version==2:
@@ -884,6 +1601,10 @@ class Server(app.Server):
 		responseType=self.ContentNegotiation(request,environ,mTypes)
 		if responseType is None:
 			return self.ODataError(request,environ,start_response,"Not Acceptable",'$value requires plain text or octet-stream formats',406)
+		if entity is not None:
+			etag=self.GetETag(entity)
+			if self.CheckNotModified(environ,etag):
+				return self.ReturnNotModified(etag,start_response,responseHeaders)
 		responseHeaders.append(("Content-Type",str(responseType)))
 		responseHeaders.append(("Content-Length",str(len(data))))
 		if entity is not None:
@@ -950,6 +1671,37 @@ class Server(app.Server):
 		logging.debug("Content negotiation result: picked %s from %s",repr(returnType),repr(mTypeList))
 		return returnType
 			
+	def IsCompressible(self,contentType):
+		"""Returns True if a response with *contentType* (a string) can
+		be compressed."""
+		try:
+			mType=http.MediaType.FromString(contentType)
+		except http.HTTPParameterError:
+			return False
+		for r in self.CompressibleRanges:
+			if r.MatchMediaType(mType):
+				return True
+		return False
+		
+	def ContentEncodingNegotiation(self,environ,encodings):
+		"""Given a list of content-codings, examines the Accept-Encoding
+		header and returns the best match.
+		
+		If the identity encoding is preferred, or there is no
+		Accept-Encoding header, None is returned.  Badly formed headers
+		are treated as missing."""
+		if "HTTP_ACCEPT_ENCODING" not in environ:
+			return None
+		try:
+			aList=http.AcceptEncodingList.FromString(environ["HTTP_ACCEPT_ENCODING"])
+		except http.HTTPParameterError:
+			return None
+		encoding=aList.SelectToken(encodings+["identity"])
+		if encoding=="identity":
+			return None
+		else:
+			return encoding
+			
 	def CheckCapabilityNegotiation(self,environ,start_response,responseHeaders):
 		"""Sets the protocol version in *responseHeaders* if we can handle this request.
 		
@@ -989,7 +1741,8 @@ class ReadOnlyServer(Server):
 		
 		*	*request* is an :py:class:`ODataURI` instance with a non-empty resourcePath."""
 		method=environ["REQUEST_METHOD"].upper()
-		if method in ("GET","HEAD"):
+		if method in ("GET","HEAD") or request.pathOption==PathOption.batch:
+			# the operations in a batch are checked individually
 			return super(ReadOnlyServer,self).HandleRequest(request,environ,start_response,responseHeaders)
 		else:
 			return self.ODataError(request,environ,start_response,"Unauthorised","Method not allowed",403)
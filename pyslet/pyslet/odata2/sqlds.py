@@ -2,7 +2,7 @@
 """This module implements the Open Data Protocol specification defined by Microsoft."""
 
 
-import sqlite3, hashlib, StringIO, time, string, sys, traceback, threading, decimal, uuid, math, logging
+import sqlite3, hashlib, StringIO, time, string, sys, traceback, threading, decimal, uuid, math, logging, itertools
 from types import *
 
 from pyslet.vfs import OSFilePath
@@ -70,6 +70,7 @@ class SQLParams(object):
 	SQLParams class."""
 	def __init__(self):
 		self.params=None	#: an object suitable for passing to DB API's execute method
+		self.slots=[]		#: the positions of the parameters added with :py:meth:`AddSlot`
 		
 	def AddParam(self,value):
 		"""Adds a value to this set of parameters returning the string to include in the query
@@ -79,6 +80,23 @@ class SQLParams(object):
 			for passing to the underlying DB API."""
 		raise NotImplementedError
 
+	def AddSlot(self,value):
+		"""Adds a value that varies between executions of the same query
+		
+		The return value is as for :py:meth:`AddParam`.  Slots are used
+		for values such as entity keys that are not part of the key
+		used to cache the query in a :py:class:`SQLStatementCache`, the
+		cached query is reused by calling :py:meth:`Rebind` with the
+		new values."""
+		self.slots.append(len(self.params))
+		return self.AddParam(value)
+	
+	def Rebind(self,values):
+		"""Returns a new instance of this class with the same parameters
+		except for those added with :py:meth:`AddSlot`, these are
+		replaced with *values*, a list of values in the same order."""
+		raise NotImplementedError
+
 
 class QMarkParams(SQLParams):
 	"""A class for building parameter lists using '?' syntax."""
@@ -90,16 +108,33 @@ class QMarkParams(SQLParams):
 		self.params.append(value)
 		return "?"	
 
+	def Rebind(self,values):
+		result=self.__class__()
+		result.params=list(self.params)
+		result.slots=self.slots
+		for i,value in zip(self.slots,values):
+			result.params[i]=value
+		return result
+
+
 class NumericParams(SQLParams):
 	"""A class for building parameter lists using ':1', ':2',... syntax"""
 	def __init__(self):
-		super(QMarkParams,self).__init__()
+		super(NumericParams,self).__init__()
 		self.params=[]
 	
 	def AddParam(self,value):
 		self.params.append(value)
 		return ":%i"%len(self.params)
 
+	def Rebind(self,values):
+		result=self.__class__()
+		result.params=list(self.params)
+		result.slots=self.slots
+		for i,value in zip(self.slots,values):
+			result.params[i]=value
+		return result
+
 class NamedParams(SQLParams):
 	"""A class for building parameter lists using ':A', ':B",... syntax
 	
@@ -107,7 +142,7 @@ class NamedParams(SQLParams):
 	support the ordered lists of the other formats we just invent
 	parameter names using ':p1', ':p2', etc."""	
 	def __init__(self):
-		super(QMarkParams,self).__init__()
+		super(NamedParams,self).__init__()
 		self.params={}
 	
 	def AddParam(self,value):
@@ -115,7 +150,78 @@ class NamedParams(SQLParams):
 		self.params[name]=value
 		return ":"+name
 
+	def Rebind(self,values):
+		result=self.__class__()
+		result.params=dict(self.params)
+		result.slots=self.slots
+		for i,value in zip(self.slots,values):
+			result.params["p%i"%i]=value
+		return result
+
 
+class SQLStatementCache(object):
+	"""A cache of generated SQL statements.
+	
+	maxSize
+		The maximum number of statements to cache, defaults to 1024. 
+		When the cache is full it is emptied before the next statement
+		is added.  A maxSize of 0 disables the cache.
+		
+	Each :py:class:`SQLEntityContainer` has a single cache shared by
+	all the collections (and threads) that use it.  Statements are
+	cached as a tuple of (query string, :py:class:`SQLParams` instance)
+	and are keyed on a tuple that describes the collection and operation
+	that generated them (see :py:meth:`SQLCollectionBase.CacheKey`). 
+	Values that vary between uses of the same statement, such as entity
+	keys, are added to the parameters with
+	:py:meth:`SQLParams.AddSlot` and rebound when the statement is
+	reused.
+	
+	Reusing the same query string also allows database modules that
+	cache prepared statements, such as sqlite3, to reuse them."""
+	def __init__(self,maxSize=1024):
+		self.maxSize=maxSize
+		self.statements={}
+		self.hits=0			#: the number of successful look-ups
+		self.misses=0		#: the number of failed look-ups
+		self.lock=threading.RLock()
+		
+	def Get(self,key):
+		"""Returns the cached (query, params) tuple for *key* or None"""
+		with self.lock:
+			result=self.statements.get(key,None)
+			if result is None:
+				self.misses+=1
+			else:
+				self.hits+=1
+			return result
+	
+	def Set(self,key,query,params):
+		"""Adds a statement to the cache"""
+		with self.lock:
+			if len(self.statements)>=self.maxSize:
+				self.statements.clear()
+			if self.maxSize:
+				self.statements[key]=(query,params)
+	
+	def HitRate(self):
+		"""Returns the proportion of look-ups that were successful
+		
+		Returns 0.0 if there have been no look-ups."""
+		with self.lock:
+			total=self.hits+self.misses
+			if total:
+				return float(self.hits)/total
+			else:
+				return 0.0
+	
+	def Clear(self):
+		"""Empties the cache and resets the hit and miss counters"""
+		with self.lock:
+			self.statements.clear()
+			self.hits=self.misses=0
+		
+		
 class SQLTransaction(object):
 	"""Class used to model a transaction.
 	
@@ -175,6 +281,34 @@ class SQLTransaction(object):
 			parameterized values."""
 		self.cursor.execute(sqlCmd,params.params)
 		self.queryCount+=1
+
+	def ExecuteMany(self,sqlCmd,paramsList):
+		"""Executes *sqlCmd* once for each item in *paramsList*
+		
+		sqlCmd
+			A string containing the query
+		
+		paramsList
+			A list of :py:class:`SQLParams` objects, the command is
+			executed using the DB API's executemany method."""
+		self.cursor.executemany(sqlCmd,map(lambda x:x.params,paramsList))
+		self.queryCount+=len(paramsList)
+
+	def FetchRows(self,size=None):
+		"""Generates the rows that result from the last command
+		
+		size
+			The number of rows to fetch from the cursor at a time, using
+			the DB API's fetchmany method.  Defaults to the cursor's
+			arraysize."""
+		if size is None:
+			size=self.cursor.arraysize
+		while True:
+			rows=self.cursor.fetchmany(size)
+			if not rows:
+				break
+			for row in rows:
+				yield row
 	
 	def Commit(self):
 		"""Ends this transaction with a commit
@@ -236,6 +370,77 @@ class SQLTransaction(object):
 			self.queryCount=0
 		
 
+class SQLChangeSetConnection(object):
+	"""A proxy for a database connection that is being used by a
+	:py:class:`SQLChangeSet`.
+	
+	dbc
+		The database connection being proxied.
+	
+	The proxy passes all calls through to *dbc* except commit, which
+	does nothing, and rollback, which rolls back the connection and
+	marks the change set as failed.  In other words, the transactions
+	of the individual operations in the change set all become part of
+	a single transaction that is committed (or rolled back) when the
+	change set ends."""
+	def __init__(self,dbc):
+		self.dbc=dbc			#: the database connection
+		self.failed=False		#: True if the change set has been rolled back
+	
+	def commit(self):
+		pass
+	
+	def rollback(self):
+		self.failed=True
+		self.dbc.rollback()
+		
+	def __getattr__(self,name):
+		return getattr(self.dbc,name)
+
+
+class SQLChangeSet(edm.ChangeSet):
+	"""A change set that executes all its operations in a single
+	database transaction on a single connection.
+
+	container
+		The :py:class:`SQLEntityContainer` that contains the entities.
+	
+	Database connections are shared within a thread so all collections
+	opened in this thread while the change set is in progress use the
+	same connection, see :py:meth:`SQLEntityContainer.StartChangeSet`
+	for details."""
+	Atomic=True
+
+	def __init__(self,container,**kwArgs):
+		super(SQLChangeSet,self).__init__(**kwArgs)
+		self.container=container		#: the parent container (database) for this change set
+		self.dbc=None		#: the connection used by this change set
+	
+	def Begin(self):
+		self.dbc=self.container.AcquireConnection(SQL_TIMEOUT)
+		if self.dbc is None:
+			raise DatabaseBusy("Failed to acquire connection after %is"%SQL_TIMEOUT)
+		self.container.StartChangeSet(self.dbc)
+	
+	def Commit(self):
+		proxy=self.container.StopChangeSet(self.dbc)
+		if proxy.failed:
+			raise SQLError("Change set failed and has been rolled back")
+		self.dbc.commit()
+	
+	def Rollback(self):
+		self.container.StopChangeSet(self.dbc)
+		try:
+			self.dbc.rollback()
+		except self.container.dbapi.NotSupportedError:
+			logging.error("Data Integrity Error: Rollback invoked for change set on a connection that does not support transactions")
+	
+	def close(self):
+		if self.dbc is not None:
+			self.container.ReleaseConnection(self.dbc)
+			self.dbc=None
+		
+
 class SQLCollectionBase(core.EntityCollection):
 	"""A base class to provide core SQL functionality.
 	
@@ -256,10 +461,10 @@ class SQLCollectionBase(core.EntityCollection):
 		self.container=container		#: the parent container (database) for this collection
 		self.tableName=self.container.mangledNames[(self.entitySet.name,)]	#: the quoted table name containing this collection
 		self.qualifyNames=qualifyNames	#: if True, field names in expressions are qualified with :py:attr:`tableName`
+		self._filterKey=None
+		self._orderKey=None
 		self.OrderBy(None)				# force orderNames to be initialised
 		self.dbc=None					#: a connection to the database
-		self._sqlLen=None
-		self._sqlGen=None
 		try:
 			self.dbc=self.container.AcquireConnection(SQL_TIMEOUT)		
 			if self.dbc is None:
@@ -274,16 +479,71 @@ class SQLCollectionBase(core.EntityCollection):
 			self.container.ReleaseConnection(self.dbc)
 			self.dbc=None
 
+	def CacheKey(self,operation,*args):
+		"""Returns a key for caching the SQL generated by an operation
+		
+		operation
+			A string identifying the operation (and therefore the type
+			of SQL statement) being cached.
+		
+		args
+			Any additional values that affect the generated SQL.
+		
+		The key identifies this collection's class, entity set, filter
+		and ordering.  The filter and orderby expressions are included
+		using :py:meth:`core.CommonExpression.ExactKey` because their
+		literals are not rebound when a cached statement is reused (the
+		string forms can't be used as they lose precision).  Any other
+		values used as parameters must
+		be added using :py:meth:`SQLParams.AddSlot` so that they can be
+		rebound when the statement is reused.  The results of
+		:py:meth:`FieldGenerator` do not need to be included as entities
+		are always created with all properties selected."""
+		if self._filterKey is None:
+			self._filterKey=() if self.filter is None else self.filter.ExactKey()
+		if self._orderKey is None:
+			self._orderKey=() if self.orderby is None else core.CommonExpression.OrderByKey(self.orderby)
+		return (self.__class__,self.entitySet.name,self.qualifyNames,self._filterKey,self._orderKey,operation)+args
+
+	def CachedQuery(self,key,entity=None,useSkip=False,skip=0,top=None):
+		"""Returns a cached statement as a tuple of (query, params) or None
+		
+		key
+			The key of the statement (see :py:meth:`CacheKey`)
+		
+		entity and useSkip
+			The entity and skip options that would be passed to
+			:py:meth:`WhereClause` to generate the statement.
+		
+		skip and top
+			The values that would be passed to :py:meth:`LimitClause`
+			to generate the statement (if it has a limit clause).
+		
+		These arguments are used to calculate the new values of the
+		slots in the cached statement's parameters."""
+		result=self.container.sqlCache.Get(key)
+		if result is not None:
+			query,params=result
+			# calculate the values of the slots without the filter
+			slots=QMarkParams()
+			self.WhereClause(entity,slots,useFilter=False,useSkip=useSkip)
+			if skip or top is not None:
+				self.LimitClause(skip,top,slots)
+			result=query,params.Rebind(slots.params)
+		return result
+		
 	def __len__(self):
-		if self._sqlLen is None:
+		key=self.CacheKey('len')
+		result=self.CachedQuery(key)
+		if result is None:
 			query=["SELECT COUNT(*) FROM %s"%self.tableName]
 			params=self.container.ParamsClass()
 			query.append(self.JoinClause())
 			query.append(self.WhereClause(None,params))
 			query=string.join(query,'')
-			self._sqlLen=(query,params)
+			self.container.sqlCache.Set(key,query,params)
 		else:
-			query,params=self._sqlLen
+			query,params=result
 		transaction=SQLTransaction(self.container.dbapi,self.dbc)
 		try:
 			transaction.Begin()
@@ -303,7 +563,9 @@ class SQLCollectionBase(core.EntityCollection):
 
 	def entityGenerator(self):
 		entity,values=None,None
-		if self._sqlGen is None:
+		key=self.CacheKey('gen')
+		result=self.CachedQuery(key)
+		if result is None:
 			entity=self.NewEntity()
 			query=["SELECT "]
 			params=self.container.ParamsClass()
@@ -318,18 +580,15 @@ class SQLCollectionBase(core.EntityCollection):
 			query.append(self.WhereClause(None,params,useFilter=True,useSkip=False))
 			query.append(self.OrderByClause())
 			query=string.join(query,'')
-			self._sqlGen=query,params
+			self.container.sqlCache.Set(key,query,params)
 		else:
-			query,params=self._sqlGen
+			query,params=result
 		transaction=SQLTransaction(self.container.dbapi,self.dbc)
 		try:
 			transaction.Begin()
 			logging.info("%s; %s",query,unicode(params.params))
 			transaction.Execute(query,params)
-			while True:
-				row=transaction.cursor.fetchone()
-				if row is None:
-					break
+			for row in transaction.FetchRows(self.FetchSize):
 				if entity is None:
 					entity=self.NewEntity()
 					values=zip(*list(self.FieldGenerator(entity)))[1]
@@ -350,6 +609,78 @@ class SQLCollectionBase(core.EntityCollection):
 		return self.ExpandEntities(
 			self.entityGenerator())
 
+	ExpandBatchSize=256
+	"""The maximum number of entities expanded together by
+	:py:meth:`ExpandEntities`.  Compound keys add one parameter per key
+	property to the expansion query so this value should be kept well
+	below the database's limit on the number of query parameters."""
+	
+	def ExpandEntities(self,entityIterable):
+		"""Overridden to expand navigation properties in bulk.
+		
+		Entities are read from *entityIterable* in batches of up to
+		:py:attr:`ExpandBatchSize` and each navigation property being
+		expanded is loaded for the whole batch using a single query (see
+		:py:meth:`SQLNavigationCollection.ExpansionGenerator`) rather
+		than with one query per entity.  The number of queries used to
+		expand a page of entities is therefore independent of the page
+		size."""
+		if not self.expand:
+			for entity in super(SQLCollectionBase,self).ExpandEntities(entityIterable):
+				yield entity
+			return
+		batch=[]
+		for entity in entityIterable:
+			batch.append(entity)
+			if len(batch)>=self.ExpandBatchSize:
+				self.ExpandBatch(batch)
+				for entity in batch:
+					yield entity
+				batch=[]
+		if batch:
+			self.ExpandBatch(batch)
+			for entity in batch:
+				yield entity
+	
+	def ExpandBatch(self,entities):
+		"""Applies the :py:attr:`expand` and :py:attr:`select` rules to
+		a list of *entities* from this collection.
+		
+		Navigation properties that are bound to SQL collections in the
+		same container are expanded with one query per property, other
+		navigation properties are expanded one entity at a time."""
+		if self.select is None:
+			select={}
+		else:
+			select=self.select
+		for entity in entities:
+			# apply the select rules only
+			entity.Expand(None,self.select)
+		for name,subExpand in self.expand.iteritems():
+			if name in select:
+				subSelect=select[name]
+				if subSelect is None:
+					# $select=Orders&$expand=Orders/OrderLines => $select=Orders/*
+					subSelect={'*':None}
+			else:
+				subSelect=None
+			with self.entitySet.OpenNavigation(name,entities[0]) as collection:
+				if not isinstance(collection,SQLNavigationCollection) or collection.container is not self.container:
+					for entity in entities:
+						entity[name].ExpandCollection(subExpand,subSelect)
+					continue
+				collection.Expand(subExpand,subSelect)
+				targets={}
+				expansion=list(collection.ExpansionGenerator(entities))
+				# chained expansions are also done in bulk
+				for target in collection.ExpandEntities(map(lambda x:x[1],expansion)):
+					pass
+				for key,target in expansion:
+					targets.setdefault(key,[]).append(target)
+				for entity in entities:
+					entity[name].SetExpansion(core.ExpandedEntityCollection(fromEntity=entity,name=name,
+						entitySet=collection.entitySet,entityList=targets.get(entity.Key(),[])))
+
 	def SetPage(self,top,skip=0,skiptoken=None):
 		"""Sets the values for paging.
 		
@@ -410,35 +741,46 @@ class SQLCollectionBase(core.EntityCollection):
 		if self.top==0:
 			# end of paging
 			return
-		entity=self.NewEntity()
-		query=["SELECT "]
-		params=self.container.ParamsClass()
-		columnNames,values=zip(*list(self.FieldGenerator(entity)))
-		columnNames=list(columnNames)
-		self.OrderByCols(columnNames,params,True)
-		query.append(string.join(columnNames,", "))
-		query.append(' FROM ')
-		query.append(self.tableName)
-		query.append(self.JoinClause())
-		query.append(self.WhereClause(None,params,useFilter=True,useSkip=True))
-		query.append(self.OrderByClause())
-		query=string.join(query,'')
+		entity,values=None,None
+		top=self.top
+		if self.topmax is not None and (top is None or self.topmax<top):
+			top=self.topmax
+		skip=self.skip
+		if skip is None:
+			skip=0
+		key=self.CacheKey('page',self.skiptoken is not None,skip>0,top is not None)
+		result=self.CachedQuery(key,useSkip=True,skip=skip,top=top)
+		if result is None:
+			entity=self.NewEntity()
+			query=["SELECT "]
+			params=self.container.ParamsClass()
+			columnNames,values=zip(*list(self.FieldGenerator(entity)))
+			columnNames=list(columnNames)
+			self.OrderByCols(columnNames,params,True)
+			query.append(string.join(columnNames,", "))
+			query.append(' FROM ')
+			query.append(self.tableName)
+			query.append(self.JoinClause())
+			query.append(self.WhereClause(None,params,useFilter=True,useSkip=True))
+			query.append(self.OrderByClause())
+			query.append(self.LimitClause(skip,top,params)[1])
+			query=string.join(query,'')
+			self.container.sqlCache.Set(key,query,params)
+		else:
+			query,params=result
+		# any rows not skipped by the database must be skipped here
+		skip=self.LimitClause(skip,top,QMarkParams())[0]
+		fetchSize=self.FetchSize
+		if top is not None and top+skip<fetchSize:
+			fetchSize=top+skip
 		transaction=SQLTransaction(self.container.dbapi,self.dbc)
 		try:
-			skip=self.skip
 			top=self.top
 			topmax=self.topmax
 			transaction.Begin()
 			logging.info("%s; %s",query,unicode(params.params))
 			transaction.Execute(query,params)
-			while True:
-				row=transaction.cursor.fetchone()
-				if row is None:
-					# no more pages
-					if setNextPage:
-						self.top=self.skip=0
-						self.skipToken=None
-					break
+			for row in transaction.FetchRows(fetchSize):
 				if skip:
 					skip=skip-1
 					continue
@@ -467,7 +809,7 @@ class SQLCollectionBase(core.EntityCollection):
 							# ditch this one, copy the previous one and add a skip
 							self.nextSkiptoken=list(self.skiptoken)
 							v=edm.Int32Value()
-							v.SetFromValue(self.topmax)
+							v.SetFromValue((self.skip or 0)+self.topmax)
 							self.nextSkiptoken.append(v)
 						if setNextPage:
 							self.skiptoken=self.nextSkiptoken
@@ -483,6 +825,11 @@ class SQLCollectionBase(core.EntityCollection):
 								self.skip=self.top
 						break
 				entity=None
+			else:
+				# no more pages
+				if setNextPage:
+					self.top=self.skip=0
+					self.skipToken=None
 			# we haven't changed the database, but we don't want to
 			# leave the connection idle in transaction
 			transaction.Commit()
@@ -498,15 +845,21 @@ class SQLCollectionBase(core.EntityCollection):
 	def __getitem__(self,key):
 		entity=self.NewEntity()
 		entity.SetKey(key)
-		params=self.container.ParamsClass()
-		query=["SELECT "]
+		cacheKey=self.CacheKey('get')
+		result=self.CachedQuery(cacheKey,entity)
 		columnNames,values=zip(*list(self.FieldGenerator(entity)))
-		query.append(string.join(columnNames,", "))
-		query.append(' FROM ')
-		query.append(self.tableName)
-		query.append(self.JoinClause())
-		query.append(self.WhereClause(entity,params))
-		query=string.join(query,'')
+		if result is None:
+			params=self.container.ParamsClass()
+			query=["SELECT "]
+			query.append(string.join(columnNames,", "))
+			query.append(' FROM ')
+			query.append(self.tableName)
+			query.append(self.JoinClause())
+			query.append(self.WhereClause(entity,params))
+			query=string.join(query,'')
+			self.container.sqlCache.Set(cacheKey,query,params)
+		else:
+			query,params=result
 		transaction=SQLTransaction(self.container.dbapi,self.dbc)
 		try:
 			transaction.Begin()
@@ -530,6 +883,76 @@ class SQLCollectionBase(core.EntityCollection):
 		finally:
 			transaction.Close()
 	
+	LookupBatchSize=256
+	"""The maximum number of keys looked up by a single query in
+	:py:meth:`ExistingKeys`.  Compound keys add one parameter per key
+	property to the query so this value should be kept well below the
+	database's limit on the number of query parameters."""
+	
+	def ExistingKeys(self,keys):
+		"""Returns the set of keys in *keys* that identify entities in
+		this collection.
+		
+		keys
+			A list of keys, each a single value or a tuple of values as
+			returned by :py:meth:`pyslet.odata2.csdl.Entity.Key`.
+		
+		The keys are looked up in batches of :py:attr:`LookupBatchSize`
+		using one query per batch rather than one query per key.  The
+		filter and paging settings of this collection are ignored."""
+		entity=self.NewEntity()
+		keyValues=map(lambda x:entity[x],self.entitySet.keys)
+		keyColumns=map(lambda x:self.container.mangledNames[(self.entitySet.name,x)],self.entitySet.keys)
+		result=set()
+		transaction=SQLTransaction(self.container.dbapi,self.dbc)
+		try:
+			transaction.Begin()
+			for i in xrange(0,len(keys),self.LookupBatchSize):
+				batch=keys[i:i+self.LookupBatchSize]
+				slots=[]
+				for key in batch:
+					entity.SetKey(key)
+					for value in keyValues:
+						slots.append(self.container.PrepareSQLValue(value))
+				cacheKey=self.CacheKey('lookup',len(batch))
+				cached=self.container.sqlCache.Get(cacheKey)
+				if cached is None:
+					query=["SELECT "]
+					params=self.container.ParamsClass()
+					query.append(string.join(keyColumns,", "))
+					query.append(' FROM ')
+					query.append(self.tableName)
+					if len(keyColumns)==1:
+						keyList=map(lambda x:params.AddSlot(x),slots)
+						query.append(" WHERE %s IN (%s)"%(keyColumns[0],string.join(keyList,", ")))
+					else:
+						where=[]
+						j=0
+						for key in batch:
+							keyMatch=[]
+							for keyColumn in keyColumns:
+								keyMatch.append("%s=%s"%(keyColumn,params.AddSlot(slots[j])))
+								j+=1
+							where.append("(%s)"%string.join(keyMatch,' AND '))
+						query.append(" WHERE %s"%string.join(where,' OR '))
+					query=string.join(query,'')
+					self.container.sqlCache.Set(cacheKey,query,params)
+				else:
+					query,params=cached
+					params=params.Rebind(slots)
+				logging.info("%s; %s",query,unicode(params.params))
+				transaction.Execute(query,params)
+				for row in transaction.FetchRows(self.FetchSize):
+					for value,newValue in zip(keyValues,row):
+						self.container.ReadSQLValue(value,newValue)
+					result.add(entity.Key())
+			transaction.Commit()
+			return result
+		except Exception as e:
+			transaction.Rollback(e)
+		finally:
+			transaction.Close()
+	
 	def JoinClause(self):
 		"""A utility method to return the JOIN clause.
 		
@@ -539,8 +962,7 @@ class SQLCollectionBase(core.EntityCollection):
 	def Filter(self,filter):
 		self.filter=filter
 		self.SetPage(None)
-		self._sqlLen=None
-		self._sqlGen=None
+		self._filterKey=None
 
 	def WhereClause(self,entity,params,useFilter=True,useSkip=False,nullCols=()):
 		"""A utility method that generates the WHERE clause for a query
@@ -603,7 +1025,7 @@ class SQLCollectionBase(core.EntityCollection):
 		entity
 			An expression is added to restrict the query to this entity"""
 		for k,v in entity.KeyDict().items():
-			where.append('%s=%s'%(self.container.mangledNames[(self.entitySet.name,k)],params.AddParam(self.container.PrepareSQLValue(v))))
+			where.append('%s=%s'%(self.container.mangledNames[(self.entitySet.name,k)],params.AddSlot(self.container.PrepareSQLValue(v))))
 	
 	def WhereSkiptokenClause(self,where,params):
 		"""Adds the entity constraint expression to a list of SQL expressions.
@@ -616,12 +1038,12 @@ class SQLCollectionBase(core.EntityCollection):
 			oName,dir=self.orderNames[i]
 			v=self.skiptoken[i]
 			op=">" if dir>0 else "<"
-			skipExpression.append("(%s %s %s"%(oName,op,params.AddParam(self.container.PrepareSQLValue(v))))
+			skipExpression.append("(%s %s %s"%(oName,op,params.AddSlot(self.container.PrepareSQLValue(v))))
 			ket+=1
 			i+=1
 			if i<len(self.orderNames):
 				# more to come
-				skipExpression.append(" OR (%s = %s AND "%(oName,params.AddParam(self.container.PrepareSQLValue(v))))
+				skipExpression.append(" OR (%s = %s AND "%(oName,params.AddSlot(self.container.PrepareSQLValue(v))))
 				ket+=1
 				continue
 			else:
@@ -664,8 +1086,36 @@ class SQLCollectionBase(core.EntityCollection):
 			if self.qualifyNames:
 				mangledName="%s.%s"%(self.tableName,mangledName)
 			self.orderNames.append((mangledName,1))
-		self._sqlGen=None
+		self._orderKey=None
+		
+	def LimitClause(self,skip,top,params):
+		"""A utility method to return the clause that limits the rows returned
+		
+		skip
+			The number of rows to skip (an integer, may be 0)
 		
+		top
+			The maximum number of rows to return or None if there is no
+			limit.
+		
+		params
+			The :py:class:`SQLParams` object to add parameters to.
+		
+		Returns a tuple of (skip, clause) where skip is the number of
+		rows that the caller must still discard from the result and
+		clause is a string to add to the end of the SELECT statement.
+		
+		There is no portable syntax for this clause so the default
+		implementation returns (skip, '') and the rows are skipped by
+		the caller.  Dialects that support LIMIT and OFFSET, or
+		equivalents, should override this method.  Any values should
+		be added using :py:meth:`SQLParams.AddSlot`."""
+		return skip,''
+	
+	FetchSize=256
+	"""The number of rows fetched from the database at a time when
+	iterating through query results."""
+	
 	def OrderByClause(self):
 		"""A utility method to return the orderby clause.
 		
@@ -1219,101 +1669,17 @@ class SQLEntityCollection(SQLCollectionBase):
 			transaction=SQLTransaction(self.container.dbapi,self.dbc)
 		if entity.exists:
 			raise edm.EntityExists(str(entity.GetLocation()))
-		# We must also go through each bound navigation property of our
-		# own and add in the foreign keys for forward links.
-		if fkValues is None:
-			fkValues=[]
-		fkMapping=self.container.fkTable[self.entitySet.name]
 		try:
 			transaction.Begin()
-			navigationDone=set()
-			for linkEnd,navName in self.entitySet.linkEnds.iteritems():
-				if navName:
-					dv=entity[navName]			
-				if linkEnd.otherEnd.associationEnd.multiplicity==edm.Multiplicity.One:
-					# a required association
-					if linkEnd==fromEnd:
-						continue
-					if navName is None:
-						# unbound principal; can only be created from this association
-						raise edm.NavigationError("Entities in %s can only be created from their principal"%self.entitySet.name)
-					if not dv.bindings:
-						raise edm.NavigationError("Required navigation property %s of %s is not bound"%(navName,self.entitySet.name))
-				associationSetName=linkEnd.parent.name
-				# if linkEnd is in fkMapping it means we are keeping a
-				# foreign key for this property, it may even be required but
-				# either way, let's deal with it now.  We're only interested
-				# in associations that are bound to navigation properties.
-				if linkEnd not in fkMapping or navName is None:
-					continue
-				nullable,unique=fkMapping[linkEnd]
-				targetSet=linkEnd.otherEnd.entitySet
-				if len(dv.bindings)==0:
-					#	we've already checked the case where nullable is False above
-					continue
-				elif len(dv.bindings)>1:
-					raise edm.NavigationError("Unexpected error: found multiple bindings for foreign key constraint %s"%navName)
-				binding=dv.bindings[0]
-				if not isinstance(binding,edm.Entity):
-					# just a key, grab the entity
-					with targetSet.OpenCollection() as targetCollection:
-						targetCollection.SelectKeys()
-						targetEntity=targetCollection[binding]
-					dv.bindings[0]=targetEntity
-				else:
-					targetEntity=binding
-					if not targetEntity.exists:
-						# add this entity to it's base collection
-						with targetSet.OpenCollection() as targetCollection:
-							targetCollection.InsertEntitySQL(targetEntity,linkEnd.otherEnd,transaction=transaction)
-				# Finally, we have a target entity, add the foreign key to fkValues
-				for keyName in targetSet.keys:
-					fkValues.append((self.container.mangledNames[(self.entitySet.name,associationSetName,keyName)],targetEntity[keyName]))
-				navigationDone.add(navName)
+			# Step 1
+			fkValues,navigationDone=self.InsertFKBindings(entity,fromEnd,fkValues,transaction)
 			# Step 2
-			entity.SetConcurrencyTokens()
-			query=['INSERT INTO ',self.tableName,' (']
-			columnNames,values=zip(*(list(self.FieldGenerator(entity))+fkValues))
-			query.append(string.join(columnNames,", "))
-			query.append(') VALUES (')
-			params=self.container.ParamsClass()
-			query.append(string.join(map(lambda x:params.AddParam(self.container.PrepareSQLValue(x)),values),", "))
-			query.append(');')
-			query=string.join(query,'')
+			query,params=self.InsertQuery(entity,fkValues)
 			logging.info("%s; %s",query,unicode(params.params))
 			transaction.Execute(query,params)
 			entity.exists=True
 			# Step 3
-			for k,dv in entity.NavigationItems():
-				linkEnd=self.entitySet.navigation[k]
-				if not dv.bindings:
-					continue
-				elif k in navigationDone:
-					dv.bindings=[]
-					continue
-				associationSetName=linkEnd.parent.name
-				targetSet=dv.Target()
-				targetFKMapping=self.container.fkTable[targetSet.name]
-				with dv.OpenCollection() as navCollection, targetSet.OpenCollection() as targetCollection:
-					while dv.bindings:
-						binding=dv.bindings[0]
-						if not isinstance(binding,edm.Entity):
-							targetCollection.SelectKeys()
-							binding=targetCollection[binding]
-						if binding.exists:
-							navCollection.InsertLink(binding,transaction)
-						else:
-							if linkEnd.otherEnd in targetFKMapping:
-								# target table has a foreign key
-								targetFKValues=[]
-								for keyName in self.entitySet.keys:
-									targetFKValues.append((self.container.mangledNames[(targetSet.name,associationSetName,keyName)],entity[keyName]))
-								targetCollection.InsertEntitySQL(binding,linkEnd.otherEnd,targetFKValues,transaction=transaction)
-							else:
-								# foreign keys are in an auxiliary table
-								targetCollection.InsertEntitySQL(binding,linkEnd.otherEnd,transaction=transaction)
-								navCollection.InsertLink(binding,transaction)
-						dv.bindings=dv.bindings[1:]
+			self.InsertBindings(entity,navigationDone,transaction)
 			transaction.Commit()
 		except self.container.dbapi.IntegrityError as e:
 			# we might need to distinguish between a failure due to fkValues or a missing key
@@ -1327,6 +1693,258 @@ class SQLEntityCollection(SQLCollectionBase):
 			transaction.Rollback(e)
 		finally:
 			transaction.Close()
+
+	InsertBatchSize=1000
+	"""The maximum number of entities inserted by a single call to the
+	DB API's executemany method, see :py:meth:`InsertEntities`."""
+	
+	def InsertEntities(self,entities,batchSize=None,transaction=None):
+		"""Inserts all the entities in the iterable *entities*
+		
+		batchSize
+			The maximum number of rows to insert with a single
+			executemany call, defaults to :py:attr:`InsertBatchSize`.
+		
+		transaction
+			An optional transaction.  If present, the connection is left
+			uncommitted.
+		
+		The entities are inserted in a single transaction using the
+		same three phases as :py:meth:`InsertEntitySQL`.  The INSERT
+		statements of step 2 are queued and executed in batches using
+		executemany, consecutive entities with the same set of columns
+		sharing a single statement.  Before step 1, bindings to the keys
+		of existing entities are checked for each batch with a single
+		query, see :py:meth:`ResolveFKBindings`.  Step 3 bindings, which require the
+		entity to exist in the database, are processed for each batch
+		after the batch has been executed.
+		
+		If the insert fails then the whole transaction is rolled back. 
+		A :py:class:`pyslet.odata2.csdl.ConstraintError` is raised if
+		the database reports an integrity error, in which case it is not
+		possible to tell which entity in a batch caused the failure and
+		the entities should be discarded."""
+		if batchSize is None:
+			batchSize=self.InsertBatchSize
+		if transaction is None:
+			transaction=SQLTransaction(self.container.dbapi,self.dbc)
+		entities=iter(entities)
+		batch=[]
+		batchQuery=None
+		batchParams=[]
+		try:
+			transaction.Begin()
+			while True:
+				chunk=list(itertools.islice(entities,batchSize))
+				if not chunk:
+					break
+				for entity in chunk:
+					if entity.exists:
+						raise edm.EntityExists(str(entity.GetLocation()))
+				self.ResolveFKBindings(chunk)
+				for entity in chunk:
+					fkValues,navigationDone=self.InsertFKBindings(entity,None,None,transaction)
+					query,params=self.InsertQuery(entity,fkValues)
+					if batch and (query!=batchQuery or len(batch)>=batchSize):
+						self.InsertBatch(batch,batchQuery,batchParams,transaction)
+						batch=[]
+						batchParams=[]
+					batchQuery=query
+					batch.append((entity,navigationDone))
+					batchParams.append(params)
+			if batch:
+				self.InsertBatch(batch,batchQuery,batchParams,transaction)
+			transaction.Commit()
+		except self.container.dbapi.IntegrityError as e:
+			transaction.Rollback(e,swallowErr=True)
+			raise edm.ConstraintError("InsertEntities failed for %s : %s"%(self.entitySet.name,str(e)))
+		except Exception as e:
+			transaction.Rollback(e)
+		finally:
+			transaction.Close()
+	
+	def InsertBatch(self,batch,query,paramsList,transaction):
+		"""Executes a batch of INSERT statements queued by :py:meth:`InsertEntities`
+		
+		batch
+			A list of (entity, navigationDone) tuples, where
+			navigationDone is the set returned by
+			:py:meth:`InsertFKBindings`
+		
+		query
+			The INSERT statement shared by all entities in the batch
+		
+		paramsList
+			A list of :py:class:`SQLParams` instances, one per entity.
+		
+		transaction
+			The transaction in which to execute the batch."""
+		logging.info("%s; %i rows",query,len(paramsList))
+		transaction.ExecuteMany(query,paramsList)
+		for entity,navigationDone in batch:
+			entity.exists=True
+			self.InsertBindings(entity,navigationDone,transaction)
+		
+	def ResolveFKBindings(self,entities):
+		"""Resolves the key bindings of a batch of new *entities*
+		
+		This method is used by :py:meth:`InsertEntities` before step 1
+		of :py:meth:`InsertEntitySQL`.  Navigation properties for which
+		we hold the foreign key may be bound to the key of an existing
+		target entity rather than to the entity itself.
+		:py:meth:`InsertFKBindings` would check each such key with a
+		separate query, instead the keys are checked for the whole
+		batch using :py:meth:`SQLCollectionBase.ExistingKeys` and each
+		binding is replaced by an entity with just its key selected.
+		
+		KeyError is raised if a bound key does not exist."""
+		fkMapping=self.container.fkTable[self.entitySet.name]
+		for linkEnd,navName in self.entitySet.linkEnds.iteritems():
+			if navName is None or linkEnd not in fkMapping:
+				continue
+			with linkEnd.otherEnd.entitySet.OpenCollection() as targetCollection:
+				targetCollection.SelectKeys()
+				targets=[]
+				for entity in entities:
+					dv=entity[navName]
+					if len(dv.bindings)==1 and not isinstance(dv.bindings[0],edm.Entity):
+						targetEntity=targetCollection.NewEntity()
+						targetEntity.SetKey(dv.bindings[0])
+						targetEntity.Expand(targetCollection.expand,targetCollection.select)
+						dv.bindings[0]=targetEntity
+						targets.append(targetEntity)
+				if not targets:
+					continue
+				existing=targetCollection.ExistingKeys(map(lambda x:x.Key(),targets))
+				for targetEntity in targets:
+					if targetEntity.Key() not in existing:
+						raise KeyError(targetEntity.Key())
+					targetEntity.exists=True
+	
+	def InsertFKBindings(self,entity,fromEnd,fkValues,transaction):
+		"""Processes the bindings for which we hold the foreign key
+		
+		This method implements step 1 of :py:meth:`InsertEntitySQL`,
+		the arguments are as described there.  Returns a tuple of::
+		
+			( fkValues, navigationDone )
+		
+		fkValues is a list of (mangled column name, value) tuples to add
+		to the INSERT statement and navigationDone is the set of
+		navigation property names that have been dealt with."""
+		# We must also go through each bound navigation property of our
+		# own and add in the foreign keys for forward links.
+		if fkValues is None:
+			fkValues=[]
+		fkMapping=self.container.fkTable[self.entitySet.name]
+		navigationDone=set()
+		for linkEnd,navName in self.entitySet.linkEnds.iteritems():
+			if navName:
+				dv=entity[navName]			
+			if linkEnd.otherEnd.associationEnd.multiplicity==edm.Multiplicity.One:
+				# a required association
+				if linkEnd==fromEnd:
+					continue
+				if navName is None:
+					# unbound principal; can only be created from this association
+					raise edm.NavigationError("Entities in %s can only be created from their principal"%self.entitySet.name)
+				if not dv.bindings:
+					raise edm.NavigationError("Required navigation property %s of %s is not bound"%(navName,self.entitySet.name))
+			associationSetName=linkEnd.parent.name
+			# if linkEnd is in fkMapping it means we are keeping a
+			# foreign key for this property, it may even be required but
+			# either way, let's deal with it now.  We're only interested
+			# in associations that are bound to navigation properties.
+			if linkEnd not in fkMapping or navName is None:
+				continue
+			nullable,unique=fkMapping[linkEnd]
+			targetSet=linkEnd.otherEnd.entitySet
+			if len(dv.bindings)==0:
+				#	we've already checked the case where nullable is False above
+				continue
+			elif len(dv.bindings)>1:
+				raise edm.NavigationError("Unexpected error: found multiple bindings for foreign key constraint %s"%navName)
+			binding=dv.bindings[0]
+			if not isinstance(binding,edm.Entity):
+				# just a key, grab the entity
+				with targetSet.OpenCollection() as targetCollection:
+					targetCollection.SelectKeys()
+					targetEntity=targetCollection[binding]
+				dv.bindings[0]=targetEntity
+			else:
+				targetEntity=binding
+				if not targetEntity.exists:
+					# add this entity to it's base collection
+					with targetSet.OpenCollection() as targetCollection:
+						targetCollection.InsertEntitySQL(targetEntity,linkEnd.otherEnd,transaction=transaction)
+			# Finally, we have a target entity, add the foreign key to fkValues
+			for keyName in targetSet.keys:
+				fkValues.append((self.container.mangledNames[(self.entitySet.name,associationSetName,keyName)],targetEntity[keyName]))
+			navigationDone.add(navName)
+		return fkValues,navigationDone
+	
+	def InsertQuery(self,entity,fkValues):
+		"""Returns a tuple of (query, params) for inserting *entity*
+		
+		This method implements step 2 of :py:meth:`InsertEntitySQL`,
+		it sets the concurrency tokens of *entity* and generates the
+		INSERT statement, including the additional columns in
+		*fkValues*."""
+		entity.SetConcurrencyTokens()
+		columnNames,values=zip(*(list(self.FieldGenerator(entity))+fkValues))
+		values=map(lambda x:self.container.PrepareSQLValue(x),values)
+		key=self.CacheKey('insert',columnNames)
+		result=self.container.sqlCache.Get(key)
+		if result is None:
+			query=['INSERT INTO ',self.tableName,' (']
+			query.append(string.join(columnNames,", "))
+			query.append(') VALUES (')
+			params=self.container.ParamsClass()
+			query.append(string.join(map(lambda x:params.AddSlot(x),values),", "))
+			query.append(');')
+			query=string.join(query,'')
+			self.container.sqlCache.Set(key,query,params)
+		else:
+			query,params=result
+			params=params.Rebind(values)
+		return query,params
+		
+	def InsertBindings(self,entity,navigationDone,transaction):
+		"""Processes the remaining bindings of a newly inserted *entity*
+		
+		This method implements step 3 of :py:meth:`InsertEntitySQL`,
+		navigationDone is the set of navigation property names returned
+		by :py:meth:`InsertFKBindings`."""
+		for k,dv in entity.NavigationItems():
+			linkEnd=self.entitySet.navigation[k]
+			if not dv.bindings:
+				continue
+			elif k in navigationDone:
+				dv.bindings=[]
+				continue
+			associationSetName=linkEnd.parent.name
+			targetSet=dv.Target()
+			targetFKMapping=self.container.fkTable[targetSet.name]
+			with dv.OpenCollection() as navCollection, targetSet.OpenCollection() as targetCollection:
+				while dv.bindings:
+					binding=dv.bindings[0]
+					if not isinstance(binding,edm.Entity):
+						targetCollection.SelectKeys()
+						binding=targetCollection[binding]
+					if binding.exists:
+						navCollection.InsertLink(binding,transaction)
+					else:
+						if linkEnd.otherEnd in targetFKMapping:
+							# target table has a foreign key
+							targetFKValues=[]
+							for keyName in self.entitySet.keys:
+								targetFKValues.append((self.container.mangledNames[(targetSet.name,associationSetName,keyName)],entity[keyName]))
+							targetCollection.InsertEntitySQL(binding,linkEnd.otherEnd,targetFKValues,transaction=transaction)
+						else:
+							# foreign keys are in an auxiliary table
+							targetCollection.InsertEntitySQL(binding,linkEnd.otherEnd,transaction=transaction)
+							navCollection.InsertLink(binding,transaction)
+					dv.bindings=dv.bindings[1:]
 																
 	def UpdateEntity(self,entity):
 		"""Updates *entity*
@@ -1866,6 +2484,93 @@ class SQLNavigationCollection(SQLCollectionBase,core.NavigationCollection):
 			uncommitted."""
 		raise NotImplementedError
 	
+	def CacheKey(self,operation,*args):
+		"""Overridden to add the source entity set and navigation property"""
+		return super(SQLNavigationCollection,self).CacheKey(operation,self.fromEntity.entitySet.name,self.name,*args)
+
+	def FromKeyColumns(self):
+		"""A utility method that returns a list of the (qualified) column
+		names that hold the key of the source entity, in the order of
+		the source entity set's keys.
+		
+		These are the columns constrained by :py:meth:`WhereClause` to
+		match the key of :py:attr:`fromEntity`."""
+		raise NotImplementedError
+		
+	def ExpansionGenerator(self,fromEntities):
+		"""A generator used to expand navigation properties in bulk.
+		
+		fromEntities
+			A list of entities from the source entity set, typically
+			including :py:attr:`fromEntity`.
+		
+		Yields tuples of (source key, target entity) for every entity
+		linked from any of *fromEntities* using a single query.  The
+		source key is a single value or a tuple of values as returned by
+		:py:meth:`pyslet.odata2.csdl.Entity.Key`.  The filter and paging
+		settings of this collection are ignored."""
+		entity=self.NewEntity()
+		columnNames,values=zip(*list(self.FieldGenerator(entity)))
+		keyColumns=self.FromKeyColumns()
+		keyValues=map(lambda x:edm.EDMValue.NewValue(self.fromEntity[x].pDef),self.fromEntity.entitySet.keys)
+		slots=[]
+		for fromEntity in fromEntities:
+			for k in self.fromEntity.entitySet.keys:
+				slots.append(self.container.PrepareSQLValue(fromEntity[k]))
+		key=self.CacheKey('expand',len(fromEntities))
+		result=self.container.sqlCache.Get(key)
+		if result is None:
+			query=["SELECT "]
+			params=self.container.ParamsClass()
+			query.append(string.join(list(columnNames)+keyColumns,", "))
+			query.append(' FROM ')
+			query.append(self.tableName)
+			query.append(self.JoinClause())
+			if len(keyColumns)==1:
+				keyList=map(lambda x:params.AddSlot(x),slots)
+				query.append(" WHERE %s IN (%s)"%(keyColumns[0],string.join(keyList,", ")))
+			else:
+				where=[]
+				i=0
+				for fromEntity in fromEntities:
+					keyMatch=[]
+					for keyColumn in keyColumns:
+						keyMatch.append("%s=%s"%(keyColumn,params.AddSlot(slots[i])))
+						i+=1
+					where.append("(%s)"%string.join(keyMatch,' AND '))
+				query.append(" WHERE %s"%string.join(where,' OR '))
+			query.append(self.OrderByClause())
+			query=string.join(query,'')
+			self.container.sqlCache.Set(key,query,params)
+		else:
+			query,params=result
+			params=params.Rebind(slots)
+		nValues=len(values)
+		transaction=SQLTransaction(self.container.dbapi,self.dbc)
+		try:
+			transaction.Begin()
+			logging.info("%s; %s",query,unicode(params.params))
+			transaction.Execute(query,params)
+			for row in transaction.FetchRows(self.FetchSize):
+				if entity is None:
+					entity=self.NewEntity()
+					values=zip(*list(self.FieldGenerator(entity)))[1]
+				for value,newValue in zip(values,row):
+					self.container.ReadSQLValue(value,newValue)
+				entity.exists=True
+				for value,newValue in zip(keyValues,row[nValues:]):
+					self.container.ReadSQLValue(value,newValue)
+				if len(keyValues)==1:
+					yield keyValues[0].value,entity
+				else:
+					yield tuple(map(lambda x:x.value,keyValues)),entity
+				entity,values=None,None
+			transaction.Commit()
+		except Exception as e:
+			transaction.Rollback(e)
+		finally:
+			transaction.Close()
+
 
 class SQLForeignKeyCollection(SQLNavigationCollection):
 	"""The collection of entities obtained by navigation via a foreign key
@@ -1952,6 +2657,11 @@ class SQLForeignKeyCollection(SQLNavigationCollection):
 		return ' INNER JOIN %s AS %s ON '%(
 			self.container.mangledNames[(self.fromEntity.entitySet.name,)],self.sourceName)+string.join(join,', ')
 
+	def FromKeyColumns(self):
+		"""The source keys are in the aliased table containing *fromEntity*"""
+		return map(lambda k:"%s.%s"%(self.sourceName,self.container.mangledNames[(self.fromEntity.entitySet.name,k)]),
+			self.fromEntity.entitySet.keys)
+		
 	def WhereClause(self,entity,params,useFilter=True,useSkip=False):
 		"""Overridden to add the constraint for entities linked from *fromEntity* only.
 		
@@ -1961,7 +2671,7 @@ class SQLForeignKeyCollection(SQLNavigationCollection):
 		for k,v in self.fromEntity.KeyDict().items():
 			where.append(u"%s.%s=%s"%(self.sourceName,
 				self.container.mangledNames[(self.fromEntity.entitySet.name,k)],
-				params.AddParam(self.container.PrepareSQLValue(v))))
+				params.AddSlot(self.container.PrepareSQLValue(v))))
 		if entity is not None:
 			self.WhereEntityClause(where,entity,params)
 		if self.filter is not None and useFilter:
@@ -2046,13 +2756,18 @@ class SQLReverseKeyCollection(SQLNavigationCollection):
 		super(SQLReverseKeyCollection,self).__init__(**kwArgs)
 		self.keyCollection=self.entitySet.OpenCollection()
 
+	def FromKeyColumns(self):
+		"""The source keys are the foreign key columns in our own table"""
+		return map(lambda k:self.container.mangledNames[(self.entitySet.name,self.associationSetName,k)],
+			self.fromEntity.entitySet.keys)
+
 	def WhereClause(self,entity,params,useFilter=True,useSkip=False):
 		"""Overridden to add the constraint to entities linked from *fromEntity* only."""
 		where=[]
 		for k,v in self.fromEntity.KeyDict().items():
 			where.append(u"%s=%s"%(
 				self.container.mangledNames[(self.entitySet.name,self.associationSetName,k)],
-				params.AddParam(self.container.PrepareSQLValue(v))))
+				params.AddSlot(self.container.PrepareSQLValue(v))))
 		if entity is not None:
 			self.WhereEntityClause(where,entity,params)
 		if self.filter is not None and useFilter:
@@ -2213,18 +2928,24 @@ class SQLAssociationCollection(SQLNavigationCollection):
 				self.container.mangledNames[(self.associationSetName,self.entitySet.name,self.toNavName,keyName)]))
 		return ' INNER JOIN %s ON '%self.associationTableName+string.join(join,', ')
 	
+	def FromKeyColumns(self):
+		"""The source keys are in the auxiliary table"""
+		return map(lambda k:"%s.%s"%(self.associationTableName,
+			self.container.mangledNames[(self.associationSetName,self.fromEntity.entitySet.name,self.fromNavName,k)]),
+			self.fromEntity.entitySet.keys)
+
 	def WhereClause(self,entity,params,useFilter=True,useSkip=False):
 		"""Overridden to provide the *fromEntity* constraint in the auxiliary table."""
 		where=[]
 		for k,v in self.fromEntity.KeyDict().items():
 			where.append(u"%s.%s=%s"%(self.associationTableName,
 				self.container.mangledNames[(self.associationSetName,self.fromEntity.entitySet.name,self.fromNavName,k)],
-				params.AddParam(self.container.PrepareSQLValue(v))))
+				params.AddSlot(self.container.PrepareSQLValue(v))))
 		if entity is not None:
 			for k,v in entity.KeyDict().items():
 				where.append(u"%s.%s=%s"%(self.associationTableName,
 					self.container.mangledNames[(self.associationSetName,entity.entitySet.name,self.toNavName,k)],
-					params.AddParam(self.container.PrepareSQLValue(v))))
+					params.AddSlot(self.container.PrepareSQLValue(v))))
 		if useFilter and self.filter is not None:
 			where.append("(%s)"%self.SQLExpression(self.filter,params))		
 		if self.skiptoken is not None and useSkip:
@@ -2556,6 +3277,10 @@ class SQLEntityContainer(object):
 		are quoted using :py:meth:`QuoteIdentifier` before appearing in
 		SQL statements.
 	
+	sqlCacheSize (optional)
+		The maximum number of generated SQL statements to keep in
+		:py:attr:`sqlCache`, defaults to 1024.
+		
 	This class is designed to work with diamond inheritance and super.
 	All derived classes must call __init__ through super and pass all
 	unused keyword arguments.  For example::
@@ -2564,11 +3289,15 @@ class SQLEntityContainer(object):
 			def __init__(self,myDBConfig,**kwArgs):
 				super(MyDBContainer,self).__init__(**kwArgs)
 				# do something with myDBConfig....""" 
-	def __init__(self,containerDef,dbapi,maxConnections=10,fieldNameJoiner=u"_",**kwArgs):
+	def __init__(self,containerDef,dbapi,maxConnections=10,fieldNameJoiner=u"_",sqlCacheSize=1024,**kwArgs):
 		if kwArgs:
 			logging.debug("Unabsorbed kwArgs in SQLEntityContainer constructor")
 		self.containerDef=containerDef
 		self.dbapi=dbapi				#: the DB API compatible module
+		self.sqlCache=SQLStatementCache(sqlCacheSize)
+		"""A :py:class:`SQLStatementCache` of the statements generated by
+		this container's collections.  Its hits and misses attributes
+		can be used to monitor the effectiveness of the cache."""
 		self.moduleLock=None
 		if self.dbapi.threadsafety==0:
 			# we can't even share the module, so just use one connection will do
@@ -2640,6 +3369,7 @@ class SQLEntityContainer(object):
 		for es in self.containerDef.EntitySet:
 			for np in es.entityType.NavigationProperty:
 				self.BindNavigationProperty(es,np.name)
+		self.containerDef.BindChangeSet(SQLChangeSet,container=self)
 		# once the navigation properties have been bound, fkTable will
 		# have been populated with any foreign keys we need to add field
 		# name mappings for
@@ -2995,6 +3725,34 @@ class SQLEntityContainer(object):
 			# ok, this really is an error!
 			logging.error("Thread[%i] attempted to unlock un unknown database connection: %s",threadId,repr(c))									
 
+	def StartChangeSet(self,c):
+		"""Starts a change set on connection *c*
+		
+		*c* must have been acquired by the current thread.  Until
+		:py:meth:`StopChangeSet` is called, calls to
+		:py:meth:`AcquireConnection` from this thread return a
+		:py:class:`SQLChangeSetConnection` proxy for *c* so all
+		operations are executed in a single transaction."""
+		threadId=threading.current_thread().ident
+		with self.cPoolLock:
+			cLock=self.cPoolLocked.get(threadId,None)
+			if cLock is None or cLock.dbc is not c:
+				raise ValueError("Thread[%i] can't start a change set on a database connection it didn't acquire"%threadId)
+			cLock.dbc=SQLChangeSetConnection(c)
+	
+	def StopChangeSet(self,c):
+		"""Stops a change set started by :py:meth:`StartChangeSet`,
+		returning the :py:class:`SQLChangeSetConnection` that was used
+		by the change set."""
+		threadId=threading.current_thread().ident
+		with self.cPoolLock:
+			cLock=self.cPoolLocked.get(threadId,None)
+			if cLock is None or not isinstance(cLock.dbc,SQLChangeSetConnection) or cLock.dbc.dbc is not c:
+				raise ValueError("Thread[%i] can't stop a change set it didn't start"%threadId)
+			proxy=cLock.dbc
+			cLock.dbc=c
+			return proxy
+
 	def OpenConnection(self):
 		"""Creates and returns a new connection object.
 		
@@ -3484,6 +4242,18 @@ class SQLiteEntityCollectionBase(SQLCollectionBase):
 	This class provides some SQLite specific mappings for certain
 	functions to improve compatibility with the OData expression
 	language."""
+
+	def LimitClause(self,skip,top,params):
+		"""Maps skip and top to SQLite's LIMIT and OFFSET clauses"""
+		clause=[]
+		if top is not None:
+			clause.append(" LIMIT %s"%params.AddSlot(top))
+		elif skip:
+			# LIMIT is required, a negative value means no limit
+			clause.append(" LIMIT -1")
+		if skip:
+			clause.append(" OFFSET %s"%params.AddSlot(skip))
+		return 0,string.join(clause,'')
 		
 	def SQLExpressionLength(self,expression,params,context):
 		"""Converts the length method: maps to length( op[0] )"""		
@@ -6,10 +6,12 @@ import time
 import datetime
 import socket, ssl
 import select
+import errno
 import types
 import base64
 import threading
 import io
+import zlib
 import pyslet.info as info
 from pyslet.rfc2616_core import *
 from pyslet.rfc2616_params import *
@@ -39,8 +41,277 @@ SOCKET_CHUNK=io.DEFAULT_BUFFER_SIZE
 USER_AGENT=ProductToken('pyslet',info.version)
 """A :py:class:`ProductToken` instance that can be used to represent the
 current version of Pyslet."""
-	
-		
+
+SELECT_READ=1		#: event mask bit indicating a socket is ready to read
+SELECT_WRITE=2		#: event mask bit indicating a socket is ready to write
+
+
+class SocketSelector(object):
+	"""Abstract class for waiting on I/O events from a set of sockets.
+
+	Python 2 has no selectors module so this class provides a minimal
+	equivalent.  Each socket is registered once, with an event mask made
+	up of :py:data:`SELECT_READ` and :py:data:`SELECT_WRITE`, and an
+	arbitrary data object that is returned with its events.  The mask
+	is changed with :py:meth:`Modify` as the socket's needs change,
+	rather than rebuilding the set on every wait.
+
+	Use :py:data:`DefaultSelector` to get the most efficient
+	implementation for the current platform."""
+
+	def __init__(self):
+		self.fileMap={}		#: a dictionary mapping file keys onto (fileobj,events,data)
+		self.keyMap={}		#: a dictionary mapping registered file objects onto their file keys
+
+	def FileKey(self,fileobj):
+		"""Returns the key used to identify *fileobj*, an integer file
+		descriptor or an object with a fileno method."""
+		if type(fileobj) in (types.IntType,types.LongType):
+			return fileobj
+		else:
+			return fileobj.fileno()
+
+	def Register(self,fileobj,events,data=None):
+		"""Starts monitoring *fileobj* for *events*.
+
+		Registering a file that is already registered replaces its
+		previous registration, this happens when a closed socket's file
+		descriptor is reused.  Returns the file key."""
+		key=self.FileKey(fileobj)
+		old=self.fileMap.get(key,None)
+		if old is not None:
+			del self.keyMap[old[0]]
+		self.fileMap[key]=(fileobj,events,data)
+		self.keyMap[fileobj]=key
+		return key
+
+	def Modify(self,fileobj,events,data=None):
+		"""Changes the events (and data) associated with *fileobj*,
+		which must be registered.  Returns the file key."""
+		key=self.keyMap[fileobj]
+		self.fileMap[key]=(fileobj,events,data)
+		return key
+
+	def Unregister(self,fileobj):
+		"""Stops monitoring *fileobj*.
+		
+		The file key recorded when *fileobj* was registered is returned,
+		or None if *fileobj* is not registered (or its registration has
+		been replaced by a file that reused its descriptor).  It is safe
+		to call this method with a file that has already been closed,
+		the file's fileno method is not called."""
+		key=self.keyMap.pop(fileobj,None)
+		if key is not None:
+			del self.fileMap[key]
+		return key
+
+	def Select(self,timeout=None):
+		"""Waits for at most *timeout* seconds (None waits forever) for
+		a registered file to become ready.
+
+		Returns a list of (data,events) tuples, one for each file that
+		is ready.  An empty list indicates that the timeout expired."""
+		raise NotImplementedError
+
+	def Close(self):
+		"""Frees any resources used by the selector."""
+		self.fileMap={}
+		self.keyMap={}
+
+
+class SelectSelector(SocketSelector):
+	"""A selector based on select.select, available on all platforms.
+
+	selectFunction
+		The function used to wait for the files, the default is
+		select.select.  It is called with the lists of readers and
+		writers and files are passed exactly as they were registered, so
+		objects without a fileno method can be used if *selectFunction*
+		supports them."""
+
+	def __init__(self,selectFunction=select.select):
+		super(SelectSelector,self).__init__()
+		self.selectFunction=selectFunction
+
+	def FileKey(self,fileobj):
+		return fileobj
+
+	def Select(self,timeout=None):
+		readers=[]
+		writers=[]
+		for fileobj,events,data in self.fileMap.itervalues():
+			if events&SELECT_READ:
+				readers.append(fileobj)
+			if events&SELECT_WRITE:
+				writers.append(fileobj)
+		if not readers and not writers:
+			return []
+		try:
+			r,w,e=self.selectFunction(readers,writers,[],timeout)
+		except select.error,err:
+			logging.error("Socket error from select: %s",str(err))
+			return []
+		ready={}
+		for fileobj in r:
+			ready[fileobj]=SELECT_READ
+		for fileobj in w:
+			ready[fileobj]=ready.get(fileobj,0)|SELECT_WRITE
+		result=[]
+		for fileobj,events in ready.iteritems():
+			result.append((self.fileMap[fileobj][2],events))
+		return result
+
+
+class PollSelector(SocketSelector):
+	"""A selector based on select.poll, it is not limited by
+	FD_SETSIZE."""
+
+	def __init__(self):
+		super(PollSelector,self).__init__()
+		self.poller=select.poll()
+
+	def Register(self,fileobj,events,data=None):
+		key=super(PollSelector,self).Register(fileobj,events,data)
+		# registering an existing descriptor modifies it
+		self.poller.register(key,self.PollMask(events))
+		return key
+
+	def Modify(self,fileobj,events,data=None):
+		key=super(PollSelector,self).Modify(fileobj,events,data)
+		self.poller.register(key,self.PollMask(events))
+		return key
+
+	def Unregister(self,fileobj):
+		key=super(PollSelector,self).Unregister(fileobj)
+		if key is not None:
+			try:
+				self.poller.unregister(key)
+			except KeyError:
+				pass
+		return key
+
+	def PollMask(self,events):
+		mask=0
+		if events&SELECT_READ:
+			mask|=select.POLLIN
+		if events&SELECT_WRITE:
+			mask|=select.POLLOUT
+		return mask
+
+	def Select(self,timeout=None):
+		if timeout is not None:
+			# poll uses milliseconds
+			timeout=int(timeout*1000)
+		try:
+			eventList=self.poller.poll(timeout)
+		except select.error,err:
+			logging.error("Socket error from poll: %s",str(err))
+			return []
+		return self.ReadyList(eventList,select.POLLIN,select.POLLOUT)
+
+	def ReadyList(self,eventList,pollIn,pollOut):
+		ready=[]
+		for key,mask in eventList:
+			if key not in self.fileMap:
+				continue
+			events=0
+			# errors and hang ups are reported as both events, the
+			# subsequent send or recv will discover the problem
+			if mask&~pollIn:
+				events|=SELECT_WRITE
+			if mask&~pollOut:
+				events|=SELECT_READ
+			ready.append((self.fileMap[key][2],events&self.fileMap[key][1]))
+		return ready
+
+	def Close(self):
+		super(PollSelector,self).Close()
+		self.poller=None
+
+
+class EpollSelector(PollSelector):
+	"""A selector based on select.epoll, available on Linux.  The cost
+	of waiting is proportional to the number of ready sockets, not the
+	number registered."""
+
+	def __init__(self):
+		SocketSelector.__init__(self)
+		self.poller=select.epoll()
+
+	def Register(self,fileobj,events,data=None):
+		old=self.fileMap.get(self.FileKey(fileobj),None)
+		if old is not None:
+			# a stale registration, perhaps for a closed socket
+			self.Unregister(old[0])
+		key=SocketSelector.Register(self,fileobj,events,data)
+		try:
+			self.poller.register(key,self.PollMask(events))
+		except IOError,err:
+			if err.errno==errno.EEXIST:
+				self.poller.modify(key,self.PollMask(events))
+			else:
+				raise
+		return key
+
+	def Modify(self,fileobj,events,data=None):
+		key=SocketSelector.Modify(self,fileobj,events,data)
+		self.poller.modify(key,self.PollMask(events))
+		return key
+
+	def Unregister(self,fileobj):
+		key=SocketSelector.Unregister(self,fileobj)
+		if key is not None:
+			try:
+				self.poller.unregister(key)
+			except (IOError,ValueError):
+				# closed sockets are removed automatically
+				pass
+		return key
+
+	def PollMask(self,events):
+		mask=0
+		if events&SELECT_READ:
+			mask|=select.EPOLLIN
+		if events&SELECT_WRITE:
+			mask|=select.EPOLLOUT
+		return mask
+
+	def Select(self,timeout=None):
+		if timeout is None:
+			timeout=-1
+		try:
+			eventList=self.poller.poll(timeout)
+		except IOError,err:
+			if err.errno==errno.EINTR:
+				return []
+			raise
+		return self.ReadyList(eventList,select.EPOLLIN,select.EPOLLOUT)
+
+	def Close(self):
+		if self.poller is not None:
+			self.poller.close()
+		super(EpollSelector,self).Close()
+
+
+if hasattr(select,'epoll'):
+	DefaultSelector=EpollSelector
+elif hasattr(select,'poll'):
+	DefaultSelector=PollSelector
+else:
+	DefaultSelector=SelectSelector
+"""The most efficient :py:class:`SocketSelector` class available on this
+platform."""
+
+
+def SocketWouldBlock(err):
+	"""Returns True if the socket.error *err* was raised because an
+	operation on a non-blocking socket would have blocked."""
+	if isinstance(err,ssl.SSLError):
+		return len(err.args)>0 and err.args[0] in (ssl.SSL_ERROR_WANT_READ,ssl.SSL_ERROR_WANT_WRITE)
+	else:
+		return len(err.args)>0 and err.args[0] in (errno.EAGAIN,errno.EWOULDBLOCK)
+
+
 class Connection(object):
 	"""Represents an HTTP connection.  Used internally by the request
 	manager to manage connections to HTTP servers.  Each connection is
@@ -97,8 +368,11 @@ class Connection(object):
 		self.socket=None
 		self.socketFile=None
 		self.sendBuffer=[]
-		self.recvBuffer=[]
-		self.recvBufferSize=0
+		# the receive buffer holds unread data in recvBuffer[recvStart:recvEnd]
+		self.recvBuffer=bytearray(SOCKET_CHUNK)
+		self.recvStart=0
+		self.recvEnd=0
+		self.recvScan=0		# the point from which to resume scanning for CRLF
 
 	def ThreadTargetKey(self):
 		return (self.threadId,self.scheme,self.host,self.port)
@@ -114,14 +388,21 @@ class Connection(object):
 	def __repr__(self):
 		return "Connection(%s,%i)"%(self.host,self.port)
 		
-	def ConnectionTask(self):
+	def ConnectionTask(self,canRead=False,canWrite=False):
 		"""Processes the requests and responses for this connection.
 		
+		canRead, canWrite
+			True if the socket has been reported ready to read or write
+			respectively.  The connection does not poll the socket
+			itself.  Sockets are non-blocking, once reported ready the
+			connection sends or receives until the operation would
+			block.
+
 		This method is mostly non-blocking.  It returns a (r,w) pair of
-		file numbers suitable for passing to select indicating whether
-		the connection is waiting to read and/or write data.  It will
-		return None,None if the connection is not currently blocked on
-		I/O.
+		file numbers suitable for registering with a
+		:py:class:`SocketSelector` indicating whether the connection is
+		waiting to read and/or write data.  It will return None,None if
+		the connection is not currently blocked on I/O.
 		
 		The connection object acts as a small buffer between the HTTP
 		message itself and the server.  The implementation breaks down
@@ -160,20 +441,19 @@ class Connection(object):
 			if self.request or self.response:
 				if self.socket is None:
 					self.NewSocket()
+					self.socket.setblocking(False)
+					# readiness was reported for an old socket
+					canRead=canWrite=False
 				rBusy=None;wBusy=None
 				# The first section deals with the sending cycle, we
 				# pass on to the response section only if we are in a
 				# waiting mode or we are waiting for the socket to be
 				# ready before we can write data
 				if self.sendBuffer:
-					try:
-						r,w,e=self.socketSelect([],[self.socketFile],[],0.0)
-					except select.error,err:
-						self.Close(err)
-						w=[]
-					if w:
+					if canWrite:
 						# We can write
-						self._SendRequestData()
+						if not self._SendRequestData():
+							canWrite=False
 					if self.sendBuffer:
 						# We are still waiting to write, move on to the response section!
 						wBusy=self.socketFile
@@ -207,16 +487,12 @@ class Connection(object):
 				# buffer is empty and we don't have any more data to send (or we are
 				# waiting for a response before sending it).
 				if self.response:
-					try:
-						r,w,e=self.socketSelect([self.socketFile],[],[self.socketFile],0)
-					except select.error, err:
-						r=[]
-						self.Close(err)
-					if e:
-						# there is an error on our socket...
-						self.Close("socket error indicated by select")
-					elif r:
-						if self._RecvResponseData():
+					if canRead:
+						done=self._RecvResponseData()
+						if done is None:
+							# nothing to read, wait for the selector
+							canRead=False
+						elif done:
 							# The response is done
 							closeConnection=False
 							if self.response:
@@ -302,8 +578,7 @@ class Connection(object):
 				if oldS is not None:
 					self._CloseSocket(oldS)
 		self.sendBuffer=[]
-		self.recvBuffer=[]
-		self.recvBufferSize=0
+		self.recvStart=self.recvEnd=self.recvScan=0
 		self.requestMode=self.REQ_READY
 
 	def Kill(self):
@@ -357,17 +632,20 @@ class Connection(object):
 		return True
 		
 	def _SendRequestData(self):
-		#	Sends the next chunk of data in the buffer
+		#	Sends the next chunk of data in the buffer, returns False
+		#	if the socket would block (or is closed)
 		if not self.sendBuffer:
-			return
+			return True
 		data=self.sendBuffer[0]
 		if data:
 			try:
 				nBytes=self.socket.send(data)
 			except socket.error, err:
+				if SocketWouldBlock(err):
+					return False
 				# stop everything
 				self.Close(err)
-				return
+				return False
 			if nBytes==0:
 				# We can't send any more data to the socket
 				# The other side has closed the connection
@@ -380,6 +658,7 @@ class Connection(object):
 				self.request=None
 				self.requestMode==self.CLOSE_WAIT
 				self.sendBuffer=[]
+				return False
 			elif nBytes<len(data):
 				# Some of the data went:
 				self.sendBuffer[0]=data[nBytes:]
@@ -388,24 +667,26 @@ class Connection(object):
 		else:
 			# shouldn't get empty strings in the buffer but if we do, delete them
 			del self.sendBuffer[0]
+		return True
 		
 	def _RecvResponseData(self):
 		#	We ask the response what it is expecting and try and
 		#	satisfy that, we return True when the response has been
-		#	received completely, False otherwise"""
-		err=None
+		#	received completely, False otherwise.  If there is no
+		#	data to read we return None
+		self._MakeRecvSpace()
 		try:
-			data=self.socket.recv(SOCKET_CHUNK)
+			nBytes=self.socket.recv_into(memoryview(self.recvBuffer)[self.recvEnd:],SOCKET_CHUNK)
 		except socket.error, e:
+			if SocketWouldBlock(e):
+				return None
 			# We can't truly tell if the server hung-up except by getting an error
 			# here so this error could be fairly benign.
-			err=e
-			data=None
-		logging.debug("Reading from %s: \n%s",self.host,repr(data))
-		if data:
-			nBytes=len(data)
-			self.recvBuffer.append(data)
-			self.recvBufferSize+=nBytes
+			logging.debug("%s: recv error %s",self.host,str(e))
+			nBytes=0
+		logging.debug("Read %i bytes from %s",nBytes,self.host)
+		if nBytes:
+			self.recvEnd+=nBytes
 		else:
 			# TODO: this is typically a signal that the other end hung
 			# up, we should implement the HTTP retry strategy for the
@@ -417,70 +698,57 @@ class Connection(object):
 		while self.response is not None:
 			recvNeeds=self.response.RecvNeeds()
 			if recvNeeds==CRLF:
-				# scan for CRLF, consolidate first
-				data=string.join(self.recvBuffer,'')
-				pos=data.find(CRLF)
-				if pos>=0:
-					line=data[0:pos+2]
-					data=data[pos+2:]
-				elif err:
-					self.Close(err)
-					return True
-				else:
-					# We didn't find the data we wanted this time
+				# only scan the data we haven't already scanned
+				pos=self.recvBuffer.find(CRLF,max(self.recvScan,self.recvStart),self.recvEnd)
+				if pos<0:
+					# We didn't find the data we wanted this time, the
+					# last byte could be the CR of a split CRLF
+					self.recvScan=max(self.recvEnd-1,self.recvStart)
 					break
-				if data:
-					self.recvBuffer=[data]
-					self.recvBufferSize=len(data)
-				else:
-					self.recvBuffer=[]
-					self.recvBufferSize=0
-				if line:
-					logging.debug("Response Header: %s",repr(line))
-					self.response.RecvLine(line)
+				line=str(self.recvBuffer[self.recvStart:pos+2])
+				self.recvStart=pos+2
+				logging.debug("Response Header: %s",repr(line))
+				self.response.RecvLine(line)
 			elif type(recvNeeds) is types.IntType:
-				nBytes=int(recvNeeds)
-				if nBytes is 0:
-					# As many as possible please
-					logging.debug("Response reading until connection closes")
-					if self.recvBufferSize>0:
-						bytes=string.join(self.recvBuffer,'')
-						self.recvBuffer=[]
-						self.recvBufferSize=0
-					else:
-						# recvBuffer is empty but we still want more
-						break
-				elif self.recvBufferSize<nBytes:
-					logging.debug("Response waiting for %s bytes",str(nBytes-self.recvBufferSize))
-					# We can't satisfy the response
+				nBytes=self.recvEnd-self.recvStart
+				if not nBytes:
+					# recvBuffer is empty but we still want more
 					break
-				else:
-					gotBytes=0
-					buffPos=0
-					while gotBytes<nBytes:
-						data=self.recvBuffer[buffPos]
-						if gotBytes+len(data)<nBytes:
-							buffPos+=1
-							gotBytes+=len(data)
-							continue
-						elif gotBytes+len(data)==nBytes:
-							bytes=string.join(self.recvBuffer[0:buffPos+1],'')
-							self.recvBuffer=self.recvBuffer[buffPos+1:]
-							break
-						else:
-							# Tricky case, only some of this string is needed
-							bytes=string.join(self.recvBuffer[0:buffPos]+[data[0:nBytes-gotBytes]],'')
-							self.recvBuffer=[data[nBytes-gotBytes:]]+self.recvBuffer[buffPos+1:]
-							break
-					self.recvBufferSize=self.recvBufferSize-len(bytes)
-				logging.debug("Response Data: %s",repr(bytes))
-				self.response.RecvBytes(bytes)
+				if recvNeeds and recvNeeds<nBytes:
+					nBytes=recvNeeds
+				# pass whatever data we have, there is no need to wait
+				# for all the bytes the response needs
+				data=memoryview(self.recvBuffer)[self.recvStart:self.recvStart+nBytes]
+				self.recvStart+=nBytes
+				logging.debug("Response Data: %i bytes",nBytes)
+				self.response.RecvBytes(data)
+				# release the view, the buffer can't be resized while it exists
+				del data
 			elif recvNeeds is None:
 				# We don't need any bytes at all, the response is done
 				return True
 			else:
 				raise HTTPException("Unexpected RecvNeeds response: %s"%repr(recvNeeds))
 		return False
+	
+	def _MakeRecvSpace(self):
+		#	Ensures there is room for SOCKET_CHUNK bytes at the end of
+		#	the receive buffer
+		if self.recvStart==self.recvEnd:
+			# the buffer is empty, rewind it
+			self.recvStart=self.recvEnd=self.recvScan=0
+		elif len(self.recvBuffer)-self.recvEnd<SOCKET_CHUNK and self.recvStart:
+			# discard the data we've already read, in practice the
+			# unread data is typically a partial line
+			nBytes=self.recvEnd-self.recvStart
+			self.recvBuffer[0:nBytes]=self.recvBuffer[self.recvStart:self.recvEnd]
+			self.recvScan=max(self.recvScan-self.recvStart,0)
+			self.recvStart=0
+			self.recvEnd=nBytes
+		extra=SOCKET_CHUNK-(len(self.recvBuffer)-self.recvEnd)
+		if extra>0:
+			# a long line, grow the buffer
+			self.recvBuffer.extend(bytearray(extra))
 		
 	def NewSocket(self):
 		with self.connectionLock:
@@ -489,7 +757,6 @@ class Connection(object):
 				raise HTTPException("Connection closed")
 			self.socket=None
 			self.socketFile=None
-			self.socketSelect=select.select
 		try:
 			for target in self.manager.DNSLookup(self.host,self.port):
 				family, socktype, protocol, canonname, address = target
@@ -517,7 +784,6 @@ class Connection(object):
 				else:
 					self.socket=sNew
 					self.socketFile=self.socket.fileno()
-					self.socketSelect=select.select
 	
 	def _CloseSocket(self,s):
 		try:
@@ -599,6 +865,7 @@ class HTTPRequestManager(object):
 	to the same host+port you must use multiple threads."""
 	ConnectionClass=Connection
 	SecureConnectionClass=SecureConnection
+	SelectorClass=DefaultSelector
 	
 	def __init__(self,maxConnections=100,ca_certs=None):
 		self.managerLock=threading.Condition()
@@ -616,9 +883,13 @@ class HTTPRequestManager(object):
 		self.dnsCache={}					# cached results from socket.getaddrinfo keyed on (hostname,port)
 		self.ca_certs=ca_certs
 		self.credentials=[]
-		self.socketSelect=select.select
+		self.threadLoops=threading.local()	# per-thread selector state, see ThreadTask
 		self.httpUserAgent="%s (HTTPRequestManager)"%str(USER_AGENT)
 		"""The default User-Agent string to use."""
+		self.httpAcceptEncoding="gzip, deflate"
+		"""The default Accept-Encoding string to use, responses in these
+		content-codings are decoded automatically, see
+		:py:attr:`HTTPRequest.autoDecode`."""
 		
 	def QueueRequest(self,request,timeout=None):
 		"""Instructs the manager to start processing *request*.
@@ -633,12 +904,15 @@ class HTTPRequestManager(object):
 			None means wait forever, 0 means don't block.
 			
 		The default implementation adds a User-Agent header from
-		:py:attr:`httpUserAgent` if none has been specified already. 
-		You can override this method to add other headers appropriate
+		:py:attr:`httpUserAgent` and an Accept-Encoding header from
+		:py:attr:`httpAcceptEncoding` if none have been specified
+		already.  You can override this method to add other headers appropriate
 		for a specific context but you must pass this call on to this
 		implementation for proper processing."""
 		if self.httpUserAgent and not request.HasHeader('User-Agent'):
 			request.SetHeader('User-Agent',self.httpUserAgent)
+		if self.httpAcceptEncoding and request.autoDecode and not request.HasHeader('Accept-Encoding'):
+			request.SetHeader('Accept-Encoding',self.httpAcceptEncoding)
 		# assign this request to a connection straight away
 		start=time.time()
 		threadId=threading.current_thread().ident
@@ -769,42 +1043,89 @@ class HTTPRequestManager(object):
 			raise NotImplementedError("Unsupported connection scheme: %s"%scheme)
 		return connection
 		
+	def NewSelector(self):
+		"""Returns a new :py:class:`SocketSelector` instance.
+		
+		Each thread that calls :py:meth:`ThreadTask` gets its own
+		selector.  The default implementation returns an instance of
+		:py:attr:`SelectorClass`."""
+		return self.SelectorClass()
+		
 	def ThreadTask(self,timeout=None):
 		"""Processes all connections bound to the current thread then
 		blocks for at most timeout (0 means don't block) while waiting
 		to send/receive data from any active sockets.
 		
-		Each active connection receives one call to
-		:py:meth:`Connection.ConnectionTask` There are some situations
-		where this method may still block even with timeout=0.  For
-		example, DNS name resolution and SSL handshaking.  These may be
-		improved in future.
+		Each thread has its own :py:class:`SocketSelector` with which
+		the sockets of its active connections are registered.  Only
+		connections reported ready by the previous wait, connections
+		with newly queued requests and connections that are not yet
+		registered receive a call to
+		:py:meth:`Connection.ConnectionTask`.  If the previous wait
+		timed out then all connections receive a call, allowing them
+		to handle their own timeouts.
+		
+		There are some situations where this method may still block even
+		with timeout=0.  For example, DNS name resolution and SSL
+		handshaking.  These may be improved in future.
 		
 		Returns True if at least one connection is active, otherwise
 		returns False."""
 		threadId=threading.current_thread().ident
 		with self.managerLock:
-			connections=self.cActiveThreads.get(threadId,{}).values()
+			connections=self.cActiveThreads.get(threadId,{}).copy()
+		loop=self.threadLoops
 		if not connections:
+			if getattr(loop,'selector',None) is not None:
+				loop.selector.Close()
+				loop.selector=None
 			return False
-		readers=[]
-		writers=[]
-		for c in connections:
+		if getattr(loop,'selector',None) is None:
+			loop.selector=self.NewSelector()
+			loop.registered={}	# (socket,file,events) keyed on connection id
+			loop.ready={}		# events keyed on connection id
+			loop.tick=False		# True if the last wait timed out
+		selector=loop.selector
+		registered=loop.registered
+		ready=loop.ready
+		# forget connections that have been unbound from this thread
+		for cid in registered.keys():
+			if cid not in connections:
+				selector.Unregister(registered[cid][1])
+				del registered[cid]
+		for c in connections.itervalues():
+			events=ready.pop(c.id,0)
+			if not (events or loop.tick or c.id not in registered or
+				(c.requestQueue and c.requestMode==c.REQ_READY)):
+				# still waiting for I/O
+				continue
 			try:
-				r,w=c.ConnectionTask()
-				if r:
-					readers.append(r)
-				if w:
-					writers.append(w)
+				r,w=c.ConnectionTask(events&SELECT_READ!=0,events&SELECT_WRITE!=0)
 			except HTTPException, err:
 				c.Close(err)
-				pass
-		if (timeout is None or timeout>0) and (readers or writers):
-			try:
-				#	logging.debug("Socket select for: readers=%s, writers=%s, timeout=%i",repr(readers),repr(writers),timeout)
-				r,w,e=self.socketSelect(readers,writers,[],timeout)
-			except select.error, err:
-				logging.error("Socket error from select: %s",str(err)) 
+				r=w=None
+			events=0
+			if r:
+				events|=SELECT_READ
+			if w:
+				events|=SELECT_WRITE
+			old=registered.get(c.id,None)
+			if old is not None and (not events or old[0] is not c.socket or old[1]!=(r or w)):
+				selector.Unregister(old[1])
+				del registered[c.id]
+				old=None
+			if events:
+				if old is None:
+					selector.Register(r or w,events,c.id)
+				elif old[2]!=events:
+					selector.Modify(r or w,events,c.id)
+				registered[c.id]=(c.socket,r or w,events)
+		ready.clear()
+		loop.tick=False
+		if registered:
+			for cid,events in selector.Select(timeout):
+				ready[cid]=events
+			loop.tick=not ready
 		return True
 			
 	def ThreadLoop(self,timeout=60):
@@ -1394,6 +1715,7 @@ class HTTPRequest(HTTPMessage):
 		else:
 			self.resBodyStream=None
 		self.autoRedirect=True	#: flag indicating whether or not to auto-redirect 3xx responses
+		self.autoDecode=True	#: flag indicating whether or not to decode gzip and deflate content-codings (decoded responses have no Content-Encoding or Content-Length headers)
 		self.done=False			
 		self.tryCredentials=None
 		
@@ -1740,6 +2062,7 @@ class HTTPResponse(HTTPMessage):
 		self.mode=self.RESP_STATUS
 		self.currHeader=None
 		self.waitStart=None
+		self.decoder=None
 		
 	def GetAcceptRanges(self):
 		"""Returns an :py:class:`AcceptRanges` instance or None if no
@@ -1880,6 +2203,12 @@ class HTTPResponse(HTTPMessage):
 				else:
 					self.transferLength=self.transferPos=0
 					self.mode=self.RESP_DONE
+				self.decoder=self.NewDecoder()
+				if self.decoder is not None:
+					# the request sees the decoded body, these headers
+					# describe the encoded one
+					self.SetHeader('Content-Encoding',None)
+					self.SetHeader('Content-Length',None)
 				self.request.HandleResponseHeader()
 		elif self.mode==self.RESP_CHUNK_SIZE:
 			# Read the chunk size
@@ -1932,13 +2261,20 @@ class HTTPResponse(HTTPMessage):
 			return True
 
 	def RecvBytes(self,data):
+		"""Called by the connection with the next part of the response
+		body.
+		
+		*data* is a string or, to avoid copying the connection's receive
+		buffer, a memoryview instance that is only valid for the
+		duration of the call.  It contains at most the number of bytes
+		returned by :py:meth:`NeedBytes`."""
 		if self.mode==self.RESP_CHUNK_DATA:
 			self.transferPos+=len(data)
 			extra=self.transferPos-(self.transferLength-2)
 			if extra>0:
-				self.request.WriteResponse(data[:-extra])
+				self.WriteData(data[:-extra])
 			else:
-				self.request.WriteResponse(data)
+				self.WriteData(data)
 			if self.transferPos>=self.transferLength:
 				# We've read all the data for this chunk, read the next one
 				self.mode=self.RESP_CHUNK_SIZE
@@ -1947,18 +2283,57 @@ class HTTPResponse(HTTPMessage):
 			if self.transferLength:
 				if self.transferPos>self.transferLength:
 					extra=self.transferPos-self.transferLength
-					self.request.WriteResponse(data[:extra])
+					self.WriteData(data[:-extra])
 				else:
-					self.request.WriteResponse(data)
+					self.WriteData(data)
 				if self.transferPos>=self.transferLength:
 					self.mode=self.RESP_DONE
 			else:
 				# keep reading until connection closed
-				self.request.WriteResponse(data)
+				self.WriteData(data)
 		if self.mode==self.RESP_DONE:
 			self.Finished()
-			
+	
+	def NewDecoder(self):
+		"""Returns a decompression object for the response body or None
+		
+		The body is decoded only if the request's
+		:py:attr:`HTTPRequest.autoDecode` flag is set and the response
+		has a single gzip or deflate content-coding.  When the body is
+		decoded the Content-Encoding and Content-Length headers are
+		removed from the response before the request is notified, as
+		they describe the body as it was transferred."""
+		if self.request.autoDecode:
+			codings=self.GetContentEncoding()
+			if codings==["gzip"] or codings==["x-gzip"]:
+				return zlib.decompressobj(16+zlib.MAX_WBITS)
+			elif codings==["deflate"]:
+				return zlib.decompressobj()
+		return None
+		
+	def WriteData(self,data):
+		"""Passes *data* to the request, decoding it if necessary"""
+		if isinstance(data,memoryview):
+			data=data.tobytes()
+		if self.decoder is not None:
+			try:
+				data=self.decoder.decompress(data)
+			except zlib.error as e:
+				raise HTTPException("Error decoding response: %s"%str(e))
+		self.request.WriteResponse(data)
+	
+	def FlushData(self):
+		"""Passes any data buffered by the decoder to the request"""
+		if self.decoder is not None:
+			try:
+				data=self.decoder.flush()
+			except zlib.error as e:
+				raise HTTPException("Error decoding response: %s"%str(e))
+			self.decoder=None
+			self.request.WriteResponse(data)
+		
 	def Finished(self):
+		self.FlushData()
 		self.request.ResponseFinished()
 		if self.status>=100 and self.status<=199:
 			# Re-read this response, we're not done!
@@ -1970,4 +2345,5 @@ class HTTPResponse(HTTPMessage):
 		are reading forever 'err' may or may not be set when the server finally
 		hangs up and stops sending."""
 		self.reason=str(err)
+		self.FlushData()
 		self.request.ResponseFinished(err)
@@ -2,9 +2,9 @@
 """Utilities to aid interaction with the unicode database"""
 
 from sys import maxunicode
-from pickle import dump,load
 from urllib import urlopen
-import types, string, os.path
+from bisect import bisect_left
+import types, string, os.path, re, struct, mmap
 
 CHINESE_TEST=u'\u82f1\u56fd'
 
@@ -13,8 +13,8 @@ UCDBlockDatabaseURL="http://www.unicode.org/Public/UNIDATA/Blocks.txt"
 UCDCategories={}
 UCDBlocks={}
 
-CATEGORY_FILE="unicode5_catogories.pck"
-BLOCK_FILE="unicode5_blocks.pck"
+CATEGORY_FILE="unicode5_categories.bin"
+BLOCK_FILE="unicode5_blocks.bin"
 
 
 MagicTable={
@@ -88,11 +88,11 @@ class CharClass:
 		
 			c=CharClass(CharClass.UCDCategory(u"Cc"))
 			c.AddChar(u" ")"""
-		global UCDCategories
-		if not UCDCategories:
-			# The category table is empty, so we need to load it
-			LoadCategoryTable()
-		return UCDCategories[category]
+		result=UCDCategories.get(category,None)
+		if result is None:
+			# Load just this category from the table file
+			result=UCDCategories[category]=_CategoryTable.GetClass(category)
+		return result
 		
 	@classmethod
 	def UCDBlock(cls,blockName):
@@ -106,14 +106,17 @@ class CharClass:
 		
 			c=CharClass(CharClass.UCDBlock(u"Basic Latin"))
 			c.AddClass(CharClass.UCDBlock(u"Latin-1 Supplement")"""
-		global UCDBlocks
-		if not UCDBlocks:
-			# The block table is empty, so we need to load it
-			LoadBlockTable()
-		return UCDBlocks[_NormalizeBlockName(blockName)]
+		blockName=_NormalizeBlockName(blockName)
+		result=UCDBlocks.get(blockName,None)
+		if result is None:
+			result=UCDBlocks[blockName]=_BlockTable.GetClass(blockName)
+		return result
 		
 	def __init__(self,*args):
 		self.ranges=[]
+		self._ends=None		#: cached list of range end points, used by Test
+		self._anyRE=None	#: cached regular expression used by TestAny
+		self._allRE=None	#: cached regular expression used by TestAll
 		for arg in args:
 			if type(arg) in types.StringTypes:
 				# Each character in the string is put in the class
@@ -254,6 +257,7 @@ class CharClass:
 	
 	def AddRange(self,a,z):
 		"""Adds a range of characters from a to z to the class"""
+		self._Changed()
 		if z<a:
 			x=z;z=a;a=x
 		a=unicode(a);z=unicode(z)
@@ -289,6 +293,7 @@ class CharClass:
 		
 	def SubtractRange(self,a,z):
 		"""Subtracts a range of characters from the character class"""
+		self._Changed()
 		if z<a:
 			x=z;z=a;a=x
 		a=unicode(a);z=unicode(z)
@@ -360,6 +365,7 @@ class CharClass:
 	
 	def AddChar(self,c):
 		"""Adds a single character to the character class"""
+		self._Changed()
 		c=unicode(c)
 		if self.ranges:
 			match,index=self.BisectionSearch(c,0,len(self.ranges)-1)
@@ -371,6 +377,7 @@ class CharClass:
 	
 	def SubtractChar(self,c):
 		"""Subtracts a single character from the character class"""
+		self._Changed()
 		c=unicode(c)
 		if self.ranges:
 			match,index=self.BisectionSearch(c,0,len(self.ranges)-1)
@@ -390,13 +397,14 @@ class CharClass:
 	
 	def AddClass(self,c):
 		"""Adds all the characters in c to the character class (union operation)"""
+		self._Changed()
 		if self.ranges:
 			for r in c.ranges:
 				self.AddRange(r[0],r[1])
 		else:
 			# take a short cut here, if we have no ranges yet just copy them
 			for r in c.ranges:
-				self.ranges.append(r)
+				self.ranges.append([r[0],r[1]])
 							
 	def SubtractClass(self,c):
 		"""Subtracts all the characters in c from the character class"""
@@ -405,10 +413,16 @@ class CharClass:
 	
 	def Negate(self):
 		"""Negates this character class"""
+		self._Changed()
 		max=CharClass([unichr(0),unichr(maxunicode)])
 		max.SubtractClass(self)
 		self.ranges=max.ranges
 				
+	def _Changed(self):
+		"""Used internally to discard cached search structures when the
+		class is modified"""
+		self._ends=self._anyRE=self._allRE=None
+		
 	def Merge(self,index):
 		"""Used internally to merge the range at index with its neighbours if possible"""
 		a,z=self.ranges[index]
@@ -431,13 +445,30 @@ class CharClass:
 		"""Test a unicode character, return True if the character is in the class.
 
 		If c is None False is returned."""
-		if c is None:
-			return False
-		elif self.ranges:
-			match,index=self.BisectionSearch(c,0,len(self.ranges)-1)
-			return match
-		else:
+		if c is None or not self.ranges:
 			return False
+		if self._ends is None:
+			self._ends=map(lambda r:r[1],self.ranges)
+		i=bisect_left(self._ends,c)
+		return i<len(self._ends) and self.ranges[i][0]<=c
+
+	def TestAll(self,src):
+		"""Tests a unicode string, returns True if all the characters in
+		*src* are in the class.
+		
+		The test is done with a single compiled regular expression rather
+		than character by character so is much faster than calling
+		:py:meth:`Test` in a loop.  An empty string returns True."""
+		if self._allRE is None:
+			self._allRE=re.compile(u"%s*\\Z"%unicode(self))
+		return self._allRE.match(src) is not None
+
+	def TestAny(self,src):
+		"""Tests a unicode string, returns True if any of the characters in
+		*src* are in the class.  An empty string returns False."""
+		if self._anyRE is None:
+			self._anyRE=re.compile(unicode(self))
+		return self._anyRE.search(src) is not None
 
 	def BisectionSearch(self,c,rmin,rmax):
 		"""Performs a recursive bisection search on the character class for c.
@@ -467,12 +498,122 @@ class CharClass:
 				return self.BisectionSearch(c,rtry+1,rmax)
 
 
+class _UCDTable(object):
+	"""Provides lazy access to a table of character classes stored in a
+	resource file.
+	
+	The file format is designed to be memory-mapped, the class for a
+	single name can then be read without unpacking the rest of the
+	table.  The file starts with a 4-byte magic string followed by the
+	number of entries in the index as a little-endian 32-bit integer. 
+	Each index entry is a 1-byte name length, the ASCII name, the file
+	offset of the entry's ranges and the number of ranges, the last two
+	as little-endian 32-bit integers.  The ranges themselves are stored
+	as pairs of little-endian 32-bit code points."""
+	
+	MAGIC='UCD5'
+	
+	def __init__(self,fileName):
+		self.fileName=fileName
+		self.data=None		#: the mapped (or read) contents of the file
+		self.index=None		#: a dictionary mapping names onto (offset,nRanges)
+	
+	def Open(self):
+		"""Maps the resource file and reads the index"""
+		f=file(os.path.join(os.path.dirname(__file__),self.fileName),'rb')
+		try:
+			try:
+				data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+			except (EnvironmentError,ValueError):
+				data=f.read()
+		finally:
+			f.close()
+		if data[0:4]!=self.MAGIC:
+			raise ValueError("%s: not a unicode5 table file"%self.fileName)
+		nEntries,=struct.unpack_from('<I',data,4)
+		index={}
+		pos=8
+		for i in xrange(nEntries):
+			nameLen=ord(data[pos])
+			name=data[pos+1:pos+1+nameLen]
+			pos=pos+1+nameLen
+			index[name]=struct.unpack_from('<II',data,pos)
+			pos=pos+8
+		self.data=data
+		self.index=index
+		
+	def Close(self):
+		"""Releases the resource file, it will be re-opened on demand"""
+		if isinstance(self.data,mmap.mmap):
+			self.data.close()
+		self.data=self.index=None
+			
+	def keys(self):
+		"""Returns a list of the names in the table"""
+		if self.index is None:
+			self.Open()
+		return self.index.keys()
+		
+	def GetClass(self,name):
+		"""Returns a new :py:class:`CharClass` instance for *name*
+		
+		Raises KeyError if there is no entry for *name*.  In narrow
+		python builds the class is truncated at maxunicode."""
+		if self.index is None:
+			self.Open()
+		offset,nRanges=self.index[name]
+		codes=struct.unpack_from('<%iI'%(2*nRanges),self.data,offset)
+		ranges=[]
+		for i in xrange(0,2*nRanges,2):
+			a,z=codes[i:i+2]
+			if a>maxunicode:
+				break
+			elif z>maxunicode:
+				z=maxunicode
+			ranges.append([unichr(a),unichr(z)])
+		result=CharClass()
+		result.ranges=ranges
+		return result
+
+
+def _SaveTable(table,fileName):
+	"""Saves a dictionary of character classes to a resource file
+	
+	See :py:class:`_UCDTable` for details of the file format."""
+	names=sorted(table.keys())
+	index=[]
+	data=[]
+	offset=8+sum(map(lambda x:9+len(x),names))
+	for name in names:
+		name=str(name)
+		ranges=table[name].ranges
+		index.append(struct.pack('<B',len(name)))
+		index.append(name)
+		index.append(struct.pack('<II',offset,len(ranges)))
+		for a,z in ranges:
+			data.append(struct.pack('<II',ord(a),ord(z)))
+		offset=offset+8*len(ranges)
+	f=file(os.path.join(os.path.dirname(__file__),fileName),'wb')
+	try:
+		f.write(_UCDTable.MAGIC)
+		f.write(struct.pack('<I',len(names)))
+		f.write(string.join(index,''))
+		f.write(string.join(data,''))
+	finally:
+		f.close()
+
+
+_CategoryTable=_UCDTable(CATEGORY_FILE)
+_BlockTable=_UCDTable(BLOCK_FILE)
+
+
 def LoadCategoryTable():
-	"""Loads the category table from a resource file."""
-	global UCDCategories
-	f=file(os.path.join(os.path.dirname(__file__),CATEGORY_FILE),'r')
-	UCDCategories=load(f)
-	f.close()
+	"""Loads the entire category table from a resource file.
+	
+	You don't normally need to call this function, categories are
+	loaded individually on demand by :py:meth:`CharClass.UCDCategory`."""
+	for catName in _CategoryTable.keys():
+		CharClass.UCDCategory(catName)
 
 
 def _GetCatClass(catName):
@@ -532,17 +673,17 @@ def ParseCategoryTable():
 		nextCode=codePoint+1
 	# when we finally exit from this loop we should not be in a marked range
 	assert mark is None,"Unicode database ended during character range definition: %08X-?"%mark
-	f=file(os.path.join(os.path.dirname(__file__),CATEGORY_FILE),'w')
-	dump(UCDCategories,f)
-	f.close()
+	_CategoryTable.Close()
+	_SaveTable(UCDCategories,CATEGORY_FILE)
 
 
 def LoadBlockTable():
-	"""Loads the block table from a resource file."""
-	global UCDBlocks
-	f=file(os.path.join(os.path.dirname(__file__),BLOCK_FILE),'r')
-	UCDBlocks=load(f)
-	f.close()
+	"""Loads the entire block table from a resource file.
+	
+	You don't normally need to call this function, blocks are loaded
+	individually on demand by :py:meth:`CharClass.UCDBlock`."""
+	for blockName in _BlockTable.keys():
+		CharClass.UCDBlock(blockName)
 
 
 def _NormalizeBlockName(blockName):
@@ -579,9 +720,8 @@ def ParseBlockTable():
 				print "Warning: block table limited by narrow python build"
 			narrowWarning=True
 		UCDBlocks[blockName]=CharClass((unichr(codePoint0),unichr(codePoint1)))
-	f=file(os.path.join(os.path.dirname(__file__),BLOCK_FILE),'w')
-	dump(UCDBlocks,f)
-	f.close()
+	_BlockTable.Close()
+	_SaveTable(UCDBlocks,BLOCK_FILE)
 
 
 class BasicParser(object):
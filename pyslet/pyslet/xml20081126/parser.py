@@ -1,19 +1,30 @@
 #! /usr/bin/env python
 
+import re, itertools, logging
+from collections import deque
+from copy import copy
+
 from pyslet.xml20081126.structures import *
 
 
 def IsValidNmToken(nmToken):
 	"""Tests if nmToken is a string matching production [5] Nmtoken"""
 	if nmToken:
-		for c in nmToken:
-			if not IsNameChar(c):
-				return False
-		return True
+		return NmtokenRE.match(nmToken) is not None
 	else:
 		return False
 
 
+# Regular expressions used to scan runs of characters in a single step, none
+# of them match the carriage return as this requires end-of-line handling
+CharDataRunRE=re.compile(u"[^<&\\]\\r]+")
+NameCharRunRE=re.compile(unicode(NameCharClass)+u"+")
+SRunRE=re.compile(u"[ \\t\\n]+")
+AttValueRunRE={
+	u'"':re.compile(u'[^<&"\\t\\n\\r]+'),
+	u"'":re.compile(u"[^<&'\\t\\n\\r]+")}
+
+
 class XMLParser:
 	
 	DocumentClassTable={}
@@ -29,6 +40,17 @@ class XMLParser:
 	RefModeInEntityValue=4		#: Treat references as per "in EntityValue" rules
 	RefModeInDTD=5				#: Treat references as per "in DTD" rules
 	
+	EventStart=0				#: :py:meth:`IterParse` event: an element has been started
+	EventEnd=1					#: :py:meth:`IterParse` event: an element has been ended
+	EventData=2					#: :py:meth:`IterParse` event: data has been added to an element
+	
+	DTDCache=None
+	"""The default value of :py:attr:`dtdCache` for new parsers.
+	
+	Set this to an instance of
+	:py:class:`~pyslet.xml20081126.structures.XMLDTDCache` to share
+	external DTD subsets between all validating parsers."""
+	
 	PredefinedEntities={
 		'lt':'<',
 		'gt':'>',
@@ -103,7 +125,12 @@ class XMLParser:
 			self.theChar=self.entity.theChar	#: the current character; None indicates end of stream
 		else:
 			self.theChar=None
-		self.buff=[]
+		self.buff=deque()
+		"""A queue of characters that have been pushed back for re-parsing.
+
+		When not empty, the first item in the queue is the current character
+		and the last item is the current character of the current entity (if
+		any).  See :py:meth:`BuffText` for more information."""
 		self.stagBuffer=None
 		self.declaration=None
 		"""The declaration parsed or None.""" 
@@ -120,6 +147,17 @@ class XMLParser:
 		"""The current element being parsed."""
 		self.elementType=None
 		"""The element type of the current element."""
+		self.dtdCache=XMLParser.DTDCache
+		"""An optional :py:class:`~pyslet.xml20081126.structures.XMLDTDCache`
+		used to share the external DTD subset between parsers.
+		
+		Defaults to the value of :py:attr:`DTDCache`, the cache is only used
+		when checking validity (otherwise the external subset is not read)
+		and when the internal subset, if any, contains no declarations."""
+		self.dataEvents=None
+		"""A list of data strings waiting to be returned by :py:meth:`IterParse`.
+		
+		Set to None when data events are not required."""
 		self.idTable={}
 		self.idRefTable={}
 		self.cursor=None
@@ -140,10 +178,10 @@ class XMLParser:
 		there are no characters left in the current entity then entities are
 		popped from an internal entity stack automatically."""
 		if self.buff:
-			self.buff=self.buff[1:]
+			self.buff.popleft()
 		if self.buff:
 			self.theChar=self.buff[0]
-		else:	
+		else:
 			self.entity.NextChar()
 			self.theChar=self.entity.theChar
 			while self.theChar is None and self.entityStack:
@@ -151,19 +189,51 @@ class XMLParser:
 				self.entity=self.entityStack.pop()
 				self.theChar=self.entity.theChar
 
+	def _ScanRun(self,runRE):
+		"""Parses a run of characters matching *runRE* in a single step.
+
+		This is a fast path for the productions that consume long runs of
+		simple characters.  The run is matched directly against the current
+		entity's buffered text, see
+		:py:meth:`~pyslet.xml20081126.structures.XMLEntity.NextRun`.
+
+		Returns the run of characters parsed or an empty string if the fast
+		path is not available, in which case the caller must fall back to
+		parsing one character at a time.  The fast path is not used while
+		there are buffered characters waiting to be re-parsed or when the
+		:py:attr:`unicodeCompatibility` option is in force."""
+		if self.buff or self.unicodeCompatibility or self.theChar is None:
+			return ''
+		run=self.entity.NextRun(runRE)
+		if run:
+			self.theChar=self.entity.theChar
+			while self.theChar is None and self.entityStack:
+				self.entity.Close()
+				self.entity=self.entityStack.pop()
+				self.theChar=self.entity.theChar
+		return run
+
 	def BuffText(self,unusedChars):
+		"""Pushes *unusedChars* back on to the parser.
+
+		The characters in *unusedChars* will be parsed again before the
+		current character, :py:attr:`theChar` is set to the first character
+		in *unusedChars*.  The cost of pushing characters back is proportional
+		to the length of *unusedChars* only, it does not depend on the number
+		of characters that are already buffered."""
 		if unusedChars:
-			if self.buff:
-				self.buff=list(unusedChars)+self.buff
-			else:
-				self.buff=list(unusedChars)
-				if self.entity.theChar is not None:
-					self.buff.append(self.entity.theChar)
+			if not self.buff and self.entity.theChar is not None:
+				self.buff.append(self.entity.theChar)
+			self.buff.extendleft(reversed(unusedChars))
 			self.theChar=self.buff[0]
 	
 	def GetBuff(self):
+		"""Returns any buffered characters following the current character.
+
+		The result is a string that can be passed to :py:meth:`BuffText` of
+		another parser."""
 		if len(self.buff)>1:
-			return string.join(self.buff[1:],'')
+			return string.join(itertools.islice(self.buff,1,None),'')
 		else:
 			return ''
 
@@ -430,12 +500,207 @@ class XMLParser:
 		if self.checkValidity:
 			for idref in self.idRefTable.keys():
 				if not idref in self.idTable:
-					self.ValidityError("IDREF: %s does not match any ID attribute value")
+					self.ValidityError("IDREF: %s does not match any ID attribute value"%idref)
 		self.ParseMisc()
 		if self.theChar is not None and not self.dontCheckWellFormedness:
 			self.WellFormednessError("Unparsed characters in entity after document: %s"%repr(self.theChar))
 		return self.doc
 		
+	def IterParse(self,doc=None,elementClasses=None):
+		"""[1] document: parses a Document incrementally, generating events.
+		
+		This method is a generator that parses the document in the same way
+		as :py:meth:`ParseDocument` but yields (*event*, *node*) tuples as
+		it goes.  *event* is one of the Event* family of constants defined
+		above.  For start and end events *node* is the element being started
+		or ended, for data events it is the character data that has just
+		been added to the current element.  The document being parsed is
+		available as :py:attr:`doc`.
+
+		Elements are created with :py:meth:`GetSTagClass` exactly as they
+		are by :py:meth:`ParseElement` so derived parsers (including those
+		that do namespace processing) generate the same typed elements as
+		they would when parsing the whole document.
+		
+		If *elementClasses* is not None then it must be a class object, or a
+		tuple of class objects, suitable for passing to isinstance.  In this
+		mode only end events are generated and only for elements that are
+		instances of *elementClasses*.  When the generator is resumed the
+		element is deleted from its parent (see
+		:py:meth:`~pyslet.xml20081126.structures.Element.DeleteChild`) so the
+		memory used is bounded by the size of the largest such element
+		rather than by the size of the document.  Any character data in
+		the parent that precedes the deleted element is deleted with it.
+		Parents must support the deletion of selected elements: if
+		DeleteChild raises XMLUnknownChild (or the parent has no such
+		method) the element is left in place and a warning is logged, the
+		parse continues but the whole document is then kept in memory.
+		For example::
+
+			for event,item in parser.IterParse(elementClasses=qtiv1.item.Item):
+				# item is a complete Item instance
+				Migrate(item)
+
+		The SGML-like options :py:attr:`sgmlOmittag` and :py:attr:`sgmlContent`
+		are not supported incrementally: if either is set the whole document
+		is parsed first and the events are then generated from the resulting
+		element tree (in this case elements are not deleted)."""
+		if self.sgmlOmittag or self.sgmlContent:
+			self.ParseDocument(doc)
+			for event in self._TreeEvents(self.doc.root,elementClasses):
+				yield event
+			return
+		self.doc=doc
+		if self.checkAllErrors:
+			self.checkCompatibility=True
+		if self.checkCompatibility:
+			self.checkValidity=True
+		if self.checkValidity:
+			self.valid=True
+		else:
+			self.valid=None
+		self.nonFatalErrors=[]
+		self.ParseProlog()
+		if self.doc is None:
+			if self.dtd.name is not None:
+				self.doc=self.GetDocumentClass(self.dtd)()
+		if elementClasses is None:
+			self.dataEvents=[]
+		# each item in the stack is a tuple of the element's name and the
+		# saved values of element, elementType and cursor for its parent
+		stack=[]
+		warned=False
+		try:
+			while True:
+				# the parser is positioned at a start tag
+				name,attrs,empty=self.ParseSTag()
+				saveElement=self.element
+				saveElementType=self.elementType
+				result=self._StartElement(name,attrs,empty)
+				if result is None:
+					# the tag was buffered, it ends the parent's content
+					if not stack:
+						break
+					ended=True
+				else:
+					ended=False
+					name,empty,saveCursor=result
+					stack.append((name,saveElement,saveElementType,saveCursor))
+					if elementClasses is None:
+						yield XMLParser.EventStart,self.element
+				while stack:
+					if ended:
+						# the end tag was omitted, as in ParseElement
+						ended=False
+						self.CheckExpectedParticle('')
+					elif not empty:
+						found=self._IterContent()
+						if self.dataEvents:
+							for data in self.dataEvents:
+								yield XMLParser.EventData,data
+							del self.dataEvents[:]
+						if found is None:
+							continue
+						elif found:
+							# start of a child element
+							break
+						endName=self.ParseETag()
+						if endName!=stack[-1][0]:
+							if self.dontCheckWellFormedness:
+								# ignore spurious end tags
+								continue
+							else:
+								self.WellFormednessError("Element Type Mismatch: found </%s>, expected <%s/>"%(endName,stack[-1][0]))
+						self.CheckExpectedParticle('')
+					empty=False
+					element=self.element
+					element.ContentChanged()
+					name,self.element,self.elementType,self.cursor=stack.pop()
+					if elementClasses is None:
+						yield XMLParser.EventEnd,element
+					elif isinstance(element,elementClasses):
+						yield XMLParser.EventEnd,element
+						if self.element is not None:
+							reason=None
+							if hasattr(self.element,'DeleteChild'):
+								try:
+									self.element.DeleteChild(element)
+									# character data between selected elements goes too
+									self.element.DeleteTrailingData()
+								except XMLUnknownChild,e:
+									reason=str(e)
+							else:
+								reason="no DeleteChild method"
+							if reason is not None and not warned:
+								logging.warning("IterParse: %s can't delete child %s, memory use is not bounded: %s",
+									self.element.__class__.__name__,element.__class__.__name__,reason)
+								warned=True
+				if not stack:
+					break
+		finally:
+			self.dataEvents=None
+		if self.checkValidity:
+			for idref in self.idRefTable.keys():
+				if not idref in self.idTable:
+					self.ValidityError("IDREF: %s does not match any ID attribute value"%idref)
+		self.ParseMisc()
+		if self.theChar is not None and not self.dontCheckWellFormedness:
+			self.WellFormednessError("Unparsed characters in entity after document: %s"%repr(self.theChar))
+
+	def _IterContent(self):
+		"""[43] content: parses a single item of content for :py:meth:`IterParse`
+		
+		Returns True if the start of a child element was found, False if an
+		end tag (or the end of the entity) was found and None if any other
+		content was parsed.  The markup that ends the content is left
+		unparsed."""
+		if self.theChar=='<':
+			self.NextChar()
+			if self.theChar=='!':
+				self.NextChar()
+				if self.theChar=='-':
+					self.ParseRequiredLiteral('--')
+					self.ParseComment(True)
+					if self.checkValidity and self.elementType and self.elementType.contentType==ElementType.Empty:
+						self.ValidityError("Element Valid: comment not allowed in element declared EMPTY: %s"%self.elementType.name)
+				elif self.theChar=='[':
+					self.ParseRequiredLiteral('[CDATA[')
+					self.ParseCDSect(True)
+				else:
+					self.WellFormednessError("Expected Comment or CDSect")
+			elif self.theChar=='?':
+				self.NextChar()
+				self.ParsePI(True)
+				if self.checkValidity and self.elementType and self.elementType.contentType==ElementType.Empty:
+					self.ValidityError("Element Valid: processing instruction not allowed in element declared EMPTY: %s"%self.elementType.name)
+			else:
+				found=self.theChar!='/'
+				self.BuffText('<')
+				return found
+		elif self.theChar=='&':
+			data=self.ParseReference()
+			if self.checkValidity and self.elementType and self.elementType.contentType==ElementType.Empty:
+				self.ValidityError("Element Valid: reference not allowed in element declared EMPTY: %s"%self.elementType.name)
+			self.HandleData(data,True)
+		elif self.theChar is None:
+			return False
+		else:
+			self.ParseCharData()
+		return None
+		
+	def _TreeEvents(self,element,elementClasses):
+		"""Generates :py:meth:`IterParse` events from a parsed *element*"""
+		if elementClasses is None:
+			yield XMLParser.EventStart,element
+		for child in element.GetChildren():
+			if isinstance(child,Element):
+				for event in self._TreeEvents(child,elementClasses):
+					yield event
+			elif elementClasses is None:
+				yield XMLParser.EventData,child
+		if elementClasses is None or isinstance(element,elementClasses):
+			yield XMLParser.EventEnd,element
+
 	def GetDocumentClass(self,dtd):
 		"""Returns a class object derived from
 		:py:class:`~pyslet.xml20081126.structures.Document` suitable for
@@ -516,8 +781,12 @@ class XMLParser:
 		sLen=0
 		while True:
 			if self.IsS():
-				s.append(self.theChar)
-				self.NextChar()
+				run=self._ScanRun(SRunRE)
+				if run:
+					s.append(run)
+				else:
+					s.append(self.theChar)
+					self.NextChar()
 			elif self.theChar=='%' and self.refMode==XMLParser.RefModeInDTD:
 				self.NextChar()
 				if IsNameStartChar(self.theChar):
@@ -557,11 +826,15 @@ class XMLParser:
 		None is returned."""
 		name=[]
 		if IsNameStartChar(self.theChar):
-			name.append(self.theChar)
-			self.NextChar()
+			# NameStartChar is a subset of NameChar so we can scan the
+			# whole name as a single run
 			while IsNameChar(self.theChar):
-				name.append(self.theChar)
-				self.NextChar()
+				run=self._ScanRun(NameCharRunRE)
+				if run:
+					name.append(run)
+				else:
+					name.append(self.theChar)
+					self.NextChar()
 		if name:
 			return string.join(name,'')
 		else:
@@ -604,8 +877,12 @@ class XMLParser:
 		If no Nmtoken can be parsed then None is returned."""
 		nmtoken=[]
 		while IsNameChar(self.theChar):
-			nmtoken.append(self.theChar)
-			self.NextChar()
+			run=self._ScanRun(NameCharRunRE)
+			if run:
+				nmtoken.append(run)
+			else:
+				nmtoken.append(self.theChar)
+				self.NextChar()
 		if nmtoken:
 			return string.join(nmtoken,'')
 		else:
@@ -691,8 +968,14 @@ class XMLParser:
 		qEntity=self.entity
 		saveMode=self.refMode
 		self.refMode=XMLParser.RefModeInAttributeValue
+		runRE=AttValueRunRE.get(q,None)
 		while True:
 			try:
+				if runRE is not None:
+					run=self._ScanRun(runRE)
+					if run:
+						value.append(run)
+						continue
 				if self.theChar is None:
 					self.WellFormednessError(production+":EOF in AttValue")
 				elif self.theChar==q:
@@ -782,6 +1065,7 @@ class XMLParser:
 		occurr until the first non-S character (so any implied start tag is
 		treated as being immediately prior to the first non-S)."""
 		data=[]
+		dataLen=0
 		while self.theChar is not None:
 			if self.theChar=='<' or self.theChar=='&':
 				break
@@ -789,10 +1073,16 @@ class XMLParser:
 				if self.ParseLiteral(']]>'):
 					self.BuffText(']]>')
 					break
-			self.IsS()		# force Unicode compatible white space handling
-			data.append(self.theChar)
-			self.NextChar()
-			if len(data)>=XMLEntity.ChunkSize:
+			run=self._ScanRun(CharDataRunRE)
+			if run:
+				data.append(run)
+				dataLen+=len(run)
+			else:
+				self.IsS()		# force Unicode compatible white space handling
+				data.append(self.theChar)
+				dataLen+=1
+				self.NextChar()
+			if dataLen>=XMLEntity.ChunkSize:
 				data=string.join(data,'')
 				try:
 					self.HandleData(data)
@@ -800,7 +1090,8 @@ class XMLParser:
 					if self.sgmlOmittag:
 						return StripLeadingS(data)
 					raise
-				data=[]				
+				data=[]
+				dataLen=0
 		data=string.join(data,'')
 		try:
 			self.HandleData(data)
@@ -919,21 +1210,37 @@ class XMLParser:
 		"""[19] CDStart: parses the literal that starts a CDATA section."""
 		self.ParseRequiredLiteral('<![CDATA[',"[19] CDStart")
 		
+	CDataRunRE={}
+	"""A cache of the regular expressions used to scan runs of CData, keyed
+	on the literal that ends the CData."""
+
 	def ParseCData(self,cdEnd=']]>'):
 		"""[20] CData: parses a run of CData up to but not including *cdEnd*.
 		
 		This method adds any parsed data to the current element."""
 		data=[]
+		dataLen=0
+		runRE=self.CDataRunRE.get(cdEnd,None)
+		if runRE is None:
+			runRE=re.compile(u"[^%s%s\\r]+"%(re.escape(cdEnd[0].lower()),re.escape(cdEnd[0].upper())))
+			self.CDataRunRE[cdEnd]=runRE
 		while self.theChar is not None:
 			if self.ParseLiteral(cdEnd):
 				self.BuffText(cdEnd)
 				break
-			data.append(self.theChar)
-			self.NextChar()
-			if len(data)>=XMLEntity.ChunkSize:
+			run=self._ScanRun(runRE)
+			if run:
+				data.append(run)
+				dataLen+=len(run)
+			else:
+				data.append(self.theChar)
+				dataLen+=1
+				self.NextChar()
+			if dataLen>=XMLEntity.ChunkSize:
 				data=string.join(data,'')
 				self.HandleData(data,True)
-				data=[]				
+				data=[]
+				dataLen=0
 		data=string.join(data,'')
 		self.HandleData(data,True)
 		
@@ -1086,12 +1393,60 @@ class XMLParser:
 			# but only if we are checking validity
 			src=self.ResolveExternalID(self.dtd.externalID)
 			if src:
-				externalDTDSubset=XMLEntity(src)
-				self.PushEntity(externalDTDSubset)
-				self.ParseExtSubset()
+				key=self._GetCachedExtSubset(src)
+				if key is not None:
+					externalDTDSubset=XMLEntity(src)
+					self.PushEntity(externalDTDSubset)
+					nErrors=len(self.nonFatalErrors)
+					self.ParseExtSubset()
+					if key is not False and len(self.nonFatalErrors)==nErrors:
+						self._SetCachedExtSubset(key)
 		self.ParseRequiredLiteral('>',production)
 		self.refMode=saveMode
 		return self.dtd
+	
+	def _GetCachedExtSubset(self,location):
+		# Looks up the external subset at location in dtdCache, if found the
+		# cached declarations are added to dtd and None is returned.
+		# Otherwise, returns the key to use when caching the subset or
+		# False if the cache is not being used.
+		if self.dtdCache is None:
+			return False
+		dtd=self.dtd
+		if (dtd.parameterEntities or dtd.generalEntities or dtd.notations or
+			dtd.elementList or dtd.attributeLists):
+			# the internal subset is processed first and may change the
+			# meaning of the external subset
+			return False
+		key=self.dtdCache.GetKey(dtd.externalID,location,(self.checkCompatibility,
+			self.checkAllErrors,self.dontCheckWellFormedness,self.unicodeCompatibility,
+			self.sgmlNamecaseGeneral,self.sgmlNamecaseEntity))
+		subset=self.dtdCache.GetDTD(key)
+		if subset is None:
+			return key
+		# entities hold the state used when reading them so are copied
+		for name,e in subset.parameterEntities.iteritems():
+			dtd.parameterEntities[name]=copy(e)
+		for name,e in subset.generalEntities.iteritems():
+			dtd.generalEntities[name]=copy(e)
+		dtd.notations.update(subset.notations)
+		dtd.elementList.update(subset.elementList)
+		for name,aList in subset.attributeLists.iteritems():
+			dtd.attributeLists[name]=aList.copy()
+		dtd.contentAutomata.update(subset.contentAutomata)
+		return None
+	
+	def _SetCachedExtSubset(self,key):
+		# Saves the declarations in dtd, which must have been obtained
+		# from the external subset only, in dtdCache
+		subset=XMLDTD()
+		subset.parameterEntities=self.dtd.parameterEntities.copy()
+		subset.generalEntities=self.dtd.generalEntities.copy()
+		subset.notations=self.dtd.notations.copy()
+		subset.elementList=self.dtd.elementList.copy()
+		for name,aList in self.dtd.attributeLists.iteritems():
+			subset.attributeLists[name]=aList.copy()
+		self.dtdCache.SetDTD(key,subset)
 		
 	def ParseDeclSep(self):
 		"""[28a] DeclSep: parses a declaration separator."""
@@ -1230,7 +1585,6 @@ class XMLParser:
 		production="[39] element"
 		saveElement=self.element
 		saveElementType=self.elementType
-		saveCursor=None
 		if self.sgmlOmittag and self.theChar!='<':
 			# Leading data means the start tag was omitted (perhaps at the start of the doc)
 			name=None
@@ -1238,56 +1592,10 @@ class XMLParser:
 			empty=False
 		else:
 			name,attrs,empty=self.ParseSTag()			
-			self.CheckAttributes(name,attrs)
-			if self.checkValidity:
-				if self.element is None and self.dtd.name is not None and self.dtd.name!=name:
-					self.ValidityError("Root Element Type: expected element %s"%self.dtd.name)
-				# The current particle map must have an entry for name...
-				self.CheckExpectedParticle(name)
-				saveCursor=self.cursor
-				self.elementType=self.dtd.GetElementType(name)
-				if self.elementType is None:
-					# An element is valid if there is a declaration matching elementdecl where
-					# the Name matches the element type...
-					self.ValidityError("Element Valid: no element declaration for %s"%name)
-					self.cursor=None
-				else:
-					self.cursor=ContentParticleCursor(self.elementType)
-			if self.stagBuffer:
-				name,attrs,empty=self.stagBuffer
-				self.stagBuffer=None
-		elementClass,elementName,bufferTag=self.GetSTagClass(name,attrs)
-		if elementClass:
-			if bufferTag and name:
-				# elementClass represents an omitted start tag
-				self.stagBuffer=(name,attrs,empty)
-				# This strange text is a valid start tag that ensures we'll be called again
-				self.BuffText("<:>")
-				# omitted start tags introduce elements that have no attributes and must not be empty
-				attrs={}
-				empty=False
-		else:
-			# this start tag indicates an omitted end tag: always buffered
-			if name:
-				self.stagBuffer=(name,attrs,empty)
-				self.BuffText("<:>")
+		result=self._StartElement(name,attrs,empty)
+		if result is None:
 			return False
-		if self.element is None:
-			self.element=self.doc.ChildElement(elementClass,elementName)
-		else:
-			self.element=self.element.ChildElement(elementClass,elementName)
-		self.element.Reset()
-		if self.sgmlContent and getattr(elementClass,'XMLCONTENT',XMLMixedContent)==XMLEmpty:
-			empty=True
-		for attr in attrs.keys():
-			try:
-				self.element.SetAttribute(attr,attrs[attr])
-			except ValueError,e:
-				if self.raiseValidityErrors:
-					raise XMLValidityError(str(e))
-			except XMLValidityError:
-				if self.raiseValidityErrors:
-					raise
+		name,empty,saveCursor=result
 		if not empty:
 			saveDataCount=self.dataCount
 			if self.sgmlContent and getattr(self.element,'SGMLCONTENT',None)==ElementType.SGMLCDATA:
@@ -1347,6 +1655,77 @@ class XMLParser:
 		self.cursor=saveCursor
 		return True
 
+	def _StartElement(self,name,attrs,empty):
+		"""Creates the element introduced by a start tag.
+		
+		Used by :py:meth:`ParseElement` and :py:meth:`IterParse`.  *name*,
+		*attrs* and *empty* are the values returned by :py:meth:`ParseSTag`
+		or, if the start tag was omitted (see :py:attr:`sgmlOmittag`),
+		None, an empty dictionary and False.
+		
+		The attributes and element type are checked and the element is
+		created as a child of the current element using the class returned
+		by :py:meth:`GetSTagClass`, it becomes the current element.  The
+		result is a triple of the name of the element, the empty flag
+		(which may differ from the values passed if the tag was buffered)
+		and the content model cursor to restore when the element ends.
+		
+		If the start tag indicates an omitted end tag then it is buffered,
+		the current element is unchanged and None is returned."""
+		saveCursor=None
+		if name is not None:
+			self.CheckAttributes(name,attrs)
+			if self.checkValidity:
+				if self.element is None and self.dtd.name is not None and self.dtd.name!=name:
+					self.ValidityError("Root Element Type: expected element %s"%self.dtd.name)
+				# The current particle map must have an entry for name...
+				self.CheckExpectedParticle(name)
+				saveCursor=self.cursor
+				self.elementType=self.dtd.GetElementType(name)
+				if self.elementType is None:
+					# An element is valid if there is a declaration matching elementdecl where
+					# the Name matches the element type...
+					self.ValidityError("Element Valid: no element declaration for %s"%name)
+					self.cursor=None
+				else:
+					self.cursor=ContentModelCursor(self.dtd.GetContentAutomaton(name))
+			if self.stagBuffer:
+				name,attrs,empty=self.stagBuffer
+				self.stagBuffer=None
+		elementClass,elementName,bufferTag=self.GetSTagClass(name,attrs)
+		if elementClass:
+			if bufferTag and name:
+				# elementClass represents an omitted start tag
+				self.stagBuffer=(name,attrs,empty)
+				# This strange text is a valid start tag that ensures we'll be called again
+				self.BuffText("<:>")
+				# omitted start tags introduce elements that have no attributes and must not be empty
+				attrs={}
+				empty=False
+		else:
+			# this start tag indicates an omitted end tag: always buffered
+			if name:
+				self.stagBuffer=(name,attrs,empty)
+				self.BuffText("<:>")
+			return None
+		if self.element is None:
+			self.element=self.doc.ChildElement(elementClass,elementName)
+		else:
+			self.element=self.element.ChildElement(elementClass,elementName)
+		self.element.Reset()
+		if self.sgmlContent and getattr(elementClass,'XMLCONTENT',XMLMixedContent)==XMLEmpty:
+			empty=True
+		for attr in attrs.keys():
+			try:
+				self.element.SetAttribute(attr,attrs[attr])
+			except ValueError,e:
+				if self.raiseValidityErrors:
+					raise XMLValidityError(str(e))
+			except XMLValidityError:
+				if self.raiseValidityErrors:
+					raise
+		return name,empty,saveCursor
+
 	def CheckAttributes(self,name,attrs):
 		"""Checks *attrs* against the declarations for element *name*.
 		
@@ -1700,6 +2079,8 @@ class XMLParser:
 					self.ValidityError("Element Valid: character data is not allowed in element %s"%self.elementType.name)
 			self.element.AddData(data)
 			self.dataCount+=len(data)
+			if self.dataEvents is not None:
+				self.dataEvents.append(data)
 		
 	def UnhandledData(self,data):
 		"""[43] content: manages unhandled data in content.
@@ -1,10 +1,10 @@
 #! /usr/bin/env python
 
-import string, types
+import string, types, re
 from StringIO import StringIO
-import urlparse, os, os.path
+import urlparse, os, os.path, stat
 from sys import maxunicode
-import codecs, random
+import codecs, random, hashlib, pickle
 from types import *
 from copy import copy
 import warnings
@@ -42,6 +42,7 @@ class XMLUnimplementedError(XMLError): pass
 class XMLUnexpectedError(XMLError): pass
 class XMLUnexpectedHTTPResponse(XMLError): pass
 class XMLUnsupportedSchemeError(XMLError): pass
+class XMLUnsafeCacheError(XMLError): pass
 
 class XMLFatalError(XMLError): pass
 class XMLWellFormedError(XMLFatalError): pass
@@ -57,88 +58,107 @@ from pyslet.unicode5 import CharClass
 from pyslet import rfc2616 as http
 
 
+EscapeTable=(('&','&amp;'),('<','&lt;'),('>','&gt;'),('\r','&#xD;'))
+"""The table of replacements used to escape XML reserved characters in
+character data.
+
+The ampersand must be replaced first.  We also escape return characters
+to prevent them being ignored."""
+
+EscapeAposTable=EscapeTable+(("'",'&apos;'),)		#: escapes apostrophes too
+EscapeQuotTable=EscapeTable+(('"','&quot;'),)		#: escapes quotation marks too
+Escape7AposTable=EscapeTable+(("'",'&#x27;'),)		#: as EscapeAposTable using a character reference
+Escape7QuotTable=EscapeTable+(('"','&#x22;'),)		#: as EscapeQuotTable using a character reference
+
+NonASCIIRE=re.compile(u'[^\\x00-\\x7F]')
+
+def _EscapeNonASCII(match):
+	code=ord(match.group())
+	if code>0xFFFFFF:
+		return "&#x%08X;"%code
+	elif code>0xFFFF:
+		return "&#x%06X;"%code
+	elif code>0xFF:
+		return "&#x%04X;"%code
+	else:
+		return "&#x%02X;"%code
+		
+def _Translate(src,table):
+	# each replacement is done in a single pass over the string, most
+	# strings contain none of the characters so we check first to avoid
+	# copying
+	for c,cStr in table:
+		if c in src:
+			src=src.replace(c,cStr)
+	return src
+	
+
 def EscapeCharData(src,quote=False):
 	"""Returns a unicode string with XML reserved characters escaped.
 	
 	We also escape return characters to prevent them being ignored.  If quote
-	is True then the string is returned as a quoted attribute value."""
-	data=[]
-	apos=0;quot=0
-	for c in src:
-		if c=='&':
-			data.append('&amp;')
-		elif c=='<':
-			data.append('&lt;')
-		elif c=='>':
-			data.append('&gt;')
-		elif c=='\r':
-			data.append('&#xD;')
-		elif c=='"':
-			quot+=1
-			data.append(c)
-		elif c=="'":
-			apos+=1
-			data.append(c)
-		else:
-			data.append(c)
+	is True then the string is returned as a quoted attribute value.
+	
+	The string is escaped using one of the precomputed replacement tables,
+	such as :py:data:`EscapeTable`."""
 	if quote:
-		if quot>apos:
-			if apos:
-				# escape apos
-				for i in xrange(len(data)):
-					if data[i]=="'":
-						data[i]='&apos;'
-			data=["'"]+data+["'"]
+		if src.count('"')>src.count("'"):
+			return "'%s'"%_Translate(src,EscapeAposTable)
 		else:
-			if quot:
-				# escape quot
-				for i in xrange(len(data)):
-					if data[i]=='"':
-						data[i]='&quot;'
-			data=['"']+data+['"']
-	return string.join(data,'')								
+			return '"%s"'%_Translate(src,EscapeQuotTable)
+	else:
+		return _Translate(src,EscapeTable)
 
 
 def EscapeCharData7(src,quote=False):
 	"""Returns a unicode string with reserved and non-ASCII characters escaped."""
-	dst=[]
 	if quote:
 		if "'" in src:
-			q='"';qStr='&#x22;'
+			src='"%s"'%_Translate(src,Escape7QuotTable)
 		elif '"' in src:
-			q="'";qStr='&#x27;'
+			src="'%s'"%_Translate(src,Escape7AposTable)
 		else:
-			q='"';qStr='&#x22;'
-		dst.append(q)
+			src='"%s"'%_Translate(src,EscapeTable)
 	else:
-		q=None;qStr=''
-	for c in src:
-		if ord(c)>0x7F:
-			if ord(c)>0xFF:
-				if ord(c)>0xFFFF:
-					if ord(c)>0xFFFFFF:
-						dst.append("&#x%08X;"%ord(c))
-					else:
-						dst.append("&#x%06X;"%ord(c))
-				else:
-						dst.append("&#x%04X;"%ord(c))
-			else:
-					dst.append("&#x%02X;"%ord(c))
-		elif c=='<':
-			dst.append("&lt;")
-		elif c=='&':
-			dst.append("&amp;")
-		elif c=='>':
-			dst.append("&gt;")
-		elif c=='\r':
-			dst.append("&#xD;")
-		elif c==q:
-			dst.append(qStr)
-		else:
-			dst.append(c)
-	if quote:
-		dst.append(q)	
-	return string.join(dst,'')
+		src=_Translate(src,EscapeTable)
+	if NonASCIIRE.search(src) is None:
+		return src
+	else:
+		return NonASCIIRE.sub(_EscapeNonASCII,src)
+
+
+def EncodeChunks(src,chunkSize,encoding='utf-8'):
+	"""Returns a generator of encoded byte strings.
+	
+	*src* is an iterable of unicode strings, such as the generator returned
+	by :py:meth:`Element.GenerateXML`.  The strings are encoded using
+	*encoding* and yielded in chunks of exactly *chunkSize* bytes, only the
+	last chunk may be shorter.
+	
+	At most one chunk, plus the string being encoded, is held in memory so
+	the result can be written to a file or returned as the body of a WSGI
+	response without first building the whole document in memory."""
+	encoder=codecs.getincrementalencoder(encoding)()
+	buff=[]
+	bSize=0
+	rest=''
+	for s in src:
+		buff.append(s)
+		bSize+=len(s)
+		if bSize>=chunkSize:
+			data=rest+encoder.encode(string.join(buff,u''))
+			buff=[]
+			pos=0
+			while len(data)-pos>=chunkSize:
+				yield data[pos:pos+chunkSize]
+				pos+=chunkSize
+			rest=data[pos:]
+			bSize=len(rest)
+	data=rest+encoder.encode(string.join(buff,u''),True)
+	pos=0
+	while pos<len(data):
+		yield data[pos:pos+chunkSize]
+		pos+=chunkSize
 	
 
 class Node(object):
@@ -219,6 +239,10 @@ class Node(object):
 class Document(Node):
 	"""Base class for all XML documents."""
 	
+	ChunkSize=8192
+	"""The size of the byte strings generated by :py:meth:`GenerateChunks`,
+	8KB by default."""
+	
 	def __init__(self, root=None, baseURI=None, reqManager=None, **args):
 		"""Initialises a new Document from optional keyword arguments.
 		
@@ -270,9 +294,7 @@ class Document(Node):
 
 	def __str__(self):
 		"""Returns the XML document as a string"""
-		s=StringIO()
-		self.WriteXML(s,EscapeCharData7)
-		return str(s.getvalue())
+		return string.join(EncodeChunks(self.GenerateXML(EscapeCharData7),self.ChunkSize,'ascii'),'')
 	
 	def __unicode__(self):
 		"""Returns the XML document as a unicode string"""
@@ -445,9 +467,9 @@ class Document(Node):
 			fdir,fname=os.path.split(fPath)
 			if not os.path.isdir(fdir):
 				os.makedirs(fdir)
-			f=codecs.open(fPath,'wb','utf-8')
+			f=open(fPath,'wb')
 			try:
-				self.WriteXML(f)
+				self.WriteChunks(f)
 			finally:
 				f.close()
 		else:
@@ -466,6 +488,24 @@ class Document(Node):
 		for s in self.GenerateXML(escapeFunction,tab):
 			writer.write(s)
 	
+	def GenerateChunks(self,escapeFunction=EscapeCharData,tab='\t',chunkSize=None):
+		"""Returns a generator of UTF-8 encoded byte strings.
+		
+		The serialised document is returned in chunks of *chunkSize* bytes
+		(defaults to :py:attr:`ChunkSize`), see :py:func:`EncodeChunks` for
+		details.  The result is suitable for returning directly as the body
+		of a WSGI response."""
+		if chunkSize is None:
+			chunkSize=self.ChunkSize
+		return EncodeChunks(self.GenerateXML(escapeFunction,tab),chunkSize)
+	
+	def WriteChunks(self,f,escapeFunction=EscapeCharData,tab='\t',chunkSize=None):
+		"""Writes the document to a binary file-like object *f*
+		
+		The document is written using UTF-8, see :py:meth:`GenerateChunks`."""
+		for chunk in self.GenerateChunks(escapeFunction,tab,chunkSize):
+			f.write(chunk)
+	
 	def Update(self,**args):
 		"""Updates the Document.
 		
@@ -478,9 +518,9 @@ class Document(Node):
 			fPath=self.baseURI.GetPathname()
 			if not os.path.isfile(fPath):
 				raise XMLMissingResourceError(fPath)
-			f=codecs.open(fPath,'wb','utf-8')
+			f=open(fPath,'wb')
 			try:
-				self.WriteXML(f)
+				self.WriteChunks(f)
 			finally:
 				f.close()
 		else:
@@ -568,10 +608,13 @@ def IsChar(c):
 	"""Tests if the character *c* matches the production for [2] Char.
 	
 	If *c* is None IsChar returns False."""
-	return c and (ord(c)==0x9 or ord(c)==0xA or ord(c)==0xD or
-		(ord(c)>=0x20 and ord(c)<=0xD7FF) or
-		(ord(c)>=0xE000 and ord(c)<=0xFFFD) or
-		(ord(c)>=0x10000 and ord(c)<=0x10FFFF))
+	if c:
+		code=ord(c)
+		if code<0xD800:
+			return code>=0x20 or code==0x9 or code==0xA or code==0xD
+		else:
+			return (code>=0xE000 and code<=0xFFFD) or (code>=0x10000 and code<=0x10FFFF)
+	return False
 
 # DiscouragedCharClass=ParseXMLClass("""[#x7F-#x84] | [#x86-#x9F] | [#xFDD0-#xFDEF] |
 # 	[#x1FFFE-#x1FFFF] | [#x2FFFE-#x2FFFF] | [#x3FFFE-#x3FFFF] |
@@ -588,45 +631,34 @@ def IsDiscouraged(c):
 	
 	Note that this test is currently limited to the range of unicode characters
 	available in the narrow python build."""
-	return DiscouragedCharClass.Test(c)
+	if c:
+		code=ord(c)
+		if code<0x10000:
+			return (XMLCharFlags[code]&DiscouragedFlag)!=0
+		return DiscouragedCharClass.Test(c)
+	return False
 	
 	
+SChars=frozenset((u' ',u'\t',u'\n',u'\r'))		#: the set of characters matching [3] S
+SCharsStr=' \t\n\r'								#: the characters matching [3] S as a string
+SRE=re.compile(u'[ \t\n\r]')
+WhiteSpaceRunRE=re.compile(u'[ \t\n\r]+')
+
 def IsS(c):
 	"""Tests if a single character *c* matches production [3] S"""
-	if c:
-		c=ord(c)
-		if c>0x20:
-			return False
-		else:
-			return c==0x20 or c==0x9 or c==0xA or c==0xD
-	return False
+	return c in SChars
 	
 def IsWhiteSpace(data):
 	"""Tests if every character in *data* matches production [3] S"""
-	for c in data:
-		if not IsS(c):
-			return False
-	return True
+	return not data.strip(SCharsStr)
 
 def ContainsS(data):
 	"""Tests if data contains any characters matching production [3] S"""
-	for c in data:
-		if IsS(c):
-			return True
-	return False
+	return SRE.search(data) is not None
 	
 def StripLeadingS(data):
 	"""Returns data with leading S removed."""
-	s=0
-	for c in data:
-		if IsS(c):
-			s+=1
-		else:
-			break
-	if s:
-		return data[s:]
-	else:
-		return data
+	return data.lstrip(SCharsStr)
 
 def NormalizeSpace(data):
 	"""Returns data normalized according to the further processing rules for attribute-value normalization:
@@ -634,18 +666,7 @@ def NormalizeSpace(data):
 	"...by discarding any leading and trailing space (#x20) characters, and by
 	replacing sequences of space (#x20) characters by a single space (#x20)
 	character"	"""
-	result=[]
-	sCount=2	# 0=no space; 1=add space; 2=don't add space 
-	for c in data:
-		if c==' ':
-			if sCount==0:
-				sCount=1
-		else:
-			if sCount==1:
-				result.append(' ')
-			result.append(c)
-			sCount=0
-	return string.join(result,'')			
+	return string.join([x for x in data.split(' ') if x],' ')
 			
 def CollapseSpace(data,sMode=True,sTest=IsS):
 	"""Returns data with all spaces collapsed to a single space.
@@ -660,6 +681,15 @@ def CollapseSpace(data,sMode=True,sTest=IsS):
 	Note on degenerate case: this function is intended to be called with
 	non-empty strings and will never *return* an empty string.  If there is no
 	data then a single space is returned (regardless of sMode)."""
+	if sTest is IsS:
+		# collapse the whole string in a single pass
+		data=WhiteSpaceRunRE.sub(' ',data)
+		if sMode and data[:1]==' ':
+			data=data[1:]
+		if data:
+			return data
+		else:
+			return ' '
 	result=[]
 	for c in data:
 		if sTest(c):
@@ -683,54 +713,32 @@ NameStartCharClass=CharClass(u':', (u'A',u'Z'), u'_', (u'a',u'z'),
 
 def IsNameStartChar(c):
 	"""Tests if the character *c* matches production [4] NameStartChar."""
-	if c<=u"z":
-		if c>=u"a":
-			return True
-		elif c<=u"Z":
-			if c>=u"A":
-				return True
-			else:
-				return c==u":"
-		else:
-			return c==u"_"
-	else:
+	if c:
+		code=ord(c)
+		if code<0x10000:
+			return (XMLCharFlags[code]&NameStartCharFlag)!=0
 		return NameStartCharClass.Test(c)
+	return False
 	
 NameCharClass=CharClass(NameStartCharClass, u'-', u'.', (u'0',u'9'),
 	u'\xb7', (u'\u0300',u'\u036f'), (u'\u203f',u'\u2040'))
 
 def IsNameChar(c):
 	"""Tests if a single character *c* matches production [4a] NameChar"""
-	# This is called a lot, so we take a few short cuts for commone cases
 	if c:
-		if c<=u"z":
-			if c>=u"a":
-				return True
-			elif c<=u"Z":
-				if c>=u"A":
-					return True
-				elif c<=u"9":
-					if c>=u"0":
-						return True
-					else:
-						return c in "-."
-				else:
-					return c==u":"
-			else:
-				return c==u"_"
-		else:
-			return NameCharClass.Test(c)
+		code=ord(c)
+		if code<0x10000:
+			return (XMLCharFlags[code]&NameCharFlag)!=0
+		return NameCharClass.Test(c)
 	return False
-		
+
+NameRE=re.compile(u"%s%s*\\Z"%(unicode(NameStartCharClass),unicode(NameCharClass)))
+NmtokenRE=re.compile(u"%s+\\Z"%unicode(NameCharClass))
+
 def IsValidName(name):
 	"""Tests if name is a string matching production [5] Name"""
 	if name:
-		if not IsNameStartChar(name[0]):
-			return False
-		for c in name[1:]:
-			if not IsNameChar(c):
-				return False
-		return True
+		return NameRE.match(name) is not None
 	else:
 		return False
 
@@ -745,9 +753,11 @@ def IsReservedName(name):
 PubidCharClass=CharClass(u' ',u'\x0d',u'\x0a', (u'0',u'9'), (u'A',u'Z'), 
 	(u'a',u'z'), "-'()+,./:=?;!*#@$_%")
 
+PubidChars=frozenset(unichr(code) for a,z in PubidCharClass.ranges for code in xrange(ord(a),ord(z)+1))
+
 def IsPubidChar(c):
 	"""Tests if the character *c* matches production for [13] PubidChar."""
-	return PubidCharClass.Test(c)
+	return c in PubidChars
 
 
 def EscapeCDSect(src):
@@ -790,6 +800,9 @@ class XMLDTD(object):
 		"""A dictionary of dictionaries, keyed on element name.  Each of the
 		resulting dictionaries is a dictionary of
 		:py:class:`XMLAttributeDefinition` keyed on attribute name."""
+		self.contentAutomata={}
+		"""A dictionary of :py:class:`ContentModelAutomaton` instances keyed
+		on element name.  See :py:meth:`GetContentAutomaton`."""
 
 	def DeclareEntity(self,entity):
 		"""Declares an entity in this document.
@@ -849,6 +862,22 @@ class XMLDTD(object):
 		None if no element with that name has been declared."""
 		return self.elementList.get(elementName,None)
 
+	def GetContentAutomaton(self,elementName):
+		"""Returns the compiled content model for an element type.
+		
+		*elementName* is the name of the element type to look up
+		
+		The method returns an instance of :py:class:`ContentModelAutomaton`
+		or None if no element with that name has been declared.  The
+		automaton is compiled the first time it is requested and then cached
+		so documents parsed with the same DTD share it."""
+		automaton=self.contentAutomata.get(elementName,None)
+		if automaton is None:
+			eType=self.elementList.get(elementName,None)
+			if eType is not None:
+				automaton=self.contentAutomata[elementName]=ContentModelAutomaton(eType)
+		return automaton
+		
 	def DeclareAttribute(self,elementName,attributeDef):
 		"""Declares an attribute.
 		
@@ -887,6 +916,195 @@ class XMLDTD(object):
 			return None
 		
 
+class XMLDTDCache(object):
+	def __init__(self,directory=None):
+		"""An object used to share external DTD subsets between parsers.
+		
+		Validating parsers have to read and parse the external subset of
+		the DTD of every document they parse, in typical applications the
+		same DTD is referred to by many documents.  A cache can be passed
+		to :py:class:`~pyslet.xml20081126.parser.XMLParser` (see
+		:py:attr:`~pyslet.xml20081126.parser.XMLParser.dtdCache`) to save
+		this work: the declarations obtained from an external subset are
+		saved in the cache and attached to later documents that refer to the
+		same subset.
+		
+		The optional *directory* is the path of a directory in which a
+		serialized form of each cached subset is stored, allowing the cache
+		to persist between processes.
+		
+		Cached declarations are keyed on the public and system identifiers
+		together with the resolved location of the external subset (see
+		:py:meth:`GetKey`) and are stored with a validator that is checked
+		each time they are looked up (see :py:meth:`GetValidator`) so a
+		subset that changes is parsed again.
+		
+		The serialized form is a python pickle and unpickling data can
+		execute arbitrary code, so anyone who can write to *directory*
+		can run code in any process that uses the cache.  On systems
+		with POSIX permissions *directory* must therefore be owned by
+		the current user and must not be writable by group or others,
+		otherwise XMLUnsafeCacheError is raised.  Files in it that fail
+		the same test are ignored and replaced when the subset is next
+		saved.  Never point the cache at a shared directory such as
+		/tmp."""
+		if directory is not None:
+			if not self.IsPrivate(os.stat(directory)):
+				raise XMLUnsafeCacheError("DTD cache directory is writable by other users: %s"%directory)
+		self.directory=directory	#: the directory used to persist the cache (may be None)
+		self.dtds={}			#: a dictionary mapping keys onto tuples of validator and cached XMLDTD instance
+		self.hits=0			#: the number of successful look ups
+		self.misses=0		#: the number of failed look ups
+
+	def GetKey(self,externalID,location,options=()):
+		"""Returns the key used to cache an external subset
+		
+		*externalID* is the :py:class:`XMLExternalID` instance used to
+		refer to the subset and *location* is the location it was resolved
+		to.  *options* is an optional tuple of parser options that affect the
+		way the subset is parsed."""
+		return (externalID.public,externalID.system,str(location),tuple(options))
+	
+	def GetValidator(self,key):
+		"""Returns a value that changes when the subset with *key* changes
+		
+		If the subset is stored in a local file the validator is a tuple
+		of the file's modification time and size.  For other locations,
+		or if the file can't be read, None is returned and the cached
+		subset is assumed to remain valid."""
+		location=URIFactory.URI(key[2])
+		if isinstance(location,FileURL):
+			try:
+				st=os.stat(location.GetPathname())
+			except OSError:
+				return None
+			return (st.st_mtime,st.st_size)
+		else:
+			return None
+		
+	def GetDTD(self,key):
+		"""Returns the cached :py:class:`XMLDTD` matching *key* or None.
+		
+		The declarations from the external subset are returned as an
+		instance of :py:class:`XMLDTD`, this instance must be treated as
+		read only.  If the cache has a *directory* then subsets that are
+		not already loaded are read from their serialized form.  If the
+		subset has changed since it was cached (see
+		:py:meth:`GetValidator`) None is returned."""
+		validator=self.GetValidator(key)
+		dtd=None
+		entry=self.dtds.get(key,None)
+		if entry is not None:
+			if entry[0]==validator:
+				dtd=entry[1]
+			else:
+				del self.dtds[key]
+		if dtd is None and self.directory is not None:
+			dtd=self.LoadDTD(key)
+			if dtd is not None:
+				self.dtds[key]=(validator,dtd)
+		if dtd is None:
+			self.misses+=1
+		else:
+			self.hits+=1
+		return dtd
+	
+	def SetDTD(self,key,dtd):
+		"""Adds *dtd* to the cache using *key*
+		
+		*dtd* is an :py:class:`XMLDTD` instance containing only the
+		declarations obtained from an external subset.  The content models
+		of all declared element types are compiled before the dtd is cached
+		so that the resulting :py:class:`ContentModelAutomaton` instances
+		are also shared."""
+		for name in dtd.elementList:
+			dtd.GetContentAutomaton(name)
+		self.dtds[key]=(self.GetValidator(key),dtd)
+		if self.directory is not None:
+			self.SaveDTD(key,dtd)
+			
+	@staticmethod
+	def IsPrivate(st):
+		"""Returns True if the file or directory with status *st* (as
+		returned by os.stat) can only be written by the current user
+		
+		Always returns True on systems without POSIX permissions."""
+		if not hasattr(os,'getuid'):
+			return True
+		return st.st_uid==os.getuid() and not (st.st_mode&(stat.S_IWGRP|stat.S_IWOTH))
+	
+	def GetPathname(self,key):
+		"""Returns the path of the file used to store the subset with *key*"""
+		return os.path.join(self.directory,
+			"%s.dtd.pickle"%hashlib.sha1(repr(key)).hexdigest())
+		
+	def SaveDTD(self,key,dtd):
+		"""Writes the serialized form of *dtd* to :py:attr:`directory`
+		
+		Declared entities and element types keep a reference to the entity
+		in which they were declared, these references are replaced with
+		empty entities that record the location only.  The key and the
+		subset's current validator are saved with *dtd*."""
+		path=self.GetPathname(key)
+		if os.path.exists(path):
+			# don't write through a file that someone else controls
+			os.remove(path)
+		f=os.fdopen(os.open(path,os.O_WRONLY|os.O_CREAT|os.O_EXCL|getattr(os,'O_BINARY',0),0644),'wb')
+		try:
+			p=pickle.Pickler(f,pickle.HIGHEST_PROTOCOL)
+			p.persistent_id=self._PersistentID
+			p.dump((key,self.GetValidator(key),dtd))
+		finally:
+			f.close()
+	
+	def LoadDTD(self,key):
+		"""Reads the serialized form of the subset with *key*
+		
+		Returns None if there is no serialized form, it can't be read, it
+		could have been written by another user (see
+		:py:class:`XMLDTDCache`) or it was saved with a different
+		validator, in which case it is replaced when the subset is next
+		saved."""
+		try:
+			f=open(self.GetPathname(key),'rb')
+		except IOError:
+			return None
+		try:
+			if not self.IsPrivate(os.fstat(f.fileno())):
+				return None
+			u=pickle.Unpickler(f)
+			u.persistent_load=self._PersistentLoad
+			try:
+				savedKey,validator,dtd=u.load()
+			except (pickle.PickleError,EOFError,AttributeError,ImportError,
+				IndexError,TypeError,ValueError):
+				return None
+			if savedKey==key and validator==self.GetValidator(key):
+				return dtd
+			else:
+				return None
+		finally:
+			f.close()
+
+	def _PersistentID(self,obj):
+		if type(obj) is XMLEntity:
+			if obj.location is None:
+				return "entity:"
+			else:
+				return "entity:"+str(obj.location)
+		else:
+			return None
+	
+	def _PersistentLoad(self,pid):
+		if pid.startswith("entity:"):
+			entity=XMLEntity()
+			if len(pid)>7:
+				entity.location=URIFactory.URI(pid[7:])
+			return entity
+		else:
+			raise pickle.UnpicklingError("unknown persistent id: %s"%pid)
+
+
 class XMLTextDeclaration(object):
 
 	def __init__(self,version="1.0",encoding="UTF-8"):
@@ -969,6 +1187,26 @@ ElementContent=ElementType.ElementContent
 SGMLCDATA=ElementType.SGMLCDATA
 
 
+class _ImmutableDict(dict):
+	"""A dictionary that raises TypeError if it is modified"""
+	
+	def _Modify(self,*args,**kwArgs):
+		raise TypeError("Attempt to modify an immutable dictionary")
+	
+	__setitem__=__delitem__=clear=pop=popitem=setdefault=update=_Modify
+
+
+class ElementClass(type):
+	"""Metaclass for :py:class:`Element` and its derived classes.
+	
+	Compiles the XMLATTR\_ definitions of each new class into the
+	attribute maps described in :py:class:`Element`."""
+	
+	def __init__(cls,name,bases,dct):
+		super(ElementClass,cls).__init__(name,bases,dct)
+		cls._ReMap()
+
+
 class Element(Node):
 	"""Basic class that represents all XML elements.
 	
@@ -1102,7 +1340,16 @@ class Element(Node):
 
 			(<xml attribute name>, encodeFunction)
 
-		The mappings are created automatically as needed.
+	XMLASETMAP
+	
+		The XMLASETMAP maps XML attribute names onto the functions used
+		to set them (including the ID attribute, if any) so that
+		:py:meth:`SetAttribute` is a single dictionary look-up.
+		
+		The mappings are created automatically by the :py:class:`ElementClass`
+		metaclass when each class is defined and should be treated as
+		read-only.  XMLATTR\_ definitions added to a class after it has
+		been created are ignored.
 		
 	For legacy reasons, the multi-valued rules can also be invoked by setting an
 	instance member to either a list or dictionary prior to parsing the instance
@@ -1114,6 +1361,17 @@ class Element(Node):
 	common xml-prefixed attributes such as xml:lang are handled using special
 	purposes methods."""
 
+	__metaclass__=ElementClass
+	__slots__=('parent','xmlname','id','_attrs','_children')
+	
+	NoAttributes=_ImmutableDict()
+	"""A shared, empty, dictionary of attributes.
+	
+	Most elements have no unmapped attributes so new elements share this
+	object, it is replaced with a new dictionary by
+	:py:meth:`_MutableAttrs` before any attribute is added.  It is
+	immutable, attempting to modify it raises TypeError."""
+	
 	XMLCONTENT=ElementType.Mixed		#: for consistency with the behaviour of the default methods we claim to be mixed content
 	
 	def __init__(self,parent,name=None):
@@ -1126,13 +1384,23 @@ class Element(Node):
 		else:
 			self.xmlname=name
 		self.id=None
-		self._attrs={}
+		self._attrs=Element.NoAttributes
 		self._children=[]
 
 	def __nonzero__(self):
 		# All elements are considered non-zero; we implement this to reduce spurious calls
 		# to __getattr__
 		return True
+	
+	def _MutableAttrs(self):
+		"""Returns the dictionary of unmapped attributes for modification
+		
+		If the element is sharing :py:attr:`NoAttributes` it is given a
+		dictionary of its own first, all changes to the unmapped
+		attributes must be made through this method."""
+		if self._attrs is Element.NoAttributes:
+			self._attrs={}
+		return self._attrs
 		
 	def SetXMLName(self,name):
 		self.xmlname=name
@@ -1143,7 +1411,7 @@ class Element(Node):
 	def Reset(self,resetAttributes=False):
 		"""Clears all attributes and (optional) children."""
 		if resetAttributes:
-			self._attrs={}
+			self._attrs=Element.NoAttributes
 		for child in self._children:
 			if isinstance(child,Element):
 				child.DetachFromDocument()
@@ -1183,7 +1451,8 @@ class Element(Node):
 		If name cannot be mangled, None is returned."""
 		return "XMLATTR_"+name
 		
-	def UnmangleAttributeName(self,mName):
+	@classmethod
+	def UnmangleAttributeName(cls,mName):
 		"""Returns an unmangled attribute name, used when getting attributes.
 
 		If mName is not a mangled name, None is returned."""
@@ -1192,14 +1461,28 @@ class Element(Node):
 		else:
 			return None
 	
-	def _ReMap(self):
+	@classmethod
+	def _ReMap(cls):
+		"""Builds the XMLAMAP, XMLARMAP and XMLASETMAP class attributes.
+		
+		Called by :py:class:`ElementClass` when the class is created.  Only
+		the dictionaries of the classes in the method resolution order are
+		searched for XMLATTR\_ definitions, we don't need to look at every
+		name returned by dir()."""
 		aMap={}
 		arMap={}
+		setMap={}
 		nop=lambda x:x
-		for mName in dir(self.__class__):
-			name=self.UnmangleAttributeName(mName)
+		definitions={}
+		for base in reversed(cls.__mro__):
+			for mName,setter in base.__dict__.items():
+				if mName.startswith('XMLATTR_'):
+					definitions[mName]=setter
+		# sorted to match the order of the names returned by dir()
+		for mName in sorted(definitions.keys()):
+			name=cls.UnmangleAttributeName(mName)
 			if name:
-				setter=getattr(self.__class__,mName)
+				setter=definitions[mName]
 				if type(setter) in StringTypes:
 					# use simple attribute assignment
 					attrName,encode,decode,vtype=setter,None,None,None
@@ -1210,28 +1493,73 @@ class Element(Node):
 					elif len(setter)==4:
 						attrName,decode,encode,vtype=setter
 					else:
-						raise XMLAttributeSetter("bad XMLATTR_ definition: %s attribute of %s"%(name,self.__class__.__name__))
+						raise XMLAttributeSetter("bad XMLATTR_ definition: %s attribute of %s"%(name,cls.__name__))
 				else:
-					raise XMLAttributeSetter("setting %s attribute of %s"%(name,self.__class__.__name__))
+					raise XMLAttributeSetter("setting %s attribute of %s"%(name,cls.__name__))
 				if encode is None:
 					encode=nop
 				if decode is None:
 					decode=nop
-				if vtype not in (types.ListType,types.DictType,None):
-					raise XMLAttributeSetter("Legacy XMLATTR_ definition: %s attribute of %s"%(name,self.__class__.__name__))
+				if vtype is ListType:
+					setMap[name]=cls._ListSetter(attrName,decode)
+				elif vtype is DictType:
+					setMap[name]=cls._DictSetter(attrName,decode)
+				elif vtype is None:
+					setMap[name]=cls._ValueSetter(name,attrName,decode)
+				else:
+					raise XMLAttributeSetter("Legacy XMLATTR_ definition: %s attribute of %s"%(name,cls.__name__))
 				aMap[name]=(attrName,decode,vtype)
 				arMap[attrName]=(name,encode)
-		setattr(self.__class__,"XMLAMAP",aMap)
-		setattr(self.__class__,"XMLARMAP",arMap)
+		idName=getattr(cls,'ID',None)
+		if idName is not None and idName not in setMap:
+			setMap[idName]=cls.SetID
+		cls.XMLAMAP=aMap
+		cls.XMLARMAP=arMap
+		cls.XMLASETMAP=setMap
+		# optional attributes default to None without a trip through __getattr__
+		for attrName in arMap:
+			if not hasattr(cls,attrName):
+				setattr(cls,attrName,None)
+	
+	@staticmethod
+	def _ListSetter(attrName,decode):
+		def Setter(self,value):
+			if value is None:
+				value=[]
+			else:
+				value=value.split()
+			setattr(self,attrName,map(decode,value))
+		return Setter
+	
+	@staticmethod
+	def _DictSetter(attrName,decode):
+		def Setter(self,value):
+			if value is None:
+				value=[]
+			else:
+				value=value.split()
+			dValue={}
+			for iv in map(decode,value):
+				dValue[iv]=dValue.get(iv,0)+1
+			setattr(self,attrName,dValue)
+		return Setter
+	
+	@staticmethod
+	def _ValueSetter(name,attrName,decode):
+		def Setter(self,value):
+			x=getattr(self,attrName,None)
+			if type(x) in (ListType,DictType):
+				print "Problem setting %s in %s: single value will overwrite List or Dict"%(repr(name),repr(self.__class__.__name__))
+			if value is None:
+				setattr(self,attrName,None)
+			else:
+				setattr(self,attrName,decode(value))
+		return Setter
 		
 	def _ARMap(self):
-		if "XMLARMAP" not in self.__class__.__dict__:
-			self._ReMap()
 		return self.__class__.XMLARMAP			 
 	
 	def _AMap(self):
-		if "XMLAMAP" not in self.__class__.__dict__:
-			self._ReMap()
 		return self.__class__.XMLAMAP			 
 			
 	def __getattr__(self,name):
@@ -1241,11 +1569,12 @@ class Element(Node):
 		document contains large numbers of such elements.
 		
 		To obviate the need for optional attributes to be present in every
-		instance this method will look up *name* in the reverse map and,
-		if present, it returns None."""
-		# print "Looking for %s in %s"%(name,self.__class__.__name__)
-		# import traceback;traceback.print_stack()
-		if name in self._ARMap():
+		instance the python attributes in the reverse map default to None.
+		They are set as class attributes when the class is created so this
+		method is only called for names that are not defined at all and
+		for names in the reverse map that have been deleted from the class.
+		In the latter case None is returned."""
+		if name in self.__class__.XMLARMAP:
 			return None
 		else:
 			raise AttributeError("%s has no attribute %s"%(self.__class__.__name__,name))
@@ -1259,7 +1588,7 @@ class Element(Node):
 		
 		The dictionary returned represents a copy of the information in the element
 		and so may be modified by the caller."""
-		attrs=copy(self._attrs)
+		attrs=dict(self._attrs)
 		if self.id:
 			attrs[self.__class__.ID]=self.id
 		arMap=self._ARMap()
@@ -1286,41 +1615,14 @@ class Element(Node):
 		If *value* is None then the attribute is removed or, if an
 		XMLATTR\\_ mapping is in place its value is set to an empty
 		list, dictionary or None as appropriate."""
-		aMap=self._AMap()
-		if name in aMap:
-			attrName,decode,vType=aMap[name]
-			if vType is ListType:
-				if value is None:
-					value=[]
-				else:
-					value=value.split()
-				setattr(self,attrName,map(decode,value))
-			elif vType is DictType:
-				if value is None:
-					value=[]
-				else:
-					value=value.split()
-				dValue={}
-				for iv in map(decode,value):
-					dValue[iv]=dValue.get(iv,0)+1
-				setattr(self,attrName,dValue)			
-			else:
-				x=getattr(self,attrName,None)
-				if type(x) in (ListType,DictType):
-					print "Problem setting %s in %s: single value will overwrite List or Dict"%(repr(name),repr(self.__class__.__name__))
-					# print self.GetDocument()
-				if value is None:
-					setattr(self,attrName,None)
-				else:
-					setattr(self,attrName,decode(value))
-		elif hasattr(self.__class__,'ID') and name==self.__class__.ID:
-			self.SetID(value)
+		setter=self.XMLASETMAP.get(name,None)
+		if setter is not None:
+			setter(self,value)
+		elif value is None:
+			if name in self._attrs:
+				del self._MutableAttrs()[name]
 		else:
-			if value is None:
-				if name in self._attrs:
-					del self._attrs[name]
-			else:
-				self._attrs[name]=value
+			self._MutableAttrs()[name]=value
 	
 	def GetAttribute(self,name):
 		"""Gets the value of a single attribute as a string.
@@ -1766,7 +2068,27 @@ class Element(Node):
 					break
 			if not ws:
 				self.ValidationError("Unexpected data",data)
+	
+	def DeleteTrailingData(self):
+		"""Deletes any character data at the end of this element's
+		children, i.e., the data added since the last child element.
 		
+		Returns the deleted data or None if there was none."""
+		if self._children and type(self._children[-1]) in StringTypes:
+			return self._children.pop()
+		else:
+			return None
+		
+	SharedSpace={}
+	"""A cache of short white space strings shared between elements.
+	
+	Indentation between elements results in large numbers of identical
+	strings, :py:meth:`ContentChanged` replaces short white space children
+	(up to :py:attr:`SharedSpaceLength` characters) with the copy in this
+	cache."""
+	
+	SharedSpaceLength=32		#: the longest white space string that is shared
+	
 	def ContentChanged(self):
 		"""Notifies an element that its content has changed.
 		
@@ -1777,22 +2099,30 @@ class Element(Node):
 		for child in self._children:
 			if type(child) in StringTypes:
 				dataChildren.append(child)
+				continue
 			elif len(dataChildren)==1:
-				newChildren.append(dataChildren[0])
-				newChildren.append(child)
+				newChildren.append(self._ShareSpace(dataChildren[0]))
 				dataChildren=[]
 			elif len(dataChildren)>1:
-				newChildren.append(string.join(dataChildren,''))
-				newChildren.append(child)
+				newChildren.append(self._ShareSpace(string.join(dataChildren,'')))
 				dataChildren=[]
-			else:
-				newChildren.append(child)
+			newChildren.append(child)
 		if len(dataChildren)==1:
-			newChildren.append(dataChildren[0])
+			newChildren.append(self._ShareSpace(dataChildren[0]))
 		elif len(dataChildren)>1:	
-			newChildren.append(string.join(dataChildren,''))
+			newChildren.append(self._ShareSpace(string.join(dataChildren,'')))
 		self._children=newChildren				
 
+	@classmethod
+	def _ShareSpace(cls,data):
+		if type(data) is UnicodeType and len(data)<=cls.SharedSpaceLength:
+			shared=Element.SharedSpace.get(data,None)
+			if shared is not None:
+				return shared
+			elif IsWhiteSpace(data) and len(Element.SharedSpace)<1024:
+				Element.SharedSpace[data]=data
+		return data
+		
 	def GenerateValue(self,ignoreElements=False):
 		"""A generator function that returns the strings that compromise
 		this element's value (useful when handling elements that contain
@@ -1941,9 +2271,8 @@ class Element(Node):
 		but this isn't enough to guarantee success.  We will still get an encoding
 		error if non-ascii characters have been used in markup names as such files
 		cannot be encoded in US-ASCII."""
-		s=StringIO()
-		self.WriteXML(s,EscapeCharData7,root=True)
-		return str(s.getvalue())
+		return string.join(EncodeChunks(self.GenerateXML(EscapeCharData7,root=True),
+			Document.ChunkSize,'ascii'),'')
 	
 	def __unicode__(self):
 		"""Returns the XML element as a unicode string"""
@@ -1986,9 +2315,10 @@ class Element(Node):
 		Changing the base of an element effects the interpretation of all
 		relative URIs in this element and its children."""
 		if base is None:
-			self._attrs.pop(xml_base,None)
+			if xml_base in self._attrs:
+				del self._MutableAttrs()[xml_base]
 		else:
-			self._attrs[xml_base]=str(base)
+			self._MutableAttrs()[xml_base]=str(base)
 
 	def ResolveBase(self):
 		"""Returns a fully specified URI for the base of the current element.
@@ -2056,9 +2386,10 @@ class Element(Node):
 		See :py:meth:`ResolveLang` for how to obtain the effective language of
 		an element."""
 		if lang is None:
-			self._attrs.pop(xml_lang,None)
+			if xml_lang in self._attrs:
+				del self._MutableAttrs()[xml_lang]
 		else:
-			self._attrs[xml_lang]=lang
+			self._MutableAttrs()[xml_lang]=lang
 
 	def ResolveLang(self):
 		"""Returns the effective language for the current element.
@@ -2082,9 +2413,10 @@ class Element(Node):
 	
 	def SetSpace(self,space):
 		if space is None:
-			self._attrs.pop(xml_space,None)
+			if xml_space in self._attrs:
+				del self._MutableAttrs()[xml_space]
 		else:
-			self._attrs[xml_space]=space
+			self._MutableAttrs()[xml_space]=space
 
 	def PrettyPrint(self):
 		"""Indicates if this element's content should be pretty-printed.
@@ -2514,6 +2846,120 @@ class ContentParticleCursor(object):
 		return result
 							
 
+class ContentModelAutomaton(object):
+	
+	StartState=0	#: The start state of every automaton
+	EndState=1		#: The state entered when the end tag is matched
+	
+	def __init__(self,elementType):
+		"""A deterministic finite automaton compiled from an :py:class:`ElementType`.
+		
+		The particle maps of the element type's content model are walked once
+		and each distinct set of particles that can represent the current
+		child element becomes an integer state.  Validating the children of
+		an element is then one dictionary look-up per child (see
+		:py:class:`ContentModelCursor`).
+		
+		Non-deterministic content models are handled by the usual subset
+		construction, so the automaton accepts exactly the same sequences of
+		children as :py:class:`ContentParticleCursor`."""
+		self.name=elementType.name		#: The name of the element type
+		self.anyContent=(elementType.contentType==ElementType.Any)
+		"""True if the element type was declared with ANY content."""
+		self.transitions=[{},{}]
+		"""A list of dictionaries indexed by state.  Each dictionary maps
+		element names onto the next state, the end tag is represented by the
+		empty string."""
+		if elementType.contentType in (ElementType.ElementContent,ElementType.Mixed):
+			if elementType.particleMap is None:
+				elementType.BuildModel()
+			states={}
+			todo=[(ContentModelAutomaton.StartState,elementType.particleMap)]
+			while todo:
+				state,pMap=todo.pop()
+				stateTransitions=self.transitions[state]
+				for name,pList in pMap.items():
+					if pList is None:
+						stateTransitions[name]=ContentModelAutomaton.EndState
+						continue
+					if type(pList) is not ListType:
+						pList=[pList]
+					key=frozenset(pList)
+					nextState=states.get(key,None)
+					if nextState is None:
+						nextState=states[key]=len(self.transitions)
+						self.transitions.append({})
+						todo.append((nextState,self.MergeParticleMaps(pList)))
+					stateTransitions[name]=nextState
+		else:
+			self.transitions[ContentModelAutomaton.StartState]['']=ContentModelAutomaton.EndState
+	
+	def MergeParticleMaps(self,pList):
+		"""Returns the union of the particle maps of the particles in *pList*."""
+		pMap={}
+		for p in pList:
+			for name,ps in p.particleMap.items():
+				if ps is None:
+					pMap[name]=None
+					continue
+				elif name in pMap:
+					targetList=pMap[name]
+					if targetList is None:
+						continue
+				else:
+					pMap[name]=targetList=[]
+				if type(ps) is not ListType:
+					ps=[ps]
+				for ip in ps:
+					if not ip in targetList:
+						targetList.append(ip)
+		return pMap
+	
+	def Expected(self,state):
+		"""Returns a sorted list of valid element names in *state*.
+		
+		If the closing tag is valid it appends a representation of the closing
+		tag too, e.g., </element>.  In the end state an empty list is
+		returned."""
+		stateTransitions=self.transitions[state]
+		result=filter(None,stateTransitions.keys())
+		result.sort()
+		if '' in stateTransitions:
+			result.append("</%s>"%self.name)
+		return result
+		
+
+class ContentModelCursor(object):
+	
+	def __init__(self,automaton):
+		"""An object used to traverse a :py:class:`ContentModelAutomaton`.
+		
+		This class provides the same interface as
+		:py:class:`ContentParticleCursor` but its position is a single integer
+		state."""
+		self.automaton=automaton
+		self.state=ContentModelAutomaton.StartState
+		
+	def Next(self,name=''):
+		"""Called when a child element with *name* is encountered.
+		
+		Returns True if *name* is a valid element and advances the model.  If
+		*name* is not valid then it returns False and the cursor is
+		unchanged."""
+		nextState=self.automaton.transitions[self.state].get(name,None)
+		if nextState is None:
+			# anything goes for an Any element, we stay in the start state
+			return bool(name) and self.automaton.anyContent and self.state==ContentModelAutomaton.StartState
+		self.state=nextState
+		return True
+	
+	def Expected(self):
+		"""Returns a sorted list of valid element names in the current state.
+		
+		See :py:meth:`ContentModelAutomaton.Expected` for details."""
+		return self.automaton.Expected(self.state)
+
+
 class XMLAttributeDefinition(object):
 
 	CData=0			#: Type constant representing CDATA
@@ -2826,6 +3272,37 @@ class XMLEntity(object):
 			else:
 				self.ignoreLF=False
 
+	def NextRun(self,runRE):
+		"""Advances over a run of characters matching *runRE*.
+
+		*runRE* is a compiled regular expression that matches one or more
+		characters, it must not match the carriage return character as
+		end-of-line handling is left to :py:meth:`NextChar`.  The run starts
+		with :py:attr:`theChar` and is limited to the characters already read
+		into the entity's internal buffer.
+
+		Returns the characters parsed as a unicode string, leaving the entity
+		positioned on the character following the run.  If no run can be
+		matched at the current position then an empty string is returned and
+		the entity is unchanged.  Line numbers and character positions are
+		updated exactly as if :py:meth:`NextChar` had been called for each
+		character in the run."""
+		if self.theChar is None or self.ignoreLF or self.charPos>=len(self.chars):
+			return ''
+		match=runRE.match(self.chars,self.charPos)
+		if match is None:
+			return ''
+		run=match.group()
+		nLines=run.count('\n',1)
+		if nLines:
+			self.lineNum=self.lineNum+nLines
+			self.linePos=len(run)-run.rfind('\n')-1
+		else:
+			self.linePos=self.linePos+len(run)-1
+		self.charPos=match.end()-1
+		self.NextChar()
+		return run
+
 	MagicTable={
 		'\x00\x00\xfe\xff':('utf_32_be',4,True),		# UCS-4, big-endian machine (1234 order)
 		'\xff\xfe\x00\x00':('utf_32_le',4,True),		# UCS-4, little-endian machine (4321 order)
@@ -3065,7 +3542,12 @@ class XMLNotation(object):
 
 def IsLetter(c):
 	"""Tests if the character *c* matches production [84] Letter."""
-	return IsBaseChar(c) or IsIdeographic(c)
+	if c:
+		code=ord(c)
+		if code<0x10000:
+			return (XMLCharFlags[code]&(BaseCharFlag|IdeographicFlag))!=0
+		return BaseCharClass.Test(c)
+	return False
 
 BaseCharClass=CharClass((u'A',u'Z'), (u'a',u'z'), (u'\xc0',u'\xd6'),
 	(u'\xd8',u'\xf6'), (u'\xf8',u'\u0131'), (u'\u0134',u'\u013e'),
@@ -3124,12 +3606,20 @@ BaseCharClass=CharClass((u'A',u'Z'), (u'a',u'z'), (u'\xc0',u'\xd6'),
 
 def IsBaseChar(c):
 	"""Tests if the character *c* matches production [85] BaseChar."""
-	return BaseCharClass.Test(c)
+	if c:
+		code=ord(c)
+		if code<0x10000:
+			return (XMLCharFlags[code]&BaseCharFlag)!=0
+		return BaseCharClass.Test(c)
+	return False
 
 def IsIdeographic(c):
 	"""Tests if the character *c* matches production [86] Ideographic."""
-	return c and ((ord(c)>=0x4E00 and ord(c)<=0x9FA5) or ord(c)==0x3007 or
-		(ord(c)>=0x3021 and ord(c)<=0x3029))
+	if c:
+		code=ord(c)
+		if code<0x10000:
+			return (XMLCharFlags[code]&IdeographicFlag)!=0
+	return False
 
 IdeographicCharClass=CharClass((u'\u4e00',u'\u9fa5'),u'\u3007',(u'\u3021',u'\u3029'))
 LetterCharClass=CharClass(BaseCharClass,IdeographicCharClass)
@@ -3161,7 +3651,12 @@ CombiningCharClass=CharClass((u'\u0300',u'\u0345'), (u'\u0360',u'\u0361'),
 
 def IsCombiningChar(c):
 	"""Tests if the character *c* matches production [87] CombiningChar."""
-	return CombiningCharClass.Test(c)
+	if c:
+		code=ord(c)
+		if code<0x10000:
+			return (XMLCharFlags[code]&CombiningCharFlag)!=0
+		return CombiningCharClass.Test(c)
+	return False
 
 DigitClass=CharClass((u'0',u'9'), (u'\u0660',u'\u0669'),
 	(u'\u06f0',u'\u06f9'), (u'\u0966',u'\u096f'), (u'\u09e6',u'\u09ef'),
@@ -3172,7 +3667,12 @@ DigitClass=CharClass((u'0',u'9'), (u'\u0660',u'\u0669'),
 
 def IsDigit(c):
 	"""Tests if the character *c* matches production [88] Digit."""
-	return DigitClass.Test(c)
+	if c:
+		code=ord(c)
+		if code<0x10000:
+			return (XMLCharFlags[code]&DigitFlag)!=0
+		return DigitClass.Test(c)
+	return False
 
 ExtenderClass=CharClass(u'\xb7', (u'\u02d0',u'\u02d1'), u'\u0387', u'\u0640',
 u'\u0e46', u'\u0ec6', u'\u3005', (u'\u3031',u'\u3035'), (u'\u309d',u'\u309e'),
@@ -3180,7 +3680,53 @@ u'\u0e46', u'\u0ec6', u'\u3005', (u'\u3031',u'\u3035'), (u'\u309d',u'\u309e'),
 
 def IsExtender(c):
 	"""Tests if the character *c* matches production [89] Extender."""
-	return ExtenderClass.Test(c)
+	if c:
+		code=ord(c)
+		if code<0x10000:
+			return (XMLCharFlags[code]&ExtenderFlag)!=0
+		return ExtenderClass.Test(c)
+	return False
+
+
+NameStartCharFlag=0x01		#: :py:data:`XMLCharFlags` bit for [4] NameStartChar
+NameCharFlag=0x02			#: :py:data:`XMLCharFlags` bit for [4a] NameChar
+BaseCharFlag=0x04			#: :py:data:`XMLCharFlags` bit for [85] BaseChar
+IdeographicFlag=0x08		#: :py:data:`XMLCharFlags` bit for [86] Ideographic
+CombiningCharFlag=0x10		#: :py:data:`XMLCharFlags` bit for [87] CombiningChar
+DigitFlag=0x20				#: :py:data:`XMLCharFlags` bit for [88] Digit
+ExtenderFlag=0x40			#: :py:data:`XMLCharFlags` bit for [89] Extender
+DiscouragedFlag=0x80		#: :py:data:`XMLCharFlags` bit for discouraged characters
+
+def _BuildCharFlags(*args):
+	# Returns a bytearray indexed by code point in the basic multilingual
+	# plane.  args are (flag,CharClass) pairs, each entry is set to the
+	# bitwise OR of the flags of all the classes containing that character.
+	# The ranges in a CharClass are disjoint so we can sweep through the
+	# start and end points toggling each class's flag.
+	toggles={}
+	for flag,charClass in args:
+		for a,z in charClass.ranges:
+			for code in (ord(a),ord(z)+1):
+				if code<0x10000:
+					toggles[code]=toggles.get(code,0)^flag
+	table=bytearray(0x10000)
+	points=sorted(toggles.keys())+[0x10000]
+	value=0
+	for i in xrange(len(points)-1):
+		value=value^toggles[points[i]]
+		if value:
+			table[points[i]:points[i+1]]=chr(value)*(points[i+1]-points[i])
+	return table
+
+XMLCharFlags=_BuildCharFlags((NameStartCharFlag,NameStartCharClass),
+	(NameCharFlag,NameCharClass),(BaseCharFlag,BaseCharClass),
+	(IdeographicFlag,IdeographicCharClass),(CombiningCharFlag,CombiningCharClass),
+	(DigitFlag,DigitClass),(ExtenderFlag,ExtenderClass),
+	(DiscouragedFlag,DiscouragedCharClass))
+"""A lookup table for the character classes used by the Is* functions.
+
+A bytearray indexed by the code points of the basic multilingual plane,
+each entry is a combination of the \*Flag bits defined above."""
 
 
 EncNameStartCharClass=CharClass((u'A',u'Z'), (u'a',u'z'))
@@ -3203,7 +3749,7 @@ def MapClassElements(classMap,scope):
 	names=scope.keys()
 	for name in names:
 		obj=scope[name]
-		if type(obj) in (ClassType,TypeType) and issubclass(obj,Element):
+		if isinstance(obj,(ClassType,TypeType)) and issubclass(obj,Element):
 			if hasattr(obj,'XMLNAME'):
 				if obj.XMLNAME in classMap:
 					raise DuplicateXMLNAME("%s and %s have matching XMLNAMEs"%(obj.__name__,classMap[obj.XMLNAME].__name__))
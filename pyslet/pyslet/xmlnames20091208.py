@@ -16,12 +16,7 @@ class XMLNSError(XMLFatalError): pass
 
 def IsValidNCName(name):
 	if name:
-		if not IsNameStartChar(name[0]) or name[0]==":":
-			return False
-		for c in name[1:]:
-			if not IsNameChar(c) or c==":":
-				return False
-		return True
+		return NameRE.match(name) is not None and not ":" in name
 	else:
 		return False
 
@@ -130,6 +125,10 @@ class XMLNSElementContainerMixin:
 			prefix=self.NewPrefix()
 		if prefix in self.prefixToNS:
 			raise ValueError
+		if not self.prefixToNS:
+			# may be the shared empty mapping, see XMLNSElement
+			self.prefixToNS={}
+			self.nsToPrefix={}
 		self.prefixToNS[prefix]=ns
 		self.nsToPrefix[ns]=prefix
 		return prefix
@@ -164,7 +163,18 @@ class XMLNSElementContainerMixin:
 				
 		
 class XMLNSElement(XMLNSElementContainerMixin,Element):
-
+	
+	__slots__=('ns','prefixToNS','nsToPrefix')
+	
+	NoPrefixes={}
+	"""A shared empty prefix mapping.
+	
+	Most elements do not declare any namespaces so, instead of two new
+	dictionaries per element, :py:attr:`prefixToNS` and
+	:py:attr:`nsToPrefix` are both initialised to this object.  It must
+	never be modified, :py:meth:`MakePrefix` replaces empty mappings before
+	adding to them."""
+	
 	def __init__(self,parent,name=None):
 		if type(name) in types.StringTypes:
 			self.ns=None
@@ -176,7 +186,7 @@ class XMLNSElement(XMLNSElementContainerMixin,Element):
 		else:
 			self.ns,name=name
 		Element.__init__(self,parent,name)
-		XMLNSElementContainerMixin.__init__(self)
+		self.prefixToNS=self.nsToPrefix=XMLNSElement.NoPrefixes
 		
 	def SetXMLName(self,name):
 		if type(name) in StringTypes:
@@ -211,7 +221,8 @@ class XMLNSElement(XMLNSElementContainerMixin,Element):
 		else:
 			return None
 		
-	def UnmangleAttributeName(self,mName):
+	@classmethod
+	def UnmangleAttributeName(cls,mName):
 		"""Returns an unmangled attribute name, used when getting attributes.
 
 		If mName is not a mangled name, None is returned."""
@@ -227,8 +238,11 @@ class XMLNSElement(XMLNSElementContainerMixin,Element):
 		which is placed in a special attribute by
 		:py:meth:`XMLNSParser.ParseNSAttributes`."""
 		if name==(NO_NAMESPACE,".ns"):
-			self.prefixToNS=nsMap=value
-			self.nsToPrefix=dict(zip(nsMap.values(),nsMap.keys()))
+			if value:
+				self.prefixToNS=nsMap=value
+				self.nsToPrefix=dict(zip(nsMap.values(),nsMap.keys()))
+			else:
+				self.prefixToNS=self.nsToPrefix=XMLNSElement.NoPrefixes
 			return
 		if type(name) in types.StringTypes:
 			return Element.SetAttribute(self,(NO_NAMESPACE,name),value)
@@ -256,27 +270,30 @@ class XMLNSElement(XMLNSElementContainerMixin,Element):
 	
 	def SetBase(self,base):
 		if base is None:
-			self._attrs.pop(xmlns_base,None)
+			if xmlns_base in self._attrs:
+				del self._MutableAttrs()[xmlns_base]
 		else:
-			self._attrs[xmlns_base]=base
+			self._MutableAttrs()[xmlns_base]=base
 	
 	def GetLang(self):
 		return self._attrs.get(xmlns_lang,None)
 	
 	def SetLang(self,lang):
 		if lang is None:
-			self._attrs.pop(xmlns_lang,None)
+			if xmlns_lang in self._attrs:
+				del self._MutableAttrs()[xmlns_lang]
 		else:
-			self._attrs[xmlns_lang]=lang
+			self._MutableAttrs()[xmlns_lang]=lang
 	
 	def GetSpace(self):
 		return self._attrs.get(xmlns_space,None)
 	
 	def SetSpace(self,space):
 		if space is None:
-			self._attrs.pop(xmlns_space,None)
+			if xmlns_space in self._attrs:
+				del self._MutableAttrs()[xmlns_space]
 		else:
-			self._attrs[xmlns_space]=space
+			self._MutableAttrs()[xmlns_space]=space
 	
 	def CheckOther(self,child,ns):
 		"""Checks child to ensure it satisfies ##other w.r.t. the given ns"""
@@ -595,7 +612,7 @@ def MapClassElements(classMap,scope,nsAliasTable=None):
 	names=scope.keys()
 	for name in names:
 		obj=scope[name]
-		if type(obj) in (ClassType,TypeType) and issubclass(obj,XMLNSElement):
+		if isinstance(obj,(ClassType,TypeType)) and issubclass(obj,XMLNSElement):
 			if hasattr(obj,'XMLNAME'):
 				if obj.XMLNAME in classMap:
 					raise DuplicateXMLNAME("%s and %s have matching XMLNAMEs"%(obj.__name__,classMap[obj.XMLNAME].__name__))
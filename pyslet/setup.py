@@ -29,8 +29,8 @@ else:
 			'pyslet.odata2'],
 		package_data={
 			'pyslet':[
-				'unicode5_blocks.pck',
-				'unicode5_catogories.pck' ]
+				'unicode5_blocks.bin',
+				'unicode5_categories.bin' ]
 			},
 		classifiers=[
 			'Development Status :: 3 - Alpha',
@@ -1,6 +1,6 @@
 #! /usr/bin/env python
 
-import unittest
+import unittest, logging, time, decimal, threading, random
 
 def suite():
 	loader=unittest.TestLoader()
@@ -21,6 +21,7 @@ TEST_DATA_DIR=FilePath(FilePath(__file__).abspath().split()[0],'data_odatav2')
 
 import pyslet.odata2.csdl as edm
 import pyslet.odata2.edmx as edmx
+import pyslet.odata2.core as core
 from test_odata2_core import DataServiceRegressionTests
 
 
@@ -60,6 +61,479 @@ class MemDSTests(unittest.TestCase):
 		self.employees.data[u"ABCDE"]=(u"ABCDE",u"John Smith",None,None)
 		self.employees.data[u"FGHIJ"]=(u"FGHIJ",u"Jane Smith",None,None)
 
+	def testCaseFilterCompiler(self):
+		for i in xrange(20):
+			self.employees.data[u"E%03i"%i]=(u"E%03i"%i,u"Employee %i"%i,
+				(u"%i High Street"%i,u"Chunton" if i%3 else u"Bogton"),None if i%2 else "\x00\x01")
+		orderLines=self.container.entityStorage['OrderLines']
+		for i in xrange(20):
+			orderLines.data[i]=(i,i%7,decimal.Decimal(i)/4)
+		for esName,filters in (
+			('Employees',(
+				"EmployeeID eq 'E005'",
+				"'E005' ne EmployeeID",
+				"EmployeeID lt 'E005' or EmployeeID ge 'E015'",
+				"startswith(EmployeeName,'Employee 1') and Address/City eq 'Bogton'",
+				"substringof('High',Address/Street) and not endswith(Address/Street,'1 High Street')",
+				"length(EmployeeName) eq 10 and indexof(EmployeeName,'1') eq 9",
+				"tolower(Address/City) eq 'bogton'",
+				"substring(EmployeeID,1) eq '011' or substring(EmployeeID,1,2) eq '00'",
+				"Version eq null",
+				"Version eq X'0001'",
+				"null eq null",
+				"concat(EmployeeID,EmployeeName) gt 'E010'")),
+			('OrderLines',(
+				"Quantity gt 3",
+				"Quantity eq 2L",
+				"Quantity add OrderLineID mod 3 eq 4",
+				"-Quantity le -5 or OrderLineID div 2 eq 3",
+				"UnitPrice ge 2.5M",
+				"UnitPrice lt 3",
+				"UnitPrice mul 4 eq OrderLineID",
+				"UnitPrice gt 2.6D",
+				"round(UnitPrice) eq 2 and floor(UnitPrice) eq 1",
+				"ceiling(UnitPrice) eq Quantity",
+				"Quantity div 0 eq 1",
+				"Quantity gt null",
+				"not (Quantity lt 3)")) ):
+			es=self.schema['SampleEntities.'+esName]
+			for f in filters:
+				fExpression=core.CommonExpression.FromString(f)
+				self.assertTrue(self.container.entityStorage[esName].CompileFilter(fExpression) is not None,"Failed to compile %s"%f)
+				with es.OpenCollection() as collection:
+					collection.Filter(fExpression)
+					try:
+						expected=set()
+						for e in collection.entityStore.GenerateEntities():
+							if collection.CheckFilter(e):
+								expected.add(e.Key())
+					except core.EvaluationError:
+						expected=None
+					try:
+						result=set(collection.keys())
+						self.assertTrue(len(collection)==len(result),"Length mismatch for %s"%f)
+					except core.EvaluationError:
+						result=None
+					self.assertTrue(result==expected,"Compiled filter %s: expected %s, found %s"%(f,repr(expected),repr(result)))
+		es=self.schema['SampleEntities.Employees']
+		for f in (
+			"Address eq null",
+			"EmployeeName eq 3",
+			"isof(EmployeeName,'Edm.String')",
+			"EmployeeName",
+			"1 div 0 eq 1"):
+			# these can't be compiled, the fallback raises or evaluates
+			fExpression=core.CommonExpression.FromString(f)
+			try:
+				FilterCompiler(es.entityType).Compile(fExpression)
+				self.fail("Compiled %s"%f)
+			except FilterNotCompilable:
+				pass
+			self.assertTrue(self.employees.CompileFilter(fExpression) is None,"Compiled %s"%f)
+		with self.schema['SampleEntities.Orders'].OpenCollection() as collection:
+			# navigation properties are not compiled
+			collection.Filter(core.CommonExpression.FromString("Customer/CustomerID eq 'ALFKI'"))
+			self.assertTrue(collection.CompiledFilter() is None)
+		with es.OpenCollection() as collection:
+			collection.Filter(core.CommonExpression.FromString("isof(EmployeeName,'Edm.String')"))
+			self.assertTrue(len(collection)==20,"Fallback to evaluation")
+			# compiled filters are cached by expression
+			fExpression=core.CommonExpression.FromString("EmployeeID eq 'E005'")
+			collection.Filter(fExpression)
+			test=collection.CompiledFilter()
+			collection.Filter(core.CommonExpression.FromString(unicode(fExpression)))
+			self.assertTrue(collection.CompiledFilter() is test,"Compiled filter cache")
+			self.assertTrue(collection.keys()==[u"E005"])
+			# the compiled filter tests the stored values, not the selected values
+			collection.Filter(core.CommonExpression.FromString("EmployeeID eq 'E006' and Address/City eq 'Bogton'"))
+			collection.Expand(None,{"EmployeeName":None})
+			self.assertTrue(collection.keys()==[u"E006"])
+			self.assertTrue(collection[u"E006"]['EmployeeName'].value==u"Employee 6")
+			try:
+				collection[u"E005"]
+				self.fail("Filtered key lookup")
+			except KeyError:
+				pass
+			
+	def testCaseFilterCacheLiterals(self):
+		# compiled filters have their literals built in so literals that
+		# format the same way must not share a compiled filter
+		with self.schema['SampleEntities.Orders'].OpenCollection() as collection:
+			for i,shipped in ((1,'2013-10-02T10:20:59.25'),(2,'2013-10-02T10:20:59.75')):
+				order=collection.NewEntity()
+				order.SetKey(i)
+				order["ShippedDate"].SetFromLiteral(shipped)
+				collection.InsertEntity(order)
+			for i,shipped in ((1,'2013-10-02T10:20:59.25'),(2,'2013-10-02T10:20:59.75')):
+				collection.Filter(core.CommonExpression.FromString("ShippedDate eq datetime'%s'"%shipped))
+				self.assertTrue(collection.CompiledFilter() is not None)
+				self.assertTrue(collection.keys()==[i],"%s: %s"%(shipped,repr(collection.keys())))
+			for src,n in (("OrderID lt 1.0000000000001D",1),("OrderID lt 1.0D",0)):
+				collection.Filter(core.CommonExpression.FromString(src))
+				self.assertTrue(len(collection)==n,"%s: %i"%(src,len(collection)))
+
+	def testCaseFilterSpeed(self):
+		for i in xrange(10000):
+			self.employees.data[u"E%04i"%i]=(u"E%04i"%i,u"Employee %i"%i,
+				(u"%i High Street"%i,u"Chunton" if i%10 else u"Bogton"),None)
+		es=self.schema['SampleEntities.Employees']
+		with es.OpenCollection() as collection:
+			collection.Filter(core.CommonExpression.FromString("startswith(EmployeeName,'Employee 1') and Address/City eq 'Bogton'"))
+			self.assertTrue(collection.CompiledFilter() is not None,"filter compiled")
+			t0=time.time()
+			count=len(collection)
+			tCompiled=time.time()-t0
+			t0=time.time()
+			fCount=0
+			for e in collection.FilterEntities(self.employees.GenerateEntities()):
+				fCount+=1
+			tEvaluated=time.time()-t0
+			self.assertTrue(count==111 and fCount==111)
+			logging.info("Filter 10000 entities: compiled %.3fs, evaluated %.3fs",tCompiled,tEvaluated)
+
+	def LoadOrderLines(self,n,indexed):
+		orderLines=self.container.entityStorage['OrderLines']
+		if indexed:
+			orderLines.AddIndex('OrderLineID')
+			orderLines.AddIndex('Quantity',ordered=True)
+		with self.schema['SampleEntities.OrderLines'].OpenCollection() as collection:
+			for i in xrange(n):
+				e=collection.NewEntity()
+				e['OrderLineID'].SetFromValue(i)
+				# a few NULLs and plenty of ties
+				e['Quantity'].SetFromValue(None if i%50==0 else (i*7919)%(n//3))
+				e['UnitPrice'].SetFromValue(decimal.Decimal(i%10))
+				collection.InsertEntity(e)
+	
+	def testCaseIndexes(self):
+		orderLines=self.container.entityStorage['OrderLines']
+		try:
+			orderLines.AddIndex('Customer')
+			self.fail("Index on navigation property")
+		except KeyError:
+			pass
+		employees=self.container.entityStorage['Employees']
+		try:
+			employees.AddIndex('Address')
+			self.fail("Index on complex property")
+		except KeyError:
+			pass
+		# create the hash index after the data, the sorted index before
+		quantityIndex=orderLines.AddIndex('Quantity',ordered=True)
+		self.LoadOrderLines(100,False)
+		idIndex=orderLines.AddIndex('OrderLineID')
+		self.assertTrue(isinstance(idIndex,InMemoryHashIndex))
+		self.assertTrue(isinstance(quantityIndex,InMemorySortedIndex))
+		self.assertTrue(idIndex.Lookup(42)==[42])
+		self.assertTrue(sorted(quantityIndex.Lookup(None))==[0,50])
+		self.assertTrue(quantityIndex.Lookup(1)==[32,65,98])
+		with self.schema['SampleEntities.OrderLines'].OpenCollection() as collection:
+			# index maintenance on update and delete
+			e=collection[65]
+			e['Quantity'].SetFromValue(1000)
+			collection.UpdateEntity(e)
+			e=collection[42]
+			e['Quantity'].SetFromValue(None)
+			collection.UpdateEntity(e)
+			del collection[50]
+			self.assertTrue(quantityIndex.Lookup(1)==[32,98])
+			self.assertTrue(quantityIndex.Lookup(1000)==[65])
+			self.assertTrue(sorted(quantityIndex.Lookup(None))==[0,42])
+			self.assertTrue(idIndex.Lookup(50)==[])
+			self.assertTrue(len(quantityIndex.keys)+len(quantityIndex.nulls)==99)
+			self.assertTrue(quantityIndex.values==sorted(quantityIndex.values))
+			self.assertTrue(orderLines.IndexedKeys(core.CommonExpression.FromString("UnitPrice eq 1"))is None)
+			self.assertTrue(orderLines.IndexedKeys(core.CommonExpression.FromString("OrderLineID eq 42L")) is None,
+				"Comparison promoted to Int64")
+			self.assertTrue(orderLines.IndexedKeys(core.CommonExpression.FromString("OrderLineID gt 42")) is None,
+				"Range on hash index")
+			self.assertTrue(orderLines.IndexedKeys(core.CommonExpression.FromString("42 eq OrderLineID and UnitPrice eq 2"))==[42])
+			self.assertTrue(orderLines.OrderedKeys(core.CommonExpression.OrderByFromString("OrderLineID"))is None)
+			keys=orderLines.OrderedKeys(core.CommonExpression.OrderByFromString("Quantity desc"))
+			self.assertTrue(keys[:3]==[65,1,34] and keys[-2:]==[0,42])
+			# now check the results are the same as those obtained by scanning
+			for f in (
+				"OrderLineID eq 42",
+				"Quantity eq 7",
+				"Quantity eq null",
+				"Quantity lt 10 or OrderLineID lt 10",
+				"Quantity lt 10 and UnitPrice ge 5",
+				"5 ge Quantity and OrderLineID le 50",
+				"Quantity gt 20 and Quantity le 25",
+				"Quantity ge 30 and OrderLineID ne 47",
+				None):
+				for orderby in (None,"Quantity","Quantity desc","UnitPrice desc"):
+					for top in (None,5):
+						if f is None:
+							collection.Filter(None)
+						else:
+							collection.Filter(core.CommonExpression.FromString(f))
+						if orderby is None:
+							collection.OrderBy(None)
+						else:
+							collection.OrderBy(core.CommonExpression.OrderByFromString(orderby))
+						collection.SetPage(top)
+						result=map(lambda x:x.Key(),collection.iterpage())
+						count=len(collection)
+						indexes=orderLines.indexes
+						orderLines.indexes={}
+						try:
+							expected=map(lambda x:x.Key(),collection.iterpage())
+							self.assertTrue(count==len(collection),"%s: count %i"%(f,count))
+						finally:
+							orderLines.indexes=indexes
+						if orderby is None:
+							result.sort()
+							expected.sort()
+						self.assertTrue(result==expected,"%s %s: expected %s, found %s"%(f,orderby,repr(expected),repr(result)))
+	
+	def testCaseIndexSpeed(self):
+		results={}
+		for indexed in (False,True):
+			self.container=InMemoryEntityContainer(self.containerDef)
+			self.LoadOrderLines(10000,indexed)
+			eqFilter=core.CommonExpression.FromString("OrderLineID eq 5000")
+			rangeFilter=core.CommonExpression.FromString("Quantity gt 3000 and Quantity le 3010")
+			# the filters are only answered from the indexes when indexed
+			orderLines=self.container.entityStorage['OrderLines']
+			if indexed:
+				self.assertTrue(orderLines.IndexedKeys(eqFilter)==[5000])
+				self.assertTrue(orderLines.IndexedKeys(rangeFilter) is not None)
+				self.assertTrue(orderLines.indexes['Quantity'].OrderedKeys(True) is not None)
+			else:
+				self.assertTrue(orderLines.IndexedKeys(eqFilter) is None)
+				self.assertTrue(orderLines.IndexedKeys(rangeFilter) is None)
+			with self.schema['SampleEntities.OrderLines'].OpenCollection() as collection:
+				collection.Filter(eqFilter)
+				eqKeys=collection.keys()
+				collection.Filter(rangeFilter)
+				rangeKeys=sorted(collection.keys())
+				# time the filter itself, without creating the entities
+				t0=time.time()
+				for i in xrange(10):
+					collection.Filter(eqFilter)
+					len(collection)
+					collection.Filter(rangeFilter)
+					len(collection)
+				tFilter=time.time()-t0
+				t0=time.time()
+				collection.Filter(None)
+				collection.OrderBy(core.CommonExpression.OrderByFromString("Quantity desc"))
+				collection.SetPage(10)
+				topKeys=map(lambda x:x.Key(),collection.iterpage())
+				tOrder=time.time()-t0
+			results[indexed]=(eqKeys,rangeKeys,topKeys,tFilter,tOrder)
+		self.assertTrue(results[True][:3]==results[False][:3])
+		self.assertTrue(results[True][0]==[5000])
+		logging.info("20 filtered counts of 10000 entities: scan %.4fs, indexed %.4fs; order by with top: scan %.4fs, indexed %.4fs",
+			results[False][3],results[True][3],results[False][4],results[True][4])
+
+	def testCaseEntityViews(self):
+		for i in xrange(10):
+			self.employees.data[u"E%04i"%i]=(u"E%04i"%i,u"Employee %i"%i,
+				(u"%i High Street"%i,u"Chunton"),'\x00\x01')
+		# the ordered index ensures the keys are read in order
+		self.employees.AddIndex('EmployeeID',ordered=True)
+		es=self.schema['SampleEntities.Employees']
+		with es.OpenCollection() as collection:
+			collection.Expand(None,{'EmployeeName':None})
+			collection.OrderBy(core.CommonExpression.OrderByFromString("EmployeeID"))
+			names=set()
+			for e in collection.itervalues():
+				self.assertTrue(isinstance(e,EntityView))
+				self.assertTrue(e.exists)
+				# nothing is created until it is used
+				self.assertTrue(len(e.data)==0)
+				self.assertTrue(e.Selected('EmployeeName') and not e.Selected('Address'))
+				names.add(e['EmployeeName'].value)
+				self.assertTrue(e.Key()==e['EmployeeID'].value)
+				self.assertFalse(e['Version'])
+				self.assertFalse(e['Address']['City'])
+				self.assertTrue(len(e.data)==4)
+				if e.Key()==u"E0000":
+					# deleting entities during the iteration
+					del collection[u"E0009"]
+					del collection[u"E0008"]
+			self.assertTrue(len(names)==8,"deleted during iteration")
+			collection.Expand(None,None)
+			e=collection[u"E0003"]
+			for e in collection.itervalues():
+				self.assertTrue(e.selected is None)
+				self.assertTrue(e['Address']['City'].value==u"Chunton")
+				self.assertTrue(e['Version'].value=='\x00\x01')
+			try:
+				e['Orders']
+				self.fail("Undefined property in view")
+			except KeyError:
+				pass
+		customers=self.container.entityStorage['Customers']
+		customers.data[u"ALFKI"]=(u"ALFKI",u"Example Inc",(u"1 Main St",u"Chunton"),None)
+		with self.schema['SampleEntities.Customers'].OpenCollection() as collection:
+			collection.Expand({'Orders':None},{'CompanyName':None})
+			for e in collection.itervalues():
+				self.assertTrue(e.IsEntityCollection('Orders'))
+				self.assertTrue(e['Orders'].isExpanded)
+				self.assertTrue(len(e['Orders'].OpenCollection())==0)
+				self.assertTrue(e['CompanyName'].value==u"Example Inc")
+				self.assertFalse(e['Address']['Street'])
+
+	def testCaseSelectSpeed(self):
+		for i in xrange(10000):
+			self.employees.data[u"E%04i"%i]=(u"E%04i"%i,u"Employee %i"%i,
+				(u"%i High Street"%i,u"Chunton"),'\x00\x01')
+		select={'EmployeeID':None,'EmployeeName':None}
+		es=self.schema['SampleEntities.Employees']
+		with es.OpenCollection() as collection:
+			collection.Expand(None,select)
+			t0=time.time()
+			viewCount=0
+			for e in collection.itervalues():
+				viewCount+=len(e['EmployeeName'].value)
+			tView=time.time()-t0
+			# views only create the property values that are used
+			self.assertTrue(isinstance(e,EntityView) and 'Address' not in e.data)
+			t0=time.time()
+			readCount=0
+			for k in self.employees.data.keys():
+				e=self.employees.ReadEntity(k,select)
+				e.Expand(None,select)
+				readCount+=len(e['EmployeeName'].value)
+			tRead=time.time()-t0
+		self.assertTrue(viewCount==readCount)
+		logging.info("Select 2 properties from 10000 entities: read %.3fs, view %.3fs",tRead,tView)
+
+	def ThreadedReadWrite(self,nReaders,locked,duration=0.5):
+		for i in xrange(1000):
+			self.employees.data[u"E%04i"%i]=(u"E%04i"%i,u"0",(u"%i High Street"%i,u"0"),None)
+		es=self.schema['SampleEntities.Employees']
+		counts=[0]*(nReaders+1)
+		errors=[]
+		stop=time.time()+duration
+		def Writer():
+			with es.OpenCollection() as collection:
+				rng=random.Random(0)
+				while time.time()<stop:
+					e=collection[u"E%04i"%rng.randrange(1000)]
+					version=unicode(counts[0]+1)
+					e['EmployeeName'].SetFromValue(version)
+					e['Address']['City'].SetFromValue(version)
+					collection.UpdateEntity(e)
+					counts[0]+=1
+		def Reader(n):
+			with es.OpenCollection() as collection:
+				rng=random.Random(n)
+				while time.time()<stop:
+					key=u"E%04i"%rng.randrange(1000)
+					if locked:
+						with self.container.lock:
+							e=collection[key]
+					else:
+						e=collection[key]
+					if e['EmployeeName'].value!=e['Address']['City'].value:
+						errors.append(key)
+					counts[n]+=1
+		threads=[threading.Thread(target=Writer)]
+		for n in xrange(1,nReaders+1):
+			threads.append(threading.Thread(target=Reader,args=(n,)))
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertFalse(errors,"Inconsistent read")
+		self.assertTrue(counts[0]>0,"Writer starved")
+		return counts[0],sum(counts[1:])
+		
+	def testCaseThreadedReadWrite(self):
+		lWrites,lReads=self.ThreadedReadWrite(4,True)
+		self.container=InMemoryEntityContainer(self.containerDef)
+		self.employees=self.container.entityStorage['Employees']
+		writes,reads=self.ThreadedReadWrite(4,False)
+		logging.info("1 writer, 4 readers for 0.5s: locked reads %i writes %i; lock-free reads %i writes %i",
+			lReads,lWrites,reads,writes)
+		self.assertTrue(reads>0)
+
+	def testCaseLinkFanOut(self):
+		# a bulk load of links from a single key, with occasional reads
+		links=self.container.associationStorage['Orders_Customers']
+		n=40000
+		t0=time.time()
+		for i in xrange(n):
+			links.AddLink(u'ALFKI',i)
+			if i%1000==0:
+				self.assertTrue(len(links.GetLinksFrom(u'ALFKI'))==i+1)
+		tAdd=time.time()-t0
+		snapshot=links.GetLinksFrom(u'ALFKI')
+		self.assertTrue(len(snapshot)==n)
+		self.assertTrue(links.GetLinksFrom(u'ALFKI') is snapshot,"snapshot reused")
+		self.assertTrue(links.GetLinksTo(n-1)==(u'ALFKI',))
+		t0=time.time()
+		for i in xrange(0,n,2):
+			links.RemoveLink(u'ALFKI',i)
+		tRemove=time.time()-t0
+		self.assertTrue(len(snapshot)==n,"old snapshot unchanged")
+		self.assertTrue(sorted(links.GetLinksFrom(u'ALFKI'))==range(1,n,2))
+		self.assertTrue(links.GetLinksTo(0)==())
+		logging.info("%i links from one key: add %.3fs, remove half %.3fs",n,tAdd,tRemove)
+
+	def testCaseChangeSet(self):
+		nameIndex=self.employees.AddIndex('EmployeeName',ordered=True)
+		links=self.container.associationStorage['Orders_Customers']
+		self.employees.data[u"ABCDE"]=(u"ABCDE",u"John Smith",(None,None),None)
+		nameIndex.AddKey(u"ABCDE",u"John Smith")
+		links.AddLink(1,u'ALFKI')
+		with self.containerDef.OpenChangeSet() as cs:
+			self.assertTrue(cs.Atomic)
+			with self.containerDef['Employees'].OpenCollection() as collection:
+				e=collection[u"ABCDE"]
+				e['EmployeeName'].SetFromValue(u"Jane Smith")
+				collection.UpdateEntity(e)
+		self.assertTrue(self.employees.data[u"ABCDE"][1]==u"Jane Smith","committed")
+		data=self.employees.data.copy()
+		try:
+			with self.containerDef.OpenChangeSet():
+				with self.containerDef['Employees'].OpenCollection() as collection:
+					e=collection[u"ABCDE"]
+					e['EmployeeName'].SetFromValue(u"Joe Bloggs")
+					collection.UpdateEntity(e)
+					e=collection.NewEntity()
+					e['EmployeeID'].SetFromValue(u"FGHIJ")
+					e['EmployeeName'].SetFromValue(u"Adam Smith")
+					collection.InsertEntity(e)
+				links.RemoveLink(1,u'ALFKI')
+				links.AddLink(2,u'ALFKI')
+				self.assertTrue(len(self.employees.data)==2)
+				# one undo record per change, not a copy of the container
+				self.assertTrue(len(self.container.undoLog)==4)
+				# readers are not blocked by the change set
+				result=[]
+				def Read():
+					result.append(links.GetLinksTo(u'ALFKI'))
+					result.append(nameIndex.OrderedKeys())
+				t=threading.Thread(target=Read)
+				t.start()
+				t.join(10)
+				self.assertFalse(t.isAlive(),"reader blocked by change set")
+				self.assertTrue(result==[(2,),[u"FGHIJ",u"ABCDE"]],repr(result))
+				raise ValueError
+		except ValueError:
+			pass
+		self.assertTrue(self.employees.data==data,"entities rolled back")
+		self.assertTrue(nameIndex.OrderedKeys()==[u"ABCDE"],"index rolled back")
+		self.assertTrue(nameIndex.Lookup(u"Jane Smith")==[u"ABCDE"])
+		self.assertTrue(links.GetLinksFrom(1)==(u'ALFKI',),"links rolled back")
+		self.assertTrue(links.GetLinksFrom(2)==())
+		self.assertTrue(links.GetLinksTo(u'ALFKI')==(1,))
+		# the lock is released by the change set
+		result=[]
+		def TryLock():
+			if self.container.lock.acquire(False):
+				self.container.lock.release()
+				result.append(True)
+		t=threading.Thread(target=TryLock)
+		t.start()
+		t.join()
+		self.assertTrue(result==[True],"lock released")
+
 
 class RegressionTests(DataServiceRegressionTests):
 	
@@ -1,6 +1,6 @@
 #! /usr/bin/env python
 
-import unittest, random, decimal, math, hashlib
+import unittest, random, decimal, math, hashlib, zlib
 from types import *
 
 HTTP_PORT=random.randint(1111,9999)
@@ -2169,11 +2169,12 @@ class SampleServerTests(unittest.TestCase):
 		any Batch Request sent to it."""
 		request=MockRequest("/service.svc/$batch")
 		request.Send(self.svc)
-		self.assertTrue(request.responseCode==404)
+		# batch requests must be POSTed
+		self.assertTrue(request.responseCode==400)
 		baseURI="/service.svc/$batch?"
 		request=MockRequest(baseURI)
 		request.Send(self.svc)
-		self.assertTrue(request.responseCode==404)
+		self.assertTrue(request.responseCode==400)
 		for x in ["$expand=Orders",
 			"$filter=substringof(CompanyName,%20'bikes')",
 			"$format=xml",
@@ -2187,6 +2188,277 @@ class SampleServerTests(unittest.TestCase):
 			request.Send(self.svc)
 			self.assertTrue(request.responseCode==400,"URI9 with %s"%x)
 	
+	def BatchRequest(self,body,boundary='batch_1'):
+		request=MockRequest("/service.svc/$batch","POST")
+		request.SetHeader('Content-Type','multipart/mixed; boundary=%s'%boundary)
+		request.SetHeader('Content-Length',str(len(body)))
+		request.rfile.write(body)
+		request.Send(self.svc)
+		return request
+	
+	def BatchResponses(self,request):
+		"""Returns a list of (Content-ID, status code, body) for the
+		operations in a batch response; nested change set responses are
+		returned as lists."""
+		self.assertTrue(request.responseCode==202)
+		result=[]
+		for headers,body in self.svc.ReadMultipart(request.responseHeaders['CONTENT-TYPE'],request.wfile.getvalue()):
+			contentType=self.svc.GetBatchHeader(headers,'Content-Type')
+			if contentType.startswith('multipart/mixed'):
+				changeSet=[]
+				for partHeaders,partBody in self.svc.ReadMultipart(contentType,body):
+					changeSet.append(self.BatchResponse(partHeaders,partBody))
+				result.append(changeSet)
+			else:
+				result.append(self.BatchResponse(headers,body))
+		return result
+	
+	def BatchResponse(self,headers,body):
+		self.assertTrue(self.svc.GetBatchHeader(headers,'Content-Type')=='application/http')
+		statusLine,body=body.split('\r\n',1)
+		responseHeaders,body=self.svc.ReadBatchHeaders(body)
+		return self.svc.GetBatchHeader(headers,'Content-ID'),int(statusLine.split()[1]),body
+		
+	def testCaseBatch(self):
+		"""A batch request is represented as a multipart MIME message
+		using the "multipart/mixed" content type, each change set is
+		itself a multipart/mixed body part.  All operations in a change
+		set succeed or fail together."""
+		body="""--batch_1\r
+Content-Type: application/http\r
+Content-Transfer-Encoding: binary\r
+\r
+GET Customers('ALFKI')/CompanyName/$value HTTP/1.1\r
+\r
+\r
+--batch_1\r
+Content-Type: multipart/mixed; boundary=changeset_1\r
+\r
+--changeset_1\r
+Content-Type: application/http\r
+Content-Transfer-Encoding: binary\r
+Content-ID: 1\r
+\r
+POST Customers HTTP/1.1\r
+Content-Type: application/json\r
+Accept: application/json\r
+\r
+{"CustomerID":"STEVE","CompanyName":"Steve's Inc","Address":{"Street":null,"City":"Cambridge"}}\r
+--changeset_1\r
+Content-Type: application/http\r
+Content-Transfer-Encoding: binary\r
+\r
+PUT $1/CompanyName HTTP/1.1\r
+Content-Type: application/json\r
+\r
+{"CompanyName":"Steve's Ltd"}\r
+--changeset_1--\r
+\r
+--batch_1\r
+Content-Type: application/http\r
+Content-Transfer-Encoding: binary\r
+\r
+GET http://host/service.svc/Customers('STEVE')/CompanyName/$value HTTP/1.1\r
+\r
+\r
+--batch_1--\r
+"""
+		request=self.BatchRequest(body)
+		self.assertTrue(request.responseHeaders['CONTENT-TYPE'].startswith('multipart/mixed'))
+		responses=self.BatchResponses(request)
+		self.assertTrue(len(responses)==3)
+		self.assertTrue(responses[0][1]==200)
+		self.assertTrue(responses[0][2].startswith('Example Inc'),repr(responses[0][2]))
+		changeSet=responses[1]
+		self.assertTrue(len(changeSet)==2)
+		self.assertTrue(changeSet[0][0]=='1' and changeSet[0][1]==201)
+		self.assertTrue(changeSet[1][0] is None and changeSet[1][1]==204)
+		self.assertTrue(responses[2][1]==200)
+		self.assertTrue(responses[2][2].startswith("Steve's Ltd"),repr(responses[2][2]))
+		# a failed operation fails the change set with a single response
+		body="""--batch_1\r
+Content-Type: multipart/mixed; boundary=changeset_1\r
+\r
+--changeset_1\r
+Content-Type: application/http\r
+Content-Transfer-Encoding: binary\r
+\r
+PUT Customers('STEVE')/CompanyName HTTP/1.1\r
+Content-Type: application/json\r
+\r
+{"CompanyName":"Steve's Plc"}\r
+--changeset_1\r
+Content-Type: application/http\r
+Content-Transfer-Encoding: binary\r
+\r
+POST Customers HTTP/1.1\r
+Content-Type: application/json\r
+\r
+{"CustomerID":"STEVE","CompanyName":"Steve's Inc","Address":{"Street":null,"City":"Cambridge"}}\r
+--changeset_1--\r
+\r
+--batch_1--\r
+"""
+		responses=self.BatchResponses(self.BatchRequest(body))
+		# the single response replaces the change set
+		self.assertTrue(len(responses)==1 and isinstance(responses[0],tuple))
+		self.assertTrue(responses[0][1]>=400,"Failed change set status")
+		# ...and the changes made before the failure are rolled back
+		request=MockRequest("/service.svc/Customers('STEVE')/CompanyName/$value")
+		request.Send(self.svc)
+		self.assertTrue(request.responseCode==200)
+		self.assertTrue(request.wfile.getvalue()=="Steve's Ltd",repr(request.wfile.getvalue()))
+		# change sets that span entity containers fail before any
+		# operation is executed
+		xBody=body.replace("POST Customers HTTP/1.1","DELETE ExtraEntities.BitsAndPieces(1) HTTP/1.1")
+		responses=self.BatchResponses(self.BatchRequest(xBody))
+		self.assertTrue(len(responses)==1 and isinstance(responses[0],tuple))
+		self.assertTrue(responses[0][1]==400,"Cross-container change set status")
+		request=MockRequest("/service.svc/Customers('STEVE')/CompanyName/$value")
+		request.Send(self.svc)
+		self.assertTrue(request.wfile.getvalue()=="Steve's Ltd",repr(request.wfile.getvalue()))
+		request=MockRequest("/service.svc/ExtraEntities.BitsAndPieces(1)")
+		request.Send(self.svc)
+		self.assertTrue(request.responseCode==200)
+		# badly formed batch requests are rejected outright
+		request=self.BatchRequest(body,"batch_2")
+		self.assertTrue(request.responseCode==400)
+		# bare LF line breaks are rejected, not rewritten
+		request=self.BatchRequest(body.replace('\r\n','\n'))
+		self.assertTrue(request.responseCode==400)
+		# retrieve operations must not appear in a change set
+		request=self.BatchRequest(body.replace("PUT Customers('STEVE')/CompanyName","GET Customers('STEVE')/CompanyName"))
+		self.assertTrue(request.responseCode==400)
+
+	def testCaseConditionalGet(self):
+		request=MockRequest("/service.svc/Customers('ALFKI')")
+		request.Send(self.svc)
+		self.assertTrue(request.responseCode==200)
+		etag=request.responseHeaders['ETAG']
+		for ifNoneMatch in (etag,'"XXX", %s'%etag,"*"):
+			request=MockRequest("/service.svc/Customers('ALFKI')")
+			request.SetHeader('If-None-Match',ifNoneMatch)
+			request.Send(self.svc)
+			self.assertTrue(request.responseCode==304,"If-None-Match: %s"%ifNoneMatch)
+			self.assertTrue(request.responseHeaders['ETAG']==etag)
+			self.assertTrue(request.wfile.getvalue()=='')
+		for ifNoneMatch in ('"XXX"','W/"XXX"','rubbish'):
+			request=MockRequest("/service.svc/Customers('ALFKI')")
+			request.SetHeader('If-None-Match',ifNoneMatch)
+			request.Send(self.svc)
+			self.assertTrue(request.responseCode==200,"If-None-Match: %s"%ifNoneMatch)
+		# property values carry the entity's ETag too
+		request=MockRequest("/service.svc/Customers('ALFKI')/CompanyName/$value")
+		request.SetHeader('If-None-Match',etag)
+		request.Send(self.svc)
+		self.assertTrue(request.responseCode==304)
+		# ...but entities with no concurrency tokens are never 'not modified'
+		request=MockRequest("/service.svc/Orders(1)")
+		request.SetHeader('If-None-Match',"*")
+		request.Send(self.svc)
+		self.assertTrue(request.responseCode==200)
+
+	def testCaseResponseCache(self):
+		self.svc.responseCache=ResponseCache()
+		request=MockRequest("/service.svc/Customers('ALFKI')")
+		request.Send(self.svc)
+		data=request.wfile.getvalue()
+		etag=request.responseHeaders['ETAG']
+		self.assertTrue(self.svc.responseCache.misses==1 and self.svc.responseCache.hits==0)
+		request=MockRequest("/service.svc/Customers('ALFKI')")
+		request.Send(self.svc)
+		self.assertTrue(request.responseCode==200)
+		self.assertTrue(request.wfile.getvalue()==data,"cached response")
+		self.assertTrue(request.responseHeaders['ETAG']==etag)
+		self.assertTrue(self.svc.responseCache.hits==1)
+		self.assertTrue(self.svc.responseCache.bytesSaved==len(data))
+		self.assertTrue(self.svc.responseCache.HitRatio()==0.5)
+		# each format is cached separately
+		request=MockRequest("/service.svc/Customers('ALFKI')?$format=json")
+		request.Send(self.svc)
+		self.assertTrue(request.wfile.getvalue()!=data)
+		self.assertTrue(self.svc.responseCache.misses==2)
+		# an update through the server invalidates the cached responses
+		request=MockRequest("/service.svc/Customers('ALFKI')/CompanyName","PUT")
+		body='{"CompanyName":"Example Ltd"}'
+		request.SetHeader('Content-Type','application/json')
+		request.SetHeader('Content-Length',str(len(body)))
+		request.rfile.write(body)
+		request.Send(self.svc)
+		self.assertTrue(request.responseCode==204)
+		self.assertTrue(self.svc.responseCache.size==0)
+		request=MockRequest("/service.svc/Customers('ALFKI')")
+		request.Send(self.svc)
+		self.assertTrue("Example Ltd" in request.wfile.getvalue())
+		self.assertTrue(self.svc.responseCache.misses==3)
+		# the least recently used responses are evicted first
+		cache=ResponseCache(10)
+		cache.Set('a',[],'12345','A')
+		cache.Set('b',[],'12345','B')
+		self.assertTrue(cache.Get('a')==([],'12345'))
+		cache.Set('c',[],'12345')
+		self.assertTrue(cache.Get('b') is None)
+		self.assertTrue(cache.Get('a') is not None and cache.size==10)
+		cache.Invalidate('A')
+		self.assertTrue(cache.Get('a') is None and cache.size==5)
+		cache.Set('d',[],'12345678901')
+		self.assertTrue(cache.Get('d') is None,"too big to cache")
+
+	def testCaseContentEncoding(self):
+		request=MockRequest("/service.svc/Customers")
+		request.Send(self.svc)
+		self.assertTrue(request.responseCode==200)
+		self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+		self.assertTrue(request.responseHeaders['VARY']=="Accept-Encoding")
+		data=request.wfile.getvalue()
+		for encoding,wbits in (("gzip",16+zlib.MAX_WBITS),("deflate",zlib.MAX_WBITS)):
+			request=MockRequest("/service.svc/Customers")
+			request.SetHeader('Accept-Encoding',encoding)
+			request.Send(self.svc)
+			self.assertTrue(request.responseCode==200)
+			self.assertTrue(request.responseHeaders['CONTENT-ENCODING']==encoding)
+			self.assertFalse("CONTENT-LENGTH" in request.responseHeaders)
+			zData=request.wfile.getvalue()
+			self.assertTrue(len(zData)<len(data))
+			self.assertTrue(zlib.decompress(zData,wbits)==data)
+		# entries have a known length, and a strong ETag is weakened
+		request=MockRequest("/service.svc/Customers('ALFKI')")
+		request.Send(self.svc)
+		etag=request.responseHeaders['ETAG']
+		data=request.wfile.getvalue()
+		self.assertTrue(len(data)>=self.svc.CompressionThreshold)
+		request=MockRequest("/service.svc/Customers('ALFKI')")
+		request.SetHeader('Accept-Encoding','gzip')
+		request.Send(self.svc)
+		self.assertTrue(request.responseHeaders['CONTENT-ENCODING']=="gzip")
+		self.assertTrue(zlib.decompress(request.wfile.getvalue(),16+zlib.MAX_WBITS)==data)
+		self.assertTrue(http.EntityTag.FromString(request.responseHeaders['ETAG']).tag==http.EntityTag.FromString(etag).tag)
+		self.assertTrue(request.responseHeaders['ETAG'].startswith("W/"))
+		# small responses are not compressed
+		request=MockRequest("/service.svc/Customers('ALFKI')/CompanyName/$value")
+		request.SetHeader('Accept-Encoding','gzip')
+		request.Send(self.svc)
+		self.assertTrue(request.responseCode==200)
+		self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+		self.assertTrue(request.wfile.getvalue()=="Example Inc")
+		request=MockRequest("/service.svc/Documents(301)/$value")
+		request.SetHeader('Accept-Encoding','gzip')
+		request.Send(self.svc)
+		self.assertTrue(request.responseCode==200)
+		self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+		self.assertTrue(request.responseHeaders['VARY']=="Accept-Encoding")
+		# error responses are not compressed
+		request=MockRequest("/service.svc/Customers('ZZZZZ')")
+		request.SetHeader('Accept-Encoding','gzip')
+		request.Send(self.svc)
+		self.assertTrue(request.responseCode==404)
+		self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+		# unacceptable encodings are not used
+		request=MockRequest("/service.svc/Customers")
+		request.SetHeader('Accept-Encoding','gzip;q=0, compress')
+		request.Send(self.svc)
+		self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+
 	def testCaseURI10(self):
 		"""URI10 = scheme serviceRoot "/" serviceOperation-et
 
@@ -3265,6 +3537,41 @@ class SampleServerTests(unittest.TestCase):
 		self.assertTrue(type(obj)==ListType,"Expected list of entities")
 		self.assertTrue(len(obj)==91,"Sample server has 91 Customers")
 
+	def testCaseStreamEntitySet(self):
+		customers=self.container.entityStorage['Customers']
+		for i in xrange(1000):
+			customers.data['YY%04i'%i]=('YY%04i'%i,'Example-%i Ltd'%i,(None,None),None)
+		self.svc.topmax=None
+		for accept,nEntities in (('application/atom+xml',1091),('application/json',1091)):
+			request=MockRequest('/service.svc/Customers')
+			request.SetHeader('Accept',accept)
+			t0=time.time()
+			data=self.svc(request.environ,request.start_response)
+			self.assertTrue(request.responseCode==200)
+			self.assertFalse("CONTENT-LENGTH" in request.responseHeaders,"Streamed response has no Content-Length")
+			# the body is generated on demand
+			self.assertFalse(isinstance(data,list))
+			chunks=iter(data)
+			chunk=chunks.next()
+			t1=time.time()
+			self.assertTrue(len(chunk)==self.svc.ChunkSize)
+			body=[chunk]
+			for chunk in chunks:
+				self.assertTrue(len(chunk)<=self.svc.ChunkSize)
+				body.append(chunk)
+			t2=time.time()
+			logging.info("%s: %i chunks, first chunk in %.1fms, complete in %.1fms",accept,
+				len(body),(t1-t0)*1000.0,(t2-t0)*1000.0)
+			self.assertTrue(t1-t0<t2-t0)
+			body=string.join(body,'')
+			if accept=='application/json':
+				obj=json.loads(body)
+				self.assertTrue(len(obj["d"]["results"])==nEntities)
+			else:
+				doc=app.Document()
+				doc.Read(body)
+				self.assertTrue(len(doc.root.Entry)==nEntities)
+				
 	def testCaseRetrieveEntity(self):
 		request=MockRequest("/service.svc/Customers('ALFKI')")
 		request.Send(self.svc)
@@ -3477,6 +3784,62 @@ class SampleServerTests(unittest.TestCase):
 		self.assertTrue("EntitySets" in obj,"EntitySets in service document response")
 		self.assertTrue(type(obj['EntitySets'])==ListType,"EntitySets is an array")
 
+	def testCasePreparedDocuments(self):
+		for path,accept in (("/service.svc/$metadata",None),
+			("/service.svc/",None),("/service.svc/","application/json")):
+			request=MockRequest(path)
+			if accept:
+				request.SetHeader('Accept',accept)
+			request.Send(self.svc)
+			self.assertTrue(request.responseCode==200)
+			self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+			self.assertTrue(request.responseHeaders['VARY']=="Accept-Encoding")
+			etag=http.EntityTag.FromString(request.responseHeaders['ETAG'])
+			self.assertFalse(etag.weak,"strong ETag for %s"%path)
+			data=request.wfile.getvalue()
+			request=MockRequest(path)
+			if accept:
+				request.SetHeader('Accept',accept)
+			request.SetHeader('Accept-Encoding','gzip, deflate')
+			request.Send(self.svc)
+			self.assertTrue(request.responseCode==200)
+			self.assertTrue(request.responseHeaders['CONTENT-ENCODING']=="gzip")
+			zData=request.wfile.getvalue()
+			self.assertTrue(int(request.responseHeaders['CONTENT-LENGTH'])==len(zData))
+			self.assertTrue(zlib.decompress(zData,16+zlib.MAX_WBITS)==data)
+			gzipETag=http.EntityTag.FromString(request.responseHeaders['ETAG'])
+			self.assertFalse(gzipETag==etag,"each encoding has its own ETag")
+			# each tag only validates a cached copy of its own encoding
+			for tag,encoding,code in (
+					(etag,None,304),
+					(gzipETag,None,200),
+					(gzipETag,'gzip',304),
+					(etag,'gzip',200)):
+				request=MockRequest(path)
+				if accept:
+					request.SetHeader('Accept',accept)
+				if encoding:
+					request.SetHeader('Accept-Encoding',encoding)
+				request.SetHeader('If-None-Match',str(tag))
+				request.Send(self.svc)
+				self.assertTrue(request.responseCode==code,"%s with %s: %i"%(str(tag),encoding,request.responseCode))
+				if code==304:
+					self.assertTrue(request.wfile.getvalue()=='')
+			request=MockRequest(path)
+			if accept:
+				request.SetHeader('Accept',accept)
+			request.SetHeader('Accept-Encoding','gzip;q=0, identity')
+			request.Send(self.svc)
+			self.assertTrue(request.wfile.getvalue()==data)
+		# the documents are serialized once, when the model is set
+		response=self.svc.metadataResponse
+		request=MockRequest("/service.svc/$metadata")
+		request.Send(self.svc)
+		self.assertTrue(self.svc.metadataResponse is response)
+		self.svc.SetModel(self.ds.GetDocument())
+		self.assertFalse(self.svc.metadataResponse is response)
+		self.assertTrue(self.svc.metadataResponse.etag==response.etag)
+
 	def testCaseRetrieveLink(self):
 		request=MockRequest("/service.svc/Customers('ALFKI')/$links/Orders")
 		request.Send(self.svc)
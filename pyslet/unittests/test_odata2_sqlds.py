@@ -20,7 +20,7 @@ from pyslet.vfs import OSFilePath as FilePath
 TEST_DATA_DIR=FilePath(FilePath(__file__).abspath().split()[0],'data_odatav2')
 
 
-import random
+import random, time
 import pyslet.odata2.csdl as edm
 import pyslet.odata2.edmx as edmx
 
@@ -230,6 +230,26 @@ class ThreadTests(unittest.TestCase):
 		pass
 
 	
+class QueryCounter(logging.Handler):
+	"""Counts the SELECT statements logged by the SQL collections"""
+	
+	def __init__(self):
+		logging.Handler.__init__(self)
+		self.count=0
+		self.logger=logging.getLogger()
+		self.saveLevel=self.logger.level
+		self.logger.addHandler(self)
+		self.logger.setLevel(logging.INFO)
+		
+	def emit(self,record):
+		if record.getMessage().startswith("SELECT"):
+			self.count+=1
+	
+	def Close(self):
+		self.logger.removeHandler(self)
+		self.logger.setLevel(self.saveLevel)
+		
+
 class SQLDSTests(unittest.TestCase):
 
 	def setUp(self):
@@ -285,6 +305,100 @@ class SQLDSTests(unittest.TestCase):
 			except edm.ConstraintError:
 				pass
 	
+	def testCaseInsertEntities(self):
+		self.db.CreateAllTables()
+		customers=self.schema['SampleEntities.Customers']
+		orders=self.schema['SampleEntities.Orders']
+		with customers.OpenCollection() as collection:
+			def CustomerGenerator():
+				for i in xrange(25):
+					customer=collection.NewEntity()
+					customer.SetKey('C%03i'%i)
+					customer["CompanyName"].SetFromValue('Widget-%i Inc'%i)
+					customer["Address"]["City"].SetFromValue('Chunton')
+					if i%5==0:
+						# deep insert, processed after each batch
+						order=orders.OpenCollection().NewEntity()
+						order.SetKey(1000+i)
+						customer['Orders'].BindEntity(order)
+					yield customer
+			collection.InsertEntities(CustomerGenerator(),batchSize=10)
+			self.assertTrue(len(collection)==25)
+			customer=collection['C010']
+			self.assertTrue(customer['CompanyName'].value=='Widget-10 Inc')
+			with customer['Orders'].OpenCollection() as orderList:
+				self.assertTrue(orderList.keys()==[1010])
+			# duplicate key rolls back the whole transaction
+			newCustomers=[]
+			for key in ('C100','C101','C001'):
+				customer=collection.NewEntity()
+				customer.SetKey(key)
+				customer["CompanyName"].SetFromValue('Duplicate')
+				newCustomers.append(customer)
+			try:
+				collection.InsertEntities(newCustomers)
+				self.fail("InsertEntities with duplicate key")
+			except edm.ConstraintError:
+				pass
+			self.assertTrue(len(collection)==25)
+			self.assertFalse('C100' in collection)
+		with orders.OpenCollection() as collection:
+			def OrderGenerator():
+				for i in xrange(50):
+					order=collection.NewEntity()
+					order.SetKey(i)
+					order["ShippedDate"].SetFromLiteral('2013-10-02T10:20:59')
+					# foreign key bindings to existing customers
+					if i%10:
+						order['Customer'].BindEntity('C%03i'%(i%25))
+					yield order
+			queries=QueryCounter()
+			try:
+				collection.InsertEntities(OrderGenerator(),batchSize=7)
+				# the bound keys are checked with one query per batch
+				self.assertTrue(queries.count==8,"Key lookup queries: %i"%queries.count)
+			finally:
+				queries.Close()
+			self.assertTrue(len(collection)==55)
+			# binding to a missing key fails the whole insert
+			newOrders=[]
+			for i,key in ((100,'C001'),(101,'C999')):
+				order=collection.NewEntity()
+				order.SetKey(i)
+				order['Customer'].BindEntity(key)
+				newOrders.append(order)
+			try:
+				collection.InsertEntities(newOrders)
+				self.fail("InsertEntities with missing target key")
+			except KeyError:
+				pass
+			self.assertTrue(len(collection)==55)
+		with customers.OpenCollection() as collection:
+			customer=collection['C003']
+			with customer['Orders'].OpenCollection() as orderList:
+				self.assertTrue(sorted(orderList.keys())==[3,28])
+		# compare rows per second with InsertEntity
+		employees=self.schema['SampleEntities.Employees']
+		with employees.OpenCollection() as collection:
+			def EmployeeGenerator(base):
+				for i in xrange(1000):
+					newHire=collection.NewEntity()
+					newHire.SetKey('%05X'%(base+i))
+					newHire["EmployeeName"].SetFromValue('Talent #%i'%i)
+					newHire["Address"]["City"].SetFromValue('Chunton')
+					newHire["Address"]["Street"].SetFromValue('Mill Road')
+					yield newHire
+			t=time.time()
+			for newHire in EmployeeGenerator(0):
+				collection.InsertEntity(newHire)
+			tSingle=time.time()-t
+			t=time.time()
+			collection.InsertEntities(EmployeeGenerator(1000))
+			tBulk=time.time()-t
+			self.assertTrue(len(collection)==2000)
+			logging.info("Insert 1000 rows: InsertEntity %.0f rows/s; InsertEntities %.0f rows/s",1000/tSingle,1000/tBulk)
+			self.assertTrue(tBulk<tSingle,"InsertEntities slower than InsertEntity")
+
 	def testCaseUpdate(self):
 		es=self.schema['SampleEntities.Employees']
 		with es.OpenCollection() as collection:
@@ -344,6 +458,47 @@ class SQLDSTests(unittest.TestCase):
 			except KeyError:
 				pass
 	
+	def testCaseChangeSet(self):
+		self.db.CreateAllTables()
+		es=self.schema['SampleEntities.Employees']
+		def NewHire(collection,key,name):
+			newHire=collection.NewEntity()
+			newHire.SetKey(key)
+			newHire["EmployeeName"].SetFromValue(name)
+			collection.InsertEntity(newHire)
+		# an exception inside the change set rolls back everything
+		try:
+			with self.container.OpenChangeSet() as changeSet:
+				self.assertTrue(isinstance(changeSet,SQLChangeSet))
+				with es.OpenCollection() as collection:
+					NewHire(collection,'00001','Joe Bloggs')
+					self.assertTrue(len(collection)==1,"Insert visible inside change set")
+				with es.OpenCollection() as collection:
+					NewHire(collection,'00002','Jane Doe')
+				raise ValueError
+			self.fail("Exception not propagated by change set")
+		except ValueError:
+			pass
+		with es.OpenCollection() as collection:
+			self.assertTrue(len(collection)==0,"Change set rolled back")
+		# a failed operation fails the whole change set
+		try:
+			with self.container.OpenChangeSet():
+				with es.OpenCollection() as collection:
+					NewHire(collection,'00001','Joe Bloggs')
+					NewHire(collection,'00001','Jane Doe')
+			self.fail("Double insert in change set")
+		except edm.ConstraintError:
+			pass
+		with es.OpenCollection() as collection:
+			self.assertTrue(len(collection)==0,"Failed change set rolled back")
+		with self.container.OpenChangeSet():
+			with es.OpenCollection() as collection:
+				NewHire(collection,'00001','Joe Bloggs')
+				NewHire(collection,'00002','Jane Doe')
+		with es.OpenCollection() as collection:
+			self.assertTrue(len(collection)==2,"Change set committed")
+	
 	def testCaseIter(self):
 		es=self.schema['SampleEntities.Employees']
 		with es.OpenCollection() as collection:
@@ -413,6 +568,63 @@ class SQLDSTests(unittest.TestCase):
 					self.assertTrue(talent['EmployeeName'].value>=lastTalent['EmployeeName'].value)
 				lastTalent=talent			
 
+	def testCasePaging(self):
+		es=self.schema['SampleEntities.Employees']
+		with es.OpenCollection() as collection:
+			collection.CreateTable()
+			def EmployeeGenerator():
+				for i in xrange(5000):
+					newHire=collection.NewEntity()
+					newHire.SetKey('%05X'%i)
+					newHire["EmployeeName"].SetFromValue('Talent #%i'%(i%97))
+					newHire["Address"]["City"].SetFromValue('Chunton')
+					yield newHire
+			collection.InsertEntities(EmployeeGenerator())
+			collection.OrderBy(core.CommonExpression.OrderByFromString("EmployeeName desc"))
+			allKeys=map(lambda x:x.Key(),collection.itervalues())
+			self.assertTrue(len(allKeys)==5000)
+			for skip in (0,1,10,4995,5000,6000):
+				collection.SetPage(10,skip)
+				keys=map(lambda x:x.Key(),collection.iterpage())
+				self.assertTrue(keys==allKeys[skip:skip+10],"skip=%i"%skip)
+			collection.SetPage(None,4990)
+			keys=map(lambda x:x.Key(),collection.iterpage())
+			self.assertTrue(keys==allKeys[4990:])
+			# server-driven paging uses the skiptoken
+			collection.TopMax(300)
+			collection.SetPage(1000,100)
+			keys=[]
+			while True:
+				page=map(lambda x:x.Key(),collection.iterpage(True))
+				if not page:
+					break
+				self.assertTrue(len(page)<=300)
+				keys=keys+page
+				token=collection.NextSkipToken()
+				if token is None:
+					break
+				collection.SetPage(None,0,token)
+			self.assertTrue(keys==allKeys[100:],"TopMax paging")
+			collection.TopMax(None)
+			# SQLite skips the rows in the database, not the collection
+			skip,clause=collection.LimitClause(4980,10,QMarkParams())
+			self.assertTrue(skip==0 and "OFFSET" in clause.upper(),"%i: %s"%(skip,clause))
+			# compare deep paging with the rows skipped by the database
+			# and by the collection itself
+			def DeepPages():
+				t=time.time()
+				for i in xrange(20):
+					collection.SetPage(10,4980)
+					keys=map(lambda x:x.Key(),collection.iterpage())
+					self.assertTrue(keys==allKeys[4980:4990])
+				return time.time()-t
+			tOffset=DeepPages()
+			collection.LimitClause=lambda skip,top,params:(skip,'')
+			collection.container.sqlCache.Clear()
+			tClient=DeepPages()
+			del collection.LimitClause
+			logging.info("20 pages of 10 at skip=4980: OFFSET %.3fs, client skip %.3fs",tOffset,tClient)
+
 	def testCaseNavigation(self):
 # 		<Property Name="CustomerID" Type="Edm.String" Nullable="false" MaxLength="5"
 # 			Unicode="true" FixedLength="true"/>
@@ -486,6 +698,191 @@ class SQLDSTests(unittest.TestCase):
 			self.assertTrue(len(collection)==1)
 			self.assertTrue(order.Key() in collection)
 
+	def testCaseExpand(self):
+		self.db.CreateAllTables()
+		customers=self.schema['SampleEntities.Customers']
+		orders=self.schema['SampleEntities.Orders']
+		with customers.OpenCollection() as collection:
+			for i in xrange(30):
+				customer=collection.NewEntity()
+				customer.SetKey('C%03i'%i)
+				customer["CompanyName"].SetFromValue('Widget-%i Inc'%i)
+				customer["Address"]["City"].SetFromValue('Chunton')
+				collection.InsertEntity(customer)
+		with orders.OpenCollection() as collection:
+			for i in xrange(87):
+				order=collection.NewEntity()
+				order.SetKey(i)
+				order["ShippedDate"].SetFromLiteral('2013-10-02T10:20:59')
+				# customer 29 has no orders
+				order['Customer'].BindEntity('C%03i'%(i%29))
+				collection.InsertEntity(order)
+		queries=QueryCounter()
+		try:
+			with customers.OpenCollection() as collection:
+				collection.Expand({'Orders':None})
+				queries.count=0
+				result=collection.values()
+				# one query for the customers and one for all the orders
+				self.assertTrue(queries.count==2,"Expand queries: %i"%queries.count)
+				self.assertTrue(len(result)==30)
+				for customer in result:
+					self.assertTrue(customer['Orders'].isExpanded)
+					with customer['Orders'].OpenCollection() as orderList:
+						keys=sorted(orderList.keys())
+					if customer.Key()=='C029':
+						self.assertTrue(keys==[])
+					else:
+						i=int(customer.Key()[1:])
+						self.assertTrue(keys==[i,i+29,i+58],"%s: %s"%(customer.Key(),repr(keys)))
+				# batches of entities are expanded separately
+				collection.ExpandBatchSize=7
+				queries.count=0
+				result=collection.values()
+				self.assertTrue(queries.count==6,"Batched queries: %i"%queries.count)
+				self.assertTrue(len(result)==30)
+				# select rules are still applied to each entity
+				collection.ExpandBatchSize=SQLCollectionBase.ExpandBatchSize
+				collection.Expand({'Orders':None},{'CompanyName':None,'Orders':None})
+				for customer in collection.values():
+					self.assertTrue(customer['CompanyName'])
+					self.assertFalse(customer['Address']['City'])
+					self.assertTrue(customer['Orders'].isExpanded)
+			with orders.OpenCollection() as collection:
+				# forward navigation, expanded through a chain
+				collection.Expand({'Customer':{'Orders':None}})
+				queries.count=0
+				result=collection.values()
+				self.assertTrue(queries.count==3,"Chained expand queries: %i"%queries.count)
+				self.assertTrue(len(result)==87)
+				for order in result:
+					customer=order['Customer'].GetEntity()
+					self.assertTrue(customer.Key()=='C%03i'%(order.Key()%29))
+					self.assertTrue(customer['Orders'].isExpanded)
+					with customer['Orders'].OpenCollection() as orderList:
+						self.assertTrue(order.Key() in orderList)
+						self.assertTrue(len(orderList)==3)
+				self.assertTrue(queries.count==3,"GetEntity on expanded collection")
+		finally:
+			queries.Close()
+
+	def testCaseParams(self):
+		for pClass in (QMarkParams,NumericParams,NamedParams):
+			params=pClass()
+			p1=params.AddParam(1)
+			p2=params.AddSlot(2)
+			p3=params.AddParam(3)
+			p4=params.AddSlot(4)
+			self.assertTrue(params.slots==[1,3])
+			newParams=params.Rebind([20,40])
+			self.assertTrue(isinstance(newParams,pClass))
+			if pClass is NamedParams:
+				self.assertTrue(newParams.params=={'p0':1,'p1':20,'p2':3,'p3':40})
+				self.assertTrue(params.params=={'p0':1,'p1':2,'p2':3,'p3':4},"original unchanged")
+			else:
+				self.assertTrue(newParams.params==[1,20,3,40])
+				self.assertTrue(params.params==[1,2,3,4],"original unchanged")
+			# rebinding a rebound set works too
+			self.assertTrue(newParams.Rebind([200,400]).slots==[1,3])
+
+	def testCaseSQLCache(self):
+		es=self.schema['SampleEntities.Employees']
+		cache=self.db.sqlCache
+		with es.OpenCollection() as collection:
+			collection.CreateTable()
+			for i in xrange(20):
+				newHire=collection.NewEntity()
+				newHire.SetKey('%05X'%i)
+				newHire["EmployeeName"].SetFromValue('Talent #%i'%i)
+				newHire["Address"]["City"].SetFromValue('Chunton')
+				newHire["Address"]["Street"].SetFromValue(('Mill Road','Main Street')[i%2])
+				collection.InsertEntity(newHire)
+			# all but the first insert reuse the same statement
+			self.assertTrue(cache.hits>=19,"Insert hits: %i"%cache.hits)
+			cache.Clear()
+			for i in xrange(20):
+				talent=collection['%05X'%i]
+				self.assertTrue(talent['EmployeeName'].value=='Talent #%i'%i)
+			self.assertTrue(cache.misses==1 and cache.hits==19)
+			self.assertTrue(cache.HitRate()==0.95)
+			try:
+				collection['00020']
+				self.fail("Cached statement found missing entity")
+			except KeyError:
+				pass
+			cache.Clear()
+			self.assertTrue(len(collection)==20)
+			self.assertTrue(len(collection)==20)
+			self.assertTrue(cache.misses==1 and cache.hits==1)
+			collection.Filter(core.CommonExpression.FromString("endswith(Address/Street,'Road')"))
+			self.assertTrue(len(collection)==10)
+			self.assertTrue(cache.misses==2,"new filter, new statement")
+			collection.Filter(core.CommonExpression.FromString("endswith(Address/Street,'Street')"))
+			self.assertTrue(len(collection)==10)
+			self.assertTrue(cache.misses==3,"filter literal changes the statement")
+			for talent in collection.values():
+				self.assertTrue(talent['Address']['Street'].value=='Main Street')
+			collection.Filter(core.CommonExpression.FromString("endswith(Address/Street,'Road')"))
+			for talent in collection.values():
+				self.assertTrue(talent['Address']['Street'].value=='Mill Road')
+			# the cache is shared with other collections for the same entity set
+			with es.OpenCollection() as collection2:
+				collection2.Filter(core.CommonExpression.FromString("endswith(Address/Street,'Road')"))
+				hits=cache.hits
+				self.assertTrue(len(collection2)==10)
+				self.assertTrue(len(collection2.values())==10)
+				self.assertTrue(cache.hits==hits+2)
+			# check that paging rebinds the skiptoken
+			collection.Filter(None)
+			collection.OrderBy(core.CommonExpression.OrderByFromString("EmployeeName desc"))
+			collection.TopMax(5)
+			collection.SetPage(None)
+			hits,misses=cache.hits,cache.misses
+			keys=[]
+			while True:
+				page=list(collection.iterpage(True))
+				if not page:
+					break
+				keys=keys+map(lambda x:x.Key(),page)
+			self.assertTrue(len(keys)==20 and len(set(keys))==20,repr(keys))
+			# one statement for the first page, one for the rest
+			self.assertTrue(cache.misses==misses+2)
+			self.assertTrue(cache.hits==hits+3)
+			collection.TopMax(None)
+			collection.Filter(core.CommonExpression.FromString(
+				"(endswith(Address/Street,'Road') or startswith(tolower(EmployeeName),'talent #1')) and length(Address/City) gt 3"))
+			collection.SetPage(None)
+			t=time.time()
+			for i in xrange(200):
+				len(collection)
+				collection['00001']
+			tCached=time.time()-t
+			cache.maxSize=0
+			t=time.time()
+			for i in xrange(200):
+				len(collection)
+				collection['00001']
+			tUncached=time.time()-t
+			logging.info("200 x len+get: cached %.3fs, uncached %.3fs",tCached,tUncached)
+
+	def testCaseSQLCacheLiterals(self):
+		# filter literals are not rebound so literals that format the
+		# same way must not share a statement
+		es=self.schema['SampleEntities.Orders']
+		with es.OpenCollection() as collection:
+			collection.CreateTable()
+			for i,shipped in ((1,'2013-10-02T10:20:59.25'),(2,'2013-10-02T10:20:59.75')):
+				order=collection.NewEntity()
+				order.SetKey(i)
+				order["ShippedDate"].SetFromLiteral(shipped)
+				collection.InsertEntity(order)
+			for i,shipped in ((1,'2013-10-02T10:20:59.25'),(2,'2013-10-02T10:20:59.75')):
+				collection.Filter(core.CommonExpression.FromString("ShippedDate eq datetime'%s'"%shipped))
+				self.assertTrue(collection.keys()==[i],"%s: %s"%(shipped,repr(collection.keys())))
+			for src,n in (("1.0000000000001D gt 1.0D",2),("1.0D gt 1.0D",0)):
+				collection.Filter(core.CommonExpression.FromString(src))
+				self.assertTrue(len(collection)==n,"%s: %i"%(src,len(collection)))
+
 	def testCaseAllTables(self):
 		self.db.CreateAllTables()
 		# run through each entity set and check there is no data in it
@@ -1,7 +1,7 @@
 #! /usr/bin/env python
 
 import unittest, logging
-import socket, time, StringIO
+import socket, select, time, StringIO, zlib, errno
 
 def suite():
 	return unittest.TestSuite((
@@ -37,6 +37,30 @@ TEST_SERVER_1={
 	"PUT /file HTTP/1.1\r\nExpect: 100-continue\r\nHost: www.domain1.com\r\nTransfer-Encoding: chunked":"HTTP/1.1 100 Go on then!\r\n\r\n"
 	}
 
+def Compress(data,wbits):
+	c=zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,zlib.DEFLATED,wbits)
+	return c.compress(data)+c.flush()
+
+GZIP_STRING=Compress(TEST_STRING*10,16+zlib.MAX_WBITS)
+DEFLATE_STRING=Compress(TEST_STRING*10,zlib.MAX_WBITS)
+
+TEST_SERVER_1.update({
+	"GET /gzip HTTP/1.1\r\nAccept-Encoding: gzip, deflate\r\nHost: www.domain1.com":
+		"HTTP/1.1 200 You got it!\r\nContent-Encoding: gzip\r\nContent-Length: %i\r\n\r\n%s"%(len(GZIP_STRING),GZIP_STRING),
+	"GET /gzip HTTP/1.1\r\nHost: www.domain1.com":
+		"HTTP/1.1 200 You got it!\r\nContent-Encoding: gzip\r\nContent-Length: %i\r\n\r\n%s"%(len(GZIP_STRING),GZIP_STRING),
+	"GET /deflate HTTP/1.1\r\nAccept-Encoding: gzip, deflate\r\nHost: www.domain1.com":
+		"HTTP/1.1 200 You got it!\r\nContent-Encoding: deflate\r\nTransfer-Encoding: chunked\r\n\r\n%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n"%(
+			len(DEFLATE_STRING[:20]),DEFLATE_STRING[:20],len(DEFLATE_STRING[20:]),DEFLATE_STRING[20:])
+	})
+
+LONG_HEADER="x"*(SOCKET_CHUNK*2+1)
+BIG_STRING=TEST_STRING*(SOCKET_CHUNK/len(TEST_STRING)+3)
+
+TEST_SERVER_1["GET /big HTTP/1.1\r\nHost: www.domain1.com"]=\
+	"HTTP/1.1 200 You got it!\r\nTransfer-Encoding: chunked\r\nX-Long: %s\r\n\r\n%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n"%(
+		LONG_HEADER,len(BIG_STRING),BIG_STRING,len(TEST_STRING),TEST_STRING)
+
 TEST_SERVER_2={
 	"HEAD / HTTP/1.1\r\nHost: www.domain2.com":"HTTP/1.1 301 Moved\r\nLocation: http://www.domain1.com/\r\n\r\n"
 	}
@@ -67,23 +91,14 @@ class FakeHTTPConnection(Connection):
 				raise HTTPException("Connection closed")
 				self.socket=None
 				self.socketFile=None
-				self.socketSelect=select.select
 			else:
 				logging.info("Opening connection to %s...",self.host)
 				self.socket=self
 				self.socketFile=self
-				self.socketSelect=self.select
 				self.socketSendBuffer=StringIO.StringIO()
 				self.socketRecvBuffer=StringIO.StringIO()
 				self.responseTable=TEST_SERVER[self.host]
 
-	def select(self,readers,writers,errors,timeout):
-		r=[]
-		w=[self.socketFile]
-		if self.CanRead():
-			r.append(self.socketFile)
-		return r,w,[]
-	
 	def CanRead(self):
 		if self.socketRecvBuffer is None:
 			return True
@@ -121,6 +136,9 @@ class FakeHTTPConnection(Connection):
 			if nBytes>5:
 				nBytes=5
 			if self.socketRecvBuffer:
+				if not self.CanRead():
+					# behave like a non-blocking socket
+					raise socket.error(errno.EAGAIN,"Resource temporarily unavailable")
 				data=self.socketRecvBuffer.read(nBytes)
 			else:
 				# recv on a closed socket indicated by zero bytes after
@@ -132,6 +150,14 @@ class FakeHTTPConnection(Connection):
 			# logging.debug("receiving: empty string")
 			return ''
 
+	def recv_into(self,buffer,nBytes=0):
+		data=self.recv(nBytes or len(buffer))
+		buffer[0:len(data)]=data
+		return len(data)
+		
+	def setblocking(self,flag):
+		pass
+
 	def shutdown(self,mode):
 		# remove the data in the recv buffer
 		self.socketRecvBuffer=None
@@ -148,7 +174,12 @@ class FakeHTTPRequestManager(HTTPRequestManager):
 
 	def __init__(self,**kwargs):
 		HTTPRequestManager.__init__(self,**kwargs)
-		self.socketSelect=self.select
+		# the fake servers expect exact requests
+		self.httpAcceptEncoding=None
+	
+	def NewSelector(self):
+		# fake sockets have no file numbers
+		return SelectSelector(self.select)
 		
 	def select(self,readers,writers,errors,timeout):
 		r=[]
@@ -900,7 +931,104 @@ class HTTP2616Tests(unittest.TestCase):
 		self.assertTrue(response.status==200,"Status in response: %i"%response.status)
 		self.assertTrue(buff.getvalue()==TEST_STRING,"Data in response: %s"%request.resBody)		
 		self.assertTrue(request.resBody=="","Data in streamed response: %s"%request.resBody)
-			
+
+	def testCaseRecvBuffer(self):
+		rm=FakeHTTPRequestManager()
+		rm.httpUserAgent=None
+		request=HTTPRequest("http://www.domain1.com/big")
+		rm.ProcessRequest(request)
+		self.assertTrue(request.response.status==200)
+		# header lines longer than the receive buffer
+		self.assertTrue(request.response.GetHeader("X-Long").strip()==LONG_HEADER)
+		self.assertTrue(request.resBody==BIG_STRING+TEST_STRING)
+		# the buffer is reused for the next request
+		request=HTTPRequest("http://www.domain1.com/")
+		rm.ProcessRequest(request)
+		self.assertTrue(request.resBody==TEST_STRING)
+
+	def testCaseContentEncoding(self):
+		rm=FakeHTTPRequestManager()
+		rm.httpUserAgent=None
+		rm.httpAcceptEncoding="gzip, deflate"
+		request=HTTPRequest("http://www.domain1.com/gzip")
+		rm.ProcessRequest(request)
+		self.assertTrue(request.response.status==200)
+		# the headers describe the decoded body
+		self.assertTrue(request.response.GetContentEncoding()==[])
+		self.assertTrue(request.response.GetContentLength() is None)
+		self.assertTrue(request.resBody==TEST_STRING*10,"Decoded response: %s"%repr(request.resBody))
+		buff=StringIO.StringIO()
+		request=HTTPRequest("http://www.domain1.com/deflate","GET",'',buff)
+		rm.ProcessRequest(request)
+		self.assertTrue(request.response.status==200)
+		self.assertTrue(buff.getvalue()==TEST_STRING*10,"Decoded chunked response: %s"%repr(buff.getvalue()))
+		# turn off decoding, Accept-Encoding is not sent either
+		request=HTTPRequest("http://www.domain1.com/gzip")
+		request.autoDecode=False
+		rm.ProcessRequest(request)
+		self.assertTrue(request.response.status==200)
+		self.assertTrue(request.response.GetContentEncoding()==["gzip"])
+		self.assertTrue(request.response.GetContentLength()==len(GZIP_STRING))
+		self.assertTrue(request.resBody==GZIP_STRING)
+
+	def testCaseSelectors(self):
+		selectorClasses=[SelectSelector]
+		if hasattr(select,'poll'):
+			selectorClasses.append(PollSelector)
+		if hasattr(select,'epoll'):
+			selectorClasses.append(EpollSelector)
+		self.assertTrue(DefaultSelector in selectorClasses)
+		for sClass in selectorClasses:
+			selector=sClass()
+			s1,s2=socket.socketpair()
+			try:
+				selector.Register(s1.fileno(),SELECT_READ|SELECT_WRITE,"s1")
+				self.assertTrue(selector.Select(0)==[("s1",SELECT_WRITE)],"%s: writable"%sClass.__name__)
+				selector.Modify(s1.fileno(),SELECT_READ,"s1")
+				self.assertTrue(selector.Select(0)==[],"%s: not readable"%sClass.__name__)
+				s2.send("Hello")
+				self.assertTrue(selector.Select(1)==[("s1",SELECT_READ)],"%s: readable"%sClass.__name__)
+				selector.Unregister(s1.fileno())
+				self.assertTrue(selector.Select(0)==[],"%s: unregistered"%sClass.__name__)
+				# unregistering a closed socket is not an error
+				selector.Register(s2.fileno(),SELECT_WRITE,"s2")
+				fd=s2.fileno()
+				s2.close()
+				selector.Unregister(fd)
+				# ...even when the socket object itself is passed
+				s3,s4=socket.socketpair()
+				try:
+					selector.Register(s3,SELECT_WRITE,"s3")
+					s3.close()
+					self.assertTrue(selector.Unregister(s3) is not None,"%s: closed socket"%sClass.__name__)
+					self.assertTrue(selector.Unregister(s3) is None)
+					self.assertFalse(selector.fileMap or selector.keyMap)
+					# a reused descriptor replaces the stale registration
+					selector.Register(s4,SELECT_READ,"s4")
+					fd=s4.fileno()
+					s4.close()
+					s5,s6=socket.socketpair()
+					try:
+						s=s5 if s5.fileno()==fd else s6
+						self.assertTrue(s.fileno()==fd,"descriptor reused")
+						selector.Register(s,SELECT_WRITE,"new")
+						if sClass is SelectSelector:
+							# file objects are their own keys
+							selector.Unregister(s4)
+						else:
+							self.assertTrue(selector.Unregister(s4) is None,"%s: stale registration"%sClass.__name__)
+						self.assertTrue(selector.Select(0)==[("new",SELECT_WRITE)],"%s: reused descriptor"%sClass.__name__)
+					finally:
+						s5.close()
+						s6.close()
+				finally:
+					s3.close()
+					s4.close()
+			finally:
+				s1.close()
+				s2.close()
+				selector.Close()
+
 
 def Domain3ThreadOneShot(rm):
 	time.sleep(1)
@@ -2,12 +2,13 @@
 import unittest, logging
 
 from sys import maxunicode
-import string
+import string, time, pickle
 
 MAX_CHAR=0x10FFFF
 if maxunicode<MAX_CHAR:
 	MAX_CHAR=maxunicode
 
+import pyslet.unicode5
 from pyslet.unicode5 import *
 
 def suite():
@@ -125,6 +126,38 @@ class CharClassTests(unittest.TestCase):
 			self.assertTrue(result==test[2],"CharClass Re test: expected %s, found %s"%(test[2],result))
 			
 			
+	def testStringTests(self):
+		c=CharClass(('a','z'),'_')
+		self.assertTrue(c.TestAll(u"hello_world"))
+		self.assertFalse(c.TestAll(u"hello world"))
+		self.assertTrue(c.TestAll(u""),"empty string")
+		self.assertTrue(c.TestAny(u"Hello"))
+		self.assertFalse(c.TestAny(u"HELLO"))
+		self.assertFalse(c.TestAny(u""),"empty string")
+		# check that cached search structures follow modifications
+		self.assertFalse(c.Test(u"-"))
+		c.AddChar(u"-")
+		self.assertTrue(c.Test(u"-"))
+		self.assertTrue(c.TestAll(u"hello-world"))
+		c.SubtractRange(u"a",u"m")
+		self.assertFalse(c.Test(u"h"))
+		self.assertFalse(c.TestAll(u"hello-world"))
+		self.assertTrue(c.TestAny(u"hello-world"))
+		c.Negate()
+		self.assertTrue(c.TestAll(u"HELLO"))
+		# special characters are escaped in the compiled expressions
+		for special in u"^-]\\[.":
+			c=CharClass(special)
+			self.assertTrue(c.TestAll(special*3))
+			self.assertFalse(c.TestAny(u"abc"))
+		self.assertFalse(CharClass().TestAny(u"abc"))
+		self.assertTrue(CharClass().TestAll(u""))
+		# copies must not share ranges with the original
+		c=CharClass(('a','z'))
+		cc=CharClass(c)
+		cc.SubtractChar(u"a")
+		self.assertTrue(c.Test(u"a"))
+		
 	def ClassTest(self,cClass):
 		result=[]
 		for c in range(ord('a'),ord('z')+1):
@@ -159,7 +192,114 @@ class UCDTests(unittest.TestCase):
 		classBasicLatin=CharClass.UCDBlock('Arrows')
 		self.assertFalse(classBasicLatin.Test(unichr(0x2150)))
 		self.assertTrue(classBasicLatin.Test(unichr(0x2190)))
-				
+
+	def testTableFiles(self):
+		# the category table is loaded one category at a time
+		table=pyslet.unicode5._UCDTable(pyslet.unicode5.CATEGORY_FILE)
+		self.assertTrue(table.index is None)
+		self.assertTrue(len(table.keys())==37)
+		classNd=table.GetClass('Nd')
+		self.assertTrue(classNd==CharClass.UCDCategory('Nd'))
+		self.assertFalse(classNd is CharClass.UCDCategory('Nd'))
+		self.assertTrue(classNd.TestAll(u'0123456789\u0660\u0669'))
+		self.assertFalse(classNd.TestAny(u'abc'))
+		try:
+			table.GetClass('Xx')
+			self.fail("Unknown category")
+		except KeyError:
+			pass
+		table.Close()
+		self.assertTrue(table.index is None)
+		# the table is re-opened on demand
+		self.assertTrue(table.GetClass('Cc')==CharClass.UCDCategory('Cc'))
+		table.Close()
+		blocks=pyslet.unicode5._UCDTable(pyslet.unicode5.BLOCK_FILE)
+		self.assertTrue(blocks.GetClass('basiclatin')==CharClass(('\x00','\x7f')))
+		blocks.Close()
+		
+	def testCaseLoadTime(self):
+		"""Loading the categories needed at import time by
+		xsdatatypes only touches part of the category table."""
+		classNames=('Nd','P','Z','C')
+		# loading one category doesn't load the others
+		table=pyslet.unicode5._UCDTable(pyslet.unicode5.CATEGORY_FILE)
+		self.assertTrue(table.data is None and table.index is None,"table is opened on demand")
+		loaded=[]
+		getClass=table.GetClass
+		def RecordingGetClass(name):
+			loaded.append(name)
+			return getClass(name)
+		table.GetClass=RecordingGetClass
+		saveTable=pyslet.unicode5._CategoryTable
+		saveCategories=pyslet.unicode5.UCDCategories.copy()
+		pyslet.unicode5._CategoryTable=table
+		pyslet.unicode5.UCDCategories.clear()
+		try:
+			for name in classNames:
+				CharClass.UCDCategory(name)
+				self.assertTrue(loaded[-1]==name)
+				self.assertTrue(sorted(pyslet.unicode5.UCDCategories.keys())==sorted(loaded))
+			for name in classNames:
+				CharClass.UCDCategory(name)
+			self.assertTrue(loaded==list(classNames),"categories loaded once each: %s"%repr(loaded))
+			self.assertTrue(len(loaded)<len(table.keys()))
+		finally:
+			pyslet.unicode5._CategoryTable=saveTable
+			pyslet.unicode5.UCDCategories.clear()
+			pyslet.unicode5.UCDCategories.update(saveCategories)
+			table.Close()
+		n=20
+		t0=time.time()
+		for i in xrange(n):
+			table=pyslet.unicode5._UCDTable(pyslet.unicode5.CATEGORY_FILE)
+			for name in classNames:
+				table.GetClass(name)
+			table.Close()
+		t1=time.time()
+		for i in xrange(n):
+			table=pyslet.unicode5._UCDTable(pyslet.unicode5.CATEGORY_FILE)
+			for name in table.keys():
+				table.GetClass(name)
+			table.Close()
+		t2=time.time()
+		# earlier versions unpickled the whole table from a file of
+		# CharClass instances, recreate that file to compare
+		oldTable={}
+		table=pyslet.unicode5._UCDTable(pyslet.unicode5.CATEGORY_FILE)
+		for name in table.keys():
+			c=CharClass()
+			c.__dict__={'ranges':table.GetClass(name).ranges}
+			oldTable[name]=c
+		table.Close()
+		data=pickle.dumps(oldTable)
+		t3=time.time()
+		for i in xrange(n):
+			oldTable=pickle.loads(data)
+		t4=time.time()
+		for name in classNames:
+			self.assertTrue(oldTable[name].ranges==CharClass.UCDCategory(name).ranges)
+		logging.info("Category load: %i categories in %.2fms, full table in %.2fms, old pickle (%i bytes) in %.2fms",
+			len(classNames),(t1-t0)*1000.0/n,(t2-t1)*1000.0/n,len(data),(t4-t3)*1000.0/n)
+		# whole string tests against a character-by-character loop
+		classL=CharClass.UCDCategory('L')
+		for test in (u"",u"abc",u"abc1",u"1abc",u"ab c",u"\u00e9\u0416",u"\u00d7"):
+			self.assertTrue(classL.TestAll(test)==(False not in map(classL.Test,test)),repr(test))
+		src=u"abcdefghijklmnopqrstuvwxyz\u00e9\u0416"*1000
+		n=20
+		t0=time.time()
+		for i in xrange(n):
+			result=True
+			for c in src:
+				if not classL.Test(c):
+					result=False
+					break
+		t1=time.time()
+		for i in xrange(n):
+			self.assertTrue(classL.TestAll(src)==result)
+		t2=time.time()
+		logging.info("Class test: %.2fms per string by character, %.2fms by TestAll",
+			(t1-t0)*1000.0/n,(t2-t1)*1000.0/n)
+		
 				 
 if __name__ == "__main__":
 	logging.basicConfig(level=logging.INFO)
@@ -1,11 +1,12 @@
 #! /usr/bin/env python
 
-import unittest, logging
+import unittest, logging, re, sys, gc, itertools
 
 from sys import maxunicode
 from tempfile import mkdtemp
-import shutil, os.path
+import shutil, os.path, time
 from StringIO import StringIO
+from collections import deque
 from types import UnicodeType
 
 MAX_CHAR=0x10FFFF
@@ -26,7 +27,7 @@ def suite():
 TEST_DATA_DIR=os.path.join(os.path.split(os.path.abspath(__file__))[0],'data_xml20081126')
 
 from pyslet.xml20081126.structures import *
-from pyslet.xml20081126.parser import XMLParser
+from pyslet.xml20081126.parser import XMLParser, IsValidNmToken
 
 
 class PIRecorderElement(Element):
@@ -121,6 +122,94 @@ class ReflectiveDocument(Document):
 			return Element
 
 		
+class IterItem(Element):
+	XMLNAME="item"
+
+
+class IterFeed(Element):
+	XMLNAME="feed"
+	
+	def __init__(self,parent):
+		Element.__init__(self,parent)
+		self.IterItem=[]
+	
+	def GetChildren(self):
+		for child in self.IterItem:
+			yield child
+		
+
+class IterDocument(Document):
+	classMap={'feed':IterFeed,'item':IterItem}
+	
+	@classmethod
+	def GetElementClass(cls,name):
+		return cls.classMap.get(name,Element)
+
+
+class DictLayoutItem(Element):
+	XMLNAME="item"
+	XMLATTR_n=('n',int,unicode)
+	XMLATTR_title='title'
+	
+	def __init__(self,parent):
+		Element.__init__(self,parent)
+		self.n=None
+		self.title=None
+		
+
+class SlotsLayoutItem(DictLayoutItem):
+	__slots__=('n','title')
+
+
+class DictLayoutDocument(Document):
+	itemClass=DictLayoutItem
+	
+	@classmethod
+	def GetElementClass(cls,name):
+		if name=="item":
+			return cls.itemClass
+		else:
+			return Element
+
+
+class SlotsLayoutDocument(DictLayoutDocument):
+	itemClass=SlotsLayoutItem
+
+
+class IterGenericDocument(IterDocument):
+	classMap={'item':IterItem}
+
+
+class IterFixedFeed(IterFeed):
+	
+	def DeleteChild(self,child):
+		raise XMLUnknownChild(child.xmlname)
+
+
+class IterFixedDocument(IterDocument):
+	classMap={'feed':IterFixedFeed,'item':IterItem}
+
+
+class IterNoSkipDocument(Document):
+	
+	@classmethod
+	def GetElementClass(cls,name):
+		if name=='skip':
+			return None
+		else:
+			return Element
+
+
+class IterBrokenFeed(IterFeed):
+	
+	def DeleteChild(self,child):
+		return self.noSuchAttribute
+
+
+class IterBrokenDocument(IterDocument):
+	classMap={'feed':IterBrokenFeed,'item':IterItem}
+
+		
 class EmptyElement(Element):
 	XMLNAME="empty"
 	XMLCONTENT=XMLEmpty
@@ -161,7 +250,7 @@ class XML20081126Tests(unittest.TestCase):
 	def testCaseDeclare(self):
 		classMap={}
 		MapClassElements(classMap,Elements)
-		self.assertTrue(type(classMap['mixed']) is types.TypeType,"class type not declared")
+		self.assertTrue(isinstance(classMap['mixed'],types.TypeType),"class type not declared")
 		self.assertFalse(hasattr(classMap,'bad'),"class type declared by mistake")
 
 		
@@ -244,6 +333,31 @@ class XMLCharacterTests(unittest.TestCase):
 		self.assertTrue(nDigits==149,"digit total %i"%nDigits)
 		self.assertTrue(nExtenders==18,"extender total %i"%nExtenders)
 
+	def testEscapeCharData(self):
+		self.assertTrue(EscapeCharData(u'a<b>&c\r')==u'a&lt;b&gt;&amp;c&#xD;')
+		self.assertTrue(EscapeCharData(u'"a"\'',True)==u"'\"a\"&apos;'")
+		self.assertTrue(EscapeCharData(u'"a\'',True)==u'"&quot;a\'"')
+		self.assertTrue(EscapeCharData('caf\xe9 & tea')=='caf\xe9 &amp; tea',"byte strings")
+		self.assertTrue(EscapeCharData7(u'caf\xe9\u4e00<\'',True)==u'"caf&#xE9;&#x4E00;&lt;\'"')
+		self.assertTrue(EscapeCharData7(u'"&"')==u'"&amp;"')
+		self.assertTrue(EscapeCharData7(u'"',True)==u"'\"'")
+		if MAX_CHAR>0xFFFF:
+			self.assertTrue(EscapeCharData7(u'\U0001D11E')==u'&#x01D11E;')
+		
+	def testSpaceFunctions(self):
+		self.assertTrue(IsWhiteSpace(u' \t\r\n') and IsWhiteSpace(u''))
+		self.assertFalse(IsWhiteSpace(u' \t.\r\n') or IsWhiteSpace(u'\xa0'))
+		self.assertTrue(ContainsS(u'a\rb') and not ContainsS(u'a\xa0b'))
+		self.assertTrue(StripLeadingS(u' \t\r\nx y ')==u'x y ')
+		self.assertTrue(NormalizeSpace(u'  a \t  b  ')==u'a \t b')
+		self.assertTrue(CollapseSpace(u' \r\na\t\tb \n')==u'a b ')
+		self.assertTrue(CollapseSpace(u' \r\na\t\tb \n',False)==u' a b ')
+		self.assertTrue(CollapseSpace(u'')==u' ' and CollapseSpace(u' \t ')==u' ')
+		self.assertTrue(CollapseSpace(u'a-b',True,lambda x:x==u'-')==u'a b')
+		# bulk tests agree with the character tests
+		data=string.join(map(unichr,xrange(0x300)),u'')
+		self.assertTrue(filter(IsS,data)==u'\t\n\r ')
+
 	def FindEdges(self,testFunc,max):
 		edges=[]
 		flag=False
@@ -269,6 +383,10 @@ class XMLValidationTests(unittest.TestCase):
 		self.assertFalse(IsValidName("BadName$"))
 		self.assertFalse(IsValidName("BadName+"))
 		self.assertTrue(IsValidName(u"Caf\xe9"))
+		self.assertFalse(IsValidName("BadName\n"),"trailing new line")
+		self.assertFalse(IsValidName("") or IsValidName(None))
+		self.assertTrue(IsValidNmToken("-0.12") and IsValidNmToken(u"\xb7Caf\xe9:"))
+		self.assertFalse(IsValidNmToken("Bad Token") or IsValidNmToken("Bad\n") or IsValidNmToken(""))
 
 	def testWellFormed(self):
 		dPath=os.path.join(TEST_DATA_DIR,'wellformed')
@@ -381,6 +499,137 @@ class XMLValidationTests(unittest.TestCase):
 				self.fail("Other XMLError raised by incompatible but Well-Formed Example (%s)"%fName)
 
 
+	def testContentModelAutomaton(self):
+		src="""<!DOCTYPE doc [
+<!ELEMENT doc (a|b|c|d|e|x|m|n)*>
+<!ELEMENT a (b?,c*,(d|e)+)>
+<!ELEMENT b ((c,d)|(c,e))>
+<!ELEMENT c (#PCDATA|d|e)*>
+<!ELEMENT d ANY>
+<!ELEMENT e EMPTY>
+<!ELEMENT x (b,c?)+>
+<!ELEMENT m (#PCDATA)>
+<!ELEMENT n ((c|d)*,e)>
+]><doc/>"""
+		p=XMLParser(XMLEntity(src))
+		p.checkValidity=True
+		p.ParseDocument()
+		self.assertTrue(p.dtd.GetContentAutomaton('a') is p.dtd.GetContentAutomaton('a'),"automaton cached")
+		self.assertTrue(p.dtd.GetContentAutomaton('z') is None)
+		names=['','b','c','d','e','f']
+		sequences=[[]]
+		for i in xrange(4):
+			sequences=sequences+[seq+[n] for seq in sequences if len(seq)==i for n in names[1:]]
+		for eName in ['doc','a','b','c','d','e','x','m','n']:
+			eType=p.dtd.GetElementType(eName)
+			automaton=p.dtd.GetContentAutomaton(eName)
+			for seq in sequences:
+				pCursor=ContentParticleCursor(eType)
+				aCursor=ContentModelCursor(automaton)
+				for name in seq+['']:
+					pResult=pCursor.Next(name)
+					self.assertTrue(aCursor.Next(name)==pResult,"%s: %s"%(eName,repr(seq)))
+					if not pResult:
+						break
+					if name and eType.particleMap is not None:
+						self.assertTrue(aCursor.Expected()==pCursor.Expected(),"%s: %s"%(eName,repr(seq)))
+		
+	def testDTDCache(self):
+		dPath=mkdtemp('.d','pyslet-test_xml20081126-')
+		try:
+			f=open(os.path.join(dPath,'ext.dtd'),'wb')
+			f.write("""<!ENTITY % content "(#PCDATA|b)*">
+<!ELEMENT doc (a)+>
+<!ELEMENT a %content;>
+<!ELEMENT b EMPTY>
+<!ATTLIST a id ID #REQUIRED x CDATA "default">
+<!ENTITY hello "Hello">""")
+			f.close()
+			def Parse(src,cache):
+				f=open(os.path.join(dPath,'doc.xml'),'wb')
+				f.write(src)
+				f.close()
+				doc=Document()
+				p=XMLParser(XMLEntity(URIFactory.URLFromPathname(os.path.join(dPath,'doc.xml'))))
+				p.checkValidity=True
+				p.dtdCache=cache
+				p.ParseDocument(doc)
+				return p,doc
+			cache=XMLDTDCache()
+			src='<!DOCTYPE doc SYSTEM "ext.dtd"><doc><a id="a1">&hello;<b/></a></doc>'
+			p1,doc=Parse(src,cache)
+			self.assertTrue(p1.valid,"first parse valid")
+			self.assertTrue(cache.hits==0 and cache.misses==1,"cache miss")
+			p2,doc=Parse(src,cache)
+			self.assertTrue(p2.valid,"cached parse valid")
+			self.assertTrue(cache.hits==1 and cache.misses==1,"cache hit")
+			a=list(doc.root.GetChildren())[0]
+			self.assertTrue(a.GetAttribute('x')=='default',"default attribute from cache")
+			children=list(a.GetChildren())
+			self.assertTrue(children[0]==u'Hello' and isinstance(children[1],Element),"entity from cache")
+			p3,doc=Parse('<!DOCTYPE doc SYSTEM "ext.dtd"><doc><b/></doc>',cache)
+			self.assertFalse(p3.valid,"cached parse invalid")
+			self.assertTrue(p2.dtd.GetContentAutomaton('a') is p3.dtd.GetContentAutomaton('a'),"shared automaton")
+			self.assertFalse(p2.dtd.GetEntity('hello') is p3.dtd.GetEntity('hello'),"entities copied")
+			# declarations in the internal subset prevent use of the cache
+			p4,doc=Parse('<!DOCTYPE doc SYSTEM "ext.dtd" [<!ENTITY bye "Bye">]><doc><a id="a1">&bye;</a></doc>',cache)
+			self.assertTrue(p4.valid,"internal subset parse valid")
+			self.assertTrue(cache.hits==2 and cache.misses==1,"internal subset: cache not used")
+			self.assertTrue(list(doc.root.GetChildren())[0].GetValue()==u'Bye')
+			# persist the cache to disk
+			cache=XMLDTDCache(dPath)
+			Parse(src,cache)
+			cache=XMLDTDCache(dPath)
+			p5,doc=Parse(src,cache)
+			self.assertTrue(p5.valid,"parse from persistent cache")
+			self.assertTrue(cache.hits==1 and cache.misses==0,"persistent cache hit")
+			self.assertTrue(list(doc.root.GetChildren())[0].GetAttribute('x')=='default',"default attribute from disk")
+			# a subset that changes is not taken from either cache
+			memCache=XMLDTDCache()
+			Parse(src,memCache)
+			f=open(os.path.join(dPath,'ext.dtd'),'r+b')
+			data=f.read().replace('"default"','"changed"')
+			f.seek(0)
+			f.write(data)
+			f.close()
+			st=os.stat(os.path.join(dPath,'ext.dtd'))
+			os.utime(os.path.join(dPath,'ext.dtd'),(st.st_atime,st.st_mtime+10))
+			for c in (memCache,XMLDTDCache(dPath)):
+				hits=c.hits
+				p7,doc=Parse(src,c)
+				self.assertTrue(c.hits==hits,"changed subset: cache miss")
+				self.assertTrue(list(doc.root.GetChildren())[0].GetAttribute('x')=='changed',"changed subset parsed")
+			cache=XMLDTDCache(dPath)
+			p8,doc=Parse(src,cache)
+			self.assertTrue(cache.hits==1 and cache.misses==0,"pickle rewritten after change")
+			self.assertTrue(list(doc.root.GetChildren())[0].GetAttribute('x')=='changed')
+			if hasattr(os,'getuid'):
+				# pickles that other users could have written are not loaded
+				for fName in os.listdir(dPath):
+					if fName.endswith('.dtd.pickle'):
+						os.chmod(os.path.join(dPath,fName),0666)
+				cache=XMLDTDCache(dPath)
+				p6,doc=Parse(src,cache)
+				self.assertTrue(p6.valid and cache.hits==0 and cache.misses==1,"unsafe pickle ignored")
+				# ...and are replaced
+				for fName in os.listdir(dPath):
+					if fName.endswith('.dtd.pickle'):
+						self.assertFalse(os.stat(os.path.join(dPath,fName)).st_mode&0022,"replaced pickle is private")
+				cache=XMLDTDCache(dPath)
+				Parse(src,cache)
+				self.assertTrue(cache.hits==1,"replaced pickle loaded")
+				# nor is a directory that other users can write to
+				os.chmod(dPath,0777)
+				try:
+					XMLDTDCache(dPath)
+					self.fail("Cache in world writable directory")
+				except XMLUnsafeCacheError:
+					pass
+				finally:
+					os.chmod(dPath,0700)
+		finally:
+			shutil.rmtree(dPath,True)
+
 	def testError(self):
 		dPath=os.path.join(TEST_DATA_DIR,'noerrors')
 		for fName in os.listdir(dPath):
@@ -443,6 +692,30 @@ class XMLEntityTests(unittest.TestCase):
 		self.assertTrue(e.lineNum==3)
 		self.assertTrue(e.linePos==2)
 
+	def testNextRun(self):
+		data="Hello\nWorld\r\n\nCiao\rTutti!"
+		runRE=re.compile(u"[^\\r]+")
+		e1=XMLEntity(data)
+		e1.KeepEncoding()
+		e2=XMLEntity(data)
+		e2.KeepEncoding()
+		while e1.theChar is not None:
+			run=e1.NextRun(runRE)
+			if run:
+				for c in run:
+					self.assertTrue(e2.theChar==c,"Run mismatch: %s"%repr(run))
+					e2.NextChar()
+			else:
+				self.assertTrue(e1.theChar=='\n',"Only CR should stop a run")
+				e1.NextChar()
+				e2.NextChar()
+			self.assertTrue(e1.theChar==e2.theChar)
+			self.assertTrue(e1.GetPositionStr()==e2.GetPositionStr(),"Position after run: %s, expected %s"%(e1.GetPositionStr(),e2.GetPositionStr()))
+		self.assertTrue(e2.theChar is None)
+		e1.Reset()
+		self.assertTrue(e1.NextRun(re.compile(u"[0-9]+"))=='',"No match")
+		self.assertTrue(e1.theChar=='H' and e1.linePos==1)
+
 	def testCodecs(self):
 		m=u'Caf\xe9'
 		e=XMLEntity('Caf\xc3\xa9')
@@ -516,6 +789,169 @@ class XMLParserTests(unittest.TestCase):
 				self.assertTrue(p.theChar==data2[i],"Failed at data[%i] after Rewind(%i)"%(i,j))
 			p.NextChar()
 	
+	def testCasePushbackCost(self):
+		# pushing back a literal (as ParseLiteral does when it fails to
+		# match) must not get slower as the buffer grows: the buffer is
+		# a deque and characters are only added and removed at the left
+		class RecordingDeque(deque):
+			def __init__(self,*args):
+				deque.__init__(self,*args)
+				self.calls=[]
+			def extendleft(self,*args):
+				self.calls.append('extendleft')
+				deque.extendleft(self,*args)
+			def popleft(self):
+				self.calls.append('popleft')
+				return deque.popleft(self)
+			def rotate(self,*args):
+				raise AssertionError("O(n) deque operation: rotate")
+			def remove(self,*args):
+				raise AssertionError("O(n) deque operation: remove")
+			def __delitem__(self,*args):
+				raise AssertionError("O(n) deque operation: __delitem__")
+		def Pushback(depth,n=2000):
+			p=XMLParser(XMLEntity("<hello>"))
+			self.assertTrue(isinstance(p.buff,deque))
+			p.BuffText(u'x'*depth)
+			p.buff=RecordingDeque(p.buff)
+			t=time.time()
+			for i in xrange(n):
+				p.BuffText(u']]')
+				p.NextChar()
+				p.NextChar()
+			t=time.time()-t
+			self.assertTrue(p.theChar==u'x' and len(p.buff)==depth+1)
+			self.assertTrue(p.buff.calls==['extendleft','popleft','popleft']*n,"pushback must use extendleft/popleft")
+			return t
+		tSmall=min(Pushback(10) for i in xrange(3))
+		tLarge=min(Pushback(100000) for i in xrange(3))
+		logging.info("Pushback: %.4fs with small buffer, %.4fs with large buffer",tSmall,tLarge)
+		
+	def testCaseRunErrorPosition(self):
+		# runs of data, names and attribute values crossing chunk boundaries
+		text=string.join(map(lambda x:"Line %i of some data\n"%x,xrange(2000)),'')
+		data='<doc a="%s">\n%s<%s>%s<![CDATA[%s]]>\n<bad attr="<"/></doc>'%("x"*5000,text,"y"*5000,text,text)
+		e=XMLEntity(data)
+		p=XMLParser(e)
+		try:
+			p.ParseDocument()
+			self.fail("Expected well-formedness error")
+		except XMLWellFormedError,err:
+			self.assertTrue(str(err).startswith("Line 6003.12:"),str(err))
+		d=Document()
+		d.Read('<doc a="%s">%s<![CDATA[%s]]></doc>'%("x"*5000,text,text))
+		self.assertTrue(d.root.GetValue()==text+text)
+		self.assertTrue(d.root.GetAttribute('a')=="x"*5000)
+			
+	def testCaseIterParse(self):
+		data='<?xml version="1.0"?><feed><title>Items &amp; more</title><item id="1">One<![CDATA[<1>]]></item><item id="2"/><!-- c --></feed>'
+		p=XMLParser(XMLEntity(data))
+		events=[]
+		for event,node in p.IterParse(IterDocument()):
+			if event==XMLParser.EventData:
+				events.append((event,node))
+			else:
+				events.append((event,node.xmlname))
+		self.assertTrue(events==[
+			(XMLParser.EventStart,'feed'),
+			(XMLParser.EventStart,'title'),
+			(XMLParser.EventData,'Items '),
+			(XMLParser.EventData,'&'),
+			(XMLParser.EventData,' more'),
+			(XMLParser.EventEnd,'title'),
+			(XMLParser.EventStart,'item'),
+			(XMLParser.EventData,'One'),
+			(XMLParser.EventData,'<1>'),
+			(XMLParser.EventEnd,'item'),
+			(XMLParser.EventStart,'item'),
+			(XMLParser.EventEnd,'item'),
+			(XMLParser.EventEnd,'feed')],repr(events))
+		# without selection the complete tree is built
+		self.assertTrue(isinstance(p.doc,IterDocument) and len(p.doc.root.IterItem)==2)
+		self.assertTrue(p.doc.root.IterItem[0].GetValue()=="One<1>")
+		# with selection, each item is complete and then dropped
+		data='<feed>%s</feed>'%string.join(map(lambda x:'<item id="%i">Item %i<x>%i</x></item>\n'%(x,x,x),xrange(100)),'')
+		p=XMLParser(XMLEntity(data))
+		i=0
+		for event,item in p.IterParse(IterDocument(),IterItem):
+			self.assertTrue(event==XMLParser.EventEnd)
+			self.assertTrue(isinstance(item,IterItem) and item.GetAttribute('id')==str(i))
+			children=list(item.GetChildren())
+			self.assertTrue(children[0]=="Item %i"%i and children[1].GetValue()==str(i))
+			self.assertTrue(len(p.doc.root.IterItem)==1 and p.doc.root.IterItem[0] is item)
+			i=i+1
+		self.assertTrue(i==100)
+		self.assertTrue(len(p.doc.root.IterItem)==0)
+		# generic elements are dropped from the parent's children
+		p=XMLParser(XMLEntity(data))
+		n=0
+		for event,x in p.IterParse(IterGenericDocument(),IterItem):
+			n=n+1
+		# only the line break after the last item remains
+		self.assertTrue(n==100 and p.doc.root.GetValue()=='\n',repr(p.doc.root.GetValue()))
+		# ...along with the parent's character data that preceded them
+		p=XMLParser(XMLEntity('<feed>Text<item/>More<item/>Tail</feed>'))
+		for event,x in p.IterParse(IterGenericDocument(),IterItem): pass
+		self.assertTrue(p.doc.root.GetValue()=='Tail')
+		# parents that can't delete their children keep them, with a warning
+		warnings=[]
+		class WarningHandler(logging.Handler):
+			def emit(self,record):
+				warnings.append(record)
+		handler=WarningHandler(logging.WARNING)
+		logger=logging.getLogger()
+		saveLevel=logger.level
+		logger.addHandler(handler)
+		logger.setLevel(logging.WARNING)
+		try:
+			p=XMLParser(XMLEntity(data))
+			n=0
+			for event,x in p.IterParse(IterFixedDocument(),IterItem):
+				n=n+1
+		finally:
+			logger.removeHandler(handler)
+			logger.setLevel(saveLevel)
+		self.assertTrue(n==100 and len(p.doc.root.IterItem)==100)
+		self.assertTrue(len(warnings)==1,"one warning per parse")
+		# ...but other errors raised by DeleteChild are not hidden
+		p=XMLParser(XMLEntity(data))
+		try:
+			for event,x in p.IterParse(IterBrokenDocument(),IterItem): pass
+			self.fail("AttributeError in DeleteChild")
+		except AttributeError:
+			pass
+		# start tags are handled exactly as they are by ParseDocument
+		for data in ('<doc><a/><skip/></doc>','<doc><a><skip/></a></doc>'):
+			errors=[]
+			for iterParse in (False,True):
+				p=XMLParser(XMLEntity(data))
+				try:
+					if iterParse:
+						for event in p.IterParse(IterNoSkipDocument()): pass
+					else:
+						p.ParseDocument(IterNoSkipDocument())
+					self.fail("%s: element with no class"%data)
+				except XMLWellFormedError,err:
+					errors.append(str(err))
+			self.assertTrue(errors[0]==errors[1],repr(errors))
+		# validity errors name the offending IDREF
+		data='<!DOCTYPE feed [<!ELEMENT feed (item)*><!ELEMENT item EMPTY><!ATTLIST item ref IDREF #IMPLIED>]><feed><item ref="missing"/></feed>'
+		p=XMLParser(XMLEntity(data))
+		p.checkValidity=True
+		p.ParseDocument()
+		self.assertTrue(len(p.nonFatalErrors)==1 and "missing" in str(p.nonFatalErrors[0]),str(p.nonFatalErrors))
+		p=XMLParser(XMLEntity(data))
+		p.checkValidity=True
+		for event in p.IterParse(): pass
+		self.assertTrue(len(p.nonFatalErrors)==1 and "missing" in str(p.nonFatalErrors[0]),str(p.nonFatalErrors))
+		# errors are still reported
+		p=XMLParser(XMLEntity('<feed><item></feed>'))
+		try:
+			for event in p.IterParse(): pass
+			self.fail("Expected well-formedness error")
+		except XMLWellFormedError:
+			pass
+		
 	def testCaseNamecaseGeneral(self):
 		data="Hello GoodBye"
 		e=XMLEntity(data)
@@ -2232,6 +2668,31 @@ class ElementTests(unittest.TestCase):
 		except AttributeError:
 			self.fail("Missing attribute auto value: AttributeError (after del)")
 	
+	def testAttributeMaps(self):
+		"""Attribute maps are compiled when the class is created"""
+		self.assertTrue("XMLAMAP" in ReflectiveElement.__dict__ and "XMLASETMAP" in ReflectiveElement.__dict__)
+		self.assertTrue(ReflectiveElement.XMLAMAP['ctest'][0]=='cTest')
+		self.assertTrue(ReflectiveElement.XMLARMAP['dTest'][0]=='dtest')
+		self.assertFalse('atest' in ReflectiveElement.XMLASETMAP)
+		self.assertTrue('id' in IDElement.XMLASETMAP)
+		class DerivedElement(ReflectiveElement):
+			XMLATTR_ctest='cTestString'
+			XMLATTR_gtest='gTest'
+		self.assertTrue(DerivedElement.XMLAMAP['ctest'][0]=='cTestString',"override in derived class")
+		self.assertTrue(DerivedElement.XMLAMAP['btest'][0]=='bTest',"inherited definition")
+		self.assertFalse('gtest' in ReflectiveElement.XMLAMAP)
+		e=DerivedElement(None)
+		self.assertTrue(e.gTest is None and e.cTestString is None)
+		e.SetAttribute('ctest','Yes')
+		e.SetAttribute('gtest','1')
+		self.assertTrue(e.cTestString=='Yes' and e.gTest=='1')
+		try:
+			class BadDefinition(Element):
+				XMLATTR_bad=('bad',None)
+			self.fail("bad XMLATTR_ definition accepted")
+		except XMLAttributeSetter:
+			pass
+		
 	def testChildElements(self):
 		"""Test child element behaviour"""
 		e=Element(None,'test')
@@ -2384,6 +2845,79 @@ class DocumentTests(unittest.TestCase):
 		f.close()
 		self.assertTrue(str(d)==fData,"XML output: %s"%str(d))
 		
+	def testCaseChunks(self):
+		d=Document(root=NamedElement)
+		for i in xrange(100):
+			d.root.ChildElement(Element,'item').SetValue(u'caf\xe9 & \u4e00 %i'%i)
+		data=unicode(d).encode('utf-8')
+		for chunkSize in (1,7,100,len(data),len(data)+1):
+			chunks=list(d.GenerateChunks(chunkSize=chunkSize))
+			self.assertTrue(string.join(chunks,'')==data,"Chunked output")
+			for chunk in chunks[:-1]:
+				self.assertTrue(len(chunk)==chunkSize,"Chunk size")
+			self.assertTrue(0<len(chunks[-1])<=chunkSize)
+		d.SetBase('chunks.xml')
+		d.Create()
+		f=open('chunks.xml','rb')
+		self.assertTrue(f.read()==data,"Create writes UTF-8")
+		f.close()
+		# encoding is incremental
+		chunks=EncodeChunks(itertools.repeat(u'<x/>'),1024)
+		self.assertTrue(chunks.next()==u'<x/>'*256)
+		chunks=EncodeChunks([u'a',u'b'],2,'utf-16')
+		self.assertTrue(string.join(chunks,'').decode('utf-16')==u'ab',"one BOM only")
+	
+	def testCaseSerializeThroughput(self):
+		# serialising a large document to encoded chunks must produce
+		# the same output as the string methods without accumulating the
+		# output in memory
+		d=Document(root=NamedElement)
+		for i in xrange(5000):
+			child=d.root.ChildElement(Element,'item')
+			child.SetAttribute('title','Item <%i> "quoted"'%i)
+			child.SetValue(u'Caf\xe9 & more text for item %i'%i)
+		chunks=list(d.GenerateChunks(EscapeCharData7))
+		self.assertTrue(len(chunks)>10)
+		for chunk in chunks:
+			self.assertTrue(len(chunk)<=d.ChunkSize,"chunk of %i bytes"%len(chunk))
+		self.assertTrue(string.join(chunks,'')==str(d))
+		self.assertTrue(string.join(d.GenerateChunks(),'')==unicode(d).encode('utf-8'))
+		# count the bytes generated but not yet returned as chunks
+		generateXML=d.GenerateXML
+		counts=[0,0]
+		def CountingGenerateXML(*args):
+			for s in generateXML(*args):
+				counts[0]+=len(s.encode('utf-8'))
+				counts[1]=max(counts[1],len(s.encode('utf-8')))
+				yield s
+		d.GenerateXML=CountingGenerateXML
+		size=0
+		peak=0
+		for chunk in d.GenerateChunks():
+			size+=len(chunk)
+			peak=max(peak,counts[0]-size)
+		del d.GenerateXML
+		logging.info("Peak buffering %i bytes for %i byte chunks",peak,d.ChunkSize)
+		self.assertTrue(peak<=2*d.ChunkSize+counts[1],"Buffered %i bytes"%peak)
+		tWrite=[]
+		tChunks=[]
+		for i in xrange(3):
+			t=time.time()
+			s=StringIO()
+			d.WriteXML(s)
+			s=s.getvalue().encode('utf-8')
+			tWrite.append(time.time()-t)
+			t=time.time()
+			size=0
+			for chunk in d.GenerateChunks():
+				size=size+len(chunk)
+			tChunks.append(time.time()-t)
+		tWrite=min(tWrite)
+		tChunks=min(tChunks)
+		logging.info("Serialised %i bytes: %.1f MB/s (StringIO) %.1f MB/s (chunks)",size,
+			size/tWrite/1000000.0,size/tChunks/1000000.0)
+		self.assertTrue(size==len(s))
+		
 	def testCaseResolveBase(self):
 		"""Test the use of ResolveURI and ResolveBase"""
 		os.chdir(TEST_DATA_DIR)
@@ -2505,6 +3039,103 @@ class DocumentTests(unittest.TestCase):
 		self.assertTrue(isinstance(root,ReflectiveElement))
 		self.assertTrue(root.bTest,"Attribute relfection")
 		self.assertTrue(root.child,"Element relfection")
+	
+	def testCaseMemoryLayout(self):
+		# benchmark: the memory used by the same document parsed with
+		# element classes that do and do not opt in to the compact layout
+		def TreeSize(doc):
+			seen=set()
+			size=0
+			stack=[doc.root]
+			while stack:
+				node=stack.pop()
+				if id(node) in seen:
+					continue
+				seen.add(id(node))
+				size=size+sys.getsizeof(node)
+				if isinstance(node,Element):
+					for r in gc.get_referents(node):
+						if type(r) in (DictType,ListType,UnicodeType):
+							stack.append(r)
+				elif type(node) is ListType:
+					stack=stack+node
+			return size
+		src='<doc>\n%s</doc>'%string.join(map(lambda x:'\t<item n="%i" title="Item %i" x="%i"/>\n\t<item n="%i"/>\n\t<p>Text %i</p>\n'%(x,x,x,x,x),xrange(1000)),'')
+		sizes=[]
+		for docClass in (DictLayoutDocument,SlotsLayoutDocument):
+			d=docClass()
+			d.Read(src)
+			items=list(d.root.FindChildrenDepthFirst(docClass.itemClass))
+			self.assertTrue(len(items)==2000 and items[2].n==1 and items[2].title=="Item 1")
+			self.assertTrue(items[0].GetAttribute('x')=="0" and items[1].GetAttributes()=={'n':"0"})
+			sizes.append(TreeSize(d))
+		logging.info("Tree sizes: %i bytes (dict) %i bytes (slots)",sizes[0],sizes[1])
+		self.assertTrue(sizes[1]<0.8*sizes[0],"Compact layout: %i bytes vs %i bytes"%(sizes[1],sizes[0]))
+		# elements that are not extended have no instance dictionary at all
+		e=Element(None)
+		self.assertFalse([r for r in gc.get_referents(e) if type(r) is DictType and r is not Element.NoAttributes])
+		e.extra=1
+		self.assertTrue(e.extra==1,"Elements can still be extended")
+		# the shared attribute dictionary can't be modified by mistake
+		try:
+			Element.NoAttributes['x']='1'
+			self.fail("NoAttributes modified")
+		except TypeError:
+			pass
+		e1=Element(None)
+		e2=Element(None)
+		e1.SetBase(None)
+		e1.SetLang(None)
+		e1.SetAttribute('x',None)
+		self.assertTrue(e1._attrs is Element.NoAttributes,"removals don't copy")
+		e1.SetAttribute('x','1')
+		e1.SetLang('en')
+		self.assertTrue(e1.GetAttributes()=={'x':'1','xml:lang':'en'})
+		self.assertTrue(e2.GetAttributes()=={} and len(Element.NoAttributes)==0)
+		
+	def testCaseFirstParseLatency(self):
+		# parsing the first document that uses a set of element classes
+		# must not be dominated by building their attribute maps: they
+		# are built when the classes are created, not when parsed
+		def MakeClasses(n=200,nAttrs=50):
+			classMap={}
+			for i in xrange(n):
+				dct={'XMLNAME':'e%i'%i}
+				for j in xrange(nAttrs):
+					dct['XMLATTR_a%i'%j]=('a%i'%j,DecodeYN,EncodeYN)
+				dct.update(('Method%i'%j,lambda self:None) for j in xrange(nAttrs))
+				classMap['e%i'%i]=type('Element%i'%i,(Element,),dct)
+			return classMap
+		src='<root>%s</root>'%string.join(map(lambda x:'<e%i a1="Yes" a2="No" b="x"/>'%x,xrange(200)),'')
+		class LatencyDocument(Document):
+			@classmethod
+			def GetElementClass(cls,name):
+				return cls.classMap.get(name,Element)
+		def Parse(classMap):
+			LatencyDocument.classMap=classMap
+			t=time.time()
+			d=LatencyDocument()
+			d.Read(src)
+			t=time.time()-t
+			self.assertTrue(d.root.GetChildren().next().a1 is True)
+			return t
+		tFirst=[]
+		tSecond=[]
+		reMap=Element.__dict__['_ReMap']
+		for i in xrange(3):
+			classMap=MakeClasses()
+			for eClass in classMap.itervalues():
+				for mapName in ('XMLAMAP','XMLARMAP','XMLASETMAP'):
+					self.assertTrue(mapName in eClass.__dict__,"%s.%s built before parsing"%(eClass.__name__,mapName))
+			calls=[]
+			Element._ReMap=classmethod(lambda cls:calls.append(cls))
+			try:
+				tFirst.append(Parse(classMap))
+				tSecond.append(Parse(classMap))
+			finally:
+				Element._ReMap=reMap
+			self.assertFalse(calls,"_ReMap called while parsing")
+		logging.info("First parse %.4fs, second parse %.4fs",min(tFirst),min(tSecond))
 		
 		
 if __name__ == "__main__":